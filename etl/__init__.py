@@ -0,0 +1,10 @@
+"""
+Python orchestrator for the iSantePlus reports ETL.
+
+Runs the scripts in sql_files/ over a single pooled MySQL connection,
+splitting them into statements the way the mysql client does, and reports
+wall-clock time and rows affected for every statement.
+
+Usage:
+    python3 -m etl -u root -p Admin123 -H localhost -P 3306
+"""
@@ -0,0 +1,1091 @@
+"""
+In-memory engine for the ARV statuses, exposed infants and alerts.
+
+Computes what sections 1 and 3 of patient_status_arv_dml.sql write
+(patient_status_arv, exposed_infants, patient.arv_status and the alert
+codes 1-12) with pandas group-by operations over plain scans of the source
+tables, instead of the temporary tables and joins of the script.  Two uses:
+
+  - Offline: the inputs can be dumped to CSV files (--dump-inputs) and the
+    engine run on another machine (--input-dir), so that a loaded MySQL
+    server only serves the scans.  --apply writes the results back with the
+    same swaps and diff as the script.
+  - As an oracle: test/run_patient_status_arv_comparison.py --engine-oracle
+    diffs the output of the SQL script against the engine's.
+
+The rules are those of the script, including its NULL semantics (a NULL
+arv_status never passes `arv_status NOT IN (1, 2, 3)`, a text test_result is
+compared as a number).  The latest visit, dispensation and viral load of each
+patient are recomputed from the source tables, as the script does when it
+runs alone.  When several statuses share the latest status date, arv_status
+is the one with the highest (id_status, start_date), the row MySQL's
+multi-table UPDATE applies last in primary key order.  Sections 2
+(regimens) and 4 (immunizations) are not covered.
+
+Requirements:
+    pip install pandas mysql-connector-python
+
+Usage:
+    python3 -m etl.arv_engine -u root -p Admin123 --output-dir arv_results
+    python3 -m etl.arv_engine -u root -p Admin123 --dump-inputs arv_inputs
+    python3 -m etl.arv_engine --input-dir arv_inputs --output-dir arv_results
+    python3 -m etl.arv_engine -u root -p Admin123 --apply
+"""
+
+import argparse
+import datetime
+import getpass
+import sys
+import time
+from pathlib import Path
+
+try:
+    import pandas as pd
+    HAS_PANDAS = True
+except ImportError:
+    HAS_PANDAS = False
+
+try:
+    import mysql.connector
+    from mysql.connector import Error as MySQLError
+    HAS_MYSQL = True
+except ImportError:
+    HAS_MYSQL = False
+    MySQLError = Exception
+
+# Resolved like the PRÉAMBULE of patient_status_arv_dml.sql
+ENCOUNTER_TYPE_UUIDS = {
+    'et_pediatric': '349ae0b4-65c1-4122-aa06-480f186c8350',
+    'et_lab': 'f037e97b-471e-4898-a07c-b8e169e0ddc4',
+    'et_discontinuation': '9d0113c6-f23a-4461-8428-7e9a7344f2ba',
+    'et_pediatric_followup': '33491314-c352-42d0-bd5d-a9d0bffc9bf1',
+    'et_first_visit': '17536ba6-dd7c-4f58-8014-08c7cb798ac7',
+    'et_followup': '204ad066-c5c2-4229-9a62-644bc5617ca2',
+    'et_dispensing1': '10d73929-54b6-4d18-a647-8b7316bc1ae3',
+    'et_dispensing2': 'a9392241-109f-4d67-885b-57cc4b8c638f',
+}
+CONCEPT_UUIDS = {
+    'concept_isoniazid_group': 'fee8bd39-2a95-47f9-b1f5-3f9e9b3ee959',
+    'concept_rifampicin_group': '2b2053bd-37f3-429d-be0b-f1f8952fe55e',
+    'concept_ddp': 'c2aacdc8-156e-4527-8934-a8fb94162419',
+}
+
+# Concepts of tmp_obs_snapshot; the DDP concept and the INH/rifampicin group
+# concepts (tmp_obs_group_snapshot) are added once resolved
+OBS_CONCEPTS = [1030, 844, 1401, 161555, 1667, 856, 1305, 1282, 159367]
+
+# name: (query, date columns, text columns).  Every other column is numeric.
+INPUTS = {
+    'encounter': (
+        'SELECT encounter_id, patient_id, visit_id, encounter_type, encounter_datetime '
+        'FROM openmrs.encounter WHERE voided <> 1',
+        ['encounter_datetime'], []),
+    'obs': (
+        'SELECT obs_id, person_id, encounter_id, concept_id, value_coded, '
+        'value_numeric, obs_datetime, obs_group_id, location_id '
+        'FROM openmrs.obs WHERE voided <> 1 AND concept_id IN ({concepts})',
+        ['obs_datetime'], []),
+    'visit': (
+        'SELECT visit_id, patient_id, date_started, voided FROM openmrs.visit',
+        ['date_started'], []),
+    'patient': (
+        'SELECT patient_id, vih_status, voided, birthdate, date_started_arv '
+        'FROM isanteplus.patient',
+        ['birthdate', 'date_started_arv'], []),
+    'patient_on_arv': (
+        'SELECT patient_id FROM isanteplus.patient_on_arv',
+        [], []),
+    'patient_dispensing': (
+        'SELECT patient_id, encounter_id, visit_id, location_id, visit_date, '
+        'next_dispensation_date, arv_drug, rx_or_prophy, drug_id, voided '
+        'FROM isanteplus.patient_dispensing',
+        ['visit_date', 'next_dispensation_date'], []),
+    'patient_laboratory': (
+        'SELECT patient_id, encounter_id, test_id, test_done, test_result, '
+        'date_test_done, visit_date, voided FROM isanteplus.patient_laboratory '
+        'WHERE test_id IN (856, 1305, 1040)',
+        ['date_test_done', 'visit_date'], ['test_result']),
+    'patient_pregnancy': (
+        'SELECT DISTINCT patient_id FROM isanteplus.patient_pregnancy',
+        [], []),
+    'discontinuation_reason': (
+        'SELECT patient_id, visit_date, reason FROM isanteplus.discontinuation_reason',
+        ['visit_date'], []),
+    # Statuses of earlier days; those of the day are replaced by the run
+    'patient_status_arv': (
+        'SELECT patient_id, id_status, start_date, date_started_status '
+        'FROM isanteplus.patient_status_arv '
+        'WHERE DATE(date_started_status) < %(as_of)s',
+        ['start_date', 'date_started_status'], []),
+}
+
+# Primary key columns of each result, as compared by the oracle
+RESULT_KEYS = {
+    'patient_status_arv': ['patient_id', 'id_status', 'start_date'],
+    'exposed_infants': ['patient_id', 'condition_exposee'],
+    'patient_arv_status': ['patient_id', 'arv_status'],
+    'alert': ['patient_id', 'id_alert', 'encounter_id', 'date_alert'],
+}
+
+# NULL in the CSV files, as in mysql's batch output
+NULL = '\\N'
+
+_NUMBER_PREFIX = r'^\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compute the ARV statuses, exposed infants and alerts in memory',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__,
+    )
+
+    db_group = parser.add_argument_group('Database connection')
+    db_group.add_argument('--host', '-H', default='localhost',
+                          help='MySQL host (default: localhost)')
+    db_group.add_argument('--port', '-P', type=int, default=3306,
+                          help='MySQL port (default: 3306)')
+    db_group.add_argument('--user', '-u', help='MySQL username')
+    db_group.add_argument('--password', '-p', help='MySQL password')
+
+    io_group = parser.add_argument_group('Inputs and outputs')
+    io_group.add_argument('--input-dir', type=Path,
+                          help='Read the inputs from CSV files written by '
+                               '--dump-inputs instead of MySQL')
+    io_group.add_argument('--dump-inputs', type=Path, metavar='DIR',
+                          help='Write the inputs read from MySQL to CSV files and stop')
+    io_group.add_argument('--output-dir', type=Path,
+                          help='Write the results to CSV files')
+    io_group.add_argument('--apply', action='store_true',
+                          help='Write the results to the isanteplus tables, '
+                               'as patient_status_arv_dml.sql does')
+    io_group.add_argument('--as-of', type=datetime.date.fromisoformat,
+                          help='Day of the run, YYYY-MM-DD (default: today, or '
+                               'the day the inputs were dumped)')
+
+    return parser.parse_args()
+
+
+# -----------------------------------------------------------------------------
+# Inputs
+# -----------------------------------------------------------------------------
+
+def _typed(frame, dates=(), texts=()):
+    """Give a frame read from MySQL or CSV the column types of the engine."""
+    for column in frame.columns:
+        if column in dates:
+            frame[column] = pd.to_datetime(frame[column], errors='coerce')
+        elif column not in texts:
+            frame[column] = pd.to_numeric(frame[column], errors='coerce').astype('float64')
+    return frame
+
+
+def connect(args):
+    """Open an autocommit connection, like the orchestrator's pool."""
+    return mysql.connector.connect(
+        host=args.host,
+        port=args.port,
+        user=args.user,
+        password=args.password,
+        autocommit=True,
+    )
+
+
+def read_frame(conn, sql, params=None, dates=(), texts=()):
+    """Run a query and return its rows as a typed DataFrame."""
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, params)
+        frame = pd.DataFrame(cursor.fetchall(), columns=cursor.column_names)
+    finally:
+        cursor.close()
+    return _typed(frame, dates, texts)
+
+
+def _resolve(conn, table, id_column, uuids):
+    frame = read_frame(
+        conn,
+        f'SELECT uuid, {id_column} FROM openmrs.{table} '
+        f'WHERE uuid IN ({", ".join(["%s"] * len(uuids))})',
+        list(uuids.values()), texts=['uuid'])
+    ids = dict(zip(frame['uuid'], frame[id_column]))
+    return {name: (int(ids[uuid]) if uuid in ids else None)
+            for name, uuid in uuids.items()}
+
+
+def load_inputs(conn, as_of):
+    """Read the engine's inputs from MySQL."""
+    settings = _resolve(conn, 'encounter_type', 'encounter_type_id', ENCOUNTER_TYPE_UUIDS)
+    settings.update(_resolve(conn, 'concept', 'concept_id', CONCEPT_UUIDS))
+    concepts = OBS_CONCEPTS + [settings[name] for name in CONCEPT_UUIDS
+                               if settings[name] is not None]
+
+    inputs = {'settings': settings, 'as_of': as_of}
+    for name, (sql, dates, texts) in INPUTS.items():
+        inputs[name] = read_frame(
+            conn, sql.replace('{concepts}', ', '.join(str(c) for c in concepts)),
+            {'as_of': as_of} if '%(as_of)s' in sql else None, dates, texts)
+    return inputs
+
+
+def write_inputs(inputs, directory):
+    """Dump the inputs to one CSV file per table, plus settings.csv."""
+    directory.mkdir(parents=True, exist_ok=True)
+    settings = dict(inputs['settings'], as_of=inputs['as_of'].isoformat())
+    pd.DataFrame(sorted(settings.items()), columns=['name', 'value']).to_csv(
+        directory / 'settings.csv', index=False, na_rep=NULL)
+    for name in INPUTS:
+        inputs[name].to_csv(directory / f'{name}.csv', index=False, na_rep=NULL,
+                            date_format='%Y-%m-%d %H:%M:%S')
+
+
+def read_inputs(directory):
+    """Read inputs dumped by write_inputs."""
+    settings = pd.read_csv(directory / 'settings.csv', na_values=[NULL],
+                           keep_default_na=False, dtype=str)
+    values = dict(zip(settings['name'], settings['value']))
+    inputs = {
+        'settings': {name: (int(values[name]) if isinstance(values.get(name), str) else None)
+                     for name in list(ENCOUNTER_TYPE_UUIDS) + list(CONCEPT_UUIDS)},
+        'as_of': datetime.date.fromisoformat(values['as_of']),
+    }
+    for name, (_, dates, texts) in INPUTS.items():
+        frame = pd.read_csv(directory / f'{name}.csv', na_values=[NULL],
+                            keep_default_na=False, dtype={t: str for t in texts})
+        inputs[name] = _typed(frame, dates, texts)
+    return inputs
+
+
+# -----------------------------------------------------------------------------
+# SQL semantics
+# -----------------------------------------------------------------------------
+
+def _in(series, values):
+    """`IN (...)`: a NULL in the list matches nothing."""
+    return series.isin([v for v in values if v is not None])
+
+
+def _not_in(series, values):
+    """`NOT IN (...)`: false for a NULL value, and for all rows if the list has a NULL."""
+    if any(v is None for v in values):
+        return pd.Series(False, index=series.index)
+    return series.notna() & ~series.isin(values)
+
+
+def _not_voided(series):
+    """`voided <> 1`: false when voided is NULL."""
+    return series.notna() & (series != 1)
+
+
+def _as_number(series):
+    """A text column compared with a number: its leading number, else 0."""
+    text = series.where(series.notna(), '').astype(str)
+    number = pd.to_numeric(text.str.extract(_NUMBER_PREFIX, expand=False),
+                           errors='coerce').astype('float64').fillna(0)
+    return number.where(series.notna())
+
+
+def _has_text(series):
+    """`column IS NOT NULL AND column <> ''`."""
+    return series.notna() & (series.astype(str) != '')
+
+
+def _months_since(start, today):
+    """TIMESTAMPDIFF(MONTH, start, CURDATE()) for a datetime Series."""
+    months = (today.year - start.dt.year) * 12 + (today.month - start.dt.month)
+    # The month only counts once the day and time of start are reached
+    start_rest = start.dt.day * 86400 + (start - start.dt.normalize()).dt.total_seconds()
+    today_rest = today.day * 86400
+    months = months.where(~((months > 0) & (today_rest < start_rest)), months - 1)
+    months = months.where(~((months < 0) & (today_rest > start_rest)), months + 1)
+    return months
+
+
+def _join(left, right, left_on, right_on=None):
+    """Inner join where, as in SQL, NULL keys match nothing."""
+    right_on = right_on or left_on
+    return left.dropna(subset=left_on).merge(
+        right.dropna(subset=right_on), left_on=left_on, right_on=right_on)
+
+
+def _ids(series):
+    return set(series.dropna())
+
+
+def _max_where(frame, by, columns):
+    """Per `by` group, MAX(IF(mask, source, NULL)) for each output column.
+
+    columns maps an output name to (mask, source column).
+    """
+    parts = [frame.loc[mask, [by, source]].groupby(by)[source].max().rename(name)
+             for name, (mask, source) in columns.items()]
+    result = pd.concat(parts, axis=1)
+    result.index.name = by
+    return result
+
+
+# -----------------------------------------------------------------------------
+# Shared derivations
+# -----------------------------------------------------------------------------
+
+def _obs_encounters(inputs):
+    """Obs joined to their encounter (tmp_obs_snapshot x tmp_encounter_snapshot)."""
+    encounter = inputs['encounter'][['encounter_id', 'patient_id', 'visit_id',
+                                     'encounter_type', 'encounter_datetime']]
+    return _join(inputs['obs'], encounter, ['encounter_id'])
+
+
+def _same_patient(ob_enc):
+    """The joins that also require o.person_id = e.patient_id."""
+    return ob_enc[ob_enc['person_id'] == ob_enc['patient_id']]
+
+
+def _lab_date(lab):
+    """IFNULL(DATE(date_test_done), DATE(visit_date))."""
+    return lab['date_test_done'].dt.normalize().fillna(lab['visit_date'].dt.normalize())
+
+
+def latest_dispensing(inputs):
+    """patient_latest_dispensing, as recomputed by the script."""
+    pdis = inputs['patient_dispensing']
+    arv = (pdis['arv_drug'] == 1065) & _not_voided(pdis['voided'])
+    rx = arv & ((pdis['rx_or_prophy'] != 163768) | pdis['rx_or_prophy'].isna())
+    pdis = pdis.assign(visit_day=pdis['visit_date'].dt.normalize())
+    return _max_where(pdis, 'patient_id', {
+        'next_arv_dispensation_date': (arv, 'next_dispensation_date'),
+        'next_arv_rx_dispensation_date': (rx, 'next_dispensation_date'),
+        'last_visit_date': (_not_voided(pdis['voided']), 'visit_day'),
+    })
+
+
+def latest_viral_load(inputs):
+    """last_result_date of patient_latest_viral_load."""
+    lab = inputs['patient_laboratory']
+    lab = lab[lab['test_id'].isin([856, 1305]) & _not_voided(lab['voided'])]
+    lab = lab.assign(lab_date=_lab_date(lab))
+    return _max_where(lab, 'patient_id', {
+        'last_result_date': (_as_number(lab['test_result']) > 0, 'lab_date'),
+    })
+
+
+def patients_on_arv(inputs):
+    """patient_on_arv once the patients without a valid ARV dispensation are removed."""
+    pdis = inputs['patient_dispensing']
+    valid = pdis[(pdis['arv_drug'] == 1065)
+                 & ((pdis['rx_or_prophy'] == 138405) | pdis['rx_or_prophy'].isna())
+                 & _not_voided(pdis['voided'])]
+    return _ids(inputs['patient_on_arv']['patient_id']) & _ids(valid['patient_id'])
+
+
+# -----------------------------------------------------------------------------
+# Section 1 : exposed_infants
+# -----------------------------------------------------------------------------
+
+def _infant_rows(frame, condition, patient='patient_id', date='encounter_datetime'):
+    return pd.DataFrame({
+        'patient_id': frame[patient].values,
+        'location_id': frame['location_id'].values,
+        'encounter_id': frame['encounter_id'].values,
+        'visit_date': frame[date].dt.normalize().values,
+        'condition_exposee': condition,
+    })
+
+
+def exposed_infants(inputs, today):
+    """Rows of exposed_infants (conditions 1, 3, 4 and 5)."""
+    ids = inputs['settings']
+    ob_enc = _obs_encounters(inputs)
+    same = _same_patient(ob_enc)
+    pediatric_or_lab = [ids['et_pediatric'], ids['et_lab']]
+    pediatric_forms = [ids['et_pediatric'], ids['et_pediatric_followup']]
+
+    # Condition 1 : PCR négatif à la date de la dernière rencontre PCR
+    pcr = ob_enc[ob_enc['concept_id'].isin([1030, 844])
+                 & _in(ob_enc['encounter_type'], pediatric_or_lab)]
+    latest_pcr = (pcr.groupby('patient_id')['encounter_datetime'].max()
+                  .dt.normalize().rename('latest_pcr_date').reset_index())
+    negative = same[same['concept_id'].isin([1030, 844])
+                    & _in(same['encounter_type'], pediatric_or_lab)]
+    negative = negative.assign(encounter_day=negative['encounter_datetime'].dt.normalize())
+    negative = _join(negative, latest_pcr, ['patient_id', 'encounter_day'],
+                     ['patient_id', 'latest_pcr_date'])
+    negative = negative[((negative['concept_id'] == 1030) & (negative['value_coded'] == 664))
+                        | ((negative['concept_id'] == 844) & (negative['value_coded'] == 1302))]
+    parts = [_infant_rows(negative, 1)]
+
+    # Condition 3 : enfant exposé coché
+    checked = ob_enc[_in(ob_enc['encounter_type'], pediatric_forms)
+                     & (ob_enc['concept_id'] == 1401) & (ob_enc['value_coded'] == 1405)]
+    parts.append(_infant_rows(checked, 3, patient='person_id').drop_duplicates())
+
+    # Condition 4 : ARV en prophylaxie à la dernière dispensation
+    pdis = inputs['patient_dispensing']
+    pdis = pdis[_not_voided(pdis['voided'])]
+    last = pdis.groupby('patient_id')['visit_date'].max().rename('last_date').reset_index()
+    prophylaxis = _join(pdis, last, ['patient_id', 'visit_date'], ['patient_id', 'last_date'])
+    prophylaxis = prophylaxis[(prophylaxis['rx_or_prophy'] == 163768)
+                              & (prophylaxis['arv_drug'] == 1065)]
+    parts.append(pd.DataFrame({
+        'patient_id': prophylaxis['patient_id'].values,
+        'location_id': prophylaxis['location_id'].values,
+        'encounter_id': prophylaxis['encounter_id'].values,
+        'visit_date': prophylaxis['visit_date'].dt.normalize().values,
+        'condition_exposee': 4,
+    }).drop_duplicates())
+
+    infants = pd.concat(parts, ignore_index=True)
+
+    # Retraits : PCR positif, test VIH positif à 18 mois ou plus, VIH confirmé
+    positive = same[((same['encounter_type'] == ids['et_pediatric'])
+                     & (same['concept_id'] == 1030) & (same['value_coded'] == 703))
+                    | ((same['encounter_type'] == ids['et_lab'])
+                       & (same['concept_id'] == 844) & (same['value_coded'] == 1301))]
+    lab = inputs['patient_laboratory']
+    lab = lab[(lab['test_id'] == 1040) & (lab['test_done'] == 1)
+              & (_as_number(lab['test_result']) == 703) & _not_voided(lab['voided'])]
+    patient = inputs['patient']
+    adults = patient[_months_since(patient['birthdate'], today) >= 18]
+    confirmed = ob_enc[_in(ob_enc['encounter_type'], pediatric_forms)
+                       & (ob_enc['concept_id'] == 1401) & (ob_enc['value_coded'] == 163717)]
+    removed = (_ids(positive['person_id'])
+               | (_ids(lab['patient_id']) & _ids(adults['patient_id']))
+               | _ids(confirmed['person_id']))
+    infants = infants[~infants['patient_id'].isin(removed)]
+
+    # Condition 5 : séroréversion, ajoutée après les retraits
+    reverted = ob_enc[_in(ob_enc['encounter_type'], [ids['et_discontinuation']])
+                      & (ob_enc['concept_id'] == 1667) & (ob_enc['value_coded'] == 165439)]
+    reverted = _infant_rows(reverted, 5, patient='person_id').drop_duplicates()
+    return pd.concat([infants, reverted], ignore_index=True)
+
+
+# -----------------------------------------------------------------------------
+# Section 1 : patient_status_arv
+# -----------------------------------------------------------------------------
+
+def _discontinuation_encounters(same, ids):
+    """tmp_status_disc_encounter: death, transfer and stop flags per encounter."""
+    disc = same[_in(same['encounter_type'], [ids['et_discontinuation']])
+                & same['concept_id'].isin([161555, 1667])]
+    reason = disc['concept_id'] == 161555
+    disc = disc.assign(
+        is_death=reason & (disc['value_coded'] == 159),
+        is_transfer=reason & (disc['value_coded'] == 159492),
+        stop_reason=reason & (disc['value_coded'] == 1667),
+        stop_detail=(disc['concept_id'] == 1667) & disc['value_coded'].isin([115198, 159737]),
+    )
+    encounters = disc.groupby('encounter_id').agg(
+        patient_id=('patient_id', 'first'),
+        encounter_datetime=('encounter_datetime', 'first'),
+        is_death=('is_death', 'max'),
+        is_transfer=('is_transfer', 'max'),
+        stop_reason=('stop_reason', 'max'),
+        stop_detail=('stop_detail', 'max'),
+    ).reset_index()
+    encounters['is_stopped'] = encounters['stop_reason'] & encounters['stop_detail']
+    encounters['encounter_date'] = encounters['encounter_datetime'].dt.normalize()
+    return encounters
+
+
+def status_features(inputs, today):
+    """tmp_status_features: one row of dates and encounters per patient."""
+    ids = inputs['settings']
+    same = _same_patient(_obs_encounters(inputs))
+    disc = _discontinuation_encounters(same, ids)
+
+    # Statuts 1, 2, 3 : dernière rencontre d'arrêt, toutes dates
+    by_discontinuation = _max_where(disc, 'patient_id', {
+        'death_date': (disc['is_death'], 'encounter_date'),
+        'death_encounter_id': (disc['is_death'], 'encounter_id'),
+        'transfer_date': (disc['is_transfer'], 'encounter_date'),
+        'transfer_encounter_id': (disc['is_transfer'], 'encounter_id'),
+        'stopped_date': (disc['is_stopped'], 'encounter_date'),
+        'stopped_encounter_id': (disc['is_stopped'], 'encounter_id'),
+    })
+
+    # Statuts 4, 5, 10, 7, 11 : rencontres des visites du jour de la dernière visite
+    visit = inputs['visit'].assign(visit_day=inputs['visit']['date_started'].dt.normalize())
+    latest_visit = (visit[visit['voided'] == 0].groupby('patient_id')['visit_day'].max()
+                    .rename('latest_visit_date').reset_index())
+    v = _join(visit, latest_visit, ['patient_id', 'visit_day'],
+              ['patient_id', 'latest_visit_date'])
+    v = _join(v, inputs['encounter'][['visit_id', 'encounter_id', 'encounter_type']],
+              ['visit_id'])
+    v = v.merge(disc[['encounter_id', 'is_death', 'is_transfer']], on='encounter_id',
+                how='left')
+    v['is_death'] = v['is_death'].eq(True)
+    v['is_transfer'] = v['is_transfer'].eq(True)
+    months = _months_since(v['date_started'], today)
+    kept = _not_voided(v['voided'])
+    lost = kept & _not_in(v['encounter_type'], [
+        ids['et_first_visit'], ids['et_pediatric'], ids['et_followup'],
+        ids['et_pediatric_followup'], ids['et_dispensing1'], ids['et_dispensing2'],
+        ids['et_lab']]) & (months > 12)
+    recent = kept & _in(v['encounter_type'], [ids['et_first_visit'], ids['et_pediatric']]) \
+        & (months <= 12)
+    active = kept & _in(v['encounter_type'], [
+        ids['et_followup'], ids['et_pediatric_followup'], ids['et_dispensing1'],
+        ids['et_dispensing2'], ids['et_lab']]) & (months <= 12)
+    by_visit = _max_where(v, 'patient_id', {
+        'death_pre_arv_date': (v['is_death'], 'visit_day'),
+        'death_pre_arv_encounter_id': (v['is_death'], 'encounter_id'),
+        'transfer_pre_arv_date': (v['is_transfer'], 'visit_day'),
+        'transfer_pre_arv_encounter_id': (v['is_transfer'], 'encounter_id'),
+        'lost_pre_arv_date': (lost, 'visit_day'),
+        'lost_pre_arv_encounter_id': (lost, 'encounter_id'),
+        'recent_pre_arv_date': (recent, 'visit_day'),
+        'recent_pre_arv_encounter_id': (recent, 'encounter_id'),
+        'active_pre_arv_date': (active, 'visit_day'),
+        'active_pre_arv_encounter_id': (active, 'encounter_id'),
+    })
+
+    # Statuts 6, 8, 9 : dispensations de la dernière date de prochaine dispensation
+    pdis = inputs['patient_dispensing']
+    pdis = pdis[_not_voided(pdis['voided'])]
+    pdis = pdis.assign(visit_day=pdis['visit_date'].dt.normalize())
+    latest = latest_dispensing(inputs)['next_arv_dispensation_date'].reset_index()
+    d = _join(pdis, latest, ['patient_id', 'next_dispensation_date'],
+              ['patient_id', 'next_arv_dispensation_date'])
+    encounter = inputs['encounter']
+    dispensing_visits = encounter.loc[
+        _in(encounter['encounter_type'], [ids['et_dispensing1'], ids['et_dispensing2']]),
+        ['visit_id']].drop_duplicates()
+    d = _join(d, dispensing_visits, ['visit_id'])
+    arv = d['arv_drug'] == 1065
+    every = pd.Series(True, index=d.index)
+    by_dispensing = _max_where(d, 'patient_id', {
+        'next_dispensation_date': (every, 'next_dispensation_date'),
+        'arv_dispensing_date': (arv, 'visit_day'),
+        'arv_dispensing_encounter_id': (arv, 'encounter_id'),
+        'dispensing_date': (every, 'visit_day'),
+        'dispensing_encounter_id': (every, 'encounter_id'),
+    })
+
+    features = pd.concat([by_discontinuation, by_visit, by_dispensing], axis=1)
+    features.index.name = 'patient_id'
+
+    # Sous ARV, fiche patient et raisons d'arrêt
+    patients = features.index.to_series()
+    patient = inputs['patient'].drop_duplicates('patient_id').set_index('patient_id')
+    reasons = inputs['discontinuation_reason']
+    features['on_arv'] = patients.isin(patients_on_arv(inputs))
+    features['in_patient'] = patients.isin(patient.index)
+    features['vih_status'] = patient['vih_status'].reindex(features.index)
+    features['patient_voided'] = patient['voided'].reindex(features.index)
+    features['disc_reason'] = patients.isin(
+        _ids(reasons.loc[reasons['reason'].isin([159, 1667, 159492]), 'patient_id']))
+    features['disc_pre_arv'] = patients.isin(
+        _ids(reasons.loc[reasons['reason'].isin([159, 159492]), 'patient_id']))
+    return features
+
+
+def patient_status_arv(inputs, today, infants=None):
+    """Statuses 1-11 of the day, without the exposed infants."""
+    f = status_features(inputs, today)
+    arv = f['on_arv']
+    pre_arv = ~f['on_arv'] & (f['vih_status'] == 1)
+    registered = pre_arv & (f['patient_voided'] == 0)
+    not_left = pre_arv & ~f['disc_pre_arv']
+    regular = arv & ~f['disc_reason']
+    late = (today - f['next_dispensation_date']).dt.days
+    rules = {
+        1: (arv, 'death_date', 'death_encounter_id'),
+        2: (arv, 'transfer_date', 'transfer_encounter_id'),
+        3: (arv, 'stopped_date', 'stopped_encounter_id'),
+        4: (registered, 'death_pre_arv_date', 'death_pre_arv_encounter_id'),
+        5: (registered, 'transfer_pre_arv_date', 'transfer_pre_arv_encounter_id'),
+        6: (regular & f['in_patient'] & (late <= 0),
+            'arv_dispensing_date', 'arv_dispensing_encounter_id'),
+        7: (not_left, 'recent_pre_arv_date', 'recent_pre_arv_encounter_id'),
+        8: (regular & f['in_patient'] & late.between(1, 30),
+            'dispensing_date', 'dispensing_encounter_id'),
+        9: (regular & (late > 30), 'arv_dispensing_date', 'arv_dispensing_encounter_id'),
+        10: (not_left, 'lost_pre_arv_date', 'lost_pre_arv_encounter_id'),
+        11: (not_left, 'active_pre_arv_date', 'active_pre_arv_encounter_id'),
+    }
+    parts = []
+    for id_status, (mask, date, encounter) in rules.items():
+        selected = f[mask & f[date].notna()]
+        parts.append(pd.DataFrame({
+            'patient_id': selected.index.values,
+            'id_status': id_status,
+            'start_date': selected[date].values,
+            'encounter_id': selected[encounter].values,
+        }))
+    statuses = pd.concat(parts, ignore_index=True)
+
+    # Raison d'arrêt : celle de la dernière raison datée après le début du statut
+    reasons = _join(statuses[['patient_id', 'id_status', 'start_date']],
+                    inputs['discontinuation_reason'], ['patient_id'])
+    reasons = reasons[reasons['start_date'] <= reasons['visit_date']]
+    reasons = (reasons.sort_values('visit_date')
+               .drop_duplicates(['patient_id', 'id_status', 'start_date'], keep='last')
+               [['patient_id', 'id_status', 'start_date', 'reason']]
+               .rename(columns={'reason': 'dis_reason'}))
+    statuses = statuses.merge(reasons, on=['patient_id', 'id_status', 'start_date'],
+                              how='left')
+
+    if infants is None:
+        infants = exposed_infants(inputs, today)
+    return statuses[~statuses['patient_id'].isin(_ids(infants['patient_id']))]
+
+
+def patient_arv_status(inputs, statuses, infants, today):
+    """patient.arv_status: the status of the latest status date of each patient."""
+    history = inputs['patient_status_arv'][['patient_id', 'id_status', 'start_date',
+                                            'date_started_status']]
+    # ON DUPLICATE KEY UPDATE keeps the date_started_status of an earlier row
+    written = statuses[['patient_id', 'id_status', 'start_date']].assign(
+        date_started_status=today)
+    rows = pd.concat([history, written], ignore_index=True).drop_duplicates(
+        ['patient_id', 'id_status', 'start_date'], keep='first')
+    rows = rows[~rows['patient_id'].isin(_ids(infants['patient_id']))]
+    rows = rows.assign(status_day=rows['date_started_status'].dt.normalize())
+    latest = rows.groupby('patient_id')['status_day'].transform('max')
+    rows = rows[rows['status_day'] == latest]
+    rows = rows.sort_values(['patient_id', 'id_status', 'start_date']).drop_duplicates(
+        'patient_id', keep='last')
+    rows = rows[rows['patient_id'].isin(_ids(inputs['patient']['patient_id']))]
+    return rows[['patient_id', 'id_status']].rename(columns={'id_status': 'arv_status'})
+
+
+# -----------------------------------------------------------------------------
+# Section 3 : alert
+# -----------------------------------------------------------------------------
+
+def _alert_rows(frame, id_alert, date, patient='patient_id', encounter='encounter_id'):
+    return pd.DataFrame({
+        'patient_id': frame[patient].values,
+        'id_alert': id_alert,
+        'encounter_id': frame[encounter].values,
+        'date_alert': frame[date].values,
+    }).drop_duplicates()
+
+
+def _both_tb_drugs(tb, allowed):
+    """Encounters where both isoniazid (78280) and rifampicin (767) are found."""
+    tb = tb[tb['patient_id'].isin(allowed) & tb['drug_id'].isin([78280, 767])]
+    drugs = tb.groupby(['patient_id', 'encounter_id', 'visit_date'],
+                       dropna=False)['drug_id'].nunique()
+    return drugs[drugs == 2].reset_index()
+
+
+def alerts(inputs, arv_status, today):
+    """Alert codes 1-12."""
+    ids = inputs['settings']
+    encounter = inputs['encounter']
+    obs = inputs['obs']
+    ob_enc = _obs_encounters(inputs)
+    same = _same_patient(ob_enc)
+    pdis = inputs['patient_dispensing']
+    lab = inputs['patient_laboratory']
+    reasons = inputs['discontinuation_reason']
+
+    p = inputs['patient'].drop_duplicates('patient_id').merge(
+        arv_status, on='patient_id', how='left')
+    hiv = p['vih_status'] == 1
+    # `arv_status NOT IN (1, 2, 3)` : faux pour un statut NULL
+    not_left = _not_in(p['arv_status'], [1, 2, 3])
+    on_arv = patients_on_arv(inputs)
+
+    disc_encounters = _ids(encounter.loc[
+        _in(encounter['encounter_type'], [ids['et_discontinuation']]), 'patient_id'])
+    disc_by_encounter = disc_encounters & _ids(reasons['patient_id'])
+
+    arv_pdis = pdis[(pdis['arv_drug'] == 1065) & _not_voided(pdis['voided'])]
+    first_arv = arv_pdis.assign(visit_day=arv_pdis['visit_date'].dt.normalize()).groupby(
+        'patient_id').agg(encounter_id=('encounter_id', 'min'),
+                          first_date=('visit_day', 'min')).reset_index()
+
+    viral_load = lab[lab['test_id'].isin([856, 1305]) & (lab['test_done'] == 1)
+                     & _not_voided(lab['voided']) & _has_text(lab['test_result'])]
+    with_viral_load = _ids(viral_load['patient_id'])
+
+    parts = []
+
+    # Alertes 1, 2, 3 : sous ARV sans résultat de charge virale
+    started = _join(p, first_arv, ['patient_id', 'date_started_arv'],
+                    ['patient_id', 'first_date'])
+    months = _months_since(started['date_started_arv'], today)
+    no_load = (started['vih_status'] == 1) & ~started['patient_id'].isin(with_viral_load)
+    kept = ~started['patient_id'].isin(disc_by_encounter)
+    parts.append(_alert_rows(started[no_load & kept & (months >= 6)], 1, 'first_date'))
+    parts.append(_alert_rows(started[no_load & ~started['patient_id'].isin(disc_encounters)
+                                     & (months == 5)], 2, 'first_date'))
+    pregnant = started['patient_id'].isin(_ids(inputs['patient_pregnancy']['patient_id']))
+    parts.append(_alert_rows(started[no_load & kept & pregnant & (months >= 4)], 3,
+                             'first_date'))
+
+    # Alerte 4 : dernière charge virale supprimée il y a 12 mois ou plus
+    allowed = _ids(p.loc[not_left & hiv, 'patient_id']) & on_arv
+    plab = lab.assign(lab_date=_lab_date(lab), result=_as_number(lab['test_result']))
+    last_result = latest_viral_load(inputs).reset_index()
+    suppressed = _join(plab[plab['patient_id'].isin(allowed)], last_result,
+                       ['patient_id', 'lab_date'], ['patient_id', 'last_result_date'])
+    suppressed = suppressed[
+        (_months_since(suppressed['last_result_date'], today) >= 12)
+        & (((suppressed['test_id'] == 856) & (suppressed['result'] < 1000))
+           | ((suppressed['test_id'] == 1305) & (suppressed['result'] == 1306)))]
+    parts.append(_alert_rows(suppressed, 4, 'lab_date'))
+
+    # Alerte 5 : dernière charge virale (obs) > 1000 copies/ml depuis 3 mois ou plus
+    load_obs = obs[obs['concept_id'].isin([856, 1305])]
+    load_obs = load_obs.assign(obs_day=load_obs['obs_datetime'].dt.normalize())
+    last_obs = load_obs.groupby('person_id')['obs_day'].max().rename('last_day').reset_index()
+    high = _join(load_obs, last_obs, ['person_id', 'obs_day'], ['person_id', 'last_day'])
+    high = high[high['person_id'].isin(_ids(p.loc[not_left, 'patient_id']))
+                & (((high['concept_id'] == 856) & (high['value_numeric'] > 1000))
+                   | ((high['concept_id'] == 1305) & (high['value_coded'] == 1301)))
+                & (_months_since(high['obs_day'], today) >= 3)]
+    parts.append(_alert_rows(high, 5, 'obs_day', patient='person_id'))
+
+    # Alerte 6 : dernière charge virale > 1000 copies/ml
+    last_856 = viral_load[viral_load['test_id'] == 856]
+    last_856 = (last_856.assign(lab_date=_lab_date(last_856))
+                .groupby('patient_id')['lab_date'].max().rename('last_date').reset_index())
+    unsuppressed = _join(plab, last_856, ['patient_id', 'lab_date'],
+                         ['patient_id', 'last_date'])
+    unsuppressed = unsuppressed[
+        (unsuppressed['test_id'] == 856) & (unsuppressed['result'] > 1000)
+        & unsuppressed['patient_id'].isin(
+            (_ids(p.loc[hiv, 'patient_id']) & on_arv) - disc_by_encounter)]
+    parts.append(_alert_rows(unsuppressed, 6, 'lab_date'))
+
+    # Alertes 7, 8 : renouvellement dans les 30 jours, plus de médicaments
+    latest = latest_dispensing(inputs).reset_index()
+    active = _ids(p.loc[not_left, 'patient_id'])
+    refill = pdis[pdis['patient_id'].isin(active)]
+    refill = refill.assign(visit_day=refill['visit_date'].dt.normalize())
+    refill = _join(refill, latest, ['patient_id', 'next_dispensation_date'],
+                   ['patient_id', 'next_arv_rx_dispensation_date'])
+    days_left = (refill['next_dispensation_date'] - today).dt.days
+    parts.append(_alert_rows(refill[days_left.between(0, 30)], 7, 'visit_day'))
+    parts.append(_alert_rows(refill[days_left < 0], 8, 'visit_day'))
+
+    # Alerte 9 : co-infection TB/VIH, formulaire de dispensation
+    tb = pdis[pdis['patient_id'].isin(on_arv) & _not_voided(pdis['voided'])]
+    tb = tb.assign(visit_day=tb['visit_date'].dt.normalize())
+    tb = _join(tb, latest, ['patient_id', 'visit_day'], ['patient_id', 'last_visit_date'])
+    tb = tb[((tb['rx_or_prophy'] == 138405) & (tb['drug_id'] == 78280))
+            | (tb['drug_id'] == 767)]
+    tb = tb[['patient_id', 'encounter_id', 'drug_id', 'visit_day']].rename(
+        columns={'visit_day': 'visit_date'}).drop_duplicates()
+    parts.append(_alert_rows(_both_tb_drugs(tb, active), 9, 'visit_date'))
+
+    # Alerte 9 : co-infection TB/VIH, formulaires de visite VIH
+    hiv_forms = encounter[_in(encounter['encounter_type'], [
+        ids['et_first_visit'], ids['et_followup'], ids['et_pediatric'],
+        ids['et_pediatric_followup']])]
+    last_hiv = (hiv_forms.groupby('patient_id')['encounter_datetime'].max()
+                .dt.normalize().rename('last_hiv_date').reset_index())
+    given = obs[(obs['concept_id'] == 159367) & (obs['value_coded'] == 1065)]
+    forms = []
+    for group, drug in [('concept_isoniazid_group', 78280),
+                        ('concept_rifampicin_group', 767)]:
+        groups = _ids(obs.loc[_in(obs['concept_id'], [ids[group]]), 'obs_id'])
+        given_groups = _ids(given.loc[given['obs_group_id'].isin(groups), 'obs_group_id'])
+        drugs = same[(same['concept_id'] == 1282) & (same['value_coded'] == drug)
+                     & same['obs_group_id'].isin(given_groups)]
+        forms.append(drugs.assign(encounter_day=drugs['encounter_datetime'].dt.normalize()))
+    forms = pd.concat(forms, ignore_index=True)
+    forms = _join(forms, last_hiv, ['patient_id', 'encounter_day'],
+                  ['patient_id', 'last_hiv_date'])
+    forms = pd.DataFrame({
+        'patient_id': forms['person_id'].values,
+        'encounter_id': forms['encounter_id'].values,
+        'drug_id': forms['value_coded'].values,
+        'visit_date': forms['encounter_day'].values,
+    }).drop_duplicates()
+    parts.append(_alert_rows(_both_tb_drugs(forms, active), 9, 'visit_date'))
+
+    # Alerte 10 : sous ARV depuis 3 mois ou plus sans charge virale
+    measured = (_ids(lab.loc[(lab['test_id'] == 856) & _has_text(lab['test_result'])
+                             & _not_voided(lab['voided']), 'patient_id'])
+                | _ids(lab.loc[(lab['test_id'] == 1305)
+                               & _as_number(lab['test_result']).isin([1301, 1306])
+                               & _not_voided(lab['voided']), 'patient_id']))
+    waiting = _ids(p.loc[_not_in(p['arv_status'], [1, 2, 3, 4]) & hiv, 'patient_id'])
+    first_visit = pdis[_not_voided(pdis['voided']) & pdis['patient_id'].isin(waiting)]
+    first_visit = first_visit.assign(visit_day=first_visit['visit_date'].dt.normalize())
+    first_visit = _join(first_visit[['patient_id', 'visit_day']].drop_duplicates(),
+                        first_arv, ['patient_id', 'visit_day'], ['patient_id', 'first_date'])
+    first_visit = first_visit[(_months_since(first_visit['first_date'], today) >= 3)
+                              & ~first_visit['patient_id'].isin(measured)]
+    parts.append(_alert_rows(first_visit, 10, 'first_date'))
+
+    # Alerte 11 : sous ARV sans prophylaxie INH
+    inh = _ids(same.loc[_in(same['encounter_type'], [ids['et_dispensing1'],
+                                                      ids['et_dispensing2']])
+                        & (same['concept_id'] == 1282) & (same['value_coded'] == 78280),
+                        'person_id'])
+    no_inh = pdis[(pdis['arv_drug'] == 1065) & (pdis['rx_or_prophy'] != 163768)
+                  & pdis['rx_or_prophy'].notna()
+                  & pdis['patient_id'].isin(_ids(p.loc[not_left & hiv, 'patient_id']) - inh)]
+    no_inh = no_inh.assign(visit_day=no_inh['visit_date'].dt.normalize())
+    parts.append(_alert_rows(no_inh, 11, 'visit_day'))
+
+    # Alerte 12 : abonnement DDP
+    ddp = obs[_in(obs['concept_id'], [ids['concept_ddp']]) & (obs['value_coded'] == 1065)]
+    ddp = ddp.assign(obs_day=ddp['obs_datetime'].dt.normalize())
+    parts.append(_alert_rows(ddp, 12, 'obs_day', patient='person_id'))
+
+    return pd.concat(parts, ignore_index=True)
+
+
+def run(inputs, as_of=None):
+    """Compute every result; returns a dict of DataFrames keyed like RESULT_KEYS."""
+    today = pd.Timestamp(as_of or inputs['as_of'])
+    infants = exposed_infants(inputs, today)
+    statuses = patient_status_arv(inputs, today, infants)
+    arv_status = patient_arv_status(inputs, statuses, infants, today)
+    return {
+        'patient_status_arv': statuses,
+        'exposed_infants': infants,
+        'patient_arv_status': arv_status,
+        'alert': alerts(inputs, arv_status, today),
+    }
+
+
+# -----------------------------------------------------------------------------
+# Outputs
+# -----------------------------------------------------------------------------
+
+def write_results(results, directory):
+    """Write each result to <directory>/<name>.csv."""
+    directory.mkdir(parents=True, exist_ok=True)
+    for name, frame in results.items():
+        frame.sort_values(RESULT_KEYS[name]).to_csv(
+            directory / f'{name}.csv', index=False, na_rep=NULL,
+            float_format='%.0f', date_format='%Y-%m-%d')
+
+
+def _sql_rows(frame, columns):
+    """Rows for executemany: Python ints and dates, None for NULL."""
+    rows = []
+    for record in frame[columns].itertuples(index=False):
+        row = []
+        for value in record:
+            if pd.isna(value):
+                row.append(None)
+            elif isinstance(value, pd.Timestamp):
+                row.append(value.date())
+            else:
+                row.append(int(value))
+        rows.append(tuple(row))
+    return rows
+
+
+def compare(expected, actual, keys):
+    """Key rows only in expected, and only in actual (NULL keys match each other)."""
+    def keyed(frame):
+        frame = frame[keys].copy()
+        for column in keys:
+            if pd.api.types.is_datetime64_any_dtype(frame[column]):
+                frame[column] = frame[column].dt.normalize()
+            else:
+                frame[column] = pd.to_numeric(frame[column], errors='coerce')
+        return frame.drop_duplicates()
+
+    merged = keyed(expected).merge(keyed(actual), on=keys, how='outer', indicator=True)
+    return (merged.loc[merged['_merge'] == 'left_only', keys],
+            merged.loc[merged['_merge'] == 'right_only', keys])
+
+
+def _execute(cursor, statements):
+    for sql in statements:
+        cursor.execute(sql)
+
+
+def apply_results(conn, results):
+    """Write the results like sections 1 and 3 of patient_status_arv_dml.sql."""
+    cursor = conn.cursor()
+    try:
+        _execute(cursor, [
+            'START TRANSACTION',
+            'DELETE poa FROM isanteplus.patient_on_arv poa '
+            'LEFT JOIN (SELECT DISTINCT pdisp.patient_id '
+            'FROM isanteplus.patient_dispensing pdisp '
+            'WHERE pdisp.arv_drug = 1065 '
+            'AND (pdisp.rx_or_prophy = 138405 OR pdisp.rx_or_prophy IS NULL) '
+            'AND pdisp.voided <> 1) valid_patients '
+            'ON poa.patient_id = valid_patients.patient_id '
+            'WHERE valid_patients.patient_id IS NULL',
+            'COMMIT',
+        ])
+
+        # Enfants exposés : table _next échangée par un seul RENAME
+        _execute(cursor, [
+            'DROP TABLE IF EXISTS isanteplus.exposed_infants_next',
+            'CREATE TABLE isanteplus.exposed_infants_next LIKE isanteplus.exposed_infants',
+        ])
+        cursor.executemany(
+            'INSERT INTO isanteplus.exposed_infants_next (patient_id, location_id, '
+            'encounter_id, visit_date, condition_exposee) VALUES (%s, %s, %s, %s, %s)',
+            _sql_rows(results['exposed_infants'], ['patient_id', 'location_id',
+                                                   'encounter_id', 'visit_date',
+                                                   'condition_exposee']))
+        _execute(cursor, [
+            'DROP TABLE IF EXISTS isanteplus.exposed_infants_old',
+            'RENAME TABLE isanteplus.exposed_infants TO isanteplus.exposed_infants_old, '
+            'isanteplus.exposed_infants_next TO isanteplus.exposed_infants',
+            'DROP TABLE isanteplus.exposed_infants_old',
+        ])
+
+        # Statuts du jour, raison d'arrêt, dernier statut et patient.arv_status
+        _execute(cursor, [
+            'START TRANSACTION',
+            'DELETE FROM isanteplus.patient_status_arv '
+            'WHERE DATE(date_started_status) = CURDATE()',
+        ])
+        cursor.executemany(
+            'INSERT INTO isanteplus.patient_status_arv (patient_id, id_status, '
+            'start_date, encounter_id, last_updated_date, date_started_status) '
+            'VALUES (%s, %s, %s, %s, NOW(), NOW()) '
+            'ON DUPLICATE KEY UPDATE last_updated_date = VALUES(last_updated_date)',
+            _sql_rows(results['patient_status_arv'], ['patient_id', 'id_status',
+                                                      'start_date', 'encounter_id']))
+        _execute(cursor, [
+            'UPDATE isanteplus.patient_status_arv psarv '
+            'INNER JOIN isanteplus.discontinuation_reason dreason '
+            'ON psarv.patient_id = dreason.patient_id '
+            'AND psarv.start_date <= dreason.visit_date '
+            'SET psarv.dis_reason = dreason.reason',
+            'DELETE psarv FROM isanteplus.patient_status_arv psarv '
+            'INNER JOIN isanteplus.exposed_infants ei ON psarv.patient_id = ei.patient_id',
+            'COMMIT',
+            'CREATE TABLE IF NOT EXISTS isanteplus.patient_latest_status ('
+            'patient_id INT(11) NOT NULL, date_started_status DATETIME, '
+            'CONSTRAINT pk_patient_latest_status PRIMARY KEY (patient_id)'
+            ') ENGINE = InnoDB DEFAULT CHARSET = utf8',
+            'TRUNCATE TABLE isanteplus.patient_latest_status',
+            'INSERT INTO isanteplus.patient_latest_status (patient_id, date_started_status) '
+            'SELECT patient_id, MAX(date_started_status) '
+            'FROM isanteplus.patient_status_arv GROUP BY patient_id',
+            'START TRANSACTION',
+            'UPDATE isanteplus.patient SET arv_status = NULL WHERE arv_status IS NOT NULL',
+            'UPDATE isanteplus.patient p '
+            'INNER JOIN isanteplus.patient_status_arv psa ON p.patient_id = psa.patient_id '
+            'INNER JOIN isanteplus.patient_latest_status B '
+            'ON psa.patient_id = B.patient_id '
+            'AND DATE(psa.date_started_status) = DATE(B.date_started_status) '
+            'SET p.arv_status = psa.id_status',
+            'COMMIT',
+        ])
+
+        # Alertes : alert_next appliquée à alert par différence
+        _execute(cursor, [
+            'DROP TABLE IF EXISTS isanteplus.alert_next',
+            'CREATE TABLE isanteplus.alert_next LIKE isanteplus.alert',
+        ])
+        cursor.executemany(
+            'INSERT INTO isanteplus.alert_next (patient_id, id_alert, encounter_id, '
+            'date_alert, last_updated_date) VALUES (%s, %s, %s, %s, NOW())',
+            _sql_rows(results['alert'], ['patient_id', 'id_alert', 'encounter_id',
+                                         'date_alert']))
+        cursor.execute(
+            "SELECT COUNT(*) FROM INFORMATION_SCHEMA.ROUTINES "
+            "WHERE ROUTINE_SCHEMA = 'isanteplus' AND ROUTINE_NAME = 'etl_reset_watermark'")
+        has_reset_watermark = cursor.fetchone()[0] > 0
+        _execute(cursor, [
+            'START TRANSACTION',
+            'DELETE a FROM isanteplus.alert a '
+            'LEFT JOIN isanteplus.alert_next n '
+            'ON n.patient_id = a.patient_id AND n.id_alert = a.id_alert '
+            'AND n.encounter_id <=> a.encounter_id AND n.date_alert <=> a.date_alert '
+            'WHERE n.patient_id IS NULL',
+            'INSERT INTO isanteplus.alert (patient_id, id_alert, encounter_id, '
+            'date_alert, last_updated_date) '
+            'SELECT n.patient_id, n.id_alert, n.encounter_id, n.date_alert, '
+            'n.last_updated_date FROM isanteplus.alert_next n '
+            'LEFT JOIN isanteplus.alert a '
+            'ON a.patient_id = n.patient_id AND a.id_alert = n.id_alert '
+            'AND a.encounter_id <=> n.encounter_id AND a.date_alert <=> n.date_alert '
+            'WHERE a.patient_id IS NULL',
+        ] + ([
+            # Marque 'alert' : la prochaine exécution du DML recalcule ses alertes
+            "CALL isanteplus.etl_reset_watermark('alert')",
+        ] if has_reset_watermark else []) + [
+            'COMMIT',
+            'DROP TABLE IF EXISTS isanteplus.alert_next',
+        ])
+    finally:
+        cursor.close()
+
+
+def preflight(args):
+    """Verify prerequisites before reading anything."""
+    if not HAS_PANDAS:
+        print('Error: pandas is required.', file=sys.stderr)
+        print('Install with: pip install pandas', file=sys.stderr)
+        sys.exit(1)
+    if args.input_dir is None and not HAS_MYSQL:
+        print('Error: mysql-connector-python is required.', file=sys.stderr)
+        print('Install with: pip install mysql-connector-python', file=sys.stderr)
+        sys.exit(1)
+    if args.input_dir is not None and (args.apply or args.dump_inputs):
+        print('Error: --apply and --dump-inputs read from MySQL, not --input-dir',
+              file=sys.stderr)
+        sys.exit(1)
+    if args.apply and args.as_of not in (None, datetime.date.today()):
+        print('Error: --apply writes the statuses of today; drop --as-of',
+              file=sys.stderr)
+        sys.exit(1)
+    if not (args.output_dir or args.apply or args.dump_inputs):
+        print('Error: nothing to do; pass --output-dir, --apply or --dump-inputs',
+              file=sys.stderr)
+        sys.exit(1)
+
+
+def main():
+    args = parse_args()
+    preflight(args)
+
+    conn = None
+    if args.input_dir is None:
+        if args.user is None:
+            args.user = input('MySQL username: ')
+        if args.password is None:
+            args.password = getpass.getpass('MySQL password: ')
+        conn = connect(args)
+
+    try:
+        start = time.perf_counter()
+        if conn is None:
+            inputs = read_inputs(args.input_dir)
+            source = args.input_dir
+        else:
+            inputs = load_inputs(conn, args.as_of or datetime.date.today())
+            source = 'MySQL'
+        rows = sum(len(inputs[name]) for name in INPUTS)
+        print(f'Read {rows} input rows from {source} '
+              f'({time.perf_counter() - start:.1f}s)', file=sys.stderr)
+
+        if args.dump_inputs:
+            write_inputs(inputs, args.dump_inputs)
+            print(f'Inputs written to {args.dump_inputs}', file=sys.stderr)
+            return
+
+        start = time.perf_counter()
+        results = run(inputs, args.as_of)
+        print(f'Computed as of {args.as_of or inputs["as_of"]} '
+              f'({time.perf_counter() - start:.1f}s): '
+              + ', '.join(f'{len(frame)} {name}' for name, frame in results.items()),
+              file=sys.stderr)
+
+        if args.output_dir:
+            write_results(results, args.output_dir)
+            print(f'Results written to {args.output_dir}', file=sys.stderr)
+        if args.apply:
+            start = time.perf_counter()
+            apply_results(conn, results)
+            print(f'Results applied ({time.perf_counter() - start:.1f}s)', file=sys.stderr)
+    except MySQLError as e:
+        print(f'Error: {e}', file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+if __name__ == '__main__':
+    main()
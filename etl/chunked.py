@@ -0,0 +1,90 @@
+"""
+Chunked execution of large UPDATE and INSERT ... SELECT statements.
+
+A statement preceded by `-- etl:chunk <table> <column>` restricts its rows
+with `<column> BETWEEN @etl_chunk_lo AND @etl_chunk_hi`.  The scripts set
+those variables to the whole INT range, so the mysql client runs the
+statement in one go.  The orchestrator instead walks the key range of
+<table> in chunks, committing after each one, so that a rewrite of
+patient_on_art or patient_dispensing never holds its row locks and undo
+log for more than about --chunk-seconds.  The key span of the next chunk
+is scaled by the ratio between the target and the measured duration.
+
+Committing between chunks also commits the statements that precede it in
+the section's transaction; the transaction is reopened afterwards.  The
+on_commit callback is called after that commit and before the first chunk,
+so that the run journal can mark the section as partially applied.
+"""
+
+import time
+from typing import Tuple
+
+from etl.sqlsplit import Statement
+
+# Same as the PHASE 0 defaults of the scripts
+INT_MIN = -2147483648
+INT_MAX = 2147483647
+
+
+class ChunkedExecutor:
+    """Runs `-- etl:chunk` statements in key-range chunks on one connection."""
+
+    def __init__(self, conn, target_seconds=1.0, initial_span=5000,
+                 min_span=1, max_growth=2.0, on_commit=None):
+        self.conn = conn
+        self.on_commit = on_commit
+        self.target_seconds = target_seconds
+        self.initial_span = initial_span
+        self.min_span = min_span
+        self.max_growth = max_growth
+
+    def _bounds(self, cursor, table, column):
+        cursor.execute(f'SELECT MIN({column}), MAX({column}) FROM {table}')
+        return cursor.fetchone()
+
+    def _set_range(self, cursor, lo, hi):
+        cursor.execute('SET @etl_chunk_lo := %s, @etl_chunk_hi := %s', (lo, hi))
+
+    def _next_span(self, span, seconds):
+        if seconds <= 0:
+            return int(span * self.max_growth)
+        factor = self.target_seconds / seconds
+        factor = min(max(factor, 1 / self.max_growth), self.max_growth)
+        return max(int(span * factor), self.min_span)
+
+    def execute(self, cursor, statement: Statement,
+                execute_statement) -> Tuple[float, int]:
+        """Run statement through execute_statement, one chunk at a time.
+
+        Returns (seconds, rows affected) for the whole statement, like
+        execute_statement.
+        """
+        if statement.chunk is None or self.target_seconds <= 0:
+            return execute_statement(cursor, statement)
+
+        start = time.perf_counter()
+        table, column = statement.chunk
+        lo, hi = self._bounds(cursor, table, column)
+        if lo is None:
+            return execute_statement(cursor, statement)
+
+        in_transaction = self.conn.in_transaction
+        if in_transaction:
+            cursor.execute('COMMIT')
+        if self.on_commit is not None:
+            self.on_commit()
+        total_rows = 0
+        span = self.initial_span
+        try:
+            while lo <= hi:
+                chunk_hi = min(lo + span - 1, hi)
+                self._set_range(cursor, lo, chunk_hi)
+                seconds, rows = execute_statement(cursor, statement)
+                total_rows += rows or 0
+                span = self._next_span(span, seconds)
+                lo = chunk_hi + 1
+        finally:
+            self._set_range(cursor, INT_MIN, INT_MAX)
+            if in_transaction:
+                cursor.execute('START TRANSACTION')
+        return time.perf_counter() - start, total_rows
@@ -0,0 +1,196 @@
+"""
+Run journal: checkpoint and resume for long ETL runs.
+
+Every completed step of a run is recorded in isanteplus.etl_run_journal
+with a hash of its statements: each script, and for the reports DML script
+each snapshot table and each section.  `python3 -m etl --resume` picks up
+the last unfinished run: scripts and sections already done are skipped,
+and a snapshot is rebuilt only if its _tmp_* table is gone.  A step whose
+statements have changed since it was recorded is run again.
+
+A section whose chunked statements (etl/chunked.py) commit part of its
+work is recorded as '<step> partial' before its first chunk.  It is not
+done, so --resume runs it again from its first statement; its statements
+are upserts and updates, which can be replayed over a partial run.
+
+The journal lives in the isanteplus database, so the DDL script (which
+recreates that database) clears it; it is recreated on the next record.
+"""
+
+import hashlib
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+from etl.sqlsplit import Statement
+
+JOURNAL_TABLE = 'isanteplus.etl_run_journal'
+
+JOURNAL_DDL = f"""CREATE TABLE IF NOT EXISTS {JOURNAL_TABLE} (
+  run_id VARCHAR(32) NOT NULL,
+  file VARCHAR(128) NOT NULL,
+  step VARCHAR(128) NOT NULL,
+  statement_hash CHAR(40) NOT NULL,
+  completed_at DATETIME NOT NULL,
+  CONSTRAINT pk_etl_run_journal PRIMARY KEY (run_id, file, step)
+) ENGINE = InnoDB DEFAULT CHARSET = utf8"""
+
+# Step recorded once every script of the run has succeeded
+RUN_COMPLETE = ('', 'complete')
+
+# Snapshot table built (or filled) by a setup statement
+_SNAPSHOT_RE = re.compile(
+    r'^(?:DROP TABLE IF EXISTS|CREATE TABLE|INSERT (?:IGNORE )?INTO)\s+(_tmp_\w+)',
+    re.IGNORECASE,
+)
+
+
+def statement_hash(statements: List[Statement]) -> str:
+    """SHA-1 of the statements of one step, in order."""
+    digest = hashlib.sha1()
+    for statement in statements:
+        digest.update(statement.sql.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+@dataclass
+class SetupUnit:
+    """Consecutive setup statements that build one snapshot table.
+
+    table is None for statements that build no snapshot (PRÉAMBULE); those
+    are always run.
+    """
+    table: Optional[str]
+    statements: List[Statement]
+
+    @property
+    def step(self):
+        return f'snapshot {self.table}'
+
+
+def setup_units(statements: List[Statement]) -> List[SetupUnit]:
+    """Group setup statements by the snapshot table they build."""
+    units = []
+    for statement in statements:
+        m = _SNAPSHOT_RE.match(statement.sql)
+        table = m.group(1) if m else None
+        if units and units[-1].table == table:
+            units[-1].statements.append(statement)
+        else:
+            units.append(SetupUnit(table, [statement]))
+    return units
+
+
+class RunJournal:
+    """Completed steps of one run, as recorded in the journal table."""
+
+    def __init__(self, run_id, done=None):
+        self.run_id = run_id
+        self.done = done or {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def start(cls):
+        """Begin a new run."""
+        return cls(time.strftime('%Y%m%d%H%M%S'))
+
+    @classmethod
+    def resume(cls, conn):
+        """Reload the last run if it did not complete, else return None."""
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT COUNT(*) FROM information_schema.tables "
+                "WHERE table_schema = 'isanteplus' AND table_name = 'etl_run_journal'"
+            )
+            if cursor.fetchone()[0] == 0:
+                return None
+            cursor.execute(f'SELECT MAX(run_id) FROM {JOURNAL_TABLE}')
+            run_id = cursor.fetchone()[0]
+            if run_id is None:
+                return None
+            cursor.execute(
+                f'SELECT file, step, statement_hash FROM {JOURNAL_TABLE} '
+                'WHERE run_id = %s', (run_id,)
+            )
+            done = {(file, step): digest for file, step, digest in cursor.fetchall()}
+        finally:
+            cursor.close()
+        if RUN_COMPLETE in done:
+            return None
+        return cls(run_id, done)
+
+    def is_done(self, file, step, digest):
+        """True if the step was recorded with the same statements."""
+        with self._lock:
+            return self.done.get((file, step)) == digest
+
+    def record(self, conn, file, step, digest):
+        """Record a completed step on conn."""
+        cursor = conn.cursor()
+        try:
+            cursor.execute(JOURNAL_DDL)
+            cursor.execute(
+                f'INSERT INTO {JOURNAL_TABLE} '
+                '(run_id, file, step, statement_hash, completed_at) '
+                'VALUES (%s, %s, %s, %s, NOW()) '
+                'ON DUPLICATE KEY UPDATE statement_hash = VALUES(statement_hash), '
+                'completed_at = VALUES(completed_at)',
+                (self.run_id, file, step, digest),
+            )
+        finally:
+            cursor.close()
+        with self._lock:
+            self.done[(file, step)] = digest
+
+    def is_partial(self, file, step):
+        """True if the step committed part of its work but did not finish."""
+        with self._lock:
+            return (file, f'{step} partial') in self.done and (file, step) not in self.done
+
+    def record_partial(self, conn, file, step, digest):
+        """Record that step is about to commit part of its work."""
+        with self._lock:
+            if self.done.get((file, f'{step} partial')) == digest:
+                return
+        self.record(conn, file, f'{step} partial', digest)
+
+    def complete(self, conn):
+        """Mark the whole run as finished; --resume will then start afresh."""
+        self.record(conn, *RUN_COMPLETE, '')
+
+
+def existing_tables(conn, tables) -> set:
+    """Names among tables that exist in the isanteplus database."""
+    tables = list(tables)
+    if not tables:
+        return set()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            'SELECT table_name FROM information_schema.tables '
+            "WHERE table_schema = 'isanteplus' AND table_name IN ("
+            + ', '.join(['%s'] * len(tables)) + ')',
+            tables,
+        )
+        return {row[0] for row in cursor.fetchall()}
+    finally:
+        cursor.close()
+
+
+def run_setup(conn, name, units: List[SetupUnit], journal: RunJournal,
+              results, run_statements, verbose=False):
+    """Build the snapshots, skipping those already built in this run."""
+    present = existing_tables(conn, {u.table for u in units if u.table})
+    for unit in units:
+        if unit.table is None:
+            run_statements(conn, name, unit.statements, results, verbose)
+            continue
+        digest = statement_hash(unit.statements)
+        if unit.table in present and journal.is_done(name, unit.step, digest):
+            continue
+        run_statements(conn, name, unit.statements, results, verbose)
+        journal.record(conn, name, unit.step, digest)
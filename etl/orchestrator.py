@@ -0,0 +1,385 @@
+"""
+Run the iSantePlus reports ETL over one pooled MySQL connection.
+
+Replaces the one-mysql-client-per-file loop in load.sh: every script in
+sql_files/ is split into statements (honouring DELIMITER) and executed on
+the same session, with wall-clock time and rows affected recorded for each
+statement.  A summary per file and the slowest statements are printed at
+the end, and the full timing list can be written to JSON.
+
+Requirements:
+    pip install mysql-connector-python
+
+Usage:
+    python3 -m etl -u root -p Admin123
+    python3 -m etl -u root -p Admin123 --files isanteplusreportsdmlscript.sql
+    python3 -m etl -u root -p Admin123 --report-json etl_timings.json
+    python3 -m etl -u root -p Admin123 --parallel 4
+    python3 -m etl -u root -p Admin123 --full-rebuild
+    python3 -m etl -u root -p Admin123 --resume
+    python3 -m etl -u root -p Admin123 --chunk-seconds 0.5
+    python3 -m etl -u root -p Admin123 --profile --profile-json etl_profile.json
+    python3 -m etl --show-dag
+"""
+
+import argparse
+import functools
+import getpass
+import json
+import sys
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import List, Optional
+
+try:
+    import mysql.connector
+    import mysql.connector.pooling
+    from mysql.connector import Error as MySQLError
+    HAS_MYSQL = True
+except ImportError:
+    HAS_MYSQL = False
+    MySQLError = Exception
+
+from etl.chunked import ChunkedExecutor
+from etl.journal import RunJournal, statement_hash
+from etl.parallel import run_sections
+from etl.profiler import PROFILE_HEADERS, Profiler
+from etl.sections import REPORTS_DML_SECTIONS, format_dependencies
+from etl.sqlsplit import Statement, split_statements
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# Same order as load.sh
+SQL_FILES = [
+    'isanteplusreportsddlscript.sql',
+    'isanteplusreportsdmlscript.sql',
+    'drug_lookup_isanteplus.sql',
+    'run_isante_patient_status.sql',
+    'event_scheduler.sql',
+    'insertion_obs_by_day.sql',
+    'patient_status_arv_dml.sql',
+    'indicators_report.sql',
+]
+
+# Script whose sections can be run concurrently (see etl/sections.py)
+REPORTS_DML = 'isanteplusreportsdmlscript.sql'
+
+# Read by PHASE 1 of the reports DML script: ignore etl_watermark
+FULL_REBUILD = Statement('SET @etl_full_rebuild := 1', 0)
+
+# Script that can read the openmrs snapshots of REPORTS_DML instead of
+# scanning openmrs again, when it runs later on the same connection
+ARV_DML = 'patient_status_arv_dml.sql'
+
+# Read by the NETTOYAGE block of the reports DML script: keep the snapshots
+SHARE_SNAPSHOT = Statement('SET @etl_share_snapshot := 1', 0)
+
+
+@dataclass
+class StatementResult:
+    """Timing of one executed statement."""
+    file: str
+    line: int
+    summary: str
+    seconds: float
+    rows: Optional[int]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Run the iSantePlus reports ETL scripts on one connection',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__,
+    )
+
+    db_group = parser.add_argument_group('Database connection')
+    db_group.add_argument('--host', '-H', default='localhost',
+                          help='MySQL host (default: localhost)')
+    db_group.add_argument('--port', '-P', type=int, default=3306,
+                          help='MySQL port (default: 3306)')
+    db_group.add_argument('--user', '-u', help='MySQL username')
+    db_group.add_argument('--password', '-p', help='MySQL password')
+
+    path_group = parser.add_argument_group('File paths')
+    path_group.add_argument('--sql-dir', type=Path,
+                            default=REPO_ROOT / 'sql_files',
+                            help='Directory containing the ETL SQL files')
+    path_group.add_argument('--files', nargs='+', default=SQL_FILES,
+                            metavar='FILE',
+                            help='Scripts to run, in order (default: same as load.sh)')
+
+    exec_group = parser.add_argument_group('Execution')
+    exec_group.add_argument('--parallel', type=int, default=1, metavar='N',
+                            help=f'Run up to N independent sections of {REPORTS_DML} '
+                                 'at once, each on its own connection (default: 1)')
+    exec_group.add_argument('--full-rebuild', action='store_true',
+                            help=f'Rebuild every patient in {REPORTS_DML} instead of '
+                                 'only those changed since the last run')
+    exec_group.add_argument('--resume', action='store_true',
+                            help='Resume the last unfinished run: skip the scripts, '
+                                 'snapshots and sections it completed')
+    exec_group.add_argument('--chunk-seconds', type=float, default=1.0, metavar='S',
+                            help='Run the statements marked -- etl:chunk in key-range '
+                                 'chunks of about S seconds, committing after each '
+                                 '(0: in one go; default: 1.0)')
+    exec_group.add_argument('--show-dag', action='store_true',
+                            help=f'Print the section dependency graph of {REPORTS_DML} and exit')
+
+    report_group = parser.add_argument_group('Reporting')
+    report_group.add_argument('--top', type=int, default=20,
+                              help='Number of slowest statements to list (default: 20)')
+    report_group.add_argument('--report-json', type=Path,
+                              help='Write every statement timing to this JSON file')
+    report_group.add_argument('--profile', action='store_true',
+                              help='Also record the EXPLAIN plan, rows examined and '
+                                   'handler/temp-table counters of every statement, '
+                                   'saved in isanteplus.etl_statement_profile')
+    report_group.add_argument('--profile-json', type=Path,
+                              help='Write the --profile results, with plans, to this JSON file')
+    report_group.add_argument('--verbose', '-v', action='store_true',
+                              help='Print each statement as it completes')
+
+    return parser.parse_args()
+
+
+def create_pool(args, pool_size=1):
+    """Create the connection pool shared by the whole run."""
+    return mysql.connector.pooling.MySQLConnectionPool(
+        pool_name='isanteplus_etl',
+        pool_size=pool_size,
+        host=args.host,
+        port=args.port,
+        user=args.user,
+        password=args.password,
+        # Match the mysql client: the scripts manage their own transactions
+        autocommit=True,
+    )
+
+
+def execute_statement(cursor, statement: Statement):
+    """Execute one statement and return (seconds, rows affected)."""
+    start = time.perf_counter()
+    cursor.execute(statement.sql)
+    if cursor.with_rows:
+        cursor.fetchall()
+    seconds = time.perf_counter() - start
+    rows = cursor.rowcount if cursor.rowcount >= 0 else None
+    return seconds, rows
+
+
+def run_statements(conn, name, statements: List[Statement],
+                   results: List[StatementResult], verbose=False, profiler=None,
+                   chunk_seconds=0, on_commit=None):
+    """Execute statements in order on conn, appending to results.
+
+    on_commit is called when a chunked statement has committed the
+    statements that precede it, before its first chunk (etl/chunked.py).
+    """
+    cursor = conn.cursor()
+    chunker = ChunkedExecutor(conn, chunk_seconds, on_commit=on_commit)
+    execute = functools.partial(chunker.execute, execute_statement=execute_statement)
+    try:
+        for statement in statements:
+            try:
+                if profiler is not None:
+                    seconds, rows = profiler.execute(cursor, name, statement, execute)
+                else:
+                    seconds, rows = execute(cursor, statement)
+            except MySQLError as e:
+                raise RuntimeError(
+                    f'{name}:{statement.line}: {statement.summary}\n{e}'
+                ) from e
+            results.append(StatementResult(
+                name, statement.line, statement.summary, seconds, rows,
+            ))
+            if verbose:
+                print(f'    {name}:{statement.line} {seconds:8.2f}s '
+                      f'{rows if rows is not None else "-":>8} {statement.summary}',
+                      file=sys.stderr)
+    finally:
+        cursor.close()
+
+
+def run_file(conn, sql_path: Path, results: List[StatementResult], verbose=False,
+             profiler=None, chunk_seconds=0):
+    """Execute every statement of a script, appending to results."""
+    statements = split_statements(sql_path.read_text(encoding='utf-8'))
+    run_statements(conn, sql_path.name, statements, results, verbose, profiler,
+                   chunk_seconds)
+
+
+def format_table(headers, rows):
+    """Format rows of strings as an ASCII box table."""
+    all_rows = [headers] + rows
+    col_widths = [
+        max(len(row[i]) for row in all_rows)
+        for i in range(len(headers))
+    ]
+
+    def rule():
+        return '+' + '+'.join('-' * (w + 2) for w in col_widths) + '+'
+
+    def data_row(row):
+        cells = ' | '.join(val.ljust(w) for val, w in zip(row, col_widths))
+        return f'| {cells} |'
+
+    lines = [rule(), data_row(headers), rule()]
+    for row in rows:
+        lines.append(data_row(row))
+    lines.append(rule())
+    return '\n'.join(lines)
+
+
+def print_report(results: List[StatementResult], top=20):
+    """Print per-file totals and the slowest statements."""
+    by_file = {}
+    for r in results:
+        count, seconds, rows = by_file.get(r.file, (0, 0.0, 0))
+        by_file[r.file] = (count + 1, seconds + r.seconds, rows + (r.rows or 0))
+
+    total = sum(r.seconds for r in results)
+    print('\n=== Time per file ===')
+    print(format_table(
+        ['file', 'statements', 'seconds', '% of run', 'rows'],
+        [[name, str(count), f'{seconds:.2f}',
+          f'{100 * seconds / total:.1f}' if total else '0.0', str(rows)]
+         for name, (count, seconds, rows) in by_file.items()],
+    ))
+
+    if top > 0 and results:
+        slowest = sorted(results, key=lambda r: r.seconds, reverse=True)[:top]
+        print(f'\n=== {len(slowest)} slowest statements ===')
+        print(format_table(
+            ['location', 'seconds', 'rows', 'statement'],
+            [[f'{r.file}:{r.line}', f'{r.seconds:.2f}',
+              str(r.rows) if r.rows is not None else '-', r.summary]
+             for r in slowest],
+        ))
+    print(f'\nTotal: {len(results)} statements in {total:.2f}s')
+
+
+def print_profile(profiler: Profiler, top=20):
+    """Print the most expensive statements with their counters."""
+    rows = profiler.table_rows(top)
+    if not rows:
+        return
+    print(f'\n=== Profile: {len(rows)} most expensive statements ===')
+    print(format_table(PROFILE_HEADERS, rows))
+    print('rows examined: performance_schema; handler reads: sum of Handler_read_*; '
+          'tmp/disk: Created_tmp_tables/Created_tmp_disk_tables; '
+          'est. cost: EXPLAIN query_cost')
+
+
+def write_json_report(path: Path, results: List[StatementResult]):
+    """Write every statement timing to a JSON file."""
+    path.write_text(
+        json.dumps([asdict(r) for r in results], indent=2), encoding='utf-8'
+    )
+
+
+def preflight(args):
+    """Verify prerequisites before running any SQL."""
+    if not HAS_MYSQL:
+        print('Error: mysql-connector-python is required.', file=sys.stderr)
+        print('Install with: pip install mysql-connector-python', file=sys.stderr)
+        sys.exit(1)
+
+    missing = [f'  {args.sql_dir / name}' for name in args.files
+               if not (args.sql_dir / name).exists()]
+    if missing:
+        print('Error: missing SQL files:', file=sys.stderr)
+        print('\n'.join(missing), file=sys.stderr)
+        sys.exit(1)
+
+
+def main():
+    args = parse_args()
+
+    if args.show_dag:
+        print(f'Section dependencies of {REPORTS_DML}:')
+        print(format_dependencies(REPORTS_DML_SECTIONS))
+        return
+
+    if args.user is None:
+        args.user = input('MySQL username: ')
+    if args.password is None:
+        args.password = getpass.getpass('MySQL password: ')
+
+    preflight(args)
+
+    results: List[StatementResult] = []
+    failed = False
+    workers = max(args.parallel, 1)
+    pool = create_pool(args, pool_size=workers + 1 if workers > 1 else 1)
+    conn = pool.get_connection()
+    session_init = [FULL_REBUILD] if args.full_rebuild else []
+    if (REPORTS_DML in args.files and ARV_DML in args.files
+            and args.files.index(REPORTS_DML) < args.files.index(ARV_DML)):
+        session_init.append(SHARE_SNAPSHOT)
+    profiler = Profiler() if args.profile or args.profile_json else None
+    journal = None
+    try:
+        run_statements(conn, 'session', session_init, [])
+        journal = RunJournal.resume(conn) if args.resume else None
+        if journal is None:
+            if args.resume:
+                print('No unfinished run to resume, starting a new run',
+                      file=sys.stderr)
+            journal = RunJournal.start()
+        else:
+            print(f'Resuming run {journal.run_id}', file=sys.stderr)
+
+        total_steps = len(args.files)
+        for step_num, name in enumerate(args.files, start=1):
+            sql_path = args.sql_dir / name
+            digest = statement_hash(split_statements(sql_path.read_text(encoding='utf-8')))
+            if journal.is_done(name, 'file', digest):
+                print(f'[{step_num}/{total_steps}] Skipping {name} '
+                      f'(done in run {journal.run_id})', file=sys.stderr)
+                continue
+            print(f'[{step_num}/{total_steps}] Running {name} ... ',
+                  end='\n' if args.verbose else '', file=sys.stderr, flush=True)
+            start = time.perf_counter()
+            try:
+                if name == REPORTS_DML:
+                    print('', file=sys.stderr)
+                    run_sections(pool, conn, sql_path, workers, results,
+                                 functools.partial(run_statements, profiler=profiler,
+                                                   chunk_seconds=args.chunk_seconds),
+                                 journal, args.verbose, session_init)
+                else:
+                    run_file(conn, sql_path, results, args.verbose, profiler,
+                             args.chunk_seconds)
+                journal.record(conn, name, 'file', digest)
+            except (RuntimeError, MySQLError) as e:
+                print('failed', file=sys.stderr)
+                print(f'Error: {e}', file=sys.stderr)
+                print(f'Resume with --resume (run {journal.run_id})', file=sys.stderr)
+                failed = True
+                break
+            print(f'done ({time.perf_counter() - start:.1f}s)', file=sys.stderr)
+        if not failed:
+            journal.complete(conn)
+    finally:
+        try:
+            if profiler is not None and journal is not None:
+                profiler.write_table(conn, journal.run_id)
+        except MySQLError as e:
+            print(f'Warning: profile not saved: {e}', file=sys.stderr)
+        finally:
+            conn.close()
+
+    print_report(results, args.top)
+    if args.report_json:
+        write_json_report(args.report_json, results)
+    if profiler is not None:
+        print_profile(profiler, args.top)
+        if args.profile_json:
+            profiler.write_json(args.profile_json)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Run the sections of isanteplusreportsdmlscript.sql, concurrently if asked.
+
+The PRÉAMBULE and SNAPSHOT blocks run once on the coordinating connection;
+the _tmp_* snapshots are ordinary tables, so every worker connection can
+read them.  Each worker replays the session block (USE and the PHASE n
+variables) on its own connection, then takes sections as soon as the
+sections they depend on (etl/sections.py) have committed.  With a single
+worker the sections run in file order on the coordinating connection.
+
+Each snapshot and section is recorded in the run journal (etl/journal.py)
+once done, and skipped when resuming a run that already completed it.  A
+section whose chunked statements committed part of its work is recorded as
+partial first, and run again from the start on resume.
+"""
+
+import sys
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import List
+
+from etl.journal import RunJournal, run_setup, setup_units, statement_hash
+from etl.sections import REPORTS_DML_SECTIONS, build_dependencies, split_blocks
+from etl.sqlsplit import Statement
+
+
+def run_sections(pool, coordinator, sql_path: Path, workers,
+                 results: List, run_statements, journal: RunJournal,
+                 verbose=False, session_init: List[Statement] = ()):
+    """Execute the reports DML script with up to `workers` sections at once.
+
+    coordinator is the orchestrator's own connection; workers draw theirs
+    from pool.  run_statements(conn, name, statements, results, verbose) is the serial
+    runner of the orchestrator; it raises RuntimeError on a failed statement.
+    session_init is run on each worker connection before the session block,
+    as the orchestrator already did on the coordinator.
+    """
+    blocks = split_blocks(sql_path.read_text(encoding='utf-8'))
+    name = sql_path.name
+    deps = build_dependencies(REPORTS_DML_SECTIONS)
+
+    unknown = set(blocks.sections) - set(deps)
+    if unknown:
+        raise RuntimeError(
+            f'{name}: sections {sorted(unknown)} are missing from etl/sections.py'
+        )
+
+    lock = threading.Lock()
+    local = threading.local()
+    connections = []
+    digests = {n: statement_hash(s) for n, s in blocks.sections.items()}
+
+    def worker_connection():
+        if workers == 1:
+            return coordinator
+        conn = getattr(local, 'conn', None)
+        if conn is None:
+            conn = pool.get_connection()
+            with lock:
+                connections.append(conn)
+            local.conn = conn
+            run_statements(conn, name, list(session_init) + blocks.session,
+                           [], False)
+        return conn
+
+    def run_section(number):
+        section_results = []
+        conn = worker_connection()
+        step = f'section {number}'
+        if journal.is_partial(name, step):
+            print(f'    section {number} restarted (partially applied in run '
+                  f'{journal.run_id})', file=sys.stderr)
+        else:
+            print(f'    section {number} started', file=sys.stderr)
+        run_statements(conn, name, blocks.sections[number], section_results, verbose,
+                       on_commit=lambda: journal.record_partial(
+                           conn, name, step, digests[number]))
+        journal.record(conn, name, step, digests[number])
+        with lock:
+            results.extend(section_results)
+        return number
+
+    try:
+        run_statements(coordinator, name, blocks.session, results, verbose)
+        run_setup(coordinator, name, setup_units(blocks.setup), journal,
+                  results, run_statements, verbose)
+
+        present = set(blocks.sections)
+        done = {n for n in present
+                if journal.is_done(name, f'section {n}', digests[n])}
+        for number in sorted(done):
+            print(f'    section {number} skipped (done in run {journal.run_id})',
+                  file=sys.stderr)
+        pending = sorted(present - done)
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while (pending and error is None) or running:
+                if error is None:
+                    ready = [n for n in pending if deps[n] & present <= done]
+                    for number in ready[:workers - len(running)]:
+                        pending.remove(number)
+                        running[executor.submit(run_section, number)] = number
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    number = running.pop(future)
+                    try:
+                        future.result()
+                    except RuntimeError as e:
+                        error = error or e
+                        continue
+                    done.add(number)
+                    print(f'    section {number} done', file=sys.stderr)
+        if error is not None:
+            raise error
+
+        run_statements(coordinator, name, blocks.cleanup, results, verbose)
+    finally:
+        for conn in connections:
+            conn.close()
@@ -0,0 +1,242 @@
+"""
+Per-statement profiling for the orchestrator (python3 -m etl --profile).
+
+For every statement the profiler records, on top of the wall-clock time:
+
+- the EXPLAIN FORMAT=JSON plan and its estimated query cost, taken just
+  before the statement runs (SELECT, INSERT, UPDATE, DELETE, REPLACE);
+- the SHOW SESSION STATUS deltas of the Handler_read_*, Created_tmp_*,
+  Select_* and Sort_merge_passes counters, less the cost of reading the
+  status itself (measured once at start);
+- the rows examined, from performance_schema.events_statements_history
+  when the server records it.
+
+The statements are ranked by cost: rows examined, then the estimated
+query cost, with the time only breaking ties.  They are printed as a table,
+saved in isanteplus.etl_statement_profile on every profiled run and can be
+written with their plans to a JSON report, to find the hot
+UPDATE ... INNER JOIN _tmp_obs statements.
+"""
+
+import json
+import re
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+try:
+    from mysql.connector import Error as MySQLError
+except ImportError:
+    MySQLError = Exception
+
+from etl.sqlsplit import Statement
+
+_STATUS_SQL = (
+    "SHOW SESSION STATUS WHERE Variable_name LIKE 'Handler\\_read\\_%' "
+    "OR Variable_name LIKE 'Created\\_tmp\\_%' "
+    "OR Variable_name IN ('Select_full_join', 'Select_range_check', "
+    "'Select_scan', 'Sort_merge_passes')"
+)
+
+# Statement before the SHOW SESSION STATUS that follows it
+_ROWS_EXAMINED_SQL = (
+    'SELECT ROWS_EXAMINED FROM performance_schema.events_statements_history '
+    'WHERE THREAD_ID = (SELECT THREAD_ID FROM performance_schema.threads '
+    '                   WHERE PROCESSLIST_ID = CONNECTION_ID()) '
+    'AND NESTING_EVENT_LEVEL = 0 '
+    'ORDER BY EVENT_ID DESC LIMIT 1 OFFSET 1'
+)
+
+PROFILE_TABLE = 'isanteplus.etl_statement_profile'
+
+PROFILE_DDL = f"""CREATE TABLE IF NOT EXISTS {PROFILE_TABLE} (
+  run_id VARCHAR(32) NOT NULL,
+  cost_rank INT(11) NOT NULL,
+  file VARCHAR(128) NOT NULL,
+  line INT(11) NOT NULL,
+  summary VARCHAR(255),
+  seconds DOUBLE NOT NULL,
+  rows_examined BIGINT,
+  rows_affected BIGINT,
+  handler_reads BIGINT,
+  tmp_tables INT(11),
+  tmp_disk_tables INT(11),
+  query_cost DOUBLE,
+  plan LONGTEXT,
+  profiled_at DATETIME NOT NULL,
+  CONSTRAINT pk_etl_statement_profile PRIMARY KEY (run_id, cost_rank),
+  INDEX idx_etl_statement_profile_location (file, line)
+) ENGINE = InnoDB DEFAULT CHARSET = utf8"""
+
+_EXPLAINABLE_RE = re.compile(
+    r'^\(?\s*(SELECT|INSERT|UPDATE|DELETE|REPLACE|WITH)\b', re.IGNORECASE
+)
+
+
+@dataclass
+class StatementProfile:
+    """Measurements of one executed statement."""
+    file: str
+    line: int
+    summary: str
+    seconds: float
+    rows_affected: Optional[int]
+    rows_examined: Optional[int]
+    counters: Dict[str, int] = field(default_factory=dict)
+    query_cost: Optional[float] = None
+    plan: Optional[dict] = None
+
+    @property
+    def handler_reads(self):
+        return sum(v for k, v in self.counters.items() if k.startswith('Handler_read'))
+
+    @property
+    def tmp_tables(self):
+        return self.counters.get('Created_tmp_tables', 0)
+
+    @property
+    def tmp_disk_tables(self):
+        return self.counters.get('Created_tmp_disk_tables', 0)
+
+
+class Profiler:
+    """Collects a StatementProfile for each statement it executes."""
+
+    def __init__(self):
+        self.profiles: List[StatementProfile] = []
+        self._lock = threading.Lock()
+        self._overhead = None
+        self._rows_examined = True
+
+    def _status(self, cursor):
+        cursor.execute(_STATUS_SQL)
+        return {name: int(value) for name, value in cursor.fetchall()}
+
+    def _explain(self, cursor, statement: Statement):
+        if not _EXPLAINABLE_RE.match(statement.sql):
+            return None, None
+        try:
+            cursor.execute('EXPLAIN FORMAT=JSON ' + statement.sql)
+            rows = cursor.fetchall()
+        except MySQLError:
+            return None, None
+        plan = json.loads(rows[0][0]) if rows else None
+        cost = (plan or {}).get('query_block', {}).get('cost_info', {}).get('query_cost')
+        return plan, float(cost) if cost is not None else None
+
+    def _fetch_rows_examined(self, cursor):
+        if not self._rows_examined:
+            return None
+        try:
+            cursor.execute(_ROWS_EXAMINED_SQL)
+            row = cursor.fetchone()
+        except MySQLError:
+            row = None
+        if row is None:
+            # performance_schema or its history consumer is disabled
+            self._rows_examined = False
+            return None
+        return int(row[0])
+
+    def _calibrate(self, cursor):
+        with self._lock:
+            if self._overhead is None:
+                before = self._status(cursor)
+                after = self._status(cursor)
+                self._overhead = {k: after[k] - before.get(k, 0) for k in after}
+        return self._overhead
+
+    def execute(self, cursor, name, statement: Statement, execute_statement):
+        """Run statement through execute_statement, recording its profile.
+
+        Returns (seconds, rows affected) like execute_statement.
+        """
+        overhead = self._calibrate(cursor)
+        plan, cost = self._explain(cursor, statement)
+        before = self._status(cursor)
+        seconds, rows = execute_statement(cursor, statement)
+        after = self._status(cursor)
+        # A chunked statement (etl/chunked.py) ends with the range reset
+        rows_examined = None if statement.chunk else self._fetch_rows_examined(cursor)
+
+        counters = {}
+        for key, value in after.items():
+            delta = value - before.get(key, 0) - overhead.get(key, 0)
+            if delta > 0:
+                counters[key] = delta
+        profile = StatementProfile(
+            name, statement.line, statement.summary, seconds, rows,
+            rows_examined, counters, cost, plan,
+        )
+        with self._lock:
+            self.profiles.append(profile)
+        return seconds, rows
+
+    def ranked(self) -> List[StatementProfile]:
+        """Profiles, most expensive first.
+
+        Ranked by rows examined, then by estimated query cost; the time only
+        breaks ties (statements without either measure come last).
+        """
+        return sorted(
+            self.profiles,
+            key=lambda p: (p.rows_examined or 0, p.query_cost or 0.0, p.seconds),
+            reverse=True,
+        )
+
+    def table_rows(self, top=20):
+        """Rows for format_table, most expensive first."""
+        def opt(value):
+            return '-' if value is None else str(value)
+
+        return [
+            [f'{p.file}:{p.line}', f'{p.seconds:.2f}', opt(p.rows_examined),
+             opt(p.rows_affected), str(p.handler_reads),
+             f'{p.tmp_tables}/{p.tmp_disk_tables}',
+             f'{p.query_cost:.1f}' if p.query_cost is not None else '-',
+             p.summary]
+            for p in self.ranked()[:top]
+        ]
+
+    def write_json(self, path: Path):
+        """Write every profile, with plans, most expensive first."""
+        report = {
+            'generated_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'statements': [
+                dict(asdict(p), handler_reads=p.handler_reads)
+                for p in self.ranked()
+            ],
+        }
+        path.write_text(json.dumps(report, indent=2), encoding='utf-8')
+
+    def write_table(self, conn, run_id):
+        """Save every profile of run run_id in the profile table, ranked."""
+        rows = [
+            (run_id, rank, p.file, p.line, p.summary[:255], p.seconds,
+             p.rows_examined, p.rows_affected, p.handler_reads, p.tmp_tables,
+             p.tmp_disk_tables, p.query_cost,
+             json.dumps(p.plan) if p.plan is not None else None)
+            for rank, p in enumerate(self.ranked(), start=1)
+        ]
+        if not rows:
+            return
+        cursor = conn.cursor()
+        try:
+            cursor.execute(PROFILE_DDL)
+            cursor.execute(f'DELETE FROM {PROFILE_TABLE} WHERE run_id = %s', (run_id,))
+            cursor.executemany(
+                f'INSERT INTO {PROFILE_TABLE} '
+                '(run_id, cost_rank, file, line, summary, seconds, rows_examined, '
+                'rows_affected, handler_reads, tmp_tables, tmp_disk_tables, '
+                'query_cost, plan, profiled_at) '
+                'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())',
+                rows,
+            )
+        finally:
+            cursor.close()
+
+
+PROFILE_HEADERS = ['location', 'seconds', 'rows examined', 'rows affected',
+                   'handler reads', 'tmp/disk', 'est. cost', 'statement']
@@ -0,0 +1,196 @@
+"""
+Section dependency graph for isanteplusreportsdmlscript.sql.
+
+The script is divided by its own banner comments (-- PHASE 0, -- SNAPSHOT,
+-- SECTION N, -- NETTOYAGE).  Each numbered section declares the isanteplus
+tables it reads and writes; the _tmp_* snapshots are read-only once built
+and are not listed.  A section depends on every earlier section it
+conflicts with (write/read, read/write or write/write on a table), so any
+schedule that respects the graph gives the same result as the serial run.
+
+A table with a FOREIGN KEY to another isanteplus table also reads it: the
+foreign keys of sql_files/isanteplusreportsddlscript.sql are added to the
+reads of the sections that write the referencing table.
+"""
+
+import re
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, FrozenSet, List, Set
+
+from etl.sqlsplit import Statement, split_statements
+
+
+@dataclass(frozen=True)
+class Section:
+    """One numbered section of the reports DML script."""
+    number: int
+    title: str
+    writes: FrozenSet[str]
+    reads: FrozenSet[str] = frozenset()
+
+
+def _section(number, title, writes, reads=()):
+    return Section(number, title, frozenset(writes), frozenset(reads))
+
+
+# Keep in sync with the SECTION blocks of sql_files/isanteplusreportsdmlscript.sql
+REPORTS_DML_SECTIONS = [
+    _section(1, 'patient', ['patient', 'location'], ['arv_drugs']),
+    _section(2, 'patient_visit', ['patient_visit', 'patient_latest_visit']),
+    _section(3, 'patient_dispensing, patient_on_arv',
+             ['patient_dispensing', 'patient_on_arv', 'patient_latest_dispensing'],
+             ['arv_drugs']),
+    _section(4, 'patient_prescription', ['patient_prescription'], ['arv_drugs']),
+    _section(5, 'health_qual_patient_visit', ['health_qual_patient_visit']),
+    _section(6, 'patient_laboratory',
+             ['patient_laboratory', 'patient_latest_viral_load']),
+    _section(7, 'patient_tb_diagnosis', ['patient_tb_diagnosis'], ['patient']),
+    _section(8, 'patient_nutrition', ['patient_nutrition'], ['patient']),
+    _section(9, 'patient_ob_gyn', ['patient_ob_gyn'], ['patient']),
+    _section(10, 'patient_imagerie, discontinuation_reason, stopping_reason',
+             ['patient_imagerie', 'discontinuation_reason', 'stopping_reason'],
+             ['patient']),
+    _section(11, 'patient_pregnancy', ['patient_pregnancy']),
+    _section(12, 'alert', ['alert'],
+             ['patient', 'patient_dispensing', 'patient_laboratory',
+              'patient_on_arv', 'patient_pregnancy', 'discontinuation_reason',
+              'patient_latest_dispensing', 'patient_latest_viral_load']),
+    _section(13, 'visit_type, delivery, virological_tests, pediatric, vaccination',
+             ['visit_type', 'patient_delivery', 'virological_tests',
+              'pediatric_hiv_visit', 'patient_menstruation', 'vih_risk_factor',
+              'vaccination', 'temp_vaccination'],
+             ['patient']),
+    _section(14, 'serological_tests, patient_pcr, patient_malaria',
+             ['serological_tests', 'patient_pcr', 'patient_malaria'],
+             ['patient', 'patient_laboratory', 'virological_tests']),
+    _section(15, 'patient_on_art, key_populations, family_planning, regimen lines',
+             ['patient_on_art', 'key_populations', 'family_planning',
+              'patient_dispensing', 'patient_laboratory'],
+             ['patient_on_arv', 'patient_latest_visit']),
+]
+
+
+DDL_PATH = Path(__file__).resolve().parent.parent / 'sql_files' / 'isanteplusreportsddlscript.sql'
+
+_COMMENT_RE = re.compile(r'/\*.*?\*/|--[^\n]*', re.DOTALL)
+_CREATE_TABLE_RE = re.compile(
+    r'CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?'
+    r'(?:`?isanteplus`?\.)?`?([\w.]+?)`?\s*\(', re.IGNORECASE
+)
+_REFERENCES_RE = re.compile(
+    r'REFERENCES\s+(?:(`?\w+`?)\.)?`?(\w+)`?', re.IGNORECASE
+)
+
+
+def ddl_foreign_keys(text) -> Dict[str, Set[str]]:
+    """Map each isanteplus table to the isanteplus tables it references."""
+    text = _COMMENT_RE.sub('', text)
+    creates = list(_CREATE_TABLE_RE.finditer(text))
+    bounds = [m.start() for m in creates[1:]] + [len(text)]
+    foreign_keys = {}
+    for create, end in zip(creates, bounds):
+        table = create.group(1)
+        for ref in _REFERENCES_RE.finditer(text, create.end(), end):
+            schema = (ref.group(1) or 'isanteplus').strip('`')
+            if schema == 'isanteplus' and ref.group(2) != table:
+                foreign_keys.setdefault(table, set()).add(ref.group(2))
+    return foreign_keys
+
+
+def with_foreign_keys(sections: List[Section],
+                      foreign_keys: Dict[str, Set[str]]) -> List[Section]:
+    """Add the tables referenced by the tables a section writes to its reads."""
+    return [
+        Section(s.number, s.title, s.writes, s.reads | frozenset(
+            ref for table in s.writes for ref in foreign_keys.get(table, ())
+        ))
+        for s in sections
+    ]
+
+
+if DDL_PATH.exists():
+    REPORTS_DML_SECTIONS = with_foreign_keys(
+        REPORTS_DML_SECTIONS, ddl_foreign_keys(DDL_PATH.read_text(encoding='utf-8'))
+    )
+
+
+def build_dependencies(sections: List[Section]) -> Dict[int, Set[int]]:
+    """Map each section number to the earlier sections it must wait for."""
+    deps = {}
+    for i, later in enumerate(sections):
+        deps[later.number] = {
+            earlier.number for earlier in sections[:i]
+            if earlier.writes & (later.reads | later.writes)
+            or earlier.reads & later.writes
+        }
+    return deps
+
+
+def dependency_levels(sections: List[Section]) -> List[List[int]]:
+    """Group sections into waves that can run concurrently."""
+    deps = build_dependencies(sections)
+    level = {}
+    for section in sections:
+        level[section.number] = max(
+            (level[d] + 1 for d in deps[section.number]), default=0
+        )
+    waves = [[] for _ in range(max(level.values(), default=-1) + 1)]
+    for section in sections:
+        waves[level[section.number]].append(section.number)
+    return waves
+
+
+def format_dependencies(sections: List[Section]) -> str:
+    """Describe the graph and its waves for --show-dag."""
+    deps = build_dependencies(sections)
+    lines = []
+    for section in sections:
+        after = ', '.join(str(d) for d in sorted(deps[section.number])) or '-'
+        lines.append(f'  {section.number:>2}  after: {after:<16} {section.title}')
+    lines.append('')
+    for n, wave in enumerate(dependency_levels(sections), start=1):
+        lines.append(f'  wave {n}: sections {", ".join(str(s) for s in wave)}')
+    return '\n'.join(lines)
+
+
+# Banner comments that open each block of the script
+_BLOCK_RE = re.compile(
+    r'^-- (PRÉAMBULE|PHASE \d+|SNAPSHOT|SECTION (\d+)|NETTOYAGE)\b', re.MULTILINE
+)
+
+
+@dataclass
+class ScriptBlocks:
+    """Statements of the reports DML script, grouped by banner block.
+
+    session: statements every connection needs (USE, PHASE n variables)
+    setup: statements run once before the sections (PRÉAMBULE, SNAPSHOT)
+    sections: statements of each numbered section
+    cleanup: statements run once after every section (NETTOYAGE)
+    """
+    session: List[Statement] = field(default_factory=list)
+    setup: List[Statement] = field(default_factory=list)
+    sections: Dict[int, List[Statement]] = field(default_factory=dict)
+    cleanup: List[Statement] = field(default_factory=list)
+
+
+def split_blocks(text) -> ScriptBlocks:
+    """Split the reports DML script on its banner comments."""
+    blocks = ScriptBlocks()
+    matches = list(_BLOCK_RE.finditer(text))
+    bounds = [0] + [m.start() for m in matches] + [len(text)]
+    labels = [None] + matches
+
+    for label, start, end in zip(labels, bounds, bounds[1:]):
+        first_line = text.count('\n', 0, start) + 1
+        statements = split_statements(text[start:end], first_line)
+        if label is None or label.group(1).startswith('PHASE'):
+            blocks.session.extend(statements)
+        elif label.group(2) is not None:
+            blocks.sections.setdefault(int(label.group(2)), []).extend(statements)
+        elif label.group(1) == 'NETTOYAGE':
+            blocks.cleanup.extend(statements)
+        else:
+            blocks.setup.extend(statements)
+    return blocks
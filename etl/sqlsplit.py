@@ -0,0 +1,134 @@
+"""
+Split a mysql client script into individual statements.
+
+Follows the mysql client rules the sql_files/ scripts rely on: the
+DELIMITER command (e.g. DELIMITER $$ around CREATE PROCEDURE, as produced
+by wrap_in_procedure in test/run_patient_status_arv_comparison.py), quoted
+strings and identifiers, and --, # and /* */ comments.  Plain comments are
+dropped; /*! */ version comments and /*+ */ optimizer hints are kept since
+the server interprets them.
+
+A `-- etl:chunk <table> <column>` comment just before a statement is read
+as a directive for the orchestrator (see etl/chunked.py); the mysql client
+ignores it like any other comment.
+"""
+
+import re
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+# The client only recognises DELIMITER on a line of its own, before any
+# statement text has been buffered.
+_DELIMITER_RE = re.compile(r'^\s*DELIMITER\s+(\S+)\s*$', re.IGNORECASE)
+
+_CHUNK_RE = re.compile(r'^--\s*etl:chunk\s+(\S+)\s+(\S+)\s*$')
+
+
+@dataclass
+class Statement:
+    """One statement of a script, without its trailing delimiter."""
+    sql: str
+    line: int
+    delimiter: str = ';'
+    # (table, key column) of an `-- etl:chunk` directive
+    chunk: Optional[Tuple[str, str]] = None
+
+    @property
+    def summary(self) -> str:
+        """First line of the statement, collapsed for reports."""
+        first = ' '.join(self.sql.split('\n', 1)[0].split())
+        return first if len(first) <= 80 else first[:77] + '...'
+
+
+def split_statements(text, first_line=1):
+    """Return the list of Statements in a script, in order.
+
+    first_line is the line number of text within its file, so that
+    statements taken from part of a script keep file-relative locations.
+    """
+    statements = []
+    buf = []
+    start_line = None
+    delimiter = ';'
+    quote = None
+    block_comment = None   # None, or True if the comment is kept
+    chunk = None
+
+    def emit():
+        nonlocal buf, start_line, chunk
+        sql = ''.join(buf).strip()
+        if start_line is not None and sql:
+            statements.append(Statement(sql, start_line, delimiter, chunk))
+            chunk = None
+        buf = []
+        start_line = None
+
+    for lineno, line in enumerate(text.splitlines(keepends=True), start=first_line):
+        if quote is None and block_comment is None and start_line is None:
+            m = _DELIMITER_RE.match(line)
+            if m:
+                buf = []
+                delimiter = m.group(1)
+                continue
+
+        i, n = 0, len(line)
+        while i < n:
+            ch = line[i]
+
+            if block_comment is not None:
+                end = line.find('*/', i)
+                stop = n if end < 0 else end + 2
+                if block_comment:
+                    buf.append(line[i:stop])
+                if end >= 0:
+                    if not block_comment:
+                        buf.append(' ')
+                    block_comment = None
+                i = stop
+                continue
+
+            if quote is not None:
+                buf.append(ch)
+                if ch == '\\' and quote != '`' and i + 1 < n:
+                    buf.append(line[i + 1])
+                    i += 2
+                    continue
+                if ch == quote:
+                    quote = None
+                i += 1
+                continue
+
+            if line.startswith('/*', i):
+                kept = line.startswith('/*!', i) or line.startswith('/*+', i)
+                block_comment = kept
+                if kept:
+                    if start_line is None:
+                        start_line = lineno
+                    buf.append('/*')
+                i += 2
+                continue
+
+            if ch == '#' or (line.startswith('--', i)
+                             and (i + 2 >= n or line[i + 2].isspace())):
+                m = _CHUNK_RE.match(line[i:].rstrip())
+                if m and start_line is None:
+                    chunk = (m.group(1), m.group(2))
+                if line.endswith('\n'):
+                    buf.append('\n')
+                break
+
+            if line.startswith(delimiter, i):
+                emit()
+                i += len(delimiter)
+                continue
+
+            if ch in '\'"`':
+                quote = ch
+            if start_line is None and not ch.isspace():
+                start_line = lineno
+            buf.append(ch)
+            i += 1
+
+    # The client runs a trailing statement even without a delimiter.
+    emit()
+    return statements
@@ -3,10 +3,17 @@ user=$1;
 pass=$2;
 host=$3;
 port=$4;
+cd "$(dirname "$0")"
+# Prefer the Python orchestrator (one connection, per-statement timings)
+# when mysql-connector-python is available.
+if python3 -c 'import mysql.connector' 2>/dev/null; then
+	exec python3 -m etl -u "${user}" -p "${pass}" -H "${host}" -P "${port}"
+fi
 mysql --protocol=tcp -h ${host} -P ${port} -u ${user} -p${pass} < ./sql_files/isanteplusreportsddlscript.sql
 mysql --protocol=tcp -h ${host} -P ${port} -u ${user} -p${pass} < ./sql_files/isanteplusreportsdmlscript.sql
 mysql --protocol=tcp -h ${host} -P ${port} -u ${user} -p${pass} < ./sql_files/drug_lookup_isanteplus.sql
 mysql --protocol=tcp -h ${host} -P ${port} -u ${user} -p${pass} < ./sql_files/run_isante_patient_status.sql
+mysql --protocol=tcp -h ${host} -P ${port} -u ${user} -p${pass} < ./sql_files/event_scheduler.sql
 mysql --protocol=tcp -h ${host} -P ${port} -u ${user} -p${pass} < ./sql_files/insertion_obs_by_day.sql
 mysql --protocol=tcp -h ${host} -P ${port} -u ${user} -p${pass} < ./sql_files/patient_status_arv_dml.sql
-mysql --protocol=tcp -h ${host} -P ${port} -u ${user} -p${pass} < ./sql_files/indicators_report.sql
\ No newline at end of file
+mysql --protocol=tcp -h ${host} -P ${port} -u ${user} -p${pass} < ./sql_files/indicators_report.sql
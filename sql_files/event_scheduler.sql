@@ -0,0 +1,104 @@
+/*Planification des evenements lances toutes les 10 minutes
+(patient_status_arv_day_event et report_indicators_event).
+Chaque evenement appelle sa procedure a travers event_run_begin et
+event_run_end, qui :
+ - prennent un verrou nomme (GET_LOCK) : si l'execution precedente n'est
+   pas terminee, l'appel est saute (ligne 'skipped' dans event_run_history)
+   au lieu de s'empiler sur elle ;
+ - enregistrent chaque execution et sa duree dans event_run_history ;
+ - allongent l'intervalle (le double, jusqu'a max_interval_minutes) quand
+   une execution depasse budget_seconds, et le ramenent a
+   base_interval_minutes des qu'une execution tient dans le budget.*/
+use isanteplus;
+
+CREATE TABLE IF NOT EXISTS event_schedule (
+	procedure_name VARCHAR(64) NOT NULL,
+	base_interval_minutes INT(11) NOT NULL,
+	interval_minutes INT(11) NOT NULL,
+	max_interval_minutes INT(11) NOT NULL,
+	budget_seconds INT(11) NOT NULL,
+	next_run_date DATETIME,
+	CONSTRAINT pk_event_schedule PRIMARY KEY (procedure_name)
+) ENGINE=INNODB DEFAULT CHARSET=utf8;
+
+INSERT IGNORE INTO event_schedule (procedure_name, base_interval_minutes,
+	interval_minutes, max_interval_minutes, budget_seconds)
+VALUES ('call_all_procedure_day', 10, 10, 120, 600),
+	   ('report_indicators_procedure', 10, 10, 120, 600);
+
+/*status : running, done, failed ou skipped (execution precedente en cours)*/
+CREATE TABLE IF NOT EXISTS event_run_history (
+	event_run_id INT(11) NOT NULL AUTO_INCREMENT,
+	procedure_name VARCHAR(64) NOT NULL,
+	start_date DATETIME NOT NULL,
+	end_date DATETIME,
+	duration_seconds INT(11),
+	status VARCHAR(10) NOT NULL,
+	CONSTRAINT pk_event_run_history PRIMARY KEY (event_run_id),
+	INDEX idx_event_run_history_start (start_date)
+) ENGINE=INNODB DEFAULT CHARSET=utf8;
+
+	DELIMITER $$
+	DROP PROCEDURE IF EXISTS event_run_begin$$
+	CREATE PROCEDURE event_run_begin(IN p_procedure VARCHAR(64), OUT p_run_id INT)
+	BEGIN
+		SET p_run_id = NULL;
+		/*Intervalle allonge apres une execution trop longue : pas encore l'heure*/
+		IF EXISTS (SELECT 1 FROM event_schedule s
+				   WHERE s.procedure_name = p_procedure
+				   AND s.next_run_date > now()) THEN
+			SET p_run_id = NULL;
+		ELSEIF GET_LOCK(CONCAT('isanteplus.', p_procedure), 0) = 1 THEN
+			INSERT INTO event_run_history (procedure_name, start_date, status)
+			VALUES (p_procedure, now(), 'running');
+			SET p_run_id = LAST_INSERT_ID();
+		ELSE
+			INSERT INTO event_run_history (procedure_name, start_date, end_date,
+				duration_seconds, status)
+			VALUES (p_procedure, now(), now(), 0, 'skipped');
+		END IF;
+	END$$
+	DELIMITER ;
+
+	DELIMITER $$
+	DROP PROCEDURE IF EXISTS event_run_end$$
+	CREATE PROCEDURE event_run_end(IN p_run_id INT, IN p_status VARCHAR(10))
+	BEGIN
+		DECLARE v_procedure VARCHAR(64);
+
+		SELECT h.procedure_name INTO v_procedure
+		FROM event_run_history h
+		WHERE h.event_run_id = p_run_id;
+
+		UPDATE event_run_history h
+		SET h.end_date = now(),
+			h.duration_seconds = TIMESTAMPDIFF(SECOND, h.start_date, now()),
+			h.status = p_status
+		WHERE h.event_run_id = p_run_id;
+
+		/*Execution trop longue : doubler l'intervalle, sinon revenir a l'intervalle
+		de base*/
+		UPDATE event_schedule s, event_run_history h
+		SET s.interval_minutes = IF(h.duration_seconds > s.budget_seconds,
+				LEAST(s.interval_minutes * 2, s.max_interval_minutes),
+				s.base_interval_minutes)
+		WHERE h.event_run_id = p_run_id
+		AND s.procedure_name = h.procedure_name;
+
+		/*Prochaine execution permise ; une minute de marge car l'evenement se
+		declenche un peu avant start_date + intervalle*/
+		UPDATE event_schedule s, event_run_history h
+		SET s.next_run_date = IF(s.interval_minutes > s.base_interval_minutes,
+				h.start_date + INTERVAL s.interval_minutes MINUTE - INTERVAL 1 MINUTE,
+				NULL)
+		WHERE h.event_run_id = p_run_id
+		AND s.procedure_name = h.procedure_name;
+
+		DELETE FROM event_run_history
+		WHERE start_date < now() - INTERVAL 30 DAY;
+
+		IF v_procedure IS NOT NULL THEN
+			DO RELEASE_LOCK(CONCAT('isanteplus.', v_procedure));
+		END IF;
+	END$$
+	DELIMITER ;
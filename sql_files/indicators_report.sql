@@ -215,10 +215,176 @@ DROP TABLE IF EXISTS isanteplus.report_type;
 	indicator_name_en,indicator_type_description,date_created)
 	VALUES(37,1,'Violences (physique, sexuelle)','Violence (physical, sexual) ','Violences (physique, sexuelle)', now());
  
+	/*Regles des indicateurs : chaque ligne associe un diagnostic (answer_concept_id
+	du concept 1284, ou answer_concept_uuid resolu par report_indicators) et, au besoin,
+	un statut suspect (159393) ou confirme (159392) a un indicateur. Un indicateur
+	a plusieurs diagnostics a une ligne par diagnostic. Les numeros reprennent ceux
+	des anciennes requetes (19 et 34 ecrivent les types 13 et 24).*/
+	DROP TABLE IF EXISTS isanteplus.indicator_rule;
+	CREATE TABLE IF NOT EXISTS isanteplus.indicator_rule (
+	  indicator_rule_id INT(11) NOT NULL,
+	  indicator_id INT(11) NOT NULL,
+	  indicator_type_id INT(11) NOT NULL,
+	  answer_concept_id INT(11),
+	  answer_concept_uuid CHAR(38),
+	  suspected_confirmed INT(11),
+	  CONSTRAINT pk_indicator_rule PRIMARY KEY (indicator_rule_id),
+	  INDEX idx_indicator_rule_answer (answer_concept_id)
+	) ENGINE=INNODB DEFAULT CHARSET=utf8;
+
+	INSERT INTO isanteplus.indicator_rule (indicator_rule_id,indicator_id,indicator_type_id,
+	answer_concept_id,answer_concept_uuid,suspected_confirmed)
+	VALUES
+	/*1 : Agression par animal suspecte de rage*/
+	(1,1,1,160146,NULL,159393),
+	/*2 : Coqueluche Suspect*/
+	(2,2,2,114190,NULL,159393),
+	/*3 : Cholera Suspect*/
+	(3,3,3,122604,NULL,159393),
+	/*4 : Deces Maternel*/
+	(4,4,4,134612,NULL,NULL),
+	/*5 : Diphterie probable*/
+	(5,5,5,119399,NULL,159393),
+	/*6 : Evenement supose etre attribuable a la vaccination et a l’immunisation (esavi)*/
+	(6,6,6,NULL,'1b4d09df-4f9f-44ff-9e7b-c1eba6514289',NULL),
+	/*7 : Meningite Suspect*/
+	(7,7,7,115835,NULL,159393),
+	/*8 : Microcephalie congenitale*/
+	(8,8,8,NULL,'87275706-5e87-4562-8cdc-b9d1e1649f83',NULL),
+	/*9 : Paludisme confirme*/
+	(9,9,9,116128,NULL,159392),
+	/*10 : Paralysie flasque aigue(pfa)*/
+	(10,10,10,160426,NULL,NULL),
+	/*11 : Peste suspecte*/
+	(11,11,11,114120,NULL,159393),
+	/*12 : Rage humaine*/
+	(12,12,12,160146,NULL,NULL),
+	/*13 : Rougeole/rubeole suspecte*/
+	(13,13,13,134561,NULL,159393),
+	/*14 : Syndrome de guillain barre*/
+	(14,14,14,139233,NULL,NULL),
+	/*15 : Syndrome de fievre hemorragique aigue*/
+	(15,15,15,163392,NULL,NULL),
+	/*16 : Syndrome de rubeole congenitale*/
+	(16,16,16,113205,NULL,NULL),
+	/*17 : Tetanos neonatal (tnn)*/
+	(17,17,17,124957,NULL,NULL),
+	/*18 : Toxi-infection alimentaire collective (tiac)*/
+	(18,18,18,NULL,'50d568a4-2e65-420c-8d9c-8b63f146e2c5',NULL),
+	/*19 : Charbon cutané suspect*/ /*Cutaneous Anthrax 143086*/
+	(19,13,13,121555,NULL,159393),
+	/*20 : Dengue suspecte*/
+	(20,20,20,142592,NULL,159393),
+	/*21:Diabète*/
+	(21,21,21,142473,NULL,NULL),
+	(22,21,21,142474,NULL,NULL),
+	/*22 : Diarrhée aigue aqueuse*/
+	(23,22,22,161887,NULL,NULL),
+	/*23 : Diarrhée aigue sanglante*/
+	(24,23,23,138868,NULL,NULL),
+	/*24:Fièvre typhoïde suspecte*/
+	(25,24,24,141,NULL,159393),
+	/*25 : Filariose probable*/
+	(26,25,25,119354,NULL,159393),
+	/*26 : Infection respiratoire aigue*/
+	(27,26,26,154983,NULL,NULL),
+	/*27 : Syndrome ictérique fébrile*/
+	(28,27,27,163402,NULL,NULL),
+	/*28 : Tétanos*/
+	(29,28,28,124957,NULL,NULL),
+	/*29 : Accidents (domestiques, voie publique)*/
+	(30,29,29,150452,NULL,NULL),
+	/*30 : Cancers (seins, col de l’utérus, prostate, autres)*/
+	(31,30,30,113753,NULL,NULL),
+	(32,30,30,146221,NULL,NULL),
+	(33,30,30,116023,NULL,NULL),
+	/*31 : Epilepsie*/
+	(34,31,31,155,NULL,NULL),
+	/*32 : Hypertension artérielle (hta)*/
+	(35,32,32,117399,NULL,NULL),
+	/*33 : Infection sexuellement transmissible (ist)*/
+	(36,33,33,112992,NULL,NULL),
+	/* 34 : Lèpre suspecte */
+	(37,24,24,116344,NULL,159393),
+	/*35 : Malnutrition*/
+	(38,35,35,832,NULL,NULL),
+	(39,35,35,126598,NULL,NULL),
+	(40,35,35,134722,NULL,NULL),
+	(41,35,35,134723,NULL,NULL),
+	/*36 : Syphilis congénitale*/
+	(42,36,36,143672,NULL,NULL),
+	/*37 : Violences (physique, sexuelle)*/
+	(43,37,37,158358,NULL,NULL);
+
+	/*Marques des procedures lancees par les evenements : dernier obs_id traite
+	(last_id) et debut de la derniere execution (last_date), par procedure*/
+	CREATE TABLE IF NOT EXISTS isanteplus.event_watermark (
+	  source_table VARCHAR(64) NOT NULL,
+	  last_id INT(11),
+	  last_date DATETIME,
+	  last_run_date DATETIME,
+	  CONSTRAINT pk_event_watermark PRIMARY KEY (source_table)
+	) ENGINE=INNODB DEFAULT CHARSET=utf8;
+
  DELIMITER $$
 	DROP PROCEDURE IF EXISTS patient_diagnosis$$
 	CREATE PROCEDURE patient_diagnosis()
 	BEGIN
+	DECLARE last_obs_id INT DEFAULT 0;
+	DECLARE last_run DATETIME DEFAULT NULL;
+	DECLARE max_obs_id INT;
+	DECLARE run_start DATETIME;
+	
+	SET run_start = now();
+	SET max_obs_id = (SELECT MAX(obs_id) FROM openmrs.obs);
+	/*Reprendre a la marque de la derniere execution, sauf si patient_diagnosis
+	est vide (base recreee) : tout retraiter*/
+	IF EXISTS (SELECT 1 FROM patient_diagnosis) THEN
+		SELECT COALESCE(w.last_id, 0), w.last_date INTO last_obs_id, last_run
+		FROM isanteplus.event_watermark w
+		WHERE w.source_table = 'patient_diagnosis';
+	END IF;
+	
+	/*Rencontres a traiter : celles qui ont une obs de diagnostic (1284),
+	suspect/confirme (159394) ou primaire/secondaire (159946) creee depuis la
+	marque, et celles modifiees ou annulees depuis la derniere execution. Les
+	obs annulees sans modifier leur rencontre ne sont relues que si l'index
+	optionnel idx_obs_date_voided existe (sql_files/openmrs_obs_index.sql) :
+	sans lui, date_voided obligerait a parcourir toute la table obs.
+	A la premiere execution, toutes.*/
+	DROP TEMPORARY TABLE IF EXISTS tmp_diagnosis_encounter;
+	CREATE TEMPORARY TABLE tmp_diagnosis_encounter (
+		encounter_id int(11) NOT NULL,
+		PRIMARY KEY (encounter_id)
+	);
+	
+	INSERT IGNORE INTO tmp_diagnosis_encounter (encounter_id)
+	SELECT ob.encounter_id
+	FROM openmrs.obs ob
+	WHERE ob.obs_id > last_obs_id
+	AND ob.obs_id <= max_obs_id
+	AND ob.concept_id IN (1284,159394,159946)
+	AND ob.encounter_id IS NOT NULL;
+	
+	IF last_run IS NOT NULL AND EXISTS (
+		SELECT 1 FROM INFORMATION_SCHEMA.STATISTICS
+		WHERE TABLE_SCHEMA = 'openmrs'
+		AND TABLE_NAME = 'obs'
+		AND INDEX_NAME = 'idx_obs_date_voided') THEN
+		INSERT IGNORE INTO tmp_diagnosis_encounter (encounter_id)
+		SELECT ob.encounter_id
+		FROM openmrs.obs ob
+		WHERE ob.date_voided >= last_run
+		AND ob.concept_id IN (1284,159394,159946)
+		AND ob.encounter_id IS NOT NULL;
+	END IF;
+	
+	INSERT IGNORE INTO tmp_diagnosis_encounter (encounter_id)
+	SELECT e.encounter_id
+	FROM openmrs.encounter e
+	WHERE last_run IS NOT NULL
+	AND (e.date_changed >= last_run OR e.date_voided >= last_run);
+	
 	/*insertion of all diagnosis in the table patient_diagnosis*/
 INSERT into patient_diagnosis
 					(
@@ -233,8 +399,10 @@ INSERT into patient_diagnosis
 					)
 					select distinct ob.person_id,ob.encounter_id,
 					ob.location_id,ob1.concept_id,ob.obs_group_id,ob.concept_id, ob.value_coded, ob.voided
-					from openmrs.obs ob, openmrs.obs ob1, openmrs.encounter e, openmrs.encounter_type et
-					where ob.person_id = ob1.person_id
+					from tmp_diagnosis_encounter de, openmrs.obs ob, openmrs.obs ob1,
+					openmrs.encounter e, openmrs.encounter_type et
+					where de.encounter_id = ob.encounter_id
+					AND ob.person_id = ob1.person_id
 					AND ob.encounter_id = ob1.encounter_id
 					AND ob.obs_group_id = ob1.obs_id
 					AND ob.encounter_id = e.encounter_id
@@ -253,29 +421,42 @@ INSERT into patient_diagnosis
 					encounter_id = ob.encounter_id,
 					voided = ob.voided;
 	/*update patient diagnosis for suspected_confirmed area*/					
-	update patient_diagnosis pdiag, openmrs.obs ob
+	update patient_diagnosis pdiag, tmp_diagnosis_encounter de, openmrs.obs ob
 	 SET pdiag.suspected_confirmed = ob.value_coded
-	 WHERE pdiag.patient_id = ob.person_id
+	 WHERE pdiag.encounter_id = de.encounter_id
+		   AND pdiag.patient_id = ob.person_id
 		   AND pdiag.obs_group_id = ob.obs_group_id
 		   AND pdiag.encounter_id = ob.encounter_id
 		   AND ob.concept_id = 159394
 		   AND ob.value_coded IN (159392,159393)
 		   AND ob.voided = 0;
 	/*Update for primary_secondary area*/
-	update patient_diagnosis pdiag, openmrs.obs ob
+	update patient_diagnosis pdiag, tmp_diagnosis_encounter de, openmrs.obs ob
 	 SET pdiag.primary_secondary = ob.value_coded
-	 WHERE pdiag.patient_id = ob.person_id
+	 WHERE pdiag.encounter_id = de.encounter_id
+		   AND pdiag.patient_id = ob.person_id
 		   AND pdiag.obs_group_id = ob.obs_group_id
 		   AND pdiag.encounter_id = ob.encounter_id
 		   AND ob.concept_id = 159946
 		   AND ob.value_coded IN (159943,159944)
 		   AND ob.voided = 0;
 	/*Update encounter date for patient_diagnosis*/	   
-	update patient_diagnosis pdiag, openmrs.encounter enc
+	update patient_diagnosis pdiag, tmp_diagnosis_encounter de, openmrs.encounter enc
     SET pdiag.encounter_date = DATE(enc.encounter_datetime)
-    WHERE pdiag.location_id = enc.location_id
+    WHERE pdiag.encounter_id = de.encounter_id
+          AND pdiag.location_id = enc.location_id
           AND pdiag.encounter_id = enc.encounter_id
 		  AND enc.voided = 0;
+	
+	/*Avancer la marque*/
+	INSERT INTO isanteplus.event_watermark (source_table, last_id, last_date, last_run_date)
+	VALUES ('patient_diagnosis', COALESCE(max_obs_id, last_obs_id), run_start, now())
+	ON DUPLICATE KEY UPDATE
+	last_id = VALUES(last_id),
+	last_date = VALUES(last_date),
+	last_run_date = VALUES(last_run_date);
+	
+	DROP TEMPORARY TABLE IF EXISTS tmp_diagnosis_encounter;
 /*Ending patient_diagnosis*/
  END$$
 DELIMITER ;
@@ -284,502 +465,22 @@ DELIMITER ;
 	DROP PROCEDURE IF EXISTS report_indicators$$
 	CREATE PROCEDURE report_indicators()
 	BEGIN
-	/*Indicateur 1 - 1 : Agression par animal suspecte de rage*/
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 1,1,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 160146
-	AND pdiag.suspected_confirmed = 159393
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*2 : Coqueluche Suspect*/
-	
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 2,2,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 114190
-	AND pdiag.suspected_confirmed = 159393
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*3 : Cholera Suspect*/
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 3,3,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 122604
-	AND pdiag.suspected_confirmed = 159393
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*Deces maternel*/
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 4,4,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 134612
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*5 : Diphterie probable*/
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 5,5,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 119399
-	AND pdiag.suspected_confirmed = 159393
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*6 : Evenement supose etre attribuable a la vaccination et a l’immunisation (esavi)*/
-		INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-		SELECT 6,6,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-		pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag,
-		openmrs.concept c
-		WHERE p.patient_id = pdiag.patient_id
-		AND pdiag.answer_concept_id = c.concept_id
-		AND pdiag.concept_id = 1284
-		AND c.uuid = '1b4d09df-4f9f-44ff-9e7b-c1eba6514289'
-		AND pdiag.voided <> 1
-		ON DUPLICATE KEY UPDATE
-		last_updated_date = NOW(),
-		voided = pdiag.voided;
-	/*7 : Meningite Suspect*/
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 7,7,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 115835
-	AND pdiag.suspected_confirmed = 159393
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*8 : Microcephalie congenitale*/
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-		SELECT 8,8,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-		pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag,
-		openmrs.concept c
-		WHERE p.patient_id = pdiag.patient_id
-		AND pdiag.answer_concept_id = c.concept_id
-		AND pdiag.concept_id = 1284
-		AND c.uuid = '87275706-5e87-4562-8cdc-b9d1e1649f83'
-		AND pdiag.voided <> 1
-		ON DUPLICATE KEY UPDATE
-		last_updated_date = NOW(),
-		voided = pdiag.voided;
-	
-	/*9 : Paludisme confirme*/
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 9,9,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 116128
-	AND pdiag.suspected_confirmed = 159392
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*10 : Paralysie flasque aigue(pfa)*/
-	
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 10,10,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 160426
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*11 : Peste suspecte*/
-	
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 11,11,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 114120
-	AND pdiag.suspected_confirmed = 159393
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*12 : Rage humaine*/
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 12,12,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 160146
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*13 : Rougeole/rubeole suspecte*/
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 13,13,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 134561
-	AND pdiag.suspected_confirmed = 159393
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*14 : Syndrome de guillain barre*/
-		INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 14,14,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 139233
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	/*15 : Syndrome de fievre hemorragique aigue*/
-		INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 15,15,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 163392
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	/*16 : Syndrome de rubeole congenitale*/
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 16,16,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 113205
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	/*17 : Tetanos neonatal (tnn)*/
-		INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 17,17,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 124957
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*18 : Toxi-infection alimentaire collective (tiac)*/
-	
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-		SELECT 18,18,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-		pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag,
-		openmrs.concept c
-		WHERE p.patient_id = pdiag.patient_id
-		AND pdiag.answer_concept_id = c.concept_id
-		AND pdiag.concept_id = 1284
-		AND c.uuid = '50d568a4-2e65-420c-8d9c-8b63f146e2c5'
-		AND pdiag.voided <> 1
-		ON DUPLICATE KEY UPDATE
-		last_updated_date = NOW(),
-		voided = pdiag.voided;
-	
-	/*19 : Charbon cutané suspect*/ /*Cutaneous Anthrax 143086*/
-		INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 13,13,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 121555
-	AND pdiag.suspected_confirmed = 159393
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*20 : Dengue suspecte*/
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 20,20,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 142592
-	AND pdiag.suspected_confirmed = 159393
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*21:Diabète*/
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 21,21,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id IN (142473,142474)
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*22 : Diarrhée aigue aqueuse*/
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 22,22,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 161887
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*23 : Diarrhée aigue sanglante*/
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 23,23,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 138868
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*24:Fièvre typhoïde suspecte*/
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 24,24,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 141
-	AND pdiag.suspected_confirmed = 159393
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*25 : Filariose probable*/
-	
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 25,25,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 119354
-	AND pdiag.suspected_confirmed = 159393
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*26 : Infection respiratoire aigue*/
-		INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 26,26,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 154983
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*27 : Syndrome ictérique fébrile*/
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 27,27,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 163402
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
+	/*Regles designees par uuid (6, 8, 18) : rechercher le concept_id*/
+	UPDATE isanteplus.indicator_rule r, openmrs.concept c
+	SET r.answer_concept_id = c.concept_id
+	WHERE r.answer_concept_uuid = c.uuid;
 	
-	/*28 : Tétanos*/
+	/*Tous les indicateurs en un seul passage sur patient_diagnosis : chaque
+	diagnostic est joint aux regles de son answer_concept_id*/
 	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
 										indicator_date,voided,created_date,last_updated_date)
-	SELECT 28,28,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
+	SELECT r.indicator_id,r.indicator_type_id,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id,
+	pdiag.encounter_date, pdiag.voided, now(), now()
+	FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag, isanteplus.indicator_rule r
 	WHERE p.patient_id = pdiag.patient_id
 	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 124957
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*29 : Accidents (domestiques, voie publique)*/
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 29,29,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 150452
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	/*30 : Cancers (seins, col de l’utérus, prostate, autres)*/
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 30,30,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id IN (113753,146221,116023)
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*31 : Epilepsie*/
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 31,31,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 155
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*32 : Hypertension artérielle (hta)*/
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 32,32,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 117399
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*33 : Infection sexuellement transmissible (ist)*/
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 33,33,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 112992
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/* 34 : Lèpre suspecte */
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 24,24,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 116344
-	AND pdiag.suspected_confirmed = 159393
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*35 : Malnutrition*/
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 35,35,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id IN (832,126598,134722,134723)
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*36 : Syphilis congénitale*/
-	
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 36,36,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 143672
-	AND pdiag.voided <> 1
-	ON DUPLICATE KEY UPDATE
-	last_updated_date = NOW(),
-	voided = pdiag.voided;
-	
-	/*37 : Violences (physique, sexuelle)*/
-	INSERT INTO isanteplus.indicators (indicator_id,indicator_type_id,patient_id,location_id,encounter_id,
-										indicator_date,voided,created_date,last_updated_date)
-	SELECT 37,37,pdiag.patient_id, pdiag.location_id, pdiag.encounter_id, pdiag.encounter_date,
-	pdiag.voided, now(), now() FROM isanteplus.patient p, isanteplus.patient_diagnosis pdiag
-	WHERE p.patient_id = pdiag.patient_id
-	AND pdiag.concept_id = 1284
-	AND pdiag.answer_concept_id = 158358
+	AND pdiag.answer_concept_id = r.answer_concept_id
+	AND (r.suspected_confirmed IS NULL OR pdiag.suspected_confirmed = r.suspected_confirmed)
 	AND pdiag.voided <> 1
 	ON DUPLICATE KEY UPDATE
 	last_updated_date = NOW(),
@@ -796,11 +497,34 @@ DELIMITER $$
 	END$$
 DELIMITER ;
 
+/*Appel par l'evenement : saute si l'execution precedente tourne encore,
+historique et intervalle geres par event_scheduler.sql*/
+DELIMITER $$
+	DROP PROCEDURE IF EXISTS report_indicators_event_procedure$$
+	CREATE PROCEDURE report_indicators_event_procedure()
+	BEGIN
+		DECLARE run_id INT DEFAULT NULL;
+		DECLARE EXIT HANDLER FOR SQLEXCEPTION
+		BEGIN
+			CALL event_run_end(run_id, 'failed');
+			RESIGNAL;
+		END;
+		
+		CALL event_run_begin('report_indicators_procedure', run_id);
+		IF run_id IS NOT NULL THEN
+			call report_indicators_procedure();
+			CALL event_run_end(run_id, 'done');
+		END IF;
+	END$$
+DELIMITER ;
+
+/*Decale de 5 minutes par rapport a patient_status_arv_day_event
+(insertion_obs_by_day.sql) pour que les deux ne tournent pas ensemble*/
 DROP EVENT if exists report_indicators_event;
 	CREATE EVENT if not exists report_indicators_event
 	ON SCHEDULE EVERY 10 MINUTE
-	 STARTS now()
+	 STARTS now() + INTERVAL 5 MINUTE
 		DO
-		call report_indicators_procedure();
+		call report_indicators_event_procedure();
 	
 	
\ No newline at end of file
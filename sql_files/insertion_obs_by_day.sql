@@ -110,15 +110,97 @@ CREATE TABLE IF NOT EXISTS patient_prescription_day (
 	last_updated_date DATETIME,
 	CONSTRAINT pk_last_obs PRIMARY KEY (obs_id)
 	);
+	
+	/*Marques des procedures lancees par les evenements : dernier obs_id traite
+	(last_id) et debut de la derniere execution (last_date), par procedure*/
+	CREATE TABLE IF NOT EXISTS isanteplus.event_watermark (
+	  source_table VARCHAR(64) NOT NULL,
+	  last_id INT(11),
+	  last_date DATETIME,
+	  last_run_date DATETIME,
+	  CONSTRAINT pk_event_watermark PRIMARY KEY (source_table)
+	) ENGINE=INNODB DEFAULT CHARSET=utf8;
 
 	DELIMITER $$
 	DROP PROCEDURE IF EXISTS insertion_obs_by_day$$
 	CREATE PROCEDURE insertion_obs_by_day()
 		BEGIN
+		DECLARE last_obs_id INT DEFAULT NULL;
+		DECLARE max_obs_id INT;
+		DECLARE last_run DATETIME DEFAULT NULL;
+		DECLARE run_start DATETIME;
 		 /*Started DML queries*/
 			/* insert data to patient table */
 			SET SQL_SAFE_UPDATES = 0;
 			
+		/*Obs creees depuis le dernier lot traite (marque 'obs_by_day', avancee
+		par isanteplusregimen_dml_day quand le lot est traite), par intervalle
+		de obs_id : pas de parcours complet de obs, et les obs creees avant
+		minuit apres la derniere execution ne sont pas perdues. Sans marque,
+		les obs creees aujourd'hui.
+		La borne haute s'arrete aux obs creees il y a plus d'une minute : une
+		transaction plus lente peut valider un obs_id plus petit que MAX(obs_id),
+		qui serait sinon sous la marque au lot suivant.*/
+		SET run_start = now();
+		SET max_obs_id = (SELECT o.obs_id FROM openmrs.obs o
+			WHERE o.date_created < run_start - INTERVAL 1 MINUTE
+			ORDER BY o.obs_id DESC LIMIT 1);
+		SELECT w.last_id, w.last_date INTO last_obs_id, last_run
+		FROM isanteplus.event_watermark w
+		WHERE w.source_table = 'obs_by_day';
+		
+		IF last_obs_id IS NULL THEN
+			SET last_obs_id = COALESCE((SELECT MIN(o.obs_id) - 1 FROM openmrs.obs o
+				WHERE o.date_created >= CURDATE()), max_obs_id);
+			INSERT IGNORE INTO isanteplus.event_watermark (source_table, last_id, last_date, last_run_date)
+			SELECT 'obs_by_day', last_obs_id, now(), now()
+			FROM DUAL WHERE last_obs_id IS NOT NULL;
+		END IF;
+		SET max_obs_id = GREATEST(COALESCE(max_obs_id, 0), COALESCE(last_obs_id, 0));
+		/*Debut de ce lot : isanteplusregimen_dml_day en fait le last_date de
+		la marque quand le lot est traite*/
+		UPDATE isanteplus.event_watermark w
+		SET w.last_run_date = run_start
+		WHERE w.source_table = 'obs_by_day';
+		
+		/*Obs a lire : les nouvelles, et celles annulees depuis le debut du
+		dernier lot traite (une correction annule l'ancienne obs et en cree
+		une nouvelle), meme creees un autre jour. Les annulations sont
+		retrouvees par date_changed/date_voided de la rencontre et, si
+		l'index optionnel idx_obs_date_voided existe
+		(sql_files/openmrs_obs_index.sql), par date_voided de l'obs.*/
+		DROP TEMPORARY TABLE IF EXISTS tmp_obs_by_day;
+		CREATE TEMPORARY TABLE tmp_obs_by_day (
+			obs_id int(11) NOT NULL,
+			PRIMARY KEY (obs_id)
+		);
+		INSERT IGNORE INTO tmp_obs_by_day (obs_id)
+		SELECT o.obs_id
+		FROM openmrs.obs o
+		WHERE o.obs_id > last_obs_id
+		AND o.obs_id <= max_obs_id;
+		
+		IF last_run IS NOT NULL THEN
+			INSERT IGNORE INTO tmp_obs_by_day (obs_id)
+			SELECT o.obs_id
+			FROM openmrs.encounter e, openmrs.obs o
+			WHERE (e.date_changed >= last_run OR e.date_voided >= last_run)
+			AND o.encounter_id = e.encounter_id
+			AND o.obs_id <= max_obs_id;
+			
+			IF EXISTS (
+				SELECT 1 FROM INFORMATION_SCHEMA.STATISTICS
+				WHERE TABLE_SCHEMA = 'openmrs'
+				AND TABLE_NAME = 'obs'
+				AND INDEX_NAME = 'idx_obs_date_voided') THEN
+				INSERT IGNORE INTO tmp_obs_by_day (obs_id)
+				SELECT o.obs_id
+				FROM openmrs.obs o
+				WHERE o.date_voided >= last_run
+				AND o.obs_id <= max_obs_id;
+			END IF;
+		END IF;
+		
 		INSERT INTO isanteplus.obs_by_day
 		SELECT o.obs_id,o.person_id,o.concept_id,o.encounter_id,o.order_id,o.obs_datetime,
 		  o.location_id,o.obs_group_id,o.accession_number,o.value_group_id,
@@ -126,7 +208,7 @@ CREATE TABLE IF NOT EXISTS patient_prescription_day (
 		  o.value_numeric,o.value_modifier,o.value_text,o.value_complex,o.comments,
 		  o.creator,o.date_created,o.voided,o.voided_by,
 		  o.date_voided,o.void_reason,o.uuid,o.previous_version,o.form_namespace_and_path
-		  FROM openmrs.obs o WHERE DATE(o.date_created) = DATE(now())
+		  FROM tmp_obs_by_day t, openmrs.obs o WHERE o.obs_id = t.obs_id
 		  ON DUPLICATE KEY UPDATE
 		  obs_datetime = o.obs_datetime,
 		  obs_group_id = o.obs_group_id,
@@ -134,7 +216,8 @@ CREATE TABLE IF NOT EXISTS patient_prescription_day (
 		  value_coded = o.value_coded,
 		  value_numeric = o.value_numeric,
 		  value_text = o.value_text,
-		  voided = o.voided;		
+		  voided = o.voided,
+		  date_voided = o.date_voided;
 			
 	END$$
 	DELIMITER ;
@@ -143,10 +226,30 @@ CREATE TABLE IF NOT EXISTS patient_prescription_day (
 	DROP PROCEDURE IF EXISTS insertion_patient_by_day$$
 	CREATE PROCEDURE insertion_patient_by_day()
 		BEGIN
+		DECLARE last_run DATETIME DEFAULT NULL;
+		DECLARE run_start DATETIME;
 		 /*Started DML queries*/
 			/* insert data to patient table */
 			SET SQL_SAFE_UPDATES = 0;
 			
+		/*Patients crees depuis le debut de la derniere execution (marque
+		'patient_by_day'), sans coupure a minuit. Sans marque, depuis minuit.*/
+		SET run_start = now();
+		SELECT w.last_date INTO last_run
+		FROM isanteplus.event_watermark w
+		WHERE w.source_table = 'patient_by_day';
+		SET last_run = COALESCE(last_run, CURDATE());
+		
+		DROP TEMPORARY TABLE IF EXISTS tmp_patient_by_day;
+		CREATE TEMPORARY TABLE tmp_patient_by_day (
+			patient_id int(11) NOT NULL,
+			PRIMARY KEY (patient_id)
+		);
+		INSERT INTO tmp_patient_by_day (patient_id)
+		SELECT pa.patient_id
+		FROM openmrs.patient pa
+		WHERE pa.date_created >= last_run;
+			
 					insert into patient
 					(
 					 patient_id,
@@ -170,9 +273,8 @@ CREATE TABLE IF NOT EXISTS patient_prescription_day (
 						   now() as last_inserted_date,
 						   now() as last_updated_date,
 						   pn.voided
-					from openmrs.person_name pn, openmrs.person pe, openmrs.patient pa 
+					from tmp_patient_by_day pa, openmrs.person_name pn, openmrs.person pe
 					where pe.person_id=pn.person_id AND pe.person_id=pa.patient_id
-					AND DATE(pa.date_created) = DATE(now())
 					on duplicate key update 
 						given_name=pn.given_name,
 						family_name=pn.family_name,
@@ -191,7 +293,15 @@ CREATE TABLE IF NOT EXISTS patient_prescription_day (
 			 OR ent.uuid='349ae0b4-65c1-4122-aa06-480f186c8350'
 			 OR ent.uuid='33491314-c352-42d0-bd5d-a9d0bffc9bf1')
 			AND en.voided = 0
-			AND DATE(p.date_created) = DATE(now());
+			AND p.patient_id IN (SELECT pd.patient_id FROM tmp_patient_by_day pd);
+			
+		INSERT INTO isanteplus.event_watermark (source_table, last_id, last_date, last_run_date)
+		VALUES ('patient_by_day', NULL, run_start, now())
+		ON DUPLICATE KEY UPDATE
+		last_date = VALUES(last_date),
+		last_run_date = VALUES(last_run_date);
+		
+		DROP TEMPORARY TABLE IF EXISTS tmp_patient_by_day;
 	END$$
 	DELIMITER ;
 	
@@ -1040,9 +1150,7 @@ DELIMITER ;
 			last_updated_date = now();
 			
 			DROP TABLE if exists pepfarTableTemp_day;
-			DROP TABLE if exists oneDrugRegimenPrefixTemp_day;
-			DROP TABLE if exists twoDrugRegimenPrefixTemp_day;
-			/*Insertion regimen for one drug arv*/
+			DROP TEMPORARY TABLE if exists tmp_regimen_drug_day;
 			create temporary table pepfarTableTemp_day
 			(location_id int(11),
 			patient_id int(11),
@@ -1050,70 +1158,47 @@ DELIMITER ;
 			regimen varchar(255),
 			rx_or_prophy int(11));
 
-			create temporary table oneDrugRegimenPrefixTemp_day (
-			location_id int(11),
-			patient_id int(11),
-			visit_date datetime,
-			drugID1 int(11),
-			rx_or_prophy int(11)
-			);
-
-			insert into oneDrugRegimenPrefixTemp_day
-			select d1.location_id, d1.patient_id, d1.visit_date, d1.drug_id, d1.rx_or_prophy
-			from patient_prescription_day d1
-			join patient p on d1.patient_id = p.patient_id
-			join (select distinct drugID1 from regimen) r
-			on r.drugID1 = d1.drug_id
-			where d1.arv_drug = 1065
-			AND d1.voided <> 1;
+			/*Signature des regimes : un medicament par ligne avec sa position
+			(1 = le medicament ARV) et le nombre de medicaments du regime*/
+			create temporary table tmp_regimen_drug_day (
+			regID int(11) not null,
+			drug_id int(11) not null,
+			drug_position tinyint not null,
+			drug_count tinyint not null,
+			primary key (regID, drug_position),
+			key idx_drug (drug_id)
+			) ENGINE=MEMORY
+			select regID, drugID1 as drug_id, 1 as drug_position,
+			1 + (drugID2 <> 0) + (drugID3 <> 0) as drug_count
+			from regimen
+			where drugID1 <> 0 and drugID2 is not null and drugID3 is not null
+			and (drugID2 <> 0 or drugID3 = 0)
+			union all
+			select regID, drugID2, 2, 2 + (drugID3 <> 0)
+			from regimen
+			where drugID1 <> 0 and drugID2 <> 0 and drugID3 is not null
+			union all
+			select regID, drugID3, 3, 3
+			from regimen
+			where drugID1 <> 0 and drugID2 <> 0 and drugID3 <> 0;
 
+			/*Regimes a un, deux ou trois medicaments en un seul parcours des
+			prescriptions du jour : un regime est retenu quand toutes ses positions
+			sont prescrites dans la visite*/
 			insert into pepfarTableTemp_day (location_id, patient_id, visit_date, regimen, rx_or_prophy)
-			select distinct location_id, patient_id, visit_date, shortname, rx_or_prophy
-			from oneDrugRegimenPrefixTemp_day d1
-			join regimen r
-			on r.drugID1 = d1.drugID1
-			where r.drugID2 = 0
-			and r.drugID3 = 0;
-
-			/*Insertion regimen for two drugs arv*/
-			create temporary table twoDrugRegimenPrefixTemp_day (
-			location_id int(11),
-			patient_id int(11),
-			visit_date datetime,
-			drugID1 int(11),
-			drugID2 int(11),
-			rx_or_prophy int(11)
-			);
-
-			insert into twoDrugRegimenPrefixTemp_day
-			select location_id, patient_id, visit_date, d1.drugID1, d2.drug_id, d1.rx_or_prophy
-			from oneDrugRegimenPrefixTemp_day d1
-			join patient_prescription_day d2 using (location_id, patient_id, visit_date)
-			join (select distinct drugID1, drugID2 from regimen) r
-			on r.drugID1 = d1.drugID1
-			and r.drugID2 = d2.drug_id
-			WHERE d2.voided <> 1;
-
-			insert into pepfarTableTemp_day (location_id, patient_id, visit_date, regimen, rx_or_prophy)
-			select distinct location_id, patient_id, visit_date, shortname, prefix.rx_or_prophy
-			from twoDrugRegimenPrefixTemp_day prefix
-			join regimen r
-			on prefix.drugID1 = r.drugID1
-			and prefix.drugID2 = r.drugID2
-			where r.drugID3 = 0;
-
-			/*Insertion regimen for three drugs arv*/
-
-			insert into pepfarTableTemp_day (location_id, patient_id, visit_date, regimen, rx_or_prophy)
-			select distinct location_id, patient_id, visit_date, shortname,prefix.rx_or_prophy
-			from twoDrugRegimenPrefixTemp_day prefix
-			join patient_prescription_day using (location_id, patient_id, visit_date)
-			join regimen r
-			on prefix.drugID1 = r.drugID1
-			and prefix.drugID2 = r.drugID2
-			and patient_prescription_day.drug_id = r.drugID3
-			where r.drugID3 != 0
-			AND patient_prescription_day.voided <> 1;
+			select distinct m.location_id, m.patient_id, m.visit_date, r.shortname, m.rx_or_prophy
+			from (
+				select d.location_id, d.patient_id, d.visit_date, rd.regID,
+				max(if(rd.drug_position = 1, d.rx_or_prophy, null)) as rx_or_prophy
+				from patient_prescription_day d
+				join patient p on d.patient_id = p.patient_id
+				join tmp_regimen_drug_day rd on rd.drug_id = d.drug_id
+				where d.voided <> 1
+				and (rd.drug_position > 1 or d.arv_drug = 1065)
+				group by d.location_id, d.patient_id, d.visit_date, rd.regID
+				having count(distinct rd.drug_position) = max(rd.drug_count)
+			) m
+			join regimen r on r.regID = m.regID;
 
 			insert into pepfarTable (location_id, patient_id, visit_date, regimen, rx_or_prophy, last_updated_date)
 			select p.location_id, p.patient_id, p.visit_date, p.regimen, p.rx_or_prophy, now() from pepfarTableTemp_day p
@@ -1121,19 +1206,36 @@ DELIMITER ;
 			rx_or_prophy = p.rx_or_prophy,
 			last_updated_date = now();
 
+			/*Dernier regime des patients de ce lot seulement, ecrit dans openmrs
+			s'il a change : aucun des regimes de leur derniere visite n'est celui
+			deja enregistre*/
+			DROP TEMPORARY TABLE if exists tmp_regimen_latest_day;
+			create temporary table tmp_regimen_latest_day (
+			patient_id int(11) not null,
+			visit_date date,
+			primary key (patient_id)
+			)
+			select pf.patient_id, max(pf.visit_date) as visit_date
+			from (select distinct patient_id from pepfarTableTemp_day) t
+			join pepfarTable pf on pf.patient_id = t.patient_id
+			group by pf.patient_id;
+
 			INSERT INTO openmrs.isanteplus_patient_arv (patient_id, arv_regimen, date_created, date_changed)
-			SELECT pft.patient_id, pft.regimen, pft.visit_date, now() FROM pepfarTable pft, openmrs.patient po,
-			(SELECT pf.patient_id, max(pf.visit_date) as visit_date_regimen FROM pepfarTable pf GROUP BY 1) B
-			WHERE pft.patient_id = po.patient_id
-            AND pft.patient_id = B.patient_id
-			AND pft.visit_date = B.visit_date_regimen
+			SELECT l.patient_id, min(pft.regimen), l.visit_date, now()
+			FROM tmp_regimen_latest_day l
+			join openmrs.patient po on po.patient_id = l.patient_id
+			join pepfarTable pft on pft.patient_id = l.patient_id
+			and pft.visit_date = l.visit_date
+			left join openmrs.isanteplus_patient_arv ipa on ipa.patient_id = l.patient_id
+			group by l.patient_id, l.visit_date
+			having max(pft.regimen <=> ipa.arv_regimen) = 0
 			ON DUPLICATE KEY UPDATE
-			arv_regimen = pft.regimen,
+			arv_regimen = values(arv_regimen),
 			date_changed = now();
 
 
-			drop temporary table oneDrugRegimenPrefixTemp_day;
-			drop temporary table twoDrugRegimenPrefixTemp_day;
+			drop temporary table tmp_regimen_latest_day;
+			drop temporary table tmp_regimen_drug_day;
 			drop temporary table pepfarTableTemp_day;
 			
         /*Transfer next_visit_date, date_started_arv, patient_status to 
@@ -1157,6 +1259,17 @@ DELIMITER ;
 		date_changed = now();
 		
 		/*delete from obs_by_day where obs_id < (select lo.obs_id from last_obs lo);*/
+		
+		/*Lot traite : avancer la marque de insertion_obs_by_day. last_date
+		prend le debut du lot (last_run_date) : les obs annulees pendant son
+		traitement seront relues au lot suivant.*/
+		INSERT INTO isanteplus.event_watermark (source_table, last_id, last_date, last_run_date)
+		SELECT 'obs_by_day', MAX(obd.obs_id), now(), now()
+		FROM obs_by_day obd
+		HAVING MAX(obd.obs_id) IS NOT NULL
+		ON DUPLICATE KEY UPDATE
+		last_id = GREATEST(last_id, VALUES(last_id)),
+		last_date = last_run_date;
 			
 		TRUNCATE TABLE patient_dispensing_day;
 		TRUNCATE TABLE patient_prescription_day;		
@@ -1184,12 +1297,33 @@ DELIMITER ;
 	DELIMITER ;
 	
 	
+	/*Appel par l'evenement : saute si l'execution precedente tourne encore,
+	historique et intervalle geres par event_scheduler.sql*/
+	DELIMITER $$
+	DROP PROCEDURE IF EXISTS call_all_procedure_day_event$$
+	CREATE PROCEDURE call_all_procedure_day_event()
+	BEGIN
+		DECLARE run_id INT DEFAULT NULL;
+		DECLARE EXIT HANDLER FOR SQLEXCEPTION
+		BEGIN
+			CALL event_run_end(run_id, 'failed');
+			RESIGNAL;
+		END;
+		
+		CALL event_run_begin('call_all_procedure_day', run_id);
+		IF run_id IS NOT NULL THEN
+			call call_all_procedure_day();
+			CALL event_run_end(run_id, 'done');
+		END IF;
+	END$$
+	DELIMITER ;
+	
 	DROP EVENT if exists patient_status_arv_day_event;
 	CREATE EVENT if not exists patient_status_arv_day_event
 	ON SCHEDULE EVERY 10 MINUTE
 	 STARTS now()
 		DO
-		call call_all_procedure_day();
+		call call_all_procedure_day_event();
 	
 	
 	
@@ -269,7 +269,8 @@ CREATE TABLE IF NOT EXISTS patient_prescription (
 	CONSTRAINT pk_patient_prescription PRIMARY KEY(encounter_id,location_id,drug_id),
 	INDEX(visit_date),
 	INDEX(encounter_id),
-	INDEX(patient_id)	
+	INDEX(patient_id),
+	INDEX idx_prescription_last_updated (last_updated_date)
 );
 
  /*Create table for lab*/
@@ -350,7 +351,8 @@ CREATE TABLE IF NOT EXISTS patient_prescription (
 	id_alert int(11),
 	encounter_id int(11),
 	date_alert date,
-	last_updated_date DATETIME)
+	last_updated_date DATETIME,
+	INDEX idx_alert_patient (patient_id))
 	ENGINE=InnoDB DEFAULT CHARSET=utf8;
 	
 	/*TABLE patient_diagnosis, this table contains all patient diagnosis*/	
@@ -547,7 +549,8 @@ CREATE TABLE if not exists pepfarTable (
 	regimen VARCHAR(255),
 	rx_or_prophy INT(11),
 	last_updated_date DATETIME,
-	CONSTRAINT pk_pepfarTable_primary_key PRIMARY KEY (location_id, patient_id, visit_date, regimen)
+	CONSTRAINT pk_pepfarTable_primary_key PRIMARY KEY (location_id, patient_id, visit_date, regimen),
+	INDEX idx_pepfar_patient_date (patient_id, visit_date)
 	);
 
 insert into regimen(regID,regimenName,drugID1,drugID2,drugID3,shortName,regGroup) values(1,'1stReg1',84309,78643,80586,'d4T-3TC-NVP','1stReg1');
@@ -23,6 +23,38 @@ PREPARE stmt FROM @sql;
 EXECUTE stmt;
 DEALLOCATE PREPARE stmt;
 
+-- Index de alert sur patient_id (bases créées avant son ajout au DDL),
+-- utilisé par la mise à jour par différence de la section 12
+SET @idx_exists := (
+    SELECT COUNT(*)
+    FROM INFORMATION_SCHEMA.STATISTICS
+    WHERE TABLE_SCHEMA = 'isanteplus'
+      AND TABLE_NAME = 'alert'
+      AND INDEX_NAME = 'idx_alert_patient'
+);
+
+SET @sql := IF(
+    @idx_exists = 0,
+    'ALTER TABLE isanteplus.alert ADD INDEX idx_alert_patient (patient_id);',
+    'SELECT ''Index idx_alert_patient already exists'';'
+);
+
+PREPARE stmt FROM @sql;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
+
+-- Effacer la marque d'une source dans etl_watermark (PHASE 1) : la prochaine
+-- exécution la retraite en entier. Seule écriture des autres scripts dans
+-- etl_watermark : patient_status_arv_dml.sql et etl/arv_engine.py effacent
+-- la marque 'alert' (section 12) après avoir recalculé alert.
+DELIMITER $$
+DROP PROCEDURE IF EXISTS etl_reset_watermark$$
+CREATE PROCEDURE etl_reset_watermark(IN p_source_table VARCHAR(64))
+BEGIN
+  DELETE FROM etl_watermark WHERE source_table = p_source_table;
+END$$
+DELIMITER ;
+
 -- =============================================================================
 -- PHASE 0 : RÉSOLUTION DES UUID EN VARIABLES DE SESSION
 -- Lectures rapides sur de petites tables de référence
@@ -30,6 +62,10 @@ DEALLOCATE PREPARE stmt;
 
 SET SQL_SAFE_UPDATES = 0;
 
+-- Plage de clés des instructions précédées de « -- etl:chunk » : toutes les
+-- lignes. python3 -m etl les exécute par tranches (etl/chunked.py).
+SET @etl_chunk_lo := -2147483648, @etl_chunk_hi := 2147483647;
+
 -- ---- Types de consultation (encounter_type) ----
 SET @et_first_hiv_visit := (SELECT encounter_type_id FROM openmrs.encounter_type WHERE uuid = '17536ba6-dd7c-4f58-8014-08c7cb798ac7');
 SET @et_followup_hiv_visit := (SELECT encounter_type_id FROM openmrs.encounter_type WHERE uuid = '204ad066-c5c2-4229-9a62-644bc5617ca2');
@@ -107,92 +143,629 @@ SET @concept_viral_load_routine := (SELECT concept_id FROM openmrs.concept WHERE
 SET @concept_tb_bact_pos_1 := (SELECT concept_id FROM openmrs.concept WHERE uuid = '36d6616b-8c7c-4768-9f38-2be4b704fccd');
 SET @concept_tb_bact_pos_2 := (SELECT concept_id FROM openmrs.concept WHERE uuid = 'f4ee3bcc-947c-4390-9190-a335c2cd5868');
 
+-- Concepts de patient_status_arv_dml.sql, lu dans le snapshot partagé (NETTOYAGE)
+SET @concept_isoniazid_group := (SELECT concept_id FROM openmrs.concept WHERE uuid = 'fee8bd39-2a95-47f9-b1f5-3f9e9b3ee959');
+SET @concept_rifampicin_group := (SELECT concept_id FROM openmrs.concept WHERE uuid = '2b2053bd-37f3-429d-be0b-f1f8952fe55e');
+
 -- =============================================================================
--- SNAPSHOT : Copie des tables openmrs dans des tables temporaires
--- Réduit la contention de verrouillage sur les tables de production
+-- PHASE 1 : MODE INCRÉMENTAL (etl_watermark)
+-- Si une exécution précédente a enregistré ses marques dans etl_watermark,
+-- les snapshots ne contiennent que les patients modifiés depuis et toutes
+-- les sections se limitent à eux. Reconstruction complète à la demande :
+--   SET @etl_full_rebuild = 1;  (ou python3 -m etl --full-rebuild)
 -- =============================================================================
 
-DROP TEMPORARY TABLE IF EXISTS _tmp_obs;
-CREATE TEMPORARY TABLE _tmp_obs AS
-SELECT * FROM openmrs.obs;
-
-DROP TEMPORARY TABLE IF EXISTS _tmp_encounter;
-CREATE TEMPORARY TABLE _tmp_encounter AS
-SELECT * FROM openmrs.encounter;
-
-DROP TEMPORARY TABLE IF EXISTS _tmp_visit;
-CREATE TEMPORARY TABLE _tmp_visit AS
-SELECT * FROM openmrs.visit;
-
-DROP TEMPORARY TABLE IF EXISTS _tmp_encounter_provider;
-CREATE TEMPORARY TABLE _tmp_encounter_provider AS
-SELECT * FROM openmrs.encounter_provider;
-
-DROP TEMPORARY TABLE IF EXISTS _tmp_person;
-CREATE TEMPORARY TABLE _tmp_person AS
-SELECT * FROM openmrs.person;
-
-DROP TEMPORARY TABLE IF EXISTS _tmp_patient;
-CREATE TEMPORARY TABLE _tmp_patient AS
-SELECT * FROM openmrs.patient;
-
-DROP TEMPORARY TABLE IF EXISTS _tmp_person_attribute;
-CREATE TEMPORARY TABLE _tmp_person_attribute AS
-SELECT * FROM openmrs.person_attribute;
-
--- Index sur les tables temporaires pour optimiser les jointures
-ALTER TABLE _tmp_obs ADD INDEX idx_obs_encounter_id (encounter_id);
-ALTER TABLE _tmp_obs ADD INDEX idx_obs_person_id (person_id);
-ALTER TABLE _tmp_obs ADD INDEX idx_obs_concept_id (concept_id);
-ALTER TABLE _tmp_obs ADD INDEX idx_obs_obs_group_id (obs_group_id);
-ALTER TABLE _tmp_obs ADD INDEX idx_obs_obs_id (obs_id);
-
-DROP TEMPORARY TABLE IF EXISTS _tmp_obs_grp;
-CREATE TEMPORARY TABLE _tmp_obs_grp AS
-SELECT * FROM openmrs.obs;
-ALTER TABLE _tmp_obs_grp ADD INDEX idx_obs_grp_encounter_id (encounter_id);
-ALTER TABLE _tmp_obs_grp ADD INDEX idx_obs_grp_person_id (person_id);
-ALTER TABLE _tmp_obs_grp ADD INDEX idx_obs_grp_concept_id (concept_id);
-ALTER TABLE _tmp_obs_grp ADD INDEX idx_obs_grp_obs_group_id (obs_group_id);
-ALTER TABLE _tmp_obs_grp ADD INDEX idx_obs_grp_obs_id (obs_id);
-
-DROP TEMPORARY TABLE IF EXISTS _tmp_obs_sib;
-CREATE TEMPORARY TABLE _tmp_obs_sib AS
-SELECT * FROM openmrs.obs
-WHERE obs_group_id IS NOT NULL;
-ALTER TABLE _tmp_obs_sib ADD INDEX idx_obs_sib_encounter_id (encounter_id);
-ALTER TABLE _tmp_obs_sib ADD INDEX idx_obs_sib_person_id (person_id);
-ALTER TABLE _tmp_obs_sib ADD INDEX idx_obs_sib_concept_id (concept_id);
-ALTER TABLE _tmp_obs_sib ADD INDEX idx_obs_sib_obs_group_id (obs_group_id);
-ALTER TABLE _tmp_obs_sib ADD INDEX idx_obs_sib_obs_id (obs_id);
-
-ALTER TABLE _tmp_encounter ADD PRIMARY KEY (encounter_id);
-ALTER TABLE _tmp_encounter ADD INDEX idx_enc_patient_id (patient_id);
-ALTER TABLE _tmp_encounter ADD INDEX idx_enc_visit_id (visit_id);
-ALTER TABLE _tmp_encounter ADD INDEX idx_enc_encounter_type (encounter_type);
-
-DROP TEMPORARY TABLE IF EXISTS _tmp_encounter_2;
-CREATE TEMPORARY TABLE _tmp_encounter_2 AS
-SELECT * FROM openmrs.encounter;
-ALTER TABLE _tmp_encounter_2 ADD PRIMARY KEY (encounter_id);
-ALTER TABLE _tmp_encounter_2 ADD INDEX idx_enc2_patient_id (patient_id);
-ALTER TABLE _tmp_encounter_2 ADD INDEX idx_enc2_visit_id (visit_id);
-ALTER TABLE _tmp_encounter_2 ADD INDEX idx_enc2_encounter_type (encounter_type);
-
-ALTER TABLE _tmp_visit ADD INDEX idx_vis_visit_id (visit_id);
-ALTER TABLE _tmp_visit ADD INDEX idx_vis_patient_id (patient_id);
-
-DROP TEMPORARY TABLE IF EXISTS _tmp_visit_2;
-CREATE TEMPORARY TABLE _tmp_visit_2 AS
-SELECT * FROM openmrs.visit;
-ALTER TABLE _tmp_visit_2 ADD INDEX idx_vis2_visit_id (visit_id);
-ALTER TABLE _tmp_visit_2 ADD INDEX idx_vis2_patient_id (patient_id);
-
-
-ALTER TABLE _tmp_encounter_provider ADD INDEX idx_ep_encounter_id (encounter_id);
-ALTER TABLE _tmp_person ADD INDEX idx_per_person_id (person_id);
-ALTER TABLE _tmp_patient ADD INDEX idx_pat_patient_id (patient_id);
-ALTER TABLE _tmp_person_attribute ADD INDEX idx_pattr_person_id (person_id);
+CREATE TABLE IF NOT EXISTS etl_watermark (
+  source_table VARCHAR(64) NOT NULL,
+  last_id INT(11),
+  last_date DATETIME,
+  last_run_date DATETIME,
+  CONSTRAINT pk_etl_watermark PRIMARY KEY (source_table)
+) ENGINE = InnoDB DEFAULT CHARSET = utf8;
+
+-- Dernières valeurs par patient, tenues à jour par les sections 2, 3 et 6
+-- pour les patients à traiter et lues par les sections 12 et 15 et par
+-- patient_status_arv_dml.sql (au lieu de recalculer MAX/MIN sur toute la table)
+CREATE TABLE IF NOT EXISTS patient_latest_visit (
+  patient_id INT(11) NOT NULL,
+  visit_date DATE,
+  hiv_first_visit_datetime DATETIME,
+  CONSTRAINT pk_patient_latest_visit PRIMARY KEY (patient_id)
+) ENGINE = InnoDB DEFAULT CHARSET = utf8;
+
+CREATE TABLE IF NOT EXISTS patient_latest_dispensing (
+  patient_id INT(11) NOT NULL,
+  first_arv_visit_date DATE,
+  last_arv_encounter_id INT(11),
+  next_arv_dispensation_date DATE,
+  next_arv_rx_dispensation_date DATE,
+  last_visit_date DATE,
+  CONSTRAINT pk_patient_latest_dispensing PRIMARY KEY (patient_id)
+) ENGINE = InnoDB DEFAULT CHARSET = utf8;
+
+CREATE TABLE IF NOT EXISTS patient_latest_viral_load (
+  patient_id INT(11) NOT NULL,
+  last_test_date DATE,
+  last_result_date DATE,
+  CONSTRAINT pk_patient_latest_viral_load PRIMARY KEY (patient_id)
+) ENGINE = InnoDB DEFAULT CHARSET = utf8;
+
+SET @etl_full_rebuild := COALESCE(@etl_full_rebuild, 0);
+SET @etl_incremental := IF(@etl_full_rebuild = 0
+  AND EXISTS (SELECT 1 FROM etl_watermark), 1, 0);
+
+-- Index optionnel de openmrs.obs sur date_voided (sql_files/openmrs_obs_index.sql,
+-- étape de déploiement) : sans lui, les obs annulées ne sont retrouvées que
+-- par date_changed/date_voided de leur rencontre, sans parcourir obs.
+SET @obs_date_voided_index := (
+  SELECT COUNT(*) > 0
+  FROM INFORMATION_SCHEMA.STATISTICS
+  WHERE TABLE_SCHEMA = 'openmrs'
+    AND TABLE_NAME = 'obs'
+    AND INDEX_NAME = 'idx_obs_date_voided'
+);
+
+-- =============================================================================
+-- SNAPSHOT : Copie des tables openmrs dans des tables _tmp_*
+-- Réduit la contention de verrouillage sur les tables de production.
+-- Tables ordinaires (non TEMPORARY) : elles sont partagées par les connexions
+-- qui exécutent les sections en parallèle (python3 -m etl --parallel N).
+-- Les tables lues/écrites par chaque section sont déclarées dans
+-- etl/sections.py : à tenir à jour quand une section change.
+-- =============================================================================
+
+-- Marques de cette exécution, enregistrées dans etl_watermark au NETTOYAGE
+-- seulement si toutes les sections ont réussi.
+DROP TABLE IF EXISTS _tmp_etl_watermark;
+CREATE TABLE _tmp_etl_watermark (
+    PRIMARY KEY (source_table)
+)
+SELECT 'obs' AS source_table, MAX(obs_id) AS last_id, NOW() AS last_date FROM openmrs.obs
+UNION ALL SELECT 'encounter', MAX(encounter_id), NOW() FROM openmrs.encounter
+UNION ALL SELECT 'encounter_provider', MAX(encounter_provider_id), NOW() FROM openmrs.encounter_provider
+UNION ALL SELECT 'visit', MAX(visit_id), NOW() FROM openmrs.visit
+UNION ALL SELECT 'person', MAX(person_id), NOW() FROM openmrs.person
+UNION ALL SELECT 'patient', MAX(patient_id), NOW() FROM openmrs.patient
+UNION ALL SELECT 'person_name', MAX(person_name_id), NOW() FROM openmrs.person_name
+UNION ALL SELECT 'person_address', MAX(person_address_id), NOW() FROM openmrs.person_address
+UNION ALL SELECT 'person_attribute', MAX(person_attribute_id), NOW() FROM openmrs.person_attribute
+UNION ALL SELECT 'patient_identifier', MAX(patient_identifier_id), NOW() FROM openmrs.patient_identifier;
+
+-- Patients à traiter : tous en reconstruction complète, sinon ceux dont une
+-- ligne a été créée, modifiée ou annulée depuis la dernière exécution.
+-- Les obs sont suivies par obs_id (modifier un formulaire crée de nouvelles
+-- obs) ; leurs annulations passent par date_changed/date_voided de la
+-- rencontre et, si l'index optionnel idx_obs_date_voided existe (PHASE 1),
+-- par date_voided de l'obs : une obs annulée sans modifier la rencontre est
+-- alors aussi retraitée.
+DROP TABLE IF EXISTS _tmp_etl_patient;
+CREATE TABLE _tmp_etl_patient (
+    PRIMARY KEY (patient_id)
+)
+SELECT pa.patient_id
+FROM openmrs.patient pa
+WHERE @etl_incremental = 0;
+
+INSERT IGNORE INTO _tmp_etl_patient (patient_id)
+SELECT o.person_id
+FROM openmrs.obs o
+INNER JOIN etl_watermark w ON w.source_table = 'obs'
+WHERE @etl_incremental = 1
+AND o.obs_id > w.last_id;
+
+INSERT IGNORE INTO _tmp_etl_patient (patient_id)
+SELECT o.person_id
+FROM openmrs.obs o
+INNER JOIN etl_watermark w ON w.source_table = 'obs'
+WHERE @etl_incremental = 1
+AND @obs_date_voided_index = 1
+AND o.date_voided >= w.last_date;
+
+INSERT IGNORE INTO _tmp_etl_patient (patient_id)
+SELECT e.patient_id
+FROM openmrs.encounter e
+INNER JOIN etl_watermark w ON w.source_table = 'encounter'
+WHERE @etl_incremental = 1
+AND (e.encounter_id > w.last_id OR e.date_created >= w.last_date
+  OR e.date_changed >= w.last_date OR e.date_voided >= w.last_date);
+
+INSERT IGNORE INTO _tmp_etl_patient (patient_id)
+SELECT e.patient_id
+FROM openmrs.encounter_provider ep
+INNER JOIN openmrs.encounter e ON e.encounter_id = ep.encounter_id
+INNER JOIN etl_watermark w ON w.source_table = 'encounter_provider'
+WHERE @etl_incremental = 1
+AND (ep.encounter_provider_id > w.last_id OR ep.date_created >= w.last_date
+  OR ep.date_changed >= w.last_date OR ep.date_voided >= w.last_date);
+
+INSERT IGNORE INTO _tmp_etl_patient (patient_id)
+SELECT v.patient_id
+FROM openmrs.visit v
+INNER JOIN etl_watermark w ON w.source_table = 'visit'
+WHERE @etl_incremental = 1
+AND (v.visit_id > w.last_id OR v.date_created >= w.last_date
+  OR v.date_changed >= w.last_date OR v.date_voided >= w.last_date);
+
+INSERT IGNORE INTO _tmp_etl_patient (patient_id)
+SELECT pe.person_id
+FROM openmrs.person pe
+INNER JOIN etl_watermark w ON w.source_table = 'person'
+WHERE @etl_incremental = 1
+AND (pe.person_id > w.last_id OR pe.date_created >= w.last_date
+  OR pe.date_changed >= w.last_date OR pe.date_voided >= w.last_date);
+
+INSERT IGNORE INTO _tmp_etl_patient (patient_id)
+SELECT pa.patient_id
+FROM openmrs.patient pa
+INNER JOIN etl_watermark w ON w.source_table = 'patient'
+WHERE @etl_incremental = 1
+AND (pa.patient_id > w.last_id OR pa.date_created >= w.last_date
+  OR pa.date_changed >= w.last_date OR pa.date_voided >= w.last_date);
+
+INSERT IGNORE INTO _tmp_etl_patient (patient_id)
+SELECT pn.person_id
+FROM openmrs.person_name pn
+INNER JOIN etl_watermark w ON w.source_table = 'person_name'
+WHERE @etl_incremental = 1
+AND (pn.person_name_id > w.last_id OR pn.date_created >= w.last_date
+  OR pn.date_changed >= w.last_date OR pn.date_voided >= w.last_date);
+
+INSERT IGNORE INTO _tmp_etl_patient (patient_id)
+SELECT pad.person_id
+FROM openmrs.person_address pad
+INNER JOIN etl_watermark w ON w.source_table = 'person_address'
+WHERE @etl_incremental = 1
+AND (pad.person_address_id > w.last_id OR pad.date_created >= w.last_date
+  OR pad.date_changed >= w.last_date OR pad.date_voided >= w.last_date);
+
+INSERT IGNORE INTO _tmp_etl_patient (patient_id)
+SELECT pat.person_id
+FROM openmrs.person_attribute pat
+INNER JOIN etl_watermark w ON w.source_table = 'person_attribute'
+WHERE @etl_incremental = 1
+AND (pat.person_attribute_id > w.last_id OR pat.date_created >= w.last_date
+  OR pat.date_changed >= w.last_date OR pat.date_voided >= w.last_date);
+
+INSERT IGNORE INTO _tmp_etl_patient (patient_id)
+SELECT pi.patient_id
+FROM openmrs.patient_identifier pi
+INNER JOIN etl_watermark w ON w.source_table = 'patient_identifier'
+WHERE @etl_incremental = 1
+AND (pi.patient_identifier_id > w.last_id OR pi.date_created >= w.last_date
+  OR pi.date_changed >= w.last_date OR pi.date_voided >= w.last_date);
+
+-- Concepts lus dans _tmp_obs par les sections ci-dessous. Toute nouvelle
+-- condition sur o.concept_id dans une section doit être ajoutée ici.
+DROP TABLE IF EXISTS _tmp_obs_concepts;
+CREATE TABLE _tmp_obs_concepts (
+    concept_id INT NOT NULL,
+    PRIMARY KEY (concept_id)
+);
+
+INSERT IGNORE INTO _tmp_obs_concepts (concept_id) VALUES
+    -- Section 1 : patient
+    (1040), (1042), (1054), (1276), (1282), (1443), (1444), (1542), (5096),
+    (159368), (159599), (159936), (162549), (163258), (163711), (165210),
+    -- Section 3 : dispensation
+    (1442), (1755), (160742),
+    -- Section 5 : qualité des soins
+    (374), (1110), (1113), (1343), (1389), (1633), (1659), (5089), (5090),
+    (5314), (159398), (159431), (159798), (160265), (160592), (160749),
+    (162320), (163283), (163284), (163710), (163951),
+    -- Section 6 : laboratoire
+    (1271), (1941), (160632), (163544),
+    -- Section 7 : TB
+    (307), (1109), (1111), (1169), (1284), (6042), (6097), (159614), (159786),
+    (160040), (160117), (163752), (165804), (165978), (165999), (166134),
+    (166136),
+    -- Section 8 : nutrition
+    (163515),
+    -- Section 9 : OB/GYN
+    (984), (1438), (5085), (5086), (5596), (160079), (160112), (160288),
+    (161007), (163764), (163765), (163766),
+    -- Section 10 : imagerie, discontinuation
+    (12), (309), (1667), (161555),
+    -- Section 11 : grossesse
+    (45), (1427), (1439), (1440), (1592), (1945), (7957), (159758), (160090),
+    (162225), (163749), (163750),
+    -- Section 13 : visites, accouchement, tests virologiques, vaccination
+    (1030), (1061), (1401), (1418), (1572), (5599), (5665), (123160), (156660),
+    (160579), (160580), (160581), (160597), (162087), (163276), (163278),
+    (163540), (163541), (163732), (163776),
+    -- Section 14 : tests sérologiques, paludisme
+    (1272), (1366), (1643), (160168), (163722),
+    -- Section 15 : patient_on_art, populations clés, planification familiale
+    (1651), (5632), (159982), (159984), (160082), (160704), (164432),
+    (509166326),
+    -- patient_status_arv_dml.sql (snapshot partagé, voir NETTOYAGE)
+    (844), (856), (1030), (1282), (1305), (1401), (1667), (159367), (161555);
+
+-- Concepts résolus par UUID en phase 0
+INSERT IGNORE INTO _tmp_obs_concepts (concept_id)
+SELECT c.concept_id
+FROM (
+    SELECT @concept_date_premiers_soins AS concept_id
+    UNION ALL SELECT @concept_ddp
+    UNION ALL SELECT @concept_posology_alt
+    UNION ALL SELECT @concept_tb_diag_group
+    UNION ALL SELECT @concept_mdr_tb_diag_group
+    UNION ALL SELECT @concept_preg_grp_1
+    UNION ALL SELECT @concept_preg_grp_2
+    UNION ALL SELECT @concept_preg_grp_3
+    UNION ALL SELECT @concept_preg_grp_4
+    UNION ALL SELECT @concept_preg_grp_5
+    UNION ALL SELECT @concept_preg_grp_6
+    UNION ALL SELECT @concept_preg_grp_7
+    UNION ALL SELECT @concept_preg_grp_8
+    UNION ALL SELECT @concept_preg_grp_9
+    UNION ALL SELECT @concept_preg_grp_10
+    UNION ALL SELECT @concept_preg_grp_11
+    UNION ALL SELECT @concept_viro_grp_1
+    UNION ALL SELECT @concept_viro_grp_2
+    UNION ALL SELECT @concept_viro_grp_3
+    UNION ALL SELECT @concept_sero_grp_1
+    UNION ALL SELECT @concept_sero_grp_2
+    UNION ALL SELECT @concept_sero_grp_3
+    UNION ALL SELECT @concept_sero_grp_4
+    UNION ALL SELECT @concept_sero_grp_5
+    UNION ALL SELECT @concept_sero_grp_6
+    UNION ALL SELECT @concept_breast_feeding
+    UNION ALL SELECT @concept_genexpert
+    UNION ALL SELECT @concept_key_population
+    UNION ALL SELECT @concept_viral_load_type
+    UNION ALL SELECT @concept_isoniazid_group
+    UNION ALL SELECT @concept_rifampicin_group
+) c
+WHERE c.concept_id IS NOT NULL;
+
+-- Section 6 : résultats des tests demandés (patient_laboratory.test_id = o.concept_id)
+INSERT IGNORE INTO _tmp_obs_concepts (concept_id)
+SELECT DISTINCT o.value_coded
+FROM openmrs.obs o
+WHERE o.concept_id = 1271
+AND o.value_coded IS NOT NULL;
+
+INSERT IGNORE INTO _tmp_obs_concepts (concept_id)
+SELECT DISTINCT pl.test_id
+FROM isanteplus.patient_laboratory pl
+WHERE pl.test_id IS NOT NULL;
+
+-- Une seule copie de obs, limitée aux concepts et colonnes utilisés.
+-- Les auto-jointures (groupe / membres du groupe) lisent cette même table :
+-- plus besoin de copies séparées pour le groupe et ses membres.
+DROP TABLE IF EXISTS _tmp_obs;
+CREATE TABLE _tmp_obs (
+    PRIMARY KEY (obs_id),
+    KEY idx_obs_encounter_concept (encounter_id, concept_id),
+    KEY idx_obs_person_concept (person_id, concept_id),
+    KEY idx_obs_concept_value (concept_id, value_coded),
+    KEY idx_obs_obs_group_id (obs_group_id)
+)
+SELECT
+    o.obs_id,
+    o.person_id,
+    o.concept_id,
+    o.encounter_id,
+    o.obs_datetime,
+    o.location_id,
+    o.obs_group_id,
+    o.value_coded,
+    o.value_datetime,
+    o.value_numeric,
+    o.value_text,
+    o.comments,
+    o.voided
+FROM openmrs.obs o
+INNER JOIN _tmp_obs_concepts c ON c.concept_id = o.concept_id
+WHERE @etl_incremental = 0;
+
+INSERT INTO _tmp_obs
+SELECT
+    o.obs_id,
+    o.person_id,
+    o.concept_id,
+    o.encounter_id,
+    o.obs_datetime,
+    o.location_id,
+    o.obs_group_id,
+    o.value_coded,
+    o.value_datetime,
+    o.value_numeric,
+    o.value_text,
+    o.comments,
+    o.voided
+FROM _tmp_etl_patient t
+INNER JOIN openmrs.obs o ON o.person_id = t.patient_id
+INNER JOIN _tmp_obs_concepts c ON c.concept_id = o.concept_id
+WHERE @etl_incremental = 1;
+
+-- Existence d'une obs par rencontre, pour les sections qui ne filtrent pas
+-- sur le concept (5, 8, 11). Dérivée de _tmp_obs (concepts lus par l'ETL)
+-- sans relire openmrs.obs.
+DROP TABLE IF EXISTS _tmp_obs_encounter;
+CREATE TABLE _tmp_obs_encounter (
+    PRIMARY KEY (encounter_id, person_id, voided)
+)
+SELECT DISTINCT o.encounter_id, o.person_id, o.voided
+FROM _tmp_obs o
+WHERE o.encounter_id IS NOT NULL;
+
+-- Nombre de membres non annulés par groupe d'obs (sections 3 et 4), parmi
+-- les concepts de _tmp_obs
+DROP TABLE IF EXISTS _tmp_obs_group_count;
+CREATE TABLE _tmp_obs_group_count (
+    PRIMARY KEY (encounter_id, obs_group_id)
+)
+SELECT o.encounter_id, o.obs_group_id, COUNT(*) AS active_members
+FROM _tmp_obs o
+WHERE o.voided = 0
+AND o.encounter_id IS NOT NULL
+AND o.obs_group_id IS NOT NULL
+GROUP BY o.encounter_id, o.obs_group_id;
+
+-- Une ligne par rencontre et une colonne par concept lu par les sections 5,
+-- 8 et 9, en un seul parcours groupé de _tmp_obs : chaque table cible est
+-- ensuite mise à jour par une seule jointure. Une colonne reste NULL si la
+-- rencontre n'a pas d'obs correspondante ; si elle en a plusieurs, la plus
+-- grande valeur est retenue.
+DROP TABLE IF EXISTS _tmp_obs_pivot;
+CREATE TABLE _tmp_obs_pivot (
+    PRIMARY KEY (encounter_id, person_id)
+)
+SELECT
+    o.encounter_id,
+    o.person_id,
+    -- Sections 5 et 8
+    MAX(CASE WHEN o.concept_id = 5089 THEN o.value_numeric END) AS weight,
+    MAX(CASE WHEN o.concept_id = 5090 THEN o.value_numeric END) AS height,
+    -- Section 5
+    MAX(CASE WHEN o.concept_id = 374 AND o.value_coded IS NOT NULL
+        THEN 1 END) AS family_planning_method_used,
+    MAX(CASE WHEN o.concept_id IN (160265, 1659, 1110, 163283, 162320, 163284,
+        1633, 1389, 163951, 159431, 1113, 159798, 159398)
+        AND o.value_coded IS NOT NULL THEN 1 END) AS evaluated_of_tb,
+    MAX(CASE WHEN o.concept_id IN (5314, 1343)
+        THEN 1 END) AS nutritional_assessment_completed,
+    MAX(CASE WHEN (o.concept_id = 160592 AND o.value_coded = 113489)
+        OR (o.concept_id = 160749 AND o.value_coded = 1065)
+        THEN 1 END) AS is_active_tb,
+    -- Section 8
+    MAX(CASE WHEN o.concept_id = 159614 AND o.value_coded = 460
+        THEN 1 END) AS edema,
+    MAX(CASE WHEN o.concept_id = 163515 THEN
+        CASE
+        WHEN o.value_coded = 1115 THEN 1 -- Normal
+        WHEN o.value_coded = 164131 THEN 2 -- SAM
+        WHEN o.value_coded = 123815 THEN 2 -- MAM
+        END
+    END) AS weight_for_height,
+    -- Section 9
+    MAX(CASE WHEN o.concept_id = 1343 THEN o.value_numeric END) AS muac,
+    MAX(CASE WHEN o.concept_id = 160288 AND o.value_coded = 1622
+        THEN 1 END) AS pregnant,
+    MAX(CASE WHEN o.concept_id = 5096 THEN o.value_datetime END) AS next_visit_date,
+    MAX(CASE WHEN o.concept_id = 5596 THEN o.value_datetime END) AS edd,
+    MAX(CASE WHEN o.concept_id IN (163764, 161007, 160112, 163765, 163766)
+        AND o.value_coded = 1065 THEN 1 END) AS birth_plan,
+    MAX(CASE WHEN o.concept_id = 160079
+        AND o.value_coded IN (1107, 145777, 148834, 119476, 460, 1053, 163119, 163120)
+        THEN 1 END) AS high_risk,
+    MAX(CASE WHEN o.concept_id = 1438 AND o.value_numeric >= 12
+        THEN 1 END) AS gestation_greater_than_12_wks,
+    MAX(CASE WHEN o.concept_id = 984 AND o.value_coded = 84879
+        THEN 1 END) AS tetanus_toxoid_vaccine,
+    MAX(CASE WHEN o.concept_id = 160079 AND o.value_coded = 148834
+        THEN 1 END) AS iron_defiency_anemia
+FROM _tmp_obs o
+WHERE o.voided = 0
+AND o.encounter_id IS NOT NULL
+AND o.concept_id IN (
+    5089, 5090, 374, 160265, 1659, 1110, 163283, 162320, 163284, 1633, 1389,
+    163951, 159431, 1113, 159798, 159398, 5314, 1343, 160592, 160749,
+    159614, 163515,
+    160288, 5096, 5596, 163764, 161007, 160112, 163765, 163766, 160079,
+    1438, 984
+)
+GROUP BY o.encounter_id, o.person_id;
+
+DROP TABLE IF EXISTS _tmp_encounter;
+CREATE TABLE _tmp_encounter (
+    PRIMARY KEY (encounter_id),
+    KEY idx_enc_patient_id (patient_id),
+    KEY idx_enc_visit_id (visit_id),
+    KEY idx_enc_encounter_type (encounter_type)
+)
+SELECT * FROM openmrs.encounter
+WHERE @etl_incremental = 0;
+
+INSERT INTO _tmp_encounter
+SELECT s.*
+FROM _tmp_etl_patient t
+INNER JOIN openmrs.encounter s ON s.patient_id = t.patient_id
+WHERE @etl_incremental = 1;
+
+DROP TABLE IF EXISTS _tmp_visit;
+CREATE TABLE _tmp_visit (
+    KEY idx_vis_visit_id (visit_id),
+    KEY idx_vis_patient_id (patient_id)
+)
+SELECT * FROM openmrs.visit
+WHERE @etl_incremental = 0;
+
+INSERT INTO _tmp_visit
+SELECT s.*
+FROM _tmp_etl_patient t
+INNER JOIN openmrs.visit s ON s.patient_id = t.patient_id
+WHERE @etl_incremental = 1;
+
+DROP TABLE IF EXISTS _tmp_encounter_provider;
+CREATE TABLE _tmp_encounter_provider (
+    KEY idx_ep_encounter_id (encounter_id)
+)
+SELECT * FROM openmrs.encounter_provider
+WHERE @etl_incremental = 0;
+
+INSERT INTO _tmp_encounter_provider
+SELECT ep.*
+FROM _tmp_etl_patient t
+INNER JOIN openmrs.encounter e ON e.patient_id = t.patient_id
+INNER JOIN openmrs.encounter_provider ep ON ep.encounter_id = e.encounter_id
+WHERE @etl_incremental = 1;
+
+-- Médicaments (1282) des groupes de prescription (1442) et de dispensation
+-- (163711) : une ligne par (encounter_id, location_id, drug_id), avec les
+-- membres de leurs groupes pivotés. Lue par les sections 3 et 4, qui
+-- construisent patient_dispensing et patient_prescription chacune en une
+-- seule écriture. disp_obs_id / rx_obs_id : obs du médicament dans un groupe
+-- de dispensation / de prescription ou dispensation ; si le médicament
+-- figure dans plusieurs groupes de la rencontre (formulaire modifié), l'obs
+-- non annulée est retenue.
+DROP TABLE IF EXISTS _tmp_drug_group;
+CREATE TABLE _tmp_drug_group (
+    PRIMARY KEY (encounter_id, location_id, drug_id)
+)
+SELECT
+    ob.encounter_id,
+    ob.location_id,
+    ob.value_coded AS drug_id,
+    MAX(ob.person_id) AS person_id,
+    COALESCE(
+        MAX(CASE WHEN ob1.concept_id = 163711
+            AND ob2.concept_id IN (1276, 1444, 159368, 1443)
+            AND ob.voided = 0 THEN ob.obs_id END),
+        MAX(CASE WHEN ob1.concept_id = 163711
+            AND ob2.concept_id IN (1276, 1444, 159368, 1443)
+            THEN ob.obs_id END)
+    ) AS disp_obs_id,
+    COALESCE(
+        MAX(CASE WHEN ob2.concept_id IN (160742, 1276, 1444, 159368, 1443)
+            AND ob.voided = 0 THEN ob.obs_id END),
+        MAX(CASE WHEN ob2.concept_id IN (160742, 1276, 1444, 159368, 1443)
+            THEN ob.obs_id END)
+    ) AS rx_obs_id,
+    MAX(CASE WHEN ob1.concept_id = 163711
+        AND ob2.concept_id IN (160742, 1276, 1444, 159368, 1443)
+        THEN 1 ELSE 0 END) AS in_dispensing_group,
+    MAX(CASE WHEN ob1.concept_id = 163711
+        AND ob2.concept_id IN (1276, 1444, 159368, 1443)
+        THEN ob2.obs_datetime END) AS obs_datetime,
+    MAX(CASE WHEN ob1.concept_id = 163711 AND ob2.concept_id = 1276
+        AND ob2.voided = 0 THEN DATE(ob2.obs_datetime) END) AS dispensation_date,
+    MAX(CASE WHEN ob1.concept_id = 1442 AND ob2.concept_id = 160742
+        AND ob2.voided = 0 THEN ob2.value_coded END) AS rx_or_prophy,
+    MAX(CASE WHEN ob1.concept_id = 1442 AND ob2.concept_id = 1444
+        AND ob2.voided = 0 THEN ob2.value_text END) AS posology,
+    MAX(CASE WHEN ob1.concept_id = 1442 AND ob2.concept_id = @concept_posology_alt
+        AND ob2.voided = 0 THEN ob2.value_text END) AS posology_alt,
+    MAX(CASE WHEN ob1.concept_id = 163711 AND ob2.concept_id = 1444
+        AND ob2.voided = 0 THEN ob2.value_text END) AS posology_alt_disp,
+    MAX(CASE WHEN ob2.concept_id = 159368
+        AND ob2.voided = 0 THEN ob2.value_numeric END) AS number_day
+FROM _tmp_obs ob
+INNER JOIN _tmp_obs ob1 ON ob.person_id = ob1.person_id
+    AND ob.encounter_id = ob1.encounter_id
+    AND ob.obs_group_id = ob1.obs_id
+INNER JOIN _tmp_obs ob2 ON ob1.obs_id = ob2.obs_group_id
+WHERE ob1.concept_id IN (1442, 163711)
+AND ob.concept_id = 1282
+AND ob2.concept_id IN (160742, 1276, 1444, 159368, 1443, @concept_posology_alt)
+GROUP BY ob.encounter_id, ob.location_id, ob.value_coded;
+
+-- Valeurs portées par les rencontres de _tmp_drug_group (sections 3 et 4) :
+-- prochaine dispensation, durée et quantité dispensées (groupes 163711),
+-- dispensation communautaire, DDP, prestataire et visite.
+DROP TABLE IF EXISTS _tmp_drug_encounter;
+CREATE TABLE _tmp_drug_encounter (
+    PRIMARY KEY (encounter_id)
+)
+SELECT
+    g.encounter_id,
+    o.next_dispensation_date,
+    o.number_day_dispense,
+    o.pills_amount_dispense,
+    o.community_dispensation,
+    o.ddp,
+    enp.provider_id,
+    vi.visit_id,
+    vi.date_started AS visit_date
+FROM (
+    SELECT DISTINCT encounter_id FROM _tmp_drug_group
+) g
+LEFT JOIN (
+    SELECT o.encounter_id,
+        MAX(CASE WHEN o.concept_id = 162549
+            THEN DATE(o.value_datetime) END) AS next_dispensation_date,
+        MAX(CASE WHEN o.concept_id = 159368 AND og.concept_id = 163711
+            THEN o.value_numeric END) AS number_day_dispense,
+        MAX(CASE WHEN o.concept_id = 1443 AND og.concept_id = 163711
+            THEN o.value_numeric END) AS pills_amount_dispense,
+        MAX(CASE WHEN o.concept_id = 1755 AND o.value_coded = 1065
+            THEN 1 END) AS community_dispensation,
+        MAX(CASE WHEN o.concept_id = @concept_ddp AND o.value_coded = 1065
+            THEN 1 END) AS ddp
+    FROM _tmp_obs o
+    LEFT JOIN _tmp_obs og ON og.obs_id = o.obs_group_id
+    WHERE o.concept_id IN (162549, 159368, 1443, 1755, @concept_ddp)
+    AND o.voided = 0
+    GROUP BY o.encounter_id
+) o ON o.encounter_id = g.encounter_id
+LEFT JOIN (
+    SELECT enp.encounter_id, MAX(enp.provider_id) AS provider_id
+    FROM _tmp_encounter_provider enp
+    WHERE enp.voided = 0
+    GROUP BY enp.encounter_id
+) enp ON enp.encounter_id = g.encounter_id
+LEFT JOIN _tmp_encounter en ON en.encounter_id = g.encounter_id
+LEFT JOIN _tmp_visit vi ON vi.visit_id = en.visit_id;
+
+DROP TABLE IF EXISTS _tmp_person;
+CREATE TABLE _tmp_person (
+    KEY idx_per_person_id (person_id)
+)
+SELECT * FROM openmrs.person
+WHERE @etl_incremental = 0;
+
+INSERT INTO _tmp_person
+SELECT s.*
+FROM _tmp_etl_patient t
+INNER JOIN openmrs.person s ON s.person_id = t.patient_id
+WHERE @etl_incremental = 1;
+
+DROP TABLE IF EXISTS _tmp_patient;
+CREATE TABLE _tmp_patient (
+    KEY idx_pat_patient_id (patient_id)
+)
+SELECT * FROM openmrs.patient
+WHERE @etl_incremental = 0;
+
+INSERT INTO _tmp_patient
+SELECT s.*
+FROM _tmp_etl_patient t
+INNER JOIN openmrs.patient s ON s.patient_id = t.patient_id
+WHERE @etl_incremental = 1;
+
+DROP TABLE IF EXISTS _tmp_person_attribute;
+CREATE TABLE _tmp_person_attribute (
+    KEY idx_pattr_person_id (person_id)
+)
+SELECT * FROM openmrs.person_attribute
+WHERE @etl_incremental = 0;
+
+INSERT INTO _tmp_person_attribute
+SELECT s.*
+FROM _tmp_etl_patient t
+INNER JOIN openmrs.person_attribute s ON s.person_id = t.patient_id
+WHERE @etl_incremental = 1;
+
+-- Rencontres d'arrêt de tous les patients : les alertes (section 12) sont
+-- recalculées pour tous les patients, même en mode incrémental.
+DROP TABLE IF EXISTS _tmp_discontinuation_encounter;
+CREATE TABLE _tmp_discontinuation_encounter (
+    KEY idx_disc_patient_id (patient_id)
+)
+SELECT e.encounter_id, e.patient_id
+FROM openmrs.encounter e
+WHERE e.encounter_type = @et_discontinuation;
 
 -- =============================================================================
 -- SECTION 1 : Données démographiques des patients (patient)
@@ -208,7 +781,196 @@ CREATE TABLE IF NOT EXISTS location(
 
 START TRANSACTION;
 
-/* insert data to patient table */
+/*Adding iSante Site_code to the patient table*/
+INSERT INTO location (name, location_id, isante_location_id)
+SELECT DISTINCT l.name, l.location_id, la.value_reference
+FROM openmrs.location l
+INNER JOIN openmrs.location_attribute la ON l.location_id = la.location_id
+WHERE la.attribute_type_id = @lat_isante_site
+ON DUPLICATE KEY UPDATE
+  name = l.name,
+  isante_location_id = la.value_reference;
+
+/* Une ligne complète par patient des snapshots, construite avant d'écrire
+   la table patient. Chaque source est pivotée en un seul parcours groupé par
+   personne : identifiants, adresses, attributs, obs, rencontres et visites.
+   Une colonne reste NULL si le patient n'a pas de valeur dans sa source.
+   Plusieurs valeurs : le nom préféré non annulé, la valeur la plus récente
+   pour l'état civil et la profession, sinon la plus grande. */
+DROP TEMPORARY TABLE IF EXISTS patient_demographics_temp;
+CREATE TEMPORARY TABLE patient_demographics_temp (
+    PRIMARY KEY (patient_id)
+)
+SELECT pn.person_id AS patient_id,
+  pn.given_name,
+  pn.family_name,
+  pe.gender,
+  pe.birthdate,
+  pn.creator,
+  pn.date_created,
+  pn.voided,
+  pid.st_id,
+  pid.pc_id,
+  pid.national_id,
+  pid.identifier,
+  pid.isante_id,
+  pid.location_id,
+  l.isante_location_id AS site_code,
+  padd.last_address,
+  pat.place_of_birth,
+  pat.telephone,
+  pat.mother_name,
+  CAST(po.maritalStatus AS SIGNED) AS maritalStatus,
+  CAST(po.occupation AS SIGNED) AS occupation,
+  po.contact_name,
+  IF(pen.vih_status = 1, 1, 0) AS vih_status,
+  pv.first_visit_date,
+  pv.last_visit_date,
+  DATE(po.next_visit_date) AS next_visit_date,
+  parv.date_started_arv,
+  po.transferred_in,
+  po.date_transferred_in,
+  po.date_started_arv_other_site
+FROM _tmp_patient pa
+INNER JOIN _tmp_person pe ON pe.person_id = pa.patient_id
+INNER JOIN (
+  SELECT pn.person_id,
+    COALESCE(
+      MAX(CASE WHEN pn.voided = 0 AND pn.preferred = 1 THEN pn.person_name_id END),
+      MAX(CASE WHEN pn.voided = 0 THEN pn.person_name_id END),
+      MAX(pn.person_name_id)
+    ) AS person_name_id
+  FROM _tmp_patient pa
+  INNER JOIN openmrs.person_name pn ON pn.person_id = pa.patient_id
+  GROUP BY pn.person_id
+) pnid ON pnid.person_id = pa.patient_id
+INNER JOIN openmrs.person_name pn ON pn.person_name_id = pnid.person_name_id
+/*ST CODE, PC CODE, National ID, iSantePlus_ID (and its location), isante_id*/
+LEFT JOIN (
+  SELECT pi.patient_id,
+    MAX(CASE WHEN pi.identifier_type = @pit_st_code AND pi.voided = 0
+      THEN pi.identifier END) AS st_id,
+    MAX(CASE WHEN pi.identifier_type = @pit_pc_code AND pi.voided = 0
+      THEN pi.identifier END) AS pc_id,
+    MAX(CASE WHEN pi.identifier_type = @pit_national_id
+      THEN pi.identifier END) AS national_id,
+    MAX(CASE WHEN pi.identifier_type = @pit_isanteplus_id
+      THEN pi.identifier END) AS identifier,
+    MAX(CASE WHEN pi.identifier_type = @pit_isante_id
+      THEN pi.identifier END) AS isante_id,
+    MAX(CASE WHEN pi.identifier_type = @pit_isanteplus_id
+      THEN pi.location_id END) AS location_id
+  FROM _tmp_patient pa
+  INNER JOIN openmrs.patient_identifier pi ON pi.patient_id = pa.patient_id
+  WHERE pi.identifier_type IN (@pit_st_code, @pit_pc_code, @pit_national_id,
+    @pit_isanteplus_id, @pit_isante_id)
+  GROUP BY pi.patient_id
+) pid ON pid.patient_id = pa.patient_id
+LEFT JOIN location l ON l.location_id = pid.location_id
+/*Address*/
+LEFT JOIN (
+  SELECT padd.person_id,
+    MAX(CASE WHEN ((padd.address1 <> '' AND padd.address1 is not null)
+      AND (padd.address2 <> '' AND padd.address2 is not null)
+    )
+      THEN CONCAT(padd.address1,' ',padd.address2)
+    WHEN ((padd.address1 <> '' AND padd.address1 is not null)
+      AND (padd.address2 = '' OR padd.address2 is null)
+    )
+      THEN padd.address1 ELSE padd.address2
+    END) AS last_address
+  FROM _tmp_patient pa
+  INNER JOIN openmrs.person_address padd ON padd.person_id = pa.patient_id
+  GROUP BY padd.person_id
+) padd ON padd.person_id = pa.patient_id
+/*BirthPlace, telephone, mother's Name*/
+LEFT JOIN (
+  SELECT pat.person_id,
+    MAX(CASE WHEN pat.person_attribute_type_id = @pat_birthplace
+      THEN pat.value END) AS place_of_birth,
+    MAX(CASE WHEN pat.person_attribute_type_id = @pat_telephone
+      THEN pat.value END) AS telephone,
+    MAX(CASE WHEN pat.person_attribute_type_id = @pat_mother_name
+      THEN pat.value END) AS mother_name
+  FROM _tmp_person_attribute pat
+  WHERE pat.person_attribute_type_id IN (@pat_birthplace, @pat_telephone,
+    @pat_mother_name)
+  GROUP BY pat.person_id
+) pat ON pat.person_id = pa.patient_id
+/*Civil Status, Occupation, Contact Name, next_visit_date, transfer*/
+LEFT JOIN (
+  SELECT o.person_id,
+    SUBSTRING_INDEX(GROUP_CONCAT(CASE WHEN o.concept_id = 1054
+      THEN o.value_coded END ORDER BY o.obs_datetime DESC, o.obs_id DESC),
+      ',', 1) AS maritalStatus,
+    SUBSTRING_INDEX(GROUP_CONCAT(CASE WHEN o.concept_id = 1542
+      THEN o.value_coded END ORDER BY o.obs_datetime DESC, o.obs_id DESC),
+      ',', 1) AS occupation,
+    MAX(CASE WHEN o.concept_id = 163258 AND ob.concept_id = 165210
+      AND (o.value_text is not null AND o.value_text <> '')
+      THEN o.value_text END) AS contact_name,
+    MAX(CASE WHEN o.concept_id IN (5096, 162549) AND o.voided = 0
+      THEN o.value_datetime END) AS next_visit_date,
+    MAX(CASE WHEN o.concept_id = 159936 AND o.value_coded = 5622
+      THEN 1 END) AS transferred_in,
+    /*Date des premiers soins dans cet établissement*/
+    MAX(CASE WHEN o.concept_id = @concept_date_premiers_soins
+      THEN o.value_datetime END) AS date_transferred_in,
+    /*Date début des ARV dans l'établissement de référence*/
+    MAX(CASE WHEN o.concept_id = 159599
+      THEN o.value_datetime END) AS date_started_arv_other_site
+  FROM _tmp_obs o
+  LEFT JOIN _tmp_obs ob ON ob.obs_id = o.obs_group_id
+      AND ob.person_id = o.person_id
+  WHERE o.concept_id IN (1054, 1542, 163258, 5096, 162549, 159936,
+    @concept_date_premiers_soins, 159599)
+  GROUP BY o.person_id
+) po ON po.person_id = pa.patient_id
+/*vih_status : HIV form, or laboratory form WITH HIV test positive*/
+LEFT JOIN (
+  SELECT en.patient_id,
+    MAX(CASE WHEN en.encounter_type IN (@et_first_hiv_visit, @et_followup_hiv_visit,
+        @et_ped_first_hiv_visit, @et_ped_followup_hiv_visit)
+      OR o.obs_id IS NOT NULL THEN 1 ELSE 0 END) AS vih_status
+  FROM _tmp_encounter en
+  LEFT JOIN _tmp_obs o ON o.encounter_id = en.encounter_id
+      AND o.person_id = en.patient_id
+      AND en.encounter_type = @et_lab
+      AND o.concept_id IN (1040,1042)
+      AND o.value_coded = 703
+      AND o.voided = 0
+  WHERE en.encounter_type IN (@et_first_hiv_visit, @et_followup_hiv_visit,
+    @et_ped_first_hiv_visit, @et_ped_followup_hiv_visit, @et_lab)
+  AND en.voided = 0
+  GROUP BY en.patient_id
+) pen ON pen.patient_id = pa.patient_id
+/*First and last visit dates*/
+LEFT JOIN (
+  SELECT v.patient_id,
+    MIN(v.date_started) AS first_visit_date,
+    MAX(v.date_started) AS last_visit_date
+  FROM _tmp_visit v
+  WHERE v.voided = 0
+  GROUP BY v.patient_id
+) pv ON pv.patient_id = pa.patient_id
+/*date_started_arv*/
+LEFT JOIN (
+  SELECT o.person_id, MIN(o.obs_datetime) AS date_started_arv
+  FROM _tmp_obs ob
+    JOIN _tmp_obs o ON ob.obs_id = o.obs_group_id
+    JOIN _tmp_obs ob2 ON o.obs_group_id = ob2.obs_group_id
+    JOIN isanteplus.arv_drugs darv ON o.value_coded = darv.drug_id
+  WHERE
+    ob.concept_id = 163711
+  AND o.concept_id = 1282
+  AND ob2.concept_id IN (1276, 1444, 159368, 1443)
+  AND o.voided = 0
+  GROUP BY
+    o.person_id
+) parv ON parv.person_id = pa.patient_id;
+
+/* insert data to patient table : one write per patient. A column without a
+   value in its source keeps its current value, as the separate UPDATEs did. */
 INSERT INTO patient
 (
   patient_id,
@@ -220,247 +982,104 @@ INSERT INTO patient
   date_created,
   last_inserted_date,
   last_updated_date,
-  voided
+  voided,
+  st_id,
+  pc_id,
+  national_id,
+  identifier,
+  isante_id,
+  location_id,
+  site_code,
+  last_address,
+  place_of_birth,
+  telephone,
+  mother_name,
+  maritalStatus,
+  occupation,
+  contact_name,
+  vih_status,
+  first_visit_date,
+  last_visit_date,
+  next_visit_date,
+  date_started_arv,
+  transferred_in,
+  date_transferred_in,
+  date_started_arv_other_site
 )
-SELECT pn.person_id,
-  pn.given_name,
-  pn.family_name,
-  pe.gender,
-  pe.birthdate,
-  pn.creator,
-  pn.date_created,
+SELECT d.patient_id,
+  d.given_name,
+  d.family_name,
+  d.gender,
+  d.birthdate,
+  d.creator,
+  d.date_created,
   now() as last_inserted_date,
   now() as last_updated_date,
-  pn.voided
-FROM openmrs.person_name pn
-INNER JOIN _tmp_person pe ON pe.person_id = pn.person_id
-INNER JOIN _tmp_patient pa ON pe.person_id = pa.patient_id
+  d.voided,
+  d.st_id,
+  d.pc_id,
+  d.national_id,
+  d.identifier,
+  d.isante_id,
+  d.location_id,
+  d.site_code,
+  d.last_address,
+  d.place_of_birth,
+  d.telephone,
+  d.mother_name,
+  d.maritalStatus,
+  d.occupation,
+  d.contact_name,
+  d.vih_status,
+  d.first_visit_date,
+  d.last_visit_date,
+  d.next_visit_date,
+  d.date_started_arv,
+  d.transferred_in,
+  d.date_transferred_in,
+  d.date_started_arv_other_site
+FROM patient_demographics_temp d
 ON DUPLICATE KEY UPDATE
-  given_name = pn.given_name,
-  family_name = pn.family_name,
-  gender = pe.gender,
-  birthdate = pe.birthdate,
-  creator = pn.creator,
-  date_created = pn.date_created,
+  given_name = d.given_name,
+  family_name = d.family_name,
+  gender = d.gender,
+  birthdate = d.birthdate,
+  creator = d.creator,
+  date_created = d.date_created,
   last_updated_date = now(),
-  voided = pn.voided;
-
-/*ST CODE*/
-UPDATE patient p
-INNER JOIN openmrs.patient_identifier pi ON p.patient_id = pi.patient_id
-SET p.st_id = pi.identifier
-WHERE pi.identifier_type = @pit_st_code
-AND pi.voided = 0;
-
-/*PC CODE*/
-UPDATE patient p
-INNER JOIN openmrs.patient_identifier pi ON p.patient_id = pi.patient_id
-SET p.pc_id = pi.identifier
-WHERE pi.identifier_type = @pit_pc_code
-AND pi.voided = 0;
-
-/*National ID*/
-UPDATE patient p
-INNER JOIN openmrs.patient_identifier pi ON p.patient_id = pi.patient_id
-SET p.national_id = pi.identifier
-WHERE pi.identifier_type = @pit_national_id;
-
-/*iSantePlus_ID*/
-UPDATE patient p
-INNER JOIN openmrs.patient_identifier pi ON p.patient_id = pi.patient_id
-SET p.identifier = pi.identifier
-WHERE pi.identifier_type = @pit_isanteplus_id;
-
-/*isante_id*/
-UPDATE patient p
-INNER JOIN openmrs.patient_identifier pi ON p.patient_id = pi.patient_id
-SET p.isante_id = pi.identifier
-WHERE pi.identifier_type = @pit_isante_id;
-
-/* update location_id for patients*/
-UPDATE patient p
-INNER JOIN (
-  SELECT DISTINCT pid.patient_id, pid.location_id
-  FROM openmrs.patient_identifier pid
-  WHERE pid.identifier_type = @pit_isanteplus_id
-) pi ON p.patient_id = pi.patient_id
-SET p.location_id = pi.location_id
-WHERE pi.location_id IS NOT NULL;
-
-/*Adding iSante Site_code to the patient table*/
-INSERT INTO location (name, location_id, isante_location_id)
-SELECT DISTINCT l.name, l.location_id, la.value_reference
-FROM openmrs.location l
-INNER JOIN openmrs.location_attribute la ON l.location_id = la.location_id
-WHERE la.attribute_type_id = @lat_isante_site
-ON DUPLICATE KEY UPDATE
-  name = l.name,
-  isante_location_id = la.value_reference;
-
+  voided = d.voided,
+  st_id = COALESCE(d.st_id, patient.st_id),
+  pc_id = COALESCE(d.pc_id, patient.pc_id),
+  national_id = COALESCE(d.national_id, patient.national_id),
+  identifier = COALESCE(d.identifier, patient.identifier),
+  isante_id = COALESCE(d.isante_id, patient.isante_id),
+  location_id = COALESCE(d.location_id, patient.location_id),
+  site_code = COALESCE(d.site_code, patient.site_code),
+  last_address = COALESCE(d.last_address, patient.last_address),
+  place_of_birth = COALESCE(d.place_of_birth, patient.place_of_birth),
+  telephone = COALESCE(d.telephone, patient.telephone),
+  mother_name = COALESCE(d.mother_name, patient.mother_name),
+  maritalStatus = COALESCE(d.maritalStatus, patient.maritalStatus),
+  occupation = COALESCE(d.occupation, patient.occupation),
+  contact_name = COALESCE(d.contact_name, patient.contact_name),
+  vih_status = IF(d.vih_status = 1, 1, patient.vih_status),
+  first_visit_date = COALESCE(d.first_visit_date, patient.first_visit_date),
+  last_visit_date = COALESCE(d.last_visit_date, patient.last_visit_date),
+  next_visit_date = COALESCE(d.next_visit_date, patient.next_visit_date),
+  date_started_arv = COALESCE(d.date_started_arv, patient.date_started_arv),
+  transferred_in = COALESCE(d.transferred_in, patient.transferred_in),
+  date_transferred_in = COALESCE(d.date_transferred_in, patient.date_transferred_in),
+  date_started_arv_other_site = COALESCE(d.date_started_arv_other_site,
+    patient.date_started_arv_other_site);
+
+DROP TEMPORARY TABLE IF EXISTS patient_demographics_temp;
+
+/* site_code of the patients not rebuilt above, when their site changed code.
+   Only the rows whose code differs are written. */
 UPDATE isanteplus.patient p
 INNER JOIN isanteplus.location l ON p.location_id = l.location_id
-SET site_code = l.isante_location_id;
-
-/*update patient with address*/
-UPDATE patient p
-INNER JOIN openmrs.person_address padd ON p.patient_id = padd.person_id
-SET p.last_address=
-CASE WHEN ((padd.address1 <> '' AND padd.address1 is not null)
-  AND (padd.address2 <> '' AND padd.address2 is not null)
-)
-  THEN CONCAT(padd.address1,' ',padd.address2)
-WHEN ((padd.address1 <> '' AND padd.address1 is not null)
-  AND (padd.address2 = '' OR padd.address2 is null)
-)
-  THEN padd.address1 ELSE padd.address2
-END;
-
-/*Update for birthPlace*/
-UPDATE patient p
-INNER JOIN _tmp_person_attribute pa ON p.patient_id = pa.person_id
-SET p.place_of_birth = pa.value
-WHERE pa.person_attribute_type_id = @pat_birthplace;
-
-/*Update for telephone*/
-UPDATE patient p
-INNER JOIN _tmp_person_attribute pa ON p.patient_id = pa.person_id
-SET p.telephone = pa.value
-WHERE pa.person_attribute_type_id = @pat_telephone;
-
-/*Update for mother's Name*/
-UPDATE patient p
-INNER JOIN _tmp_person_attribute pa ON p.patient_id = pa.person_id
-SET p.mother_name = pa.value
-WHERE pa.person_attribute_type_id = @pat_mother_name;
-
-/*Update for Civil Status */
-DROP TABLE IF EXISTS patient_obs_temp;
-CREATE TEMPORARY TABLE patient_obs_temp
-SELECT person_id, MAX(obs_datetime) AS obsDt, value_coded
-FROM _tmp_obs WHERE concept_id = 1054
-GROUP BY person_id;
-
-UPDATE patient p
-INNER JOIN patient_obs_temp po ON p.patient_id = po.person_id
-SET p.maritalStatus = po.value_coded;
-
-/*Update for Occupation */
-DROP TABLE IF EXISTS patient_obs_temp;
-CREATE TEMPORARY TABLE patient_obs_temp
-SELECT person_id, MAX(obs_datetime) AS obsDt, value_coded
-FROM _tmp_obs WHERE concept_id = 1542
-GROUP BY person_id;
-
-UPDATE patient p
-INNER JOIN patient_obs_temp po ON p.patient_id = po.person_id
-SET p.occupation = po.value_coded;
-
-/*Update for Contact Name*/
-UPDATE patient p
-INNER JOIN _tmp_obs o ON p.patient_id = o.person_id
-INNER JOIN _tmp_obs_grp ob ON o.person_id = ob.person_id
-    AND o.obs_group_id = ob.obs_id
-SET p.contact_name = o.value_text
-WHERE o.concept_id = 163258
-AND ob.concept_id = 165210
-AND (o.value_text is not null AND o.value_text <> '');
-
-/* update patient with vih_status when patient has a HIV form*/
-UPDATE patient p
-INNER JOIN _tmp_encounter en ON p.patient_id = en.patient_id
-SET p.vih_status = 1
-WHERE en.encounter_type IN (@et_first_hiv_visit, @et_followup_hiv_visit, @et_ped_first_hiv_visit, @et_ped_followup_hiv_visit)
-AND en.voided = 0;
-
-/*Update vih_status WHEN patient has a laboratory form WITH HIV test positive*/
-UPDATE patient p
-INNER JOIN _tmp_encounter en ON p.patient_id = en.patient_id
-INNER JOIN _tmp_obs o ON en.encounter_id = o.encounter_id
-    AND en.patient_id = o.person_id
-SET p.vih_status = 1
-WHERE en.encounter_type = @et_lab
-AND o.concept_id IN (1040,1042)
-AND o.value_coded = 703
-AND en.voided = 0
-AND o.voided = 0;
-
-/*Update patient table for having first visit date */
-UPDATE patient p
-INNER JOIN _tmp_visit vi ON p.patient_id = vi.patient_id
-INNER JOIN (
-  SELECT v.patient_id, MIN(v.date_started) as date_started
-  FROM _tmp_visit_2 v
-  GROUP BY v.patient_id
-) B ON vi.patient_id = B.patient_id
-    AND vi.date_started = B.date_started
-SET p.first_visit_date = vi.date_started
-WHERE vi.voided = 0;
-
-/*Update patient table for having last visit date */
-UPDATE patient p
-INNER JOIN _tmp_visit vi ON p.patient_id = vi.patient_id
-INNER JOIN (
-  SELECT v.patient_id, MAX(v.date_started) as date_started
-  FROM _tmp_visit_2 v
-  GROUP BY v.patient_id
-) B ON vi.patient_id = B.patient_id
-    AND vi.date_started = B.date_started
-SET p.last_visit_date = vi.date_started
-WHERE vi.voided = 0;
-
-/*Update next_visit_date on table patient*/
-DROP TABLE IF EXISTS patient_obs_temp;
-CREATE TEMPORARY TABLE patient_obs_temp
-SELECT person_id, MAX(value_datetime) AS obsDt, value_coded
-FROM _tmp_obs WHERE concept_id IN(5096,162549) AND voided = 0
-AND value_datetime IS NOT NULL
-GROUP BY person_id;
-
-UPDATE patient p
-INNER JOIN patient_obs_temp po ON p.patient_id = po.person_id
-SET p.next_visit_date = DATE(po.obsDt);
-
-/*Update for date_started_arv area in patient table */
-DROP TABLE IF EXISTS patient_obs_temp;
-CREATE TEMPORARY TABLE patient_obs_temp
-SELECT o.person_id, MIN(o.obs_datetime) AS obsDt, o.value_coded
-FROM _tmp_obs_grp ob
-  JOIN _tmp_obs o ON ob.obs_id = o.obs_group_id
-  JOIN _tmp_obs_sib ob2 ON o.obs_group_id = ob2.obs_group_id
-  JOIN isanteplus.arv_drugs darv ON o.value_coded = darv.drug_id
-WHERE
-  ob.concept_id = 163711
-AND o.concept_id = 1282
-AND ob2.concept_id IN (1276, 1444, 159368, 1443)
-AND o.voided = 0
-GROUP BY
-  o.person_id;
-
-UPDATE patient p
-INNER JOIN patient_obs_temp po ON p.patient_id = po.person_id
-SET p.date_started_arv = po.obsDt;
-
-DROP TABLE IF EXISTS patient_obs_temp;
-
-UPDATE patient p
-INNER JOIN _tmp_obs o ON p.patient_id = o.person_id
-SET p.transferred_in = 1
-WHERE o.concept_id = 159936
-AND o.value_coded = 5622;
-
-/*Date des premiers soins dans cet établissement*/
-UPDATE patient p
-INNER JOIN _tmp_obs o ON p.patient_id = o.person_id
-SET p.date_transferred_in = o.value_datetime
-WHERE o.concept_id = @concept_date_premiers_soins
-AND o.value_datetime IS NOT NULL;
-
-/*Date début des ARV dans l'établissement de référence*/
-UPDATE patient p
-INNER JOIN _tmp_obs o ON p.patient_id = o.person_id
-SET p.date_started_arv_other_site = o.value_datetime
-WHERE o.concept_id = 159599
-AND o.value_datetime IS NOT NULL;
+SET site_code = l.isante_location_id
+WHERE NOT (p.site_code <=> l.isante_location_id);
 
 COMMIT;
 
@@ -494,12 +1113,43 @@ ON DUPLICATE KEY UPDATE
 
 COMMIT;
 
+/* Dernière visite et dernière première consultation VIH par patient
+   (patient_latest_visit), recalculées pour les patients à traiter */
+SET @sql := IF(@etl_incremental = 1,
+    'DELETE lv FROM patient_latest_visit lv INNER JOIN _tmp_etl_patient t ON t.patient_id = lv.patient_id',
+    'TRUNCATE TABLE patient_latest_visit');
+PREPARE stmt FROM @sql;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
+
+INSERT INTO patient_latest_visit (patient_id, visit_date, hiv_first_visit_datetime)
+SELECT t.patient_id, v.visit_date, e.hiv_first_visit_datetime
+FROM _tmp_etl_patient t
+LEFT JOIN (
+  SELECT vi.patient_id, MAX(DATE(vi.date_started)) AS visit_date
+  FROM _tmp_visit vi
+  WHERE vi.voided = 0
+  GROUP BY vi.patient_id
+) v ON v.patient_id = t.patient_id
+LEFT JOIN (
+  SELECT en.patient_id, MAX(en.encounter_datetime) AS hiv_first_visit_datetime
+  FROM _tmp_encounter en
+  WHERE en.encounter_type IN (@et_first_hiv_visit, @et_ped_first_hiv_visit)
+  AND en.voided = 0
+  GROUP BY en.patient_id
+) e ON e.patient_id = t.patient_id
+WHERE v.visit_date IS NOT NULL
+OR e.hiv_first_visit_datetime IS NOT NULL;
+
 -- =============================================================================
 -- SECTION 3 : Dispensation (patient_dispensing, patient_on_arv)
 -- =============================================================================
 START TRANSACTION;
 
-/*Insert for patient_id,encounter_id, drug_id areas*/
+/* Une ligne par médicament dispensé, avec toutes ses colonnes, en une seule
+   écriture de patient_dispensing (voir _tmp_drug_group et
+   _tmp_drug_encounter au SNAPSHOT). Une colonne sans valeur dans sa source
+   garde sa valeur actuelle, comme avec les UPDATE séparés. */
 INSERT INTO patient_dispensing
 (
   patient_id,
@@ -509,125 +1159,64 @@ INSERT INTO patient_dispensing
   obs_group_id,
   drug_id,
   dispensation_date,
+  next_dispensation_date,
+  provider_id,
+  dose_day,
+  pills_amount,
+  visit_id,
+  visit_date,
+  dispensation_location,
+  ddp,
+  arv_drug,
+  rx_or_prophy,
   last_updated_date,
   voided
 )
-SELECT DISTINCT ob.person_id,
-  ob.encounter_id,ob.location_id,ob.obs_id, ob.obs_group_id,
-  ob.value_coded,ob2.obs_datetime, now(), ob.voided
-FROM _tmp_obs ob
-INNER JOIN _tmp_obs_grp ob1 ON ob.person_id = ob1.person_id
-    AND ob.encounter_id = ob1.encounter_id
-    AND ob.obs_group_id = ob1.obs_id
-INNER JOIN _tmp_obs_sib ob2 ON ob1.obs_id = ob2.obs_group_id
-WHERE ob1.concept_id = 163711
-AND ob.concept_id = 1282
-AND ob2.concept_id IN(1444,159368,1443,1276)
+SELECT d.person_id,
+  d.encounter_id,
+  d.location_id,
+  ob.obs_id,
+  ob.obs_group_id,
+  d.drug_id,
+  COALESCE(d.dispensation_date, d.obs_datetime),
+  e.next_dispensation_date,
+  e.provider_id,
+  e.number_day_dispense,
+  e.pills_amount_dispense,
+  e.visit_id,
+  e.visit_date,
+  IF(e.community_dispensation = 1, 1755, 0),
+  IF(e.ddp = 1, 1065, NULL),
+  IF(ad.drug_id IS NOT NULL, 1065, 1066),
+  d.rx_or_prophy,
+  now(),
+  IF(gc.active_members <= 1, 1, ob.voided)
+FROM _tmp_drug_group d
+INNER JOIN _tmp_obs ob ON ob.obs_id = d.disp_obs_id
+INNER JOIN _tmp_drug_encounter e ON e.encounter_id = d.encounter_id
+/*the drug is a ARV drug*/
+LEFT JOIN arv_drugs ad ON ad.drug_id = d.drug_id
+/*voided for drug removing: no other active member left in the group*/
+LEFT JOIN _tmp_obs_group_count gc ON gc.encounter_id = ob.encounter_id
+    AND gc.obs_group_id = ob.obs_group_id
 ON DUPLICATE KEY UPDATE
   obs_id = ob.obs_id,
   obs_group_id = ob.obs_group_id,
-  dispensation_date = ob2.obs_datetime,
+  dispensation_date = COALESCE(d.dispensation_date, d.obs_datetime),
+  next_dispensation_date = COALESCE(e.next_dispensation_date,
+    patient_dispensing.next_dispensation_date),
+  provider_id = COALESCE(e.provider_id, patient_dispensing.provider_id),
+  dose_day = COALESCE(e.number_day_dispense, patient_dispensing.dose_day),
+  pills_amount = COALESCE(e.pills_amount_dispense, patient_dispensing.pills_amount),
+  visit_id = COALESCE(e.visit_id, patient_dispensing.visit_id),
+  visit_date = COALESCE(e.visit_date, patient_dispensing.visit_date),
+  dispensation_location = IF(e.community_dispensation = 1, 1755,
+    patient_dispensing.dispensation_location),
+  ddp = IF(e.ddp = 1, 1065, patient_dispensing.ddp),
+  arv_drug = IF(ad.drug_id IS NOT NULL, 1065, patient_dispensing.arv_drug),
+  rx_or_prophy = COALESCE(d.rx_or_prophy, patient_dispensing.rx_or_prophy),
   last_updated_date = NOW(),
-  voided = ob.voided;
-
-/*update dispensation_date for table patient_dispensing */
-UPDATE patient_dispensing patdisp
-INNER JOIN _tmp_obs ob ON patdisp.encounter_id = ob.encounter_id
-INNER JOIN _tmp_obs_grp o ON ob.obs_group_id = o.obs_group_id
-    AND patdisp.drug_id = o.value_coded
-SET patdisp.dispensation_date = DATE(ob.obs_datetime)
-WHERE o.concept_id = 1282
-AND ob.concept_id = 1276
-AND ob.voided = 0;
-
-/*update next_dispensation_date for table patient_dispensing*/
-UPDATE patient_dispensing patdisp
-INNER JOIN _tmp_obs ob ON patdisp.encounter_id = ob.encounter_id
-SET patdisp.next_dispensation_date = DATE(ob.value_datetime)
-WHERE ob.concept_id = 162549
-AND ob.voided = 0;
-
-/*update provider for patient_dispensing*/
-UPDATE patient_dispensing padisp
-INNER JOIN _tmp_encounter_provider enp ON padisp.encounter_id = enp.encounter_id
-SET padisp.provider_id = enp.provider_id
-WHERE enp.voided = 0;
-
-/*Update dose_day, pill_amount for patient_dispensing*/
-UPDATE isanteplus.patient_dispensing patdisp
-INNER JOIN _tmp_obs ob ON patdisp.encounter_id = ob.encounter_id
-INNER JOIN _tmp_obs_grp ob1 ON ob.encounter_id = ob1.encounter_id
-    AND ob.obs_group_id = ob1.obs_id
-SET patdisp.dose_day = ob.value_numeric
-WHERE ob1.concept_id = 163711
-AND ob.concept_id = 159368
-AND ob.voided = 0;
-
-/*Update pill_amount for patient_dispensing*/
-UPDATE isanteplus.patient_dispensing patdisp
-INNER JOIN _tmp_obs ob ON patdisp.encounter_id = ob.encounter_id
-INNER JOIN _tmp_obs_grp ob1 ON ob.encounter_id = ob1.encounter_id
-    AND ob.obs_group_id = ob1.obs_id
-SET patdisp.pills_amount = ob.value_numeric
-WHERE ob1.concept_id = 163711
-AND ob.concept_id = 1443
-AND ob.voided = 0;
-
-/*update visit_id, visit_date for table patient_dispensing*/
-UPDATE patient_dispensing patdisp
-INNER JOIN _tmp_encounter en ON patdisp.encounter_id = en.encounter_id
-INNER JOIN _tmp_visit vi ON en.visit_id = vi.visit_id
-SET patdisp.visit_id = vi.visit_id, patdisp.visit_date = vi.date_started;
-
-/*update dispensation_location Dispensation communautaire=1755 for table patient_dispensing*/
-UPDATE patient_dispensing patdisp
-INNER JOIN _tmp_obs ob ON patdisp.encounter_id = ob.encounter_id
-SET patdisp.dispensation_location = 1755
-WHERE ob.concept_id = 1755
-AND ob.value_coded = 1065
-AND ob.voided = 0;
-
-/*UPDATE ddp field for patient on DDP*/
-UPDATE patient_dispensing patdisp
-INNER JOIN _tmp_obs ob ON patdisp.encounter_id = ob.encounter_id
-SET patdisp.ddp = 1065
-WHERE ob.concept_id = @concept_ddp
-AND ob.value_coded = 1065
-AND ob.voided = 0;
-
-/* Update on patient_dispensing where the drug is a ARV drug */
-UPDATE patient_dispensing pdis
-INNER JOIN arv_drugs ad ON pdis.drug_id = ad.drug_id
-SET pdis.arv_drug = 1065;
-
-/*update rx_or_prophy for table patient_dispensing*/
-UPDATE isanteplus.patient_dispensing pdisp
-INNER JOIN _tmp_obs ob2 ON pdisp.encounter_id = ob2.encounter_id
-    AND pdisp.patient_id = ob2.person_id
-    AND pdisp.location_id = ob2.location_id
-INNER JOIN _tmp_obs_grp ob1 ON ob1.obs_id = ob2.obs_group_id
-INNER JOIN _tmp_obs_sib ob3 ON ob1.obs_id = ob3.obs_group_id
-    AND pdisp.drug_id = ob3.value_coded
-SET pdisp.rx_or_prophy = ob2.value_coded
-WHERE ob1.concept_id = 1442
-AND ob2.concept_id = 160742
-AND ob3.concept_id = 1282
-AND ob2.voided = 0;
-
-/*Update voided for drug removing*/
-UPDATE isanteplus.patient_dispensing pp
-INNER JOIN (
-  select pap.obs_group_id, count(ob.obs_group_id)
-  FROM _tmp_obs ob
-  INNER JOIN isanteplus.patient_prescription pap
-  ON pap.encounter_id = ob.encounter_id
-  AND ob.obs_group_id = pap.obs_group_id
-  WHERE ob.voided = 0
-  GROUP BY 1
-  HAVING count(ob.obs_group_id) <= 1
-) B ON pp.obs_group_id = B.obs_group_id
-SET pp.voided = 1
-WHERE pp.voided <> 1;
+  voided = IF(gc.active_members <= 1, 1, ob.voided);
 
 /*INSERTION for patient on ARV*/
 INSERT INTO patient_on_arv(patient_id,visit_id,visit_date, last_updated_date)
@@ -644,42 +1233,42 @@ ON DUPLICATE KEY UPDATE
 
 COMMIT;
 
+/* Première et dernière dispensation par patient (patient_latest_dispensing),
+   recalculées pour les patients à traiter */
+SET @sql := IF(@etl_incremental = 1,
+    'DELETE ld FROM patient_latest_dispensing ld INNER JOIN _tmp_etl_patient t ON t.patient_id = ld.patient_id',
+    'TRUNCATE TABLE patient_latest_dispensing');
+PREPARE stmt FROM @sql;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
+
+INSERT INTO patient_latest_dispensing (patient_id, first_arv_visit_date,
+  last_arv_encounter_id, next_arv_dispensation_date,
+  next_arv_rx_dispensation_date, last_visit_date)
+SELECT pdis.patient_id,
+  MIN(CASE WHEN pdis.arv_drug = 1065 THEN DATE(pdis.visit_date) END),
+  MAX(CASE WHEN pdis.arv_drug = 1065 THEN pdis.encounter_id END),
+  MAX(CASE WHEN pdis.arv_drug = 1065 AND pdis.voided <> 1
+    THEN pdis.next_dispensation_date END),
+  MAX(CASE WHEN pdis.arv_drug = 1065 AND pdis.voided <> 1
+    AND (pdis.rx_or_prophy <> 163768 OR pdis.rx_or_prophy IS NULL)
+    THEN pdis.next_dispensation_date END),
+  MAX(CASE WHEN pdis.voided <> 1 THEN DATE(pdis.visit_date) END)
+FROM _tmp_etl_patient t
+INNER JOIN patient_dispensing pdis ON pdis.patient_id = t.patient_id
+GROUP BY pdis.patient_id;
+
 -- =============================================================================
 -- SECTION 4 : Prescription (patient_prescription)
 -- =============================================================================
 START TRANSACTION;
 
-/*Insert for patient_id,encounter_id, drug_id areas*/
-INSERT INTO patient_prescription(
-  patient_id,
-  encounter_id,
-  location_id,
-  obs_id,
-  obs_group_id,
-  drug_id,
-  dispense,
-  last_updated_date,
-  voided
-)
-SELECT DISTINCT ob.person_id,
-  ob.encounter_id,ob.location_id,ob.obs_id, ob.obs_group_id,ob.value_coded,
-  IF(ob1.concept_id = 163711, 1065, 1066), now(), ob.voided
-FROM _tmp_obs ob
-INNER JOIN _tmp_obs_grp ob1 ON ob.person_id = ob1.person_id
-    AND ob.encounter_id = ob1.encounter_id
-    AND ob.obs_group_id = ob1.obs_id
-INNER JOIN _tmp_obs_sib ob2 ON ob1.obs_id = ob2.obs_group_id
-WHERE (ob1.concept_id = 1442 OR ob1.concept_id = 163711)
-AND ob.concept_id = 1282
-AND ob2.concept_id IN(160742,1276,1444,159368,1443)
-ON DUPLICATE KEY UPDATE
-  encounter_id = ob.encounter_id,
-  obs_id = ob.obs_id,
-  obs_group_id = ob.obs_group_id,
-  last_updated_date = now(),
-  voided = ob.voided;
-
-/*Insert for dispensing drugs*/
+/* Une ligne par médicament prescrit ou dispensé, avec toutes ses colonnes,
+   en une seule écriture de patient_prescription, à partir des mêmes tables
+   que patient_dispensing (_tmp_drug_group, _tmp_drug_encounter). L'obs et
+   la date de dispensation viennent du groupe de dispensation quand il
+   existe. Une colonne sans valeur dans sa source garde sa valeur actuelle,
+   comme avec les UPDATE séparés. */
 INSERT INTO patient_prescription(
   patient_id,
   encounter_id,
@@ -689,164 +1278,82 @@ INSERT INTO patient_prescription(
   drug_id,
   dispensation_date,
   dispense,
+  arv_drug,
+  provider_id,
+  visit_id,
+  visit_date,
+  next_dispensation_date,
+  dispensation_location,
+  rx_or_prophy,
+  posology,
+  posology_alt,
+  posology_alt_disp,
+  number_day,
+  number_day_dispense,
+  pills_amount_dispense,
   last_updated_date,
   voided
 )
-SELECT DISTINCT ob.person_id,
-  ob.encounter_id,ob.location_id,ob.obs_id,ob.obs_group_id,
-  ob.value_coded,DATE(ob2.obs_datetime), 1065, now(), ob.voided
-FROM _tmp_obs ob
-INNER JOIN _tmp_obs_grp ob1 ON ob.person_id = ob1.person_id
-    AND ob.encounter_id = ob1.encounter_id
-    AND ob.obs_group_id = ob1.obs_id
-INNER JOIN _tmp_obs_sib ob2 ON ob1.obs_id = ob2.obs_group_id
-WHERE ob1.concept_id = 163711
-AND ob.concept_id = 1282
-AND ob2.concept_id IN(1276,1444,159368,1443)
+SELECT d.person_id,
+  d.encounter_id,
+  d.location_id,
+  ob.obs_id,
+  ob.obs_group_id,
+  d.drug_id,
+  IF(d.disp_obs_id IS NOT NULL,
+    COALESCE(d.dispensation_date, DATE(d.obs_datetime)), NULL),
+  IF(d.in_dispensing_group = 1, 1065, 1066),
+  IF(ad.drug_id IS NOT NULL, 1065, 1066),
+  e.provider_id,
+  e.visit_id,
+  e.visit_date,
+  e.next_dispensation_date,
+  IF(e.community_dispensation = 1, 1755, 0),
+  d.rx_or_prophy,
+  d.posology,
+  d.posology_alt,
+  d.posology_alt_disp,
+  d.number_day,
+  e.number_day_dispense,
+  e.pills_amount_dispense,
+  now(),
+  IF(gc.active_members <= 1, 1, ob.voided)
+FROM _tmp_drug_group d
+INNER JOIN _tmp_obs ob ON ob.obs_id = COALESCE(d.disp_obs_id, d.rx_obs_id)
+INNER JOIN _tmp_drug_encounter e ON e.encounter_id = d.encounter_id
+/*the drug is a ARV drug*/
+LEFT JOIN arv_drugs ad ON ad.drug_id = d.drug_id
+/*voided for drug removing: no other active member left in the group*/
+LEFT JOIN _tmp_obs_group_count gc ON gc.encounter_id = ob.encounter_id
+    AND gc.obs_group_id = ob.obs_group_id
+WHERE d.rx_obs_id IS NOT NULL
 ON DUPLICATE KEY UPDATE
   obs_id = ob.obs_id,
   obs_group_id = ob.obs_group_id,
-  dispensation_date = ob2.obs_datetime,
-  dispense = 1065,
+  dispensation_date = COALESCE(IF(d.disp_obs_id IS NOT NULL,
+    COALESCE(d.dispensation_date, DATE(d.obs_datetime)), NULL),
+    patient_prescription.dispensation_date),
+  dispense = IF(d.disp_obs_id IS NOT NULL, 1065, patient_prescription.dispense),
+  arv_drug = IF(ad.drug_id IS NOT NULL, 1065, patient_prescription.arv_drug),
+  provider_id = COALESCE(e.provider_id, patient_prescription.provider_id),
+  visit_id = COALESCE(e.visit_id, patient_prescription.visit_id),
+  visit_date = COALESCE(e.visit_date, patient_prescription.visit_date),
+  next_dispensation_date = COALESCE(e.next_dispensation_date,
+    patient_prescription.next_dispensation_date),
+  dispensation_location = IF(e.community_dispensation = 1, 1755,
+    patient_prescription.dispensation_location),
+  rx_or_prophy = COALESCE(d.rx_or_prophy, patient_prescription.rx_or_prophy),
+  posology = COALESCE(d.posology, patient_prescription.posology),
+  posology_alt = COALESCE(d.posology_alt, patient_prescription.posology_alt),
+  posology_alt_disp = COALESCE(d.posology_alt_disp,
+    patient_prescription.posology_alt_disp),
+  number_day = COALESCE(d.number_day, patient_prescription.number_day),
+  number_day_dispense = COALESCE(e.number_day_dispense,
+    patient_prescription.number_day_dispense),
+  pills_amount_dispense = COALESCE(e.pills_amount_dispense,
+    patient_prescription.pills_amount_dispense),
   last_updated_date = now(),
-  voided = ob.voided;
-
-/* Update on patient_prescription where the drug is a ARV drug */
-UPDATE patient_prescription ppres
-INNER JOIN arv_drugs ad ON ppres.drug_id = ad.drug_id
-SET ppres.arv_drug = 1065;
-
-/*update provider for patient_prescription*/
-UPDATE patient_prescription pp
-INNER JOIN _tmp_encounter_provider enp ON pp.encounter_id = enp.encounter_id
-SET pp.provider_id = enp.provider_id;
-
-/*update visit_id, visit_date for table patient_prescription*/
-UPDATE patient_prescription patp
-INNER JOIN _tmp_encounter en ON patp.encounter_id = en.encounter_id
-INNER JOIN _tmp_visit vi ON en.visit_id = vi.visit_id
-SET patp.visit_id = vi.visit_id, patp.visit_date = vi.date_started;
-
-/*update next_dispensation_date for table patient_prescription*/
-UPDATE patient_prescription pp
-INNER JOIN _tmp_obs ob ON pp.encounter_id = ob.encounter_id
-SET pp.next_dispensation_date = DATE(ob.value_datetime)
-WHERE ob.concept_id = 162549
-AND ob.voided = 0;
-
-/*update dispensation_location Dispensation communautaire=1755 for table patient_prescription*/
-UPDATE patient_prescription pp
-INNER JOIN _tmp_obs ob ON pp.encounter_id = ob.encounter_id
-SET pp.dispensation_location = 1755
-WHERE ob.concept_id = 1755
-AND ob.value_coded = 1065
-AND ob.voided = 0;
-
-/*update rx_or_prophy for table patient_prescription*/
-UPDATE isanteplus.patient_prescription pp
-INNER JOIN _tmp_obs ob2 ON pp.encounter_id = ob2.encounter_id
-INNER JOIN _tmp_obs_grp ob1 ON ob1.obs_id = ob2.obs_group_id
-INNER JOIN _tmp_obs_sib ob3 ON ob1.obs_id = ob3.obs_group_id
-    AND pp.drug_id = ob3.value_coded
-SET pp.rx_or_prophy = ob2.value_coded
-WHERE ob1.concept_id = 1442
-AND ob2.concept_id = 160742
-AND ob3.concept_id = 1282
-AND ob2.voided = 0;
-
-/*update posology_day for table patient_prescription*/
-UPDATE isanteplus.patient_prescription pp
-INNER JOIN _tmp_obs ob2 ON pp.encounter_id = ob2.encounter_id
-INNER JOIN _tmp_obs_grp ob1 ON ob1.obs_id = ob2.obs_group_id
-INNER JOIN _tmp_obs_sib ob3 ON ob1.obs_id = ob3.obs_group_id
-    AND pp.drug_id = ob3.value_coded
-SET pp.posology = ob2.value_text
-WHERE ob1.concept_id = 1442
-AND ob2.concept_id = 1444
-AND ob3.concept_id = 1282
-AND ob2.voided = 0;
-
-/*Update for posology_alt */
-UPDATE isanteplus.patient_prescription pp
-INNER JOIN _tmp_obs ob2 ON pp.encounter_id = ob2.encounter_id
-INNER JOIN _tmp_obs_grp ob1 ON ob1.obs_id = ob2.obs_group_id
-INNER JOIN _tmp_obs_sib ob3 ON ob1.obs_id = ob3.obs_group_id
-    AND pp.drug_id = ob3.value_coded
-SET pp.posology_alt = ob2.value_text
-WHERE ob1.concept_id = 1442
-AND ob2.concept_id = @concept_posology_alt
-AND ob3.concept_id = 1282
-AND ob2.voided = 0;
-
-/*update posology_alt_disp for table patient_prescription*/
-UPDATE isanteplus.patient_prescription pp
-INNER JOIN _tmp_obs ob2 ON pp.encounter_id = ob2.encounter_id
-INNER JOIN _tmp_obs_grp ob1 ON ob1.obs_id = ob2.obs_group_id
-INNER JOIN _tmp_obs_sib ob3 ON ob1.obs_id = ob3.obs_group_id
-    AND pp.drug_id = ob3.value_coded
-SET pp.posology_alt_disp = ob2.value_text
-WHERE ob1.concept_id = 163711
-AND ob2.concept_id = 1444
-AND ob3.concept_id = 1282
-AND ob2.voided = 0;
-
-/*update number_day for table patient_prescription*/
-UPDATE isanteplus.patient_prescription pp
-INNER JOIN _tmp_obs ob2 ON pp.encounter_id = ob2.encounter_id
-INNER JOIN _tmp_obs_grp ob1 ON ob1.obs_id = ob2.obs_group_id
-INNER JOIN _tmp_obs_sib ob3 ON ob1.obs_id = ob3.obs_group_id
-    AND pp.drug_id = ob3.value_coded
-SET pp.number_day = ob2.value_numeric
-WHERE (ob1.concept_id = 1442 OR ob1.concept_id = 163711)
-AND ob2.concept_id = 159368
-AND ob3.concept_id = 1282
-AND ob2.voided = 0;
-
-/*Update number_day_dispense for patient_prescription*/
-UPDATE isanteplus.patient_prescription patdisp
-INNER JOIN _tmp_obs ob ON patdisp.encounter_id = ob.encounter_id
-INNER JOIN _tmp_obs_grp ob1 ON ob.encounter_id = ob1.encounter_id
-    AND ob.obs_group_id = ob1.obs_id
-SET patdisp.number_day_dispense = ob.value_numeric
-WHERE ob1.concept_id = 163711
-AND ob.concept_id = 159368
-AND ob.voided = 0;
-
-/*Update pills_amount_dispense for patient_prescription*/
-UPDATE isanteplus.patient_prescription patdisp
-INNER JOIN _tmp_obs ob ON patdisp.encounter_id = ob.encounter_id
-INNER JOIN _tmp_obs_grp ob1 ON ob.encounter_id = ob1.encounter_id
-    AND ob.obs_group_id = ob1.obs_id
-SET patdisp.pills_amount_dispense = ob.value_numeric
-WHERE ob1.concept_id = 163711
-AND ob.concept_id = 1443
-AND ob.voided = 0;
-
-/*Update for having dispensation_date of the drug*/
-UPDATE isanteplus.patient_prescription pp
-INNER JOIN _tmp_obs ob2 ON pp.drug_id = ob2.value_coded
-INNER JOIN _tmp_obs_grp ob1 ON ob1.obs_id = ob2.obs_group_id
-INNER JOIN _tmp_obs_sib ob3 ON pp.encounter_id = ob3.encounter_id
-    AND ob1.obs_id = ob3.obs_group_id
-SET pp.dispensation_date = DATE(ob3.obs_datetime)
-WHERE ob1.concept_id = 163711
-AND ob2.concept_id = 1282
-AND ob3.concept_id = 1276
-AND ob3.voided = 0;
-
-UPDATE isanteplus.patient_prescription pp
-INNER JOIN (
-  select pap.obs_group_id, count(ob.obs_group_id)
-  FROM _tmp_obs ob
-  INNER JOIN isanteplus.patient_prescription pap
-  ON pap.encounter_id = ob.encounter_id
-  AND ob.obs_group_id = pap.obs_group_id
-  WHERE ob.voided = 0
-  GROUP BY 1
-  HAVING count(ob.obs_group_id) <= 1
-) B ON pp.obs_group_id = B.obs_group_id
-SET pp.voided = 1
-WHERE pp.voided <> 1;
+  voided = IF(gc.active_members <= 1, 1, ob.voided);
 
 COMMIT;
 
@@ -861,62 +1368,34 @@ SELECT v.date_started AS visit_date, v.visit_id, e.encounter_id,v.location_id, v
 FROM _tmp_visit v
 INNER JOIN _tmp_encounter e ON v.visit_id = e.visit_id
     AND v.patient_id = e.patient_id
-INNER JOIN _tmp_obs o ON o.person_id = e.patient_id
-    AND o.encounter_id = e.encounter_id
-WHERE o.voided = 0
+INNER JOIN _tmp_obs_encounter oe ON oe.person_id = e.patient_id
+    AND oe.encounter_id = e.encounter_id
+WHERE oe.voided = 0
 ON DUPLICATE KEY UPDATE
   encounter_id = e.encounter_id,
   last_updated_date = NOW(),
   voided = v.voided;
 
-/*Update health_qual_patient_visit table for having bmi*/
+/*Update health_qual_patient_visit table for bmi, family planning method and
+evaluation of TB, from the encounters of the visit*/
 UPDATE isanteplus.health_qual_patient_visit pv
 INNER JOIN (
-  SELECT hs.visit_id, ws.weight , hs.height, ( ws.weight / (hs.height*hs.height/10000) ) AS 'patient_bmi'
-  FROM (
-    SELECT pv.visit_id, o.value_numeric AS 'height'
-    FROM isanteplus.health_qual_patient_visit pv
-    INNER JOIN _tmp_obs o
-    ON o.person_id = pv.patient_id
-    INNER JOIN _tmp_encounter e
-    ON pv.visit_id = e.visit_id
-    AND e.encounter_id = o.encounter_id
-    AND e.encounter_id = pv.encounter_id
-    WHERE o.concept_id = 5090
-    AND o.voided = 0
-  ) AS hs
-  JOIN (
-    SELECT pv.visit_id, o.value_numeric AS 'weight'
-    FROM isanteplus.health_qual_patient_visit pv
-    INNER JOIN _tmp_obs_grp o
-    ON o.person_id = pv.patient_id
-    INNER JOIN _tmp_encounter_2 e
-    ON pv.visit_id = e.visit_id
-    AND e.encounter_id = o.encounter_id
-    AND e.encounter_id = pv.encounter_id
-    WHERE o.concept_id = 5089
-    AND o.voided = 0
-  ) AS ws
-  ON hs.visit_id = ws.visit_id
-) AS bmi ON pv.visit_id = bmi.visit_id
-SET pv.patient_bmi = bmi.patient_bmi;
-
-/*Update patient_visit table for having family method planning indicator.*/
-UPDATE isanteplus.health_qual_patient_visit pv
-INNER JOIN (
-  SELECT pv.visit_id, o.value_coded
+  SELECT pv.visit_id,
+  MAX(p.weight) / (MAX(p.height) * MAX(p.height) / 10000) AS patient_bmi,
+  MAX(p.family_planning_method_used) AS family_planning_method_used,
+  MAX(p.evaluated_of_tb) AS evaluated_of_tb
   FROM isanteplus.health_qual_patient_visit pv
-  INNER JOIN _tmp_obs o
-  ON o.person_id = pv.patient_id
   INNER JOIN _tmp_encounter e
   ON pv.visit_id = e.visit_id
-  AND e.encounter_id = o.encounter_id
   AND e.encounter_id = pv.encounter_id
-  WHERE o.concept_id = 374
-  AND o.voided = 0
-) AS family_planning ON family_planning.visit_id = pv.visit_id
-SET pv.family_planning_method_used = TRUE
-WHERE value_coded IS NOT NULL;
+  INNER JOIN _tmp_obs_pivot p
+  ON p.encounter_id = e.encounter_id
+  AND p.person_id = pv.patient_id
+  GROUP BY pv.visit_id
+) AS v ON v.visit_id = pv.visit_id
+SET pv.patient_bmi = COALESCE(v.patient_bmi, pv.patient_bmi),
+pv.family_planning_method_used = COALESCE(v.family_planning_method_used, pv.family_planning_method_used),
+pv.evaluated_of_tb = COALESCE(v.evaluated_of_tb, pv.evaluated_of_tb);
 
 /*Update health_qual_patient_visit table for adherence evaluation.*/
 UPDATE isanteplus.health_qual_patient_visit pv
@@ -934,58 +1413,16 @@ INNER JOIN (
 SET pv.adherence_evaluation = adherence.value_numeric
 WHERE value_numeric IS NOT NULL;
 
-/*Update health_qual_patient_visit table for evaluation of TB flag.*/
+/*update for nutritional_assessment_status and is_active_tb*/
 UPDATE isanteplus.health_qual_patient_visit pv
-INNER JOIN (
-  SELECT pv.visit_id, o.value_coded
-  FROM isanteplus.health_qual_patient_visit pv
-  INNER JOIN _tmp_obs o
-  ON o.person_id = pv.patient_id
-  INNER JOIN _tmp_encounter e
-  ON pv.visit_id = e.visit_id
-  AND e.encounter_id = o.encounter_id
-  AND e.encounter_id = pv.encounter_id
-  WHERE (o.concept_id IN (160265, 1659, 1110, 163283, 162320, 163284, 1633, 1389, 163951, 159431, 1113, 159798, 159398))
-  AND o.voided = 0
-) AS evaluation_of_tb ON evaluation_of_tb.visit_id = pv.visit_id
-SET pv.evaluated_of_tb = TRUE
-WHERE value_coded IS NOT NULL;
-
-/*update for nutritional_assessment_status*/
-UPDATE isanteplus.health_qual_patient_visit hqpv
-INNER JOIN (
-  SELECT pv.encounter_id, o.concept_id
-  FROM isanteplus.health_qual_patient_visit pv
-  INNER JOIN _tmp_obs o
-  ON o.person_id = pv.patient_id
-  INNER JOIN _tmp_encounter e
-  ON pv.visit_id = e.visit_id
-  AND e.encounter_id = o.encounter_id
-  AND e.encounter_id = pv.encounter_id
-  WHERE (
-    (o.concept_id = 5089 AND o.concept_id = 5090)
-    OR o.concept_id = 5314
-    OR o.concept_id = 1343
-  )
-  AND o.voided = 0
-) AS visits ON visits.encounter_id = hqpv.encounter_id
-SET hqpv.nutritional_assessment_completed = TRUE;
-
-/*update for is_active_tb*/
-UPDATE isanteplus.health_qual_patient_visit hqpv
-INNER JOIN (
-  SELECT pv.encounter_id
-  FROM isanteplus.health_qual_patient_visit pv
-  INNER JOIN _tmp_obs o
-  ON o.person_id = pv.patient_id
-  INNER JOIN _tmp_encounter e
-  ON pv.visit_id = e.visit_id
-  AND e.encounter_id = o.encounter_id
-  AND e.encounter_id = pv.encounter_id
-  WHERE ((o.concept_id = 160592 AND o.value_coded = 113489) OR (o.concept_id = 160749 AND o.value_coded = 1065))
-  AND o.voided = 0
-) v ON v.encounter_id = hqpv.encounter_id
-SET hqpv.is_active_tb = TRUE;
+INNER JOIN _tmp_encounter e
+ON pv.visit_id = e.visit_id
+AND e.encounter_id = pv.encounter_id
+INNER JOIN _tmp_obs_pivot p
+ON p.encounter_id = e.encounter_id
+AND p.person_id = pv.patient_id
+SET pv.nutritional_assessment_completed = COALESCE(p.nutritional_assessment_completed, pv.nutritional_assessment_completed),
+pv.is_active_tb = COALESCE(p.is_active_tb, pv.is_active_tb);
 
 /*Update health_qual_patient_visit table for age patient at the visit.*/
 UPDATE isanteplus.health_qual_patient_visit pv
@@ -1087,6 +1524,29 @@ AND cn.voided = 0;
 
 COMMIT;
 
+/* Dernier test de charge virale par patient (patient_latest_viral_load),
+   recalculé pour les patients à traiter : last_test_date pour les tests
+   faits avec un résultat, last_result_date pour les résultats > 0 */
+SET @sql := IF(@etl_incremental = 1,
+    'DELETE lvl FROM patient_latest_viral_load lvl INNER JOIN _tmp_etl_patient t ON t.patient_id = lvl.patient_id',
+    'TRUNCATE TABLE patient_latest_viral_load');
+PREPARE stmt FROM @sql;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
+
+INSERT INTO patient_latest_viral_load (patient_id, last_test_date, last_result_date)
+SELECT pl.patient_id,
+  MAX(CASE WHEN pl.test_done = 1
+    AND ((pl.test_result IS NOT NULL) OR (pl.test_result <> ''))
+    THEN IFNULL(DATE(pl.date_test_done), DATE(pl.visit_date)) END),
+  MAX(CASE WHEN pl.test_result > 0
+    THEN IFNULL(DATE(pl.date_test_done), DATE(pl.visit_date)) END)
+FROM _tmp_etl_patient t
+INNER JOIN patient_laboratory pl ON pl.patient_id = t.patient_id
+WHERE pl.test_id IN (856, 1305)
+AND pl.voided <> 1
+GROUP BY pl.patient_id;
+
 -- =============================================================================
 -- SECTION 7 : Diagnostic TB (patient_tb_diagnosis)
 -- =============================================================================
@@ -1104,7 +1564,7 @@ INSERT INTO patient_tb_diagnosis
 SELECT DISTINCT ob.person_id,
   ob.encounter_id,ob.location_id, now(), ob.voided
 FROM _tmp_obs ob
-INNER JOIN _tmp_obs_grp ob1 ON ob.person_id = ob1.person_id
+INNER JOIN _tmp_obs ob1 ON ob.person_id = ob1.person_id
     AND ob.encounter_id = ob1.encounter_id
     AND ob.obs_group_id = ob1.obs_id
 WHERE ob1.concept_id IN (@concept_tb_diag_group, @concept_mdr_tb_diag_group)
@@ -1211,7 +1671,7 @@ WHERE enp.voided = 0;
 /*Update tb_diag*/
 UPDATE patient_tb_diagnosis pat
 INNER JOIN _tmp_obs ob ON pat.encounter_id = ob.encounter_id
-INNER JOIN _tmp_obs_grp ob1 ON ob.obs_group_id = ob1.obs_id
+INNER JOIN _tmp_obs ob1 ON ob.obs_group_id = ob1.obs_id
 SET pat.tb_diag = 1
 WHERE ob1.concept_id = @concept_tb_diag_group
 AND (ob.concept_id = 1284 AND ob.value_coded = 112141)
@@ -1220,7 +1680,7 @@ AND ob.voided = 0;
 /*Update mdr_tb_diag*/
 UPDATE patient_tb_diagnosis pat
 INNER JOIN _tmp_obs ob ON pat.encounter_id = ob.encounter_id
-INNER JOIN _tmp_obs_grp ob1 ON ob.obs_group_id = ob1.obs_id
+INNER JOIN _tmp_obs ob1 ON ob.obs_group_id = ob1.obs_id
 SET pat.mdr_tb_diag = 1
 WHERE ob1.concept_id = @concept_mdr_tb_diag_group
 AND (ob.concept_id = 1284 AND ob.value_coded = 159345)
@@ -1291,7 +1751,7 @@ UPDATE patient_tb_diagnosis pat
 INNER JOIN _tmp_obs ob ON pat.encounter_id = ob.encounter_id
 INNER JOIN (
   SELECT o.person_id, o.encounter_id, COUNT(o.encounter_id) AS nb
-  FROM _tmp_obs_grp o
+  FROM _tmp_obs o
   WHERE o.concept_id = 6042
   AND o.value_coded IN (42,159355,118890)
   GROUP BY 1
@@ -1394,7 +1854,7 @@ INNER JOIN (
   MAX(CASE WHEN ob.concept_id = 165999 THEN (CASE WHEN ob1.value_coded = 703 THEN 1 WHEN ob1.value_coded = 664 THEN 2 END) END) AS tb_test_result_mon_5,
   MAX(CASE WHEN ob.concept_id = 165804 THEN (CASE WHEN ob1.value_coded = 703 THEN 1 WHEN ob1.value_coded = 664 THEN 2 END) END) AS tb_test_result_end
   FROM _tmp_obs ob1
-  INNER JOIN _tmp_obs_grp ob
+  INNER JOIN _tmp_obs ob
   ON ob.obs_id = ob1.obs_group_id
   WHERE ob.concept_id IN (166136, 166134, 165978, 165999, 165804)
   AND ob1.concept_id = 307
@@ -1508,25 +1968,25 @@ ON DUPLICATE KEY UPDATE
 
 /*Age At Visit in Years and Months*/
 UPDATE isanteplus.patient_nutrition pat
-INNER JOIN _tmp_obs o ON pat.encounter_id = o.encounter_id
+INNER JOIN _tmp_obs_encounter oe ON pat.encounter_id = oe.encounter_id
 INNER JOIN isanteplus.patient p ON pat.patient_id = p.patient_id
 SET pat.age_at_visit_years = TIMESTAMPDIFF(YEAR,p.birthdate,pat.visit_date),
 pat.age_at_visit_months = TIMESTAMPDIFF(MONTH,p.birthdate,pat.visit_date)
-WHERE o.voided = 0;
+WHERE oe.voided = 0;
 
-/*Weight*/
+/*Edema*/
 UPDATE isanteplus.patient_nutrition pat
-INNER JOIN _tmp_obs o ON pat.encounter_id = o.encounter_id
-SET pat.weight = o.value_numeric
-WHERE o.concept_id = 5089
-AND o.voided = 0;
+INNER JOIN _tmp_obs_encounter oe ON pat.encounter_id = oe.encounter_id
+SET pat.edema = 0
+WHERE oe.voided = 0;
 
-/*Height*/
+/*Weight, Height, Edema, Weight for height*/
 UPDATE isanteplus.patient_nutrition pat
-INNER JOIN _tmp_obs o ON pat.encounter_id = o.encounter_id
-SET pat.height = o.value_numeric
-WHERE o.concept_id = 5090
-AND o.voided = 0;
+INNER JOIN _tmp_obs_pivot p ON pat.encounter_id = p.encounter_id
+SET pat.weight = COALESCE(p.weight, pat.weight),
+pat.height = COALESCE(p.height, pat.height),
+pat.edema = COALESCE(p.edema, pat.edema),
+pat.weight_for_height = COALESCE(p.weight_for_height, pat.weight_for_height);
 
 /*BMI*/
 UPDATE isanteplus.patient_nutrition pat
@@ -1534,26 +1994,6 @@ SET pat.bmi = ROUND((pat.weight/(pat.height/100*pat.height/100)),1)
 WHERE pat.age_at_visit_years>=20
 AND pat.voided = 0;
 
-/*Edema*/
-UPDATE isanteplus.patient_nutrition pat
-INNER JOIN _tmp_obs o ON pat.encounter_id = o.encounter_id
-SET pat.edema = (CASE WHEN o.concept_id = 159614 AND o.value_coded = 460 THEN 1 ELSE 0 END)
-WHERE o.voided = 0;
-
-/*Weight for height*/
-UPDATE isanteplus.patient_nutrition pat
-INNER JOIN _tmp_obs o ON pat.encounter_id = o.encounter_id
-SET pat.weight_for_height = (
-  CASE
-  WHEN o.value_coded = 1115 THEN 1 -- Normal
-  WHEN o.value_coded = 164131 THEN 2 -- SAM
-  WHEN o.value_coded = 123815 THEN 2 -- MAM
-  END
-)
-WHERE o.concept_id = 163515
-AND o.value_coded IN (1115, 164131, 123815)
-AND o.voided = 0;
-
 COMMIT;
 
 -- =============================================================================
@@ -1589,58 +2029,19 @@ ON DUPLICATE KEY UPDATE
   last_updated_date = NOW(),
   voided = enc.voided;
 
-/*MUAC*/
+/*MUAC, Pregnant, Next Visit Date, Edd, Birth Plan, High Risk, Gestation
+Greater Than 12Wks, Tetanus Toxoid Vaccine, Iron Defiency Anemia*/
 UPDATE isanteplus.patient_ob_gyn pat
-INNER JOIN _tmp_obs o ON pat.encounter_id = o.encounter_id
-SET pat.muac = o.value_numeric
-WHERE o.concept_id = 1343
-AND o.voided = 0;
-
-/*Pregnant*/
-UPDATE isanteplus.patient_ob_gyn pat
-INNER JOIN _tmp_obs o ON pat.encounter_id = o.encounter_id
-SET pat.pregnant = 1
-WHERE o.concept_id = 160288
-AND o.value_coded = 1622
-AND o.voided = 0;
-
-/*Next Visit Date*/
-UPDATE isanteplus.patient_ob_gyn pat
-INNER JOIN _tmp_obs o ON pat.encounter_id = o.encounter_id
-SET pat.next_visit_date = o.value_datetime
-WHERE o.concept_id = 5096
-AND o.voided = 0;
-
-/*Edd*/
-UPDATE isanteplus.patient_ob_gyn pat
-INNER JOIN _tmp_obs o ON pat.encounter_id = o.encounter_id
-SET pat.edd = o.value_datetime
-WHERE o.concept_id = 5596
-AND o.voided = 0;
-
-/*Birth Plan*/
-UPDATE isanteplus.patient_ob_gyn pat
-INNER JOIN _tmp_obs o ON pat.encounter_id = o.encounter_id
-SET pat.birth_plan = 1
-WHERE o.concept_id IN (163764, 161007, 160112, 163765, 163766)
-AND o.value_coded = 1065
-AND o.voided = 0;
-
-/*High Risk*/
-UPDATE isanteplus.patient_ob_gyn pat
-INNER JOIN _tmp_obs o ON pat.encounter_id = o.encounter_id
-SET pat.high_risk = 1
-WHERE o.concept_id = 160079
-AND o.value_coded IN (1107, 145777, 148834, 119476, 460, 1053, 163119, 163120)
-AND o.voided = 0;
-
-/*Gestation Greater Than 12Wks*/
-UPDATE isanteplus.patient_ob_gyn pat
-INNER JOIN _tmp_obs o ON pat.encounter_id = o.encounter_id
-SET pat.gestation_greater_than_12_wks = 1
-WHERE o.concept_id = 1438
-AND o.value_numeric>=12
-AND o.voided = 0;
+INNER JOIN _tmp_obs_pivot p ON pat.encounter_id = p.encounter_id
+SET pat.muac = COALESCE(p.muac, pat.muac),
+pat.pregnant = COALESCE(p.pregnant, pat.pregnant),
+pat.next_visit_date = COALESCE(p.next_visit_date, pat.next_visit_date),
+pat.edd = COALESCE(p.edd, pat.edd),
+pat.birth_plan = COALESCE(p.birth_plan, pat.birth_plan),
+pat.high_risk = COALESCE(p.high_risk, pat.high_risk),
+pat.gestation_greater_than_12_wks = COALESCE(p.gestation_greater_than_12_wks, pat.gestation_greater_than_12_wks),
+pat.tetanus_toxoid_vaccine = COALESCE(p.tetanus_toxoid_vaccine, pat.tetanus_toxoid_vaccine),
+pat.iron_defiency_anemia = COALESCE(p.iron_defiency_anemia, pat.iron_defiency_anemia);
 
 /*Iron Supplement, Folic Acid Supplement, Prescribed Iron, Prescribed Folic Acid (concept_id=1282)*/
 UPDATE isanteplus.patient_ob_gyn pat
@@ -1661,22 +2062,6 @@ pat.folic_acid_supplement = agg.folic_acid_supplement,
 pat.prescribed_iron = agg.prescribed_iron,
 pat.prescribed_folic_acid = agg.prescribed_folic_acid;
 
-/*Tetanus Toxoid Vaccine*/
-UPDATE isanteplus.patient_ob_gyn pat
-INNER JOIN _tmp_obs o ON pat.encounter_id = o.encounter_id
-SET pat.tetanus_toxoid_vaccine = 1
-WHERE o.concept_id = 984
-AND o.value_coded = 84879
-AND o.voided = 0;
-
-/*Iron Defiency Anemia*/
-UPDATE isanteplus.patient_ob_gyn pat
-INNER JOIN _tmp_obs o ON pat.encounter_id = o.encounter_id
-SET pat.iron_defiency_anemia = 1
-WHERE o.concept_id = 160079
-AND o.value_coded = 148834
-AND o.voided = 0;
-
 /*Elevated Blood Pressure*/
 UPDATE isanteplus.patient_ob_gyn pat
 INNER JOIN _tmp_obs o ON pat.encounter_id = o.encounter_id
@@ -1690,8 +2075,30 @@ COMMIT;
 -- =============================================================================
 -- SECTION 10 : Imagerie + Discontinuation (patient_imagerie, discontinuation_reason, stopping_reason)
 -- =============================================================================
-TRUNCATE TABLE discontinuation_reason;
-TRUNCATE TABLE stopping_reason;
+/* discontinuation_reason et stopping_reason sont reconstruites dans des
+   tables *_next puis échangées par un seul RENAME TABLE : jusque-là les
+   lecteurs voient les anciennes tables complètes. En mode incrémental, les
+   *_next reprennent les lignes des patients qui ne sont pas à traiter. */
+DROP TABLE IF EXISTS discontinuation_reason_next;
+CREATE TABLE discontinuation_reason_next LIKE discontinuation_reason;
+
+INSERT INTO discontinuation_reason_next
+SELECT dr.*
+FROM discontinuation_reason dr
+LEFT JOIN _tmp_etl_patient t ON t.patient_id = dr.patient_id
+WHERE @etl_incremental = 1
+AND t.patient_id IS NULL;
+
+DROP TABLE IF EXISTS stopping_reason_next;
+CREATE TABLE stopping_reason_next LIKE stopping_reason;
+
+INSERT INTO stopping_reason_next
+SELECT sr.*
+FROM stopping_reason sr
+LEFT JOIN _tmp_etl_patient t ON t.patient_id = sr.patient_id
+WHERE @etl_incremental = 1
+AND t.patient_id IS NULL;
+
 START TRANSACTION;
 
 /*Insertion for patient_imagerie */
@@ -1727,8 +2134,10 @@ SET patim.crachat_barr = ob.value_coded
 WHERE ob.concept_id = 307
 AND ob.voided = 0;
 
+COMMIT;
+
 /*Part of patient Status*/
-INSERT INTO discontinuation_reason(patient_id,visit_id,visit_date,reason,reason_name)
+INSERT INTO discontinuation_reason_next(patient_id,visit_id,visit_date,reason,reason_name)
 SELECT v.patient_id,v.visit_id, MAX(v.date_started),ob.value_coded,
 CASE WHEN(ob.value_coded = 5240) THEN 'Perdu de vue'
 WHEN (ob.value_coded = 159492) THEN 'Transfert'
@@ -1746,7 +2155,7 @@ AND enc.voided <> 1
 GROUP BY v.patient_id, ob.value_coded;
 
 /*INSERT for stopping_reason*/
-INSERT INTO stopping_reason(patient_id,visit_id,visit_date,reason,reason_name,other_reason)
+INSERT INTO stopping_reason_next(patient_id,visit_id,visit_date,reason,reason_name,other_reason)
 SELECT v.patient_id,v.visit_id,
   MAX(v.date_started),ob.value_coded,
 CASE WHEN(ob.value_coded = 1754) THEN 'ARVs non-disponibles'
@@ -1765,14 +2174,19 @@ AND ob.voided = 0
 GROUP BY v.patient_id, ob.value_coded;
 
 /*Delete FROM discontinuation_reason*/
-DELETE FROM discontinuation_reason
-WHERE visit_id NOT IN(SELECT str.visit_id FROM stopping_reason str
+DELETE FROM discontinuation_reason_next
+WHERE visit_id NOT IN(SELECT str.visit_id FROM stopping_reason_next str
   WHERE str.reason = 115198
   OR str.reason = 159737
 )
 AND reason = 1667;
 
-COMMIT;
+DROP TABLE IF EXISTS discontinuation_reason_old, stopping_reason_old;
+RENAME TABLE discontinuation_reason TO discontinuation_reason_old,
+  discontinuation_reason_next TO discontinuation_reason,
+  stopping_reason TO stopping_reason_old,
+  stopping_reason_next TO stopping_reason;
+DROP TABLE discontinuation_reason_old, stopping_reason_old;
 
 -- =============================================================================
 -- SECTION 11 : Grossesse (patient_pregnancy)
@@ -1783,7 +2197,7 @@ START TRANSACTION;
 INSERT INTO patient_pregnancy (patient_id,encounter_id,start_date,last_updated_date, voided)
 SELECT DISTINCT ob.person_id,ob.encounter_id,DATE(ob.obs_datetime) AS start_date, now(), ob.voided
 FROM _tmp_obs ob
-INNER JOIN _tmp_obs_grp ob1 ON ob.obs_group_id = ob1.obs_id
+INNER JOIN _tmp_obs ob1 ON ob.obs_group_id = ob1.obs_id
 WHERE ob1.concept_id IN (@concept_preg_grp_1, @concept_preg_grp_2, @concept_preg_grp_3,
   @concept_preg_grp_4, @concept_preg_grp_5, @concept_preg_grp_6, @concept_preg_grp_7,
   @concept_preg_grp_8, @concept_preg_grp_9, @concept_preg_grp_10, @concept_preg_grp_11
@@ -1880,7 +2294,7 @@ ON DUPLICATE KEY UPDATE
 INSERT INTO patient_pregnancy(patient_id,encounter_id,start_date, end_date, last_updated_date, voided)
 SELECT DISTINCT ob.person_id,ob.encounter_id,(DATE(enc.encounter_datetime)- INTERVAL 9 MONTH) AS start_date,
   DATE(enc.encounter_datetime) AS end_date, NOW(), ob.voided
-FROM _tmp_obs ob
+FROM _tmp_obs_encounter ob
 INNER JOIN _tmp_encounter enc ON ob.encounter_id = enc.encounter_id
 WHERE enc.encounter_type = @et_labor_delivery
 ON DUPLICATE KEY UPDATE
@@ -1994,31 +2408,74 @@ COMMIT;
 -- =============================================================================
 -- SECTION 12 : Alertes (alert)
 -- =============================================================================
-TRUNCATE TABLE alert;
-START TRANSACTION;
+/* Mode incrémental, si la table alert a été calculée par ce script (marque
+   'alert' de etl_watermark, last_date = début de cette évaluation) : les
+   alertes ne sont réévaluées que pour les patients à traiter et pour ceux
+   dont un délai des règles ci-dessous a été franchi depuis la dernière
+   évaluation, puis appliquées à alert par différence. Sinon elles sont
+   toutes recalculées dans alert_next, échangée avec alert par un seul
+   RENAME TABLE. patient_status_arv_dml.sql, qui recalcule alert avec ses
+   propres règles, efface la marque par etl_reset_watermark('alert')
+   (PRÉAMBULE). */
+SET @alert_run := NOW();
+SET @alert_last_run := (SELECT w.last_date FROM etl_watermark w
+  WHERE w.source_table = 'alert');
+SET @alert_incremental := IF(@etl_incremental = 1
+  AND @alert_last_run IS NOT NULL, 1, 0);
+/* Marge de 3 jours : date + INTERVAL n MONTH peut précéder de 3 jours le
+   passage de TIMESTAMPDIFF(MONTH, date, NOW()) à n (fins de mois). */
+SET @alert_since := DATE(@alert_last_run) - INTERVAL 3 DAY;
+
+DROP TEMPORARY TABLE IF EXISTS tmp_alert_patient;
+CREATE TEMPORARY TABLE tmp_alert_patient (
+  PRIMARY KEY (patient_id)
+)
+SELECT p.patient_id
+FROM isanteplus.patient p
+LEFT JOIN _tmp_etl_patient t ON t.patient_id = p.patient_id
+WHERE @alert_incremental = 0
+OR t.patient_id IS NOT NULL;
+
+/* Délais : 4, 5 et 6 mois depuis le début ARV (alertes 1, 2 et 8) */
+INSERT IGNORE INTO tmp_alert_patient (patient_id)
+SELECT p.patient_id
+FROM isanteplus.patient p
+WHERE @alert_incremental = 1
+AND (p.date_started_arv + INTERVAL 4 MONTH BETWEEN @alert_since AND CURDATE()
+  OR p.date_started_arv + INTERVAL 5 MONTH BETWEEN @alert_since AND CURDATE()
+  OR p.date_started_arv + INTERVAL 6 MONTH BETWEEN @alert_since AND CURDATE());
+
+/* 4 et 12 mois depuis la dernière charge virale (alertes 3 et 4) */
+INSERT IGNORE INTO tmp_alert_patient (patient_id)
+SELECT vl.patient_id
+FROM isanteplus.patient_latest_viral_load vl
+WHERE @alert_incremental = 1
+AND (vl.last_test_date + INTERVAL 4 MONTH BETWEEN @alert_since AND CURDATE()
+  OR vl.last_test_date + INTERVAL 12 MONTH BETWEEN @alert_since AND CURDATE());
+
+/* 30 jours avant et lendemain de la prochaine dispensation (alertes 7) */
+INSERT IGNORE INTO tmp_alert_patient (patient_id)
+SELECT ld.patient_id
+FROM isanteplus.patient_latest_dispensing ld
+WHERE @alert_incremental = 1
+AND (ld.next_arv_rx_dispensation_date - INTERVAL 30 DAY BETWEEN @alert_since AND CURDATE()
+  OR ld.next_arv_rx_dispensation_date + INTERVAL 1 DAY BETWEEN @alert_since AND CURDATE());
+
+DROP TABLE IF EXISTS alert_next;
+CREATE TABLE alert_next LIKE alert;
 
 /*Insertion for Nombre de patient sous ARV depuis 6 mois sans un résultat de charge virale*/
-INSERT INTO alert(patient_id,id_alert,encounter_id,date_alert)
-SELECT DISTINCT B.patient_id,1,B.encounter_id, B.visit_date
+INSERT INTO alert_next(patient_id,id_alert,encounter_id,date_alert)
+SELECT DISTINCT B.patient_id,1,B.last_arv_encounter_id, B.first_arv_visit_date
 FROM isanteplus.patient p
-INNER JOIN (
-  SELECT pdis.patient_id, MAX(pdis.encounter_id) AS encounter_id, MIN(DATE(pdis.visit_date)) AS visit_date
-  FROM isanteplus.patient_dispensing pdis
-  WHERE pdis.arv_drug = 1065
-  GROUP BY 1
-) B ON p.patient_id = B.patient_id
-    AND p.date_started_arv = B.visit_date
+INNER JOIN tmp_alert_patient ap ON ap.patient_id = p.patient_id
+INNER JOIN isanteplus.patient_latest_dispensing B ON p.patient_id = B.patient_id
+    AND p.date_started_arv = B.first_arv_visit_date
+LEFT JOIN isanteplus.patient_latest_viral_load vl ON p.patient_id = vl.patient_id
 WHERE (TIMESTAMPDIFF(MONTH,DATE(p.date_started_arv),DATE(NOW())) >= 6)
-AND NOT EXISTS (SELECT 1 FROM isanteplus.patient_laboratory pl
-  WHERE pl.patient_id = p.patient_id
-  AND pl.test_id IN(856, 1305)
-  AND pl.test_done = 1
-  AND pl.voided <> 1
-  AND ((pl.test_result IS NOT NULL) OR (pl.test_result <> ''))
-)
-AND NOT EXISTS (SELECT 1 FROM _tmp_encounter enc
+AND vl.last_test_date IS NULL
+AND NOT EXISTS (SELECT 1 FROM _tmp_discontinuation_encounter enc
   WHERE enc.patient_id = p.patient_id
-  AND enc.encounter_type = @et_discontinuation
   AND EXISTS (SELECT 1 FROM isanteplus.discontinuation_reason dr
     WHERE dr.patient_id = enc.patient_id
   )
@@ -2026,28 +2483,18 @@ AND NOT EXISTS (SELECT 1 FROM _tmp_encounter enc
 AND p.vih_status = 1;
 
 /*Insertion for Nombre de femmes enceintes, sous ARV depuis 4 mois sans un résultat de charge virale*/
-INSERT INTO alert(patient_id,id_alert,encounter_id,date_alert)
-SELECT DISTINCT B.patient_id,2,B.encounter_id, B.visit_date
+INSERT INTO alert_next(patient_id,id_alert,encounter_id,date_alert)
+SELECT DISTINCT B.patient_id,2,B.last_arv_encounter_id, B.first_arv_visit_date
 FROM isanteplus.patient p
-INNER JOIN (
-  SELECT pdis.patient_id, MAX(pdis.encounter_id) AS encounter_id, MIN(DATE(pdis.visit_date)) AS visit_date
-  FROM isanteplus.patient_dispensing pdis
-  WHERE pdis.arv_drug = 1065
-  GROUP BY 1
-) B ON p.patient_id = B.patient_id
-    AND p.date_started_arv = B.visit_date
+INNER JOIN tmp_alert_patient ap ON ap.patient_id = p.patient_id
+INNER JOIN isanteplus.patient_latest_dispensing B ON p.patient_id = B.patient_id
+    AND p.date_started_arv = B.first_arv_visit_date
+LEFT JOIN isanteplus.patient_latest_viral_load vl ON p.patient_id = vl.patient_id
 INNER JOIN isanteplus.patient_pregnancy pp ON p.patient_id = pp.patient_id
 WHERE (TIMESTAMPDIFF(MONTH,DATE(p.date_started_arv),DATE(NOW())) >= 4)
-AND NOT EXISTS (SELECT 1 FROM isanteplus.patient_laboratory pl
-  WHERE pl.patient_id = p.patient_id
-  AND pl.test_id IN(856, 1305)
-  AND pl.test_done = 1
-  AND pl.voided <> 1
-  AND ((pl.test_result IS NOT NULL) OR (pl.test_result <> ''))
-)
-AND NOT EXISTS (SELECT 1 FROM _tmp_encounter enc
+AND vl.last_test_date IS NULL
+AND NOT EXISTS (SELECT 1 FROM _tmp_discontinuation_encounter enc
   WHERE enc.patient_id = p.patient_id
-  AND enc.encounter_type = @et_discontinuation
   AND EXISTS (SELECT 1 FROM isanteplus.discontinuation_reason dr
     WHERE dr.patient_id = enc.patient_id
   )
@@ -2055,25 +2502,17 @@ AND NOT EXISTS (SELECT 1 FROM _tmp_encounter enc
 AND p.vih_status = 1;
 
 /*Insertion for Nombre de patients ayant leur dernière charge virale remontant à au moins 12 mois*/
-INSERT INTO alert(patient_id,id_alert,encounter_id,date_alert)
+INSERT INTO alert_next(patient_id,id_alert,encounter_id,date_alert)
 SELECT DISTINCT plab.patient_id,3,plab.encounter_id, IFNULL(DATE(plab.date_test_done),DATE(plab.visit_date))
 FROM isanteplus.patient p
+INNER JOIN tmp_alert_patient ap ON ap.patient_id = p.patient_id
 INNER JOIN isanteplus.patient_laboratory plab ON p.patient_id = plab.patient_id
-INNER JOIN (
-  SELECT pl.patient_id, MAX(IFNULL(DATE(date_test_done),DATE(pl.visit_date))) AS visit_date
-  FROM isanteplus.patient_laboratory pl
-  WHERE pl.test_id IN(856, 1305)
-  AND pl.test_done = 1
-  AND pl.voided <> 1
-  AND ((pl.test_result IS NOT NULL) OR (pl.test_result <> ''))
-  GROUP BY 1
-) C ON plab.patient_id = C.patient_id
-    AND IFNULL(DATE(plab.date_test_done),DATE(plab.visit_date)) = C.visit_date
+INNER JOIN isanteplus.patient_latest_viral_load C ON plab.patient_id = C.patient_id
+    AND IFNULL(DATE(plab.date_test_done),DATE(plab.visit_date)) = C.last_test_date
 INNER JOIN isanteplus.patient_on_arv parv ON p.patient_id = parv.patient_id
-WHERE (TIMESTAMPDIFF(MONTH,DATE(C.visit_date),DATE(NOW())) >= 12)
-AND NOT EXISTS (SELECT 1 FROM _tmp_encounter enc
+WHERE (TIMESTAMPDIFF(MONTH,C.last_test_date,DATE(NOW())) >= 12)
+AND NOT EXISTS (SELECT 1 FROM _tmp_discontinuation_encounter enc
   WHERE enc.patient_id = p.patient_id
-  AND enc.encounter_type = @et_discontinuation
   AND EXISTS (SELECT 1 FROM isanteplus.discontinuation_reason dr
     WHERE dr.patient_id = enc.patient_id
   )
@@ -2081,26 +2520,18 @@ AND NOT EXISTS (SELECT 1 FROM _tmp_encounter enc
 AND p.vih_status = 1;
 
 /*Insertion for charge virale > 1000 copies/ml remontant à au moins 3 mois*/
-INSERT INTO alert(patient_id,id_alert,encounter_id,date_alert)
+INSERT INTO alert_next(patient_id,id_alert,encounter_id,date_alert)
 SELECT DISTINCT plab.patient_id,4,plab.encounter_id, IFNULL(DATE(plab.date_test_done),DATE(plab.visit_date))
 FROM isanteplus.patient p
+INNER JOIN tmp_alert_patient ap ON ap.patient_id = p.patient_id
 INNER JOIN isanteplus.patient_laboratory plab ON p.patient_id = plab.patient_id
-INNER JOIN (
-  SELECT pl.patient_id, MAX(IFNULL(DATE(date_test_done),DATE(pl.visit_date))) AS visit_date
-  FROM isanteplus.patient_laboratory pl
-  WHERE pl.test_id IN(856, 1305)
-  AND pl.test_done = 1
-  AND pl.voided <> 1
-  AND ((pl.test_result IS NOT NULL) OR (pl.test_result <> ''))
-  GROUP BY 1
-) C ON plab.patient_id = C.patient_id
-    AND IFNULL(DATE(plab.date_test_done),DATE(plab.visit_date)) = C.visit_date
+INNER JOIN isanteplus.patient_latest_viral_load C ON plab.patient_id = C.patient_id
+    AND IFNULL(DATE(plab.date_test_done),DATE(plab.visit_date)) = C.last_test_date
 INNER JOIN isanteplus.patient_on_arv parv ON p.patient_id = parv.patient_id
-WHERE (TIMESTAMPDIFF(MONTH,DATE(C.visit_date),DATE(NOW())) > 3)
+WHERE (TIMESTAMPDIFF(MONTH,C.last_test_date,DATE(NOW())) > 3)
 AND plab.test_result > 1000
-AND NOT EXISTS (SELECT 1 FROM _tmp_encounter enc
+AND NOT EXISTS (SELECT 1 FROM _tmp_discontinuation_encounter enc
   WHERE enc.patient_id = p.patient_id
-  AND enc.encounter_type = @et_discontinuation
   AND EXISTS (SELECT 1 FROM isanteplus.discontinuation_reason dr
     WHERE dr.patient_id = enc.patient_id
   )
@@ -2108,25 +2539,17 @@ AND NOT EXISTS (SELECT 1 FROM _tmp_encounter enc
 AND p.vih_status = 1;
 
 /*patient avec une dernière charge viral >1000 copies/ml*/
-INSERT INTO alert(patient_id,id_alert,encounter_id,date_alert)
+INSERT INTO alert_next(patient_id,id_alert,encounter_id,date_alert)
 SELECT DISTINCT plab.patient_id,5,plab.encounter_id, IFNULL(DATE(plab.date_test_done),DATE(plab.visit_date))
 FROM isanteplus.patient p
+INNER JOIN tmp_alert_patient ap ON ap.patient_id = p.patient_id
 INNER JOIN isanteplus.patient_laboratory plab ON p.patient_id = plab.patient_id
-INNER JOIN (
-  SELECT pl.patient_id, MAX(IFNULL(DATE(date_test_done),DATE(pl.visit_date))) AS visit_date
-  FROM isanteplus.patient_laboratory pl
-  WHERE pl.test_id IN(856, 1305)
-  AND pl.test_done = 1
-  AND pl.voided <> 1
-  AND ((pl.test_result IS NOT NULL) OR (pl.test_result <> ''))
-  GROUP BY 1
-) C ON plab.patient_id = C.patient_id
-    AND IFNULL(DATE(plab.date_test_done),DATE(plab.visit_date)) = C.visit_date
+INNER JOIN isanteplus.patient_latest_viral_load C ON plab.patient_id = C.patient_id
+    AND IFNULL(DATE(plab.date_test_done),DATE(plab.visit_date)) = C.last_test_date
 INNER JOIN isanteplus.patient_on_arv parv ON p.patient_id = parv.patient_id
 WHERE plab.test_result > 1000
-AND NOT EXISTS (SELECT 1 FROM _tmp_encounter enc
+AND NOT EXISTS (SELECT 1 FROM _tmp_discontinuation_encounter enc
   WHERE enc.patient_id = p.patient_id
-  AND enc.encounter_type = @et_discontinuation
   AND EXISTS (SELECT 1 FROM isanteplus.discontinuation_reason dr
     WHERE dr.patient_id = enc.patient_id
   )
@@ -2134,24 +2557,17 @@ AND NOT EXISTS (SELECT 1 FROM _tmp_encounter enc
 AND p.vih_status = 1;
 
 /*Tout patient dont la prochaine date de dispensation arrive dans les 30 prochains jours*/
-INSERT INTO alert(patient_id,id_alert,encounter_id,date_alert)
+INSERT INTO alert_next(patient_id,id_alert,encounter_id,date_alert)
 SELECT DISTINCT pdisp.patient_id,7,pdisp.encounter_id, DATE(pdisp.visit_date)
 FROM isanteplus.patient p
+INNER JOIN tmp_alert_patient ap ON ap.patient_id = p.patient_id
 INNER JOIN isanteplus.patient_dispensing pdisp ON p.patient_id = pdisp.patient_id
-INNER JOIN (
-  SELECT pd.patient_id, MAX(pd.next_dispensation_date) AS next_dispensation_date
-  FROM isanteplus.patient_dispensing pd
-  WHERE pd.arv_drug = 1065
-  AND (pd.rx_or_prophy <> 163768 OR pd.rx_or_prophy IS NULL)
-  AND pd.voided <> 1
-  GROUP BY 1
-) B ON pdisp.patient_id = B.patient_id
-    AND pdisp.next_dispensation_date = B.next_dispensation_date
+INNER JOIN isanteplus.patient_latest_dispensing B ON pdisp.patient_id = B.patient_id
+    AND pdisp.next_dispensation_date = B.next_arv_rx_dispensation_date
 WHERE DATEDIFF(pdisp.next_dispensation_date,NOW()) BETWEEN 0
 AND 30
-AND NOT EXISTS (SELECT 1 FROM _tmp_encounter enc
+AND NOT EXISTS (SELECT 1 FROM _tmp_discontinuation_encounter enc
   WHERE enc.patient_id = p.patient_id
-  AND enc.encounter_type = @et_discontinuation
   AND EXISTS (SELECT 1 FROM isanteplus.discontinuation_reason dr
     WHERE dr.patient_id = enc.patient_id
   )
@@ -2159,53 +2575,74 @@ AND NOT EXISTS (SELECT 1 FROM _tmp_encounter enc
   ;
 
 /*Tout patient dont la prochaine date de dispensation se situe dans le passe*/
-INSERT INTO alert(patient_id,id_alert,encounter_id,date_alert)
+INSERT INTO alert_next(patient_id,id_alert,encounter_id,date_alert)
 SELECT DISTINCT pdisp.patient_id,7,pdisp.encounter_id, DATE(pdisp.visit_date)
 FROM isanteplus.patient p
+INNER JOIN tmp_alert_patient ap ON ap.patient_id = p.patient_id
 INNER JOIN isanteplus.patient_dispensing pdisp ON p.patient_id = pdisp.patient_id
-INNER JOIN (
-  SELECT pd.patient_id, MAX(pd.next_dispensation_date) AS next_dispensation_date
-  FROM isanteplus.patient_dispensing pd
-  WHERE pd.arv_drug = 1065
-  AND (pd.rx_or_prophy <> 163768 OR pd.rx_or_prophy IS NULL)
-  AND pd.voided <> 1
-  GROUP BY 1
-) B ON pdisp.patient_id = B.patient_id
-    AND pdisp.next_dispensation_date = B.next_dispensation_date
-WHERE DATEDIFF(B.next_dispensation_date,NOW()) < 0
-AND NOT EXISTS (SELECT 1 FROM _tmp_encounter enc
+INNER JOIN isanteplus.patient_latest_dispensing B ON pdisp.patient_id = B.patient_id
+    AND pdisp.next_dispensation_date = B.next_arv_rx_dispensation_date
+WHERE DATEDIFF(B.next_arv_rx_dispensation_date,NOW()) < 0
+AND NOT EXISTS (SELECT 1 FROM _tmp_discontinuation_encounter enc
   WHERE enc.patient_id = p.patient_id
-  AND enc.encounter_type = @et_discontinuation
 )
   ;
 
 /*patients sous ARV depuis 5 mois sans un résultat de charge virale*/
-INSERT INTO alert(patient_id,id_alert,encounter_id,date_alert)
-SELECT DISTINCT B.patient_id,8,B.encounter_id, B.visit_date
+INSERT INTO alert_next(patient_id,id_alert,encounter_id,date_alert)
+SELECT DISTINCT B.patient_id,8,B.last_arv_encounter_id, B.first_arv_visit_date
 FROM isanteplus.patient p
-INNER JOIN (
-  SELECT pdis.patient_id, MAX(pdis.encounter_id) AS encounter_id, MIN(DATE(pdis.visit_date)) AS visit_date
-  FROM isanteplus.patient_dispensing pdis
-  WHERE pdis.arv_drug = 1065
-  GROUP BY 1
-) B ON p.patient_id = B.patient_id
-    AND p.date_started_arv = B.visit_date
+INNER JOIN tmp_alert_patient ap ON ap.patient_id = p.patient_id
+INNER JOIN isanteplus.patient_latest_dispensing B ON p.patient_id = B.patient_id
+    AND p.date_started_arv = B.first_arv_visit_date
+LEFT JOIN isanteplus.patient_latest_viral_load vl ON p.patient_id = vl.patient_id
 WHERE (TIMESTAMPDIFF(MONTH,DATE(p.date_started_arv),DATE(NOW())) = 5)
-AND NOT EXISTS (SELECT 1 FROM isanteplus.patient_laboratory pl
-  WHERE pl.patient_id = p.patient_id
-  AND pl.test_id IN(856, 1305)
-  AND pl.test_done = 1
-  AND pl.voided <> 1
-  AND ((pl.test_result IS NOT NULL) OR (pl.test_result <> ''))
-)
-AND NOT EXISTS (SELECT 1 FROM _tmp_encounter enc
+AND vl.last_test_date IS NULL
+AND NOT EXISTS (SELECT 1 FROM _tmp_discontinuation_encounter enc
   WHERE enc.patient_id = p.patient_id
-  AND enc.encounter_type = @et_discontinuation
 )
 AND p.vih_status = 1;
 
+/* Mode incrémental : supprimer les alertes des patients réévalués qui ne
+   sont plus levées, puis ajouter les nouvelles, en une transaction */
+START TRANSACTION;
+
+DELETE a FROM alert a
+INNER JOIN tmp_alert_patient ap ON ap.patient_id = a.patient_id
+LEFT JOIN alert_next n ON n.patient_id = a.patient_id
+    AND n.id_alert = a.id_alert
+    AND n.encounter_id <=> a.encounter_id
+    AND n.date_alert <=> a.date_alert
+WHERE @alert_incremental = 1
+AND n.patient_id IS NULL;
+
+INSERT INTO alert(patient_id,id_alert,encounter_id,date_alert,last_updated_date)
+SELECT n.patient_id, n.id_alert, n.encounter_id, n.date_alert, n.last_updated_date
+FROM alert_next n
+LEFT JOIN alert a ON a.patient_id = n.patient_id
+    AND a.id_alert = n.id_alert
+    AND a.encounter_id <=> n.encounter_id
+    AND a.date_alert <=> n.date_alert
+WHERE @alert_incremental = 1
+AND a.patient_id IS NULL;
+
 COMMIT;
 
+DROP TABLE IF EXISTS alert_old;
+SET @sql := IF(@alert_incremental = 1,
+    'DROP TABLE alert_next',
+    'RENAME TABLE alert TO alert_old, alert_next TO alert');
+PREPARE stmt FROM @sql;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
+DROP TABLE IF EXISTS alert_old;
+DROP TEMPORARY TABLE IF EXISTS tmp_alert_patient;
+
+/* Marque de cette évaluation, enregistrée au NETTOYAGE avec les autres */
+INSERT INTO _tmp_etl_watermark (source_table, last_id, last_date)
+VALUES ('alert', NULL, @alert_run)
+ON DUPLICATE KEY UPDATE last_date = VALUES(last_date);
+
 -- =============================================================================
 -- SECTION 13 : Type de visite, Accouchement, Tests virologiques,
 --              VIH pédiatrique, Menstruation, Facteurs de risque, Vaccination
@@ -2273,7 +2710,7 @@ INSERT INTO virological_tests
 SELECT DISTINCT ob.person_id,ob.encounter_id,
   ob.location_id,ob1.concept_id,ob.obs_group_id,ob.concept_id, ob.value_coded, now(), ob.voided
 FROM _tmp_obs ob
-INNER JOIN _tmp_obs_grp ob1 ON ob.person_id = ob1.person_id
+INNER JOIN _tmp_obs ob1 ON ob.person_id = ob1.person_id
     AND ob.encounter_id = ob1.encounter_id
     AND ob.obs_group_id = ob1.obs_id
 WHERE ob1.concept_id IN (@concept_viro_grp_1, @concept_viro_grp_2, @concept_viro_grp_3)
@@ -2507,7 +2944,7 @@ END;
 INSERT INTO temp_vaccination (person_id, value_coded, dose, obs_group_id, obs_datetime, encounter_id)
 SELECT ob.person_id, ob.value_coded, ob2.value_numeric, ob.obs_group_id, ob.obs_datetime, ob.encounter_id
 FROM _tmp_obs ob
-INNER JOIN _tmp_obs_grp ob2 ON ob2.obs_group_id = ob.obs_group_id
+INNER JOIN _tmp_obs ob2 ON ob2.obs_group_id = ob.obs_group_id
 WHERE ob2.concept_id = 1418
 AND ob.concept_id = 984
 AND ob.voided = 0;
@@ -2603,7 +3040,11 @@ DROP TABLE IF EXISTS `temp_vaccination`;
 -- =============================================================================
 -- SECTION 14 : Tests sérologiques, PCR, Paludisme
 -- =============================================================================
-TRUNCATE TABLE patient_pcr;
+/* patient_pcr est reconstruite dans patient_pcr_next puis échangée par un
+   seul RENAME TABLE en fin de section */
+DROP TABLE IF EXISTS patient_pcr_next;
+CREATE TABLE patient_pcr_next LIKE patient_pcr;
+
 START TRANSACTION;
 
 /*Part of serological tests*/
@@ -2622,7 +3063,7 @@ INSERT into serological_tests
 SELECT DISTINCT ob.person_id,ob.encounter_id,
   ob.location_id,ob1.concept_id,ob.obs_group_id,ob.concept_id, ob.value_coded, now(), ob.voided
 FROM _tmp_obs ob
-INNER JOIN _tmp_obs_grp ob1 ON ob.person_id = ob1.person_id
+INNER JOIN _tmp_obs ob1 ON ob.person_id = ob1.person_id
     AND ob.encounter_id = ob1.encounter_id
     AND ob.obs_group_id = ob1.obs_id
 WHERE ob1.concept_id IN (@concept_sero_grp_1,
@@ -2692,14 +3133,14 @@ AND answer_concept_id IN(163722,1042);
 
 /*END of virological_tests table*/
 /*Insert pcr on patient_pcr*/
-INSERT INTO patient_pcr(patient_id,encounter_id,location_id,visit_date,pcr_result, test_date)
+INSERT INTO patient_pcr_next(patient_id,encounter_id,location_id,visit_date,pcr_result, test_date)
 SELECT DISTINCT pl.patient_id,pl.encounter_id,pl.location_id,pl.visit_date,pl.test_result,pl.date_test_done
 FROM isanteplus.patient_laboratory pl
 WHERE pl.test_id = 844
 AND pl.test_done = 1
 AND pl.test_result IN(1301,1302,1300,1304);
 
-INSERT INTO patient_pcr(patient_id,encounter_id,location_id,visit_date,pcr_result, test_date)
+INSERT INTO patient_pcr_next(patient_id,encounter_id,location_id,visit_date,pcr_result, test_date)
 SELECT DISTINCT vt.patient_id,vt.encounter_id, vt.location_id,
   vt.encounter_date,vt.test_result,vt.test_date
 FROM isanteplus.virological_tests vt
@@ -2853,6 +3294,10 @@ AND o.voided = 0;
 
 COMMIT;
 
+DROP TABLE IF EXISTS patient_pcr_old;
+RENAME TABLE patient_pcr TO patient_pcr_old, patient_pcr_next TO patient_pcr;
+DROP TABLE patient_pcr_old;
+
 -- =============================================================================
 -- SECTION 15 : Patient sous ARV (patient_on_art), Populations clés,
 --              Planning familial, Charge virale, Régime
@@ -2877,12 +3322,14 @@ ON DUPLICATE KEY UPDATE
   patient_id = ob.person_id;
 
 /*Update lab VHI+ for patient_on_art table*/
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pa
 INNER JOIN _tmp_obs ob ON pa.patient_id = ob.person_id
 SET pa.tested_hiv_postive = 1, pa.date_tested_hiv_postive = DATE(ob.obs_datetime)
 WHERE ob.concept_id = 1040
 AND ob.value_coded = 703
-AND ob.voided = 0;
+AND ob.voided = 0
+AND pa.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
 /*Insertion visit VHI+ for patient_on_art table*/
 INSERT INTO isanteplus.patient_on_art(patient_id, tested_hiv_postive, date_tested_hiv_postive)
@@ -2894,64 +3341,83 @@ ON DUPLICATE KEY UPDATE
   patient_id = ob.person_id;
 
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art par
 INNER JOIN _tmp_obs o ON par.patient_id = o.person_id
 SET par.date_completed_preventive_tb_treatment = DATE (o.value_datetime)
 WHERE o.concept_id = 163284
-AND o.voided = 0;
+AND o.voided = 0
+AND par.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art par
 INNER JOIN _tmp_obs o ON par.patient_id = o.person_id
 SET par.date_completed_preventive_tb_treatment = DATE (o.value_datetime)
 WHERE o.concept_id = 509166326
-AND o.voided = 0;
+AND o.voided = 0
+AND par.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art par
 INNER JOIN _tmp_encounter e ON e.patient_id = par.patient_id
 SET par.first_vist_date = DATE(e.encounter_datetime)
 WHERE e.encounter_type IN (@et_followup_hiv_visit, @et_ped_followup_hiv_visit)
-AND e.voided = 0;
+AND e.voided = 0
+AND par.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pat
-INNER JOIN (
-  SELECT e.patient_id, MAX(e.encounter_datetime) as encounter_datetime
-  FROM _tmp_encounter e
-  WHERE e.encounter_type IN (@et_first_hiv_visit,
-    @et_ped_first_hiv_visit
-  )
-  AND e.voided = 0
-  GROUP BY 1
-) B ON pat.patient_id = B.patient_id
-SET pat.last_folowup_vist_date = B.encounter_datetime;
-
+INNER JOIN _tmp_etl_patient t ON t.patient_id = pat.patient_id
+INNER JOIN isanteplus.patient_latest_visit B ON pat.patient_id = B.patient_id
+SET pat.last_folowup_vist_date = B.hiv_first_visit_datetime
+WHERE B.hiv_first_visit_datetime IS NOT NULL
+AND pat.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
+
+
+/*Date exclue de l'avant-derniere visite, calculee une seule fois sur toutes
+les rencontres et non a chaque tranche*/
+DROP TEMPORARY TABLE IF EXISTS tmp_first_hiv_visit_excluded;
+CREATE TEMPORARY TABLE tmp_first_hiv_visit_excluded (
+    PRIMARY KEY (encounter_datetime)
+)
+SELECT MAX(e.encounter_datetime) AS encounter_datetime
+FROM _tmp_encounter e
+WHERE e.encounter_type IN (@et_first_hiv_visit, @et_ped_first_hiv_visit)
+AND e.voided = 0
+HAVING MAX(e.encounter_datetime) IS NOT NULL;
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pat
 INNER JOIN (
   SELECT e.patient_id, MAX(e.encounter_datetime) as encounter_datetime
   FROM _tmp_encounter e
+  LEFT JOIN tmp_first_hiv_visit_excluded x
+    ON x.encounter_datetime = e.encounter_datetime
   WHERE e.encounter_type IN (@et_first_hiv_visit,
     @et_ped_first_hiv_visit
   )
   AND e.voided = 0
-  AND e.encounter_datetime NOT IN (SELECT MAX(e.encounter_datetime)
-    FROM _tmp_encounter_2 e
-    WHERE e.encounter_type IN (@et_first_hiv_visit, @et_ped_first_hiv_visit)
-    AND e.voided = 0
-  )
+  AND e.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi
+  AND x.encounter_datetime IS NULL
   GROUP BY 1
 ) B ON pat.patient_id = B.patient_id
 SET pat.second_last_folowup_vist_date = B.encounter_datetime;
 
+DROP TEMPORARY TABLE IF EXISTS tmp_first_hiv_visit_excluded;
+
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pt
 INNER JOIN _tmp_obs o ON o.person_id = pt.patient_id
 INNER JOIN _tmp_encounter e ON o.encounter_id = e.encounter_id
 SET pt.date_started_arv_for_transfered = DATE(o.obs_datetime)
 WHERE o.concept_id = 159599
 AND e.encounter_type = @et_first_hiv_visit
-AND o.voided = 0;
+AND o.voided = 0
+AND pt.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pt
 INNER JOIN _tmp_obs o ON o.person_id = pt.patient_id
 SET pt.screened_cervical_cancer = (CASE WHEN o.value_coded = 151185 THEN 1 ELSE 0 END)  ,
@@ -2960,8 +3426,10 @@ WHERE o.obs_group_id = 160714
 AND o.concept_id = 1651
 AND o.value_coded = 151185
 AND o.value_coded = 0
-AND o.voided = 0;
+AND o.voided = 0
+AND pt.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pt
 INNER JOIN _tmp_obs o ON o.person_id = pt.patient_id
 SET pt.cervical_cancer_status = (
@@ -2971,8 +3439,10 @@ SET pt.cervical_cancer_status = (
 ),
 pt.date_started_cervical_cancer_status = DATE(o.obs_datetime)
 WHERE o.concept_id = 160704
-AND o.voided = 0;
+AND o.voided = 0
+AND pt.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pt
 INNER JOIN _tmp_obs o ON o.person_id = pt.patient_id
 SET pt.cervical_cancer_treatment = (
@@ -2982,14 +3452,18 @@ SET pt.cervical_cancer_treatment = (
 ),
 pt.date_cervical_cancer_treatment = DATE(o.obs_datetime)
 WHERE o.concept_id = 1651
-AND o.voided = 0;
+AND o.voided = 0
+AND pt.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pt
 INNER JOIN _tmp_obs o ON o.person_id = pt.patient_id
 SET pt.date_started_breast_feeding = DATE(o.obs_datetime)
 WHERE o.concept_id = @concept_breast_feeding
-AND o.voided = 0;
+AND o.voided = 0
+AND pt.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pt
 INNER JOIN _tmp_obs o ON o.person_id = pt.patient_id
 SET pt.key_population = (
@@ -3000,8 +3474,10 @@ SET pt.key_population = (
   WHEN o.value_coded = 105 THEN 'DRUG USER' END
 )
 WHERE o.concept_id = @concept_key_population
-AND o.voided = 0;
+AND o.voided = 0
+AND pt.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pt
 INNER JOIN _tmp_obs o ON o.person_id = pt.patient_id
 SET pt.reason_non_enrollment = (
@@ -3014,16 +3490,20 @@ SET pt.reason_non_enrollment = (
 ),
 pt.date_non_enrollment = DATE(o.obs_datetime)
 WHERE o.concept_id in (1667,161555)
-AND o.voided = 0;
+AND o.voided = 0
+AND pt.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pt
 INNER JOIN _tmp_obs o ON o.person_id = pt.patient_id
 SET pt.breast_feeding = (CASE WHEN o.value_coded = 1065 THEN 1 ELSE 0 END),
 pt.date_breast_feeding = DATE(o.obs_datetime)
 WHERE o.concept_id = 5632
-AND o.voided = 0;
+AND o.voided = 0
+AND pt.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
 /*Treatment regime lines: highest priority wins (THIRD > SECOND > FIRST)*/
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pat
 INNER JOIN (
   SELECT o.person_id,
@@ -3037,39 +3517,49 @@ INNER JOIN (
   WHERE o.concept_id = 164432
   AND o.value_coded IN (@concept_first_line_regimen, @concept_second_line_regimen, @concept_third_line_regimen)
   AND o.voided = 0
+  AND o.person_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi
   GROUP BY o.person_id
 ) agg ON pat.patient_id = agg.person_id
 SET pat.treatment_regime_lines = agg.treatment_regime_lines,
 pat.date_started_regime_treatment = agg.date_started_regime_treatment;
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pat
 INNER JOIN _tmp_obs o ON o.person_id = pat.patient_id
 SET pat.date_full_6_months_of_inh_has_px = DATE (o.value_datetime)
 WHERE o.concept_id = 163284
-AND o.voided = 0;
+AND o.voided = 0
+AND pat.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pat
 INNER JOIN _tmp_obs o ON o.person_id = pat.patient_id
 SET pat.tb_screened = 1 ,
 pat.date_tb_screened = DATE (o.obs_datetime)
 WHERE o.concept_id = 1659
-AND o.value_coded IN  (142177,1660);
+AND o.value_coded IN  (142177,1660)
+AND pat.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pat
 INNER JOIN _tmp_obs o ON o.person_id = pat.patient_id
 SET pat.tb_status = (
   CASE WHEN o.value_coded = 142177 THEN 'POSTIVE'
   WHEN o.value_coded = 1660 THEN 'NEGATIVE' END
 )
-WHERE o.concept_id = 1659;
+WHERE o.concept_id = 1659
+AND pat.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pat
 INNER JOIN _tmp_obs o ON o.person_id = pat.patient_id
 SET pat.date_enrolled_on_tb_treatment = DATE (o.value_datetime)
 WHERE o.concept_id = 1113
-AND o.voided = 0;
+AND o.voided = 0
+AND pat.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pat
 INNER JOIN (
   SELECT e.patient_id, MIN(e.encounter_datetime) as min_encounter_date
@@ -3079,57 +3569,71 @@ INNER JOIN (
     @et_first_hiv_visit,
     @et_ped_first_hiv_visit
   )
+  AND e.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi
   GROUP BY 1
 ) B ON pat.patient_id = B.patient_id
 SET pat.date_tested_hiv_postive = B.min_encounter_date;
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pat
 INNER JOIN _tmp_obs o ON pat.patient_id = o.person_id
 SET  pat.tb_genexpert_test = 1 ,
 pat.date_sample_sent_for_diagnositic_tb = DATE (o.obs_datetime),
 pat.tb_bacteriological_test_status = (CASE WHEN o.value_coded = 1301 THEN 'POSTIVE' ELSE NULL END)
 WHERE o.concept_id = @concept_genexpert
-AND o.voided = 0;
+AND o.voided = 0
+AND pat.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pat
 INNER JOIN _tmp_obs o ON pat.patient_id = o.person_id
 SET  pat.tb_crachat_test = 1 ,
 pat.date_sample_sent_for_diagnositic_tb = DATE (o.obs_datetime) ,
 pat.tb_bacteriological_test_status = (CASE WHEN o.value_coded IN (1362,1363,1364) THEN 'POSTIVE' ELSE NULL END)
 WHERE o.concept_id = 307
-AND o.voided = 0;
+AND o.voided = 0
+AND pat.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pat
 INNER JOIN _tmp_obs o ON pat.patient_id = o.person_id
 SET  pat.tb_other_test = 1 ,
 pat.date_sample_sent_for_diagnositic_tb = DATE (o.obs_datetime)
 WHERE o.concept_id  IN (159984 ,159982 )
-AND o.voided = 0;
+AND o.voided = 0
+AND pat.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pat
 INNER JOIN _tmp_obs o ON pat.patient_id = o.person_id
 SET  pat.tb_bacteriological_test_status = 'POSTIVE'
 WHERE o.concept_id = 159982
 AND o.value_coded IN (@concept_tb_bact_pos_1, @concept_tb_bact_pos_2)
-AND o.voided = 0;
+AND o.voided = 0
+AND pat.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pat
 INNER JOIN _tmp_obs o ON pat.patient_id = o.person_id
 SET  pat.tb_bacteriological_test_status = 'POSTIVE'
 WHERE o.concept_id = 159984
 AND o.value_coded IN (162204, 162203)
-AND o.voided = 0;
+AND o.voided = 0
+AND pat.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pat
 INNER JOIN _tmp_obs o ON pat.patient_id = o.person_id
 SET  pat.viral_load_targeted = 1
 WHERE o.concept_id = @concept_viral_load_type
 AND o.value_coded = @concept_viral_load_targeted
-AND o.voided = 0;
+AND o.voided = 0
+AND pat.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
 /*Family planning: accepted method, using method, dates (concept_id=374)*/
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pat
 INNER JOIN _tmp_obs o ON pat.patient_id = o.person_id
 SET pat.accepted_family_planning_method = (
@@ -3148,23 +3652,28 @@ pat.using_family_planning_method = (
 ),
 pat.date_using_family_planning_method = DATE(o.obs_datetime)
 WHERE o.concept_id = 374
-AND o.voided = 0;
+AND o.voided = 0
+AND pat.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
 /*Family planning: earliest acceptance date (concept_id=374)*/
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pat
 INNER JOIN (
   SELECT o.person_id, MIN(o.obs_datetime) AS min_obs_datetime
   FROM _tmp_obs o
   WHERE o.concept_id = 374
   AND o.voided = 0
+  AND o.person_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi
   GROUP BY o.person_id
 ) fp ON pat.patient_id = fp.person_id
 SET pat.date_accepted_family_planning_method = fp.min_obs_datetime;
 
+-- etl:chunk isanteplus.patient_on_art patient_id
 UPDATE isanteplus.patient_on_art pat
 INNER JOIN _tmp_obs o ON o.person_id = pat.patient_id
 SET pat.migrated = (CASE WHEN o.value_coded = 160415 THEN 1 ELSE 0 END )
-WHERE o.concept_id = 161555;
+WHERE o.concept_id = 161555
+AND pat.patient_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
 /* Insertion for key_populations table */
 INSERT INTO key_populations
@@ -3250,6 +3759,7 @@ AND o.value_coded IN (@concept_viral_load_routine, @concept_viral_load_targeted)
 AND pl.test_id IN (856,1305);
 
 /*Update for regimen First line, second line, third line*/
+-- etl:chunk isanteplus.patient_dispensing encounter_id
 UPDATE isanteplus.patient_dispensing pdi
 INNER JOIN _tmp_obs o ON pdi.patient_id = o.person_id
     AND pdi.encounter_id = o.encounter_id
@@ -3263,21 +3773,60 @@ AND o.value_coded IN (@concept_first_line_regimen,
   @concept_second_line_regimen,
   @concept_third_line_regimen
 )
-AND pdi.arv_drug = 1065;
+AND pdi.arv_drug = 1065
+AND pdi.encounter_id BETWEEN @etl_chunk_lo AND @etl_chunk_hi;
 
 COMMIT;
 
 -- =============================================================================
--- NETTOYAGE : Supprimer les tables temporaires
+-- NETTOYAGE : Supprimer les tables de snapshot
+-- Lecture partagée (SET @etl_share_snapshot = 1, posé par python3 -m etl
+-- quand patient_status_arv_dml.sql suit dans la même exécution) : en
+-- reconstruction complète, _tmp_obs et _tmp_encounter couvrent tous les
+-- patients ; ils sont renommés en etl_shared_* et patient_status_arv_dml.sql
+-- les lit au lieu de parcourir openmrs, puis les supprime.
 -- =============================================================================
-DROP TEMPORARY TABLE IF EXISTS _tmp_obs;
-DROP TEMPORARY TABLE IF EXISTS _tmp_obs_grp;
-DROP TEMPORARY TABLE IF EXISTS _tmp_obs_sib;
-DROP TEMPORARY TABLE IF EXISTS _tmp_encounter;
-DROP TEMPORARY TABLE IF EXISTS _tmp_encounter_2;
-DROP TEMPORARY TABLE IF EXISTS _tmp_visit;
-DROP TEMPORARY TABLE IF EXISTS _tmp_visit_2;
-DROP TEMPORARY TABLE IF EXISTS _tmp_encounter_provider;
-DROP TEMPORARY TABLE IF EXISTS _tmp_person;
-DROP TEMPORARY TABLE IF EXISTS _tmp_patient;
-DROP TEMPORARY TABLE IF EXISTS _tmp_person_attribute;
+DROP TABLE IF EXISTS etl_shared_obs;
+DROP TABLE IF EXISTS etl_shared_encounter;
+
+SET @etl_shared_snapshot := IF(COALESCE(@etl_share_snapshot, 0) = 1
+  AND @etl_incremental = 0, 1, 0);
+SET @sql := IF(
+    @etl_shared_snapshot = 1,
+    'RENAME TABLE _tmp_obs TO etl_shared_obs, _tmp_encounter TO etl_shared_encounter',
+    'DO 0'
+);
+
+PREPARE stmt FROM @sql;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
+
+DROP TABLE IF EXISTS _tmp_obs;
+DROP TABLE IF EXISTS _tmp_obs_concepts;
+DROP TABLE IF EXISTS _tmp_obs_encounter;
+DROP TABLE IF EXISTS _tmp_obs_group_count;
+DROP TABLE IF EXISTS _tmp_obs_pivot;
+DROP TABLE IF EXISTS _tmp_encounter;
+DROP TABLE IF EXISTS _tmp_visit;
+DROP TABLE IF EXISTS _tmp_encounter_provider;
+DROP TABLE IF EXISTS _tmp_drug_group;
+DROP TABLE IF EXISTS _tmp_drug_encounter;
+DROP TABLE IF EXISTS _tmp_person;
+DROP TABLE IF EXISTS _tmp_patient;
+DROP TABLE IF EXISTS _tmp_person_attribute;
+DROP TABLE IF EXISTS _tmp_discontinuation_encounter;
+DROP TABLE IF EXISTS _tmp_etl_patient;
+
+-- Toutes les sections ont réussi : avancer les marques
+INSERT INTO etl_watermark (source_table, last_id, last_date, last_run_date)
+SELECT w.source_table, w.last_id, w.last_date, NOW()
+FROM _tmp_etl_watermark w
+ON DUPLICATE KEY UPDATE
+  last_id = VALUES(last_id),
+  last_date = VALUES(last_date),
+  last_run_date = VALUES(last_run_date);
+DROP TABLE IF EXISTS _tmp_etl_watermark;
+
+-- Tables patient_latest_* à jour : patient_status_arv_dml.sql, exécuté
+-- ensuite dans la même session, les lit sans les recalculer
+SET @etl_latest_refreshed := 1;
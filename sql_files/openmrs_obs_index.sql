@@ -0,0 +1,24 @@
+/*Etape de deploiement optionnelle, hors load.sh et python3 -m etl : index de
+openmrs.obs sur date_voided. Avec lui, le mode incremental du DML des rapports
+(isanteplusreportsdmlscript.sql) et patient_diagnosis (indicators_report.sql)
+retrouvent aussi les obs annulees sans modifier leur rencontre ; sans lui, ils
+passent par date_changed/date_voided de la rencontre.
+Droit ALTER requis sur openmrs. La creation de l'index parcourt toute la
+table obs : a lancer une fois, hors des heures de consultation.*/
+SET @idx_exists := (
+    SELECT COUNT(*)
+    FROM INFORMATION_SCHEMA.STATISTICS
+    WHERE TABLE_SCHEMA = 'openmrs'
+      AND TABLE_NAME = 'obs'
+      AND INDEX_NAME = 'idx_obs_date_voided'
+);
+
+SET @sql := IF(
+    @idx_exists = 0,
+    'ALTER TABLE openmrs.obs ADD INDEX idx_obs_date_voided (date_voided);',
+    'SELECT ''Index idx_obs_date_voided already exists'';'
+);
+
+PREPARE stmt FROM @sql;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
@@ -11,9 +11,32 @@ SET SQL_SAFE_UPDATES = 0;
 -- Résout les variables de session, les UUID de types de consultation et de
 -- concepts, puis pré-charge les tables temporaires partagées en un minimum
 -- de parcours des grandes tables openmrs.obs et openmrs.encounter.
+--
+-- Lecture partagée : exécuté dans la même session après une reconstruction
+-- complète de isanteplusreportsdmlscript.sql avec @etl_share_snapshot = 1
+-- (python3 -m etl, donc load.sh), ce script lit les snapshots
+-- etl_shared_obs et etl_shared_encounter laissés par son NETTOYAGE
+-- (@etl_shared_snapshot = 1) au lieu de parcourir à nouveau openmrs.
 -- =============================================================================
 
 SET SESSION TRANSACTION ISOLATION LEVEL READ UNCOMMITTED;
+
+-- Snapshots de isanteplusreportsdmlscript.sql : utilisés seulement s'ils ont
+-- été produits dans cette session. Tables vides à défaut, pour que les
+-- requêtes ci-dessous restent valides.
+SET @etl_shared_snapshot := COALESCE(@etl_shared_snapshot, 0);
+
+CREATE TABLE IF NOT EXISTS etl_shared_obs
+SELECT o.obs_id, o.person_id, o.concept_id, o.encounter_id, o.obs_datetime,
+       o.location_id, o.obs_group_id, o.value_coded, o.value_datetime,
+       o.value_numeric, o.value_text, o.comments, o.voided
+FROM openmrs.obs o
+WHERE 1 = 0;
+
+CREATE TABLE IF NOT EXISTS etl_shared_encounter
+SELECT * FROM openmrs.encounter
+WHERE 1 = 0;
+
 START TRANSACTION;
 
 -- -------------------------------------------------------------------------
@@ -66,23 +89,6 @@ SET @concept_ddp := (
     WHERE uuid = 'c2aacdc8-156e-4527-8934-a8fb94162419'
 );
 
--- -------------------------------------------------------------------------
--- Pré-chargement des données de openmrs.visit dans une table temporaire
--- Un seul parcours de la table des visites au lieu de requêtes multiples
--- -------------------------------------------------------------------------
-DROP TEMPORARY TABLE IF EXISTS tmp_latest_visit;
-CREATE TEMPORARY TABLE tmp_latest_visit (
-    patient_id INT NOT NULL,
-    visit_date DATE NOT NULL,
-    PRIMARY KEY (patient_id)
-) ENGINE=MEMORY
-SELECT
-    pvi.patient_id,
-    MAX(DATE(pvi.date_started)) AS visit_date
-FROM openmrs.visit pvi
-WHERE pvi.voided = 0
-GROUP BY pvi.patient_id;
-
 -- -------------------------------------------------------------------------
 -- Pré-chargement de TOUTES les données obs nécessaires en UN SEUL PARCOURS
 -- Superset des concepts utilisés par Section 1 (patient_status_arv) et
@@ -121,7 +127,8 @@ SELECT
     o.location_id,
     o.voided
 FROM openmrs.obs o
-WHERE o.concept_id IN (
+WHERE @etl_shared_snapshot = 0
+AND o.concept_id IN (
     -- Concepts Section 1
     1030,    -- Test PCR
     844,     -- Test sérologique
@@ -138,8 +145,29 @@ WHERE o.concept_id IN (
 )
 AND o.voided <> 1;
 
+-- Mêmes concepts, lus dans le snapshot de isanteplusreportsdmlscript.sql
+-- (ces concepts figurent dans son _tmp_obs_concepts)
+INSERT INTO tmp_obs_snapshot
+SELECT
+    o.obs_id,
+    o.person_id,
+    o.encounter_id,
+    o.concept_id,
+    o.value_coded,
+    o.value_numeric,
+    o.value_datetime,
+    o.obs_datetime,
+    o.obs_group_id,
+    o.location_id,
+    o.voided
+FROM etl_shared_obs o
+WHERE @etl_shared_snapshot = 1
+AND o.concept_id IN (1030, 844, 1401, 161555, 1667, 856, 1305, 1282, 159367,
+                     @concept_ddp)
+AND o.voided <> 1;
+
 -- Deuxième copie des obs pour les auto-jointures (MySQL ne peut pas rouvrir les tables temporaires)
--- Section 1 utilise 1667 (statut 3), Section 3 utilise 159367 (alerte TB)
+-- Section 3 utilise 159367 (alerte TB)
 DROP TEMPORARY TABLE IF EXISTS tmp_obs_snapshot_2;
 CREATE TEMPORARY TABLE tmp_obs_snapshot_2 (
     obs_id INT NOT NULL,
@@ -160,10 +188,21 @@ SELECT
     o.value_coded,
     o.obs_group_id
 FROM openmrs.obs o
-WHERE o.concept_id IN (
-    1667,    -- Détail raison d'arrêt (auto-jointure statut 3 dans Section 1)
-    159367   -- Statut du médicament (auto-jointure alerte TB dans Section 3)
-)
+WHERE @etl_shared_snapshot = 0
+AND o.concept_id = 159367   -- Statut du médicament (auto-jointure alerte TB dans Section 3)
+AND o.voided <> 1;
+
+INSERT INTO tmp_obs_snapshot_2
+SELECT
+    o.obs_id,
+    o.person_id,
+    o.encounter_id,
+    o.concept_id,
+    o.value_coded,
+    o.obs_group_id
+FROM etl_shared_obs o
+WHERE @etl_shared_snapshot = 1
+AND o.concept_id = 159367
 AND o.voided <> 1;
 
 -- Copie séparée pour les recherches de groupes obs (groupes INH/Rifampicine)
@@ -185,7 +224,20 @@ SELECT
     o.concept_id,
     o.obs_group_id
 FROM openmrs.obs o
-WHERE o.concept_id IN (@concept_isoniazid_group, @concept_rifampicin_group)
+WHERE @etl_shared_snapshot = 0
+  AND o.concept_id IN (@concept_isoniazid_group, @concept_rifampicin_group)
+  AND o.voided <> 1;
+
+INSERT INTO tmp_obs_group_snapshot
+SELECT
+    o.obs_id,
+    o.person_id,
+    o.encounter_id,
+    o.concept_id,
+    o.obs_group_id
+FROM etl_shared_obs o
+WHERE @etl_shared_snapshot = 1
+  AND o.concept_id IN (@concept_isoniazid_group, @concept_rifampicin_group)
   AND o.voided <> 1;
 
 -- -------------------------------------------------------------------------
@@ -214,11 +266,137 @@ SELECT
     e.encounter_datetime,
     e.voided
 FROM openmrs.encounter e
-WHERE e.voided <> 1;
+WHERE @etl_shared_snapshot = 0
+AND e.voided <> 1;
+
+INSERT INTO tmp_encounter_snapshot
+SELECT
+    e.encounter_id,
+    e.patient_id,
+    e.visit_id,
+    e.encounter_type,
+    e.encounter_datetime,
+    e.voided
+FROM etl_shared_encounter e
+WHERE @etl_shared_snapshot = 1
+AND e.voided <> 1;
 
 -- Valider la transaction de lecture - libère les verrous sur les tables openmrs
 COMMIT;
 
+-- Les snapshots partagés ne servent plus
+DROP TABLE IF EXISTS etl_shared_obs;
+DROP TABLE IF EXISTS etl_shared_encounter;
+SET @etl_shared_snapshot := 0;
+
+-- -------------------------------------------------------------------------
+-- Dernières valeurs par patient (patient_latest_visit,
+-- patient_latest_dispensing, patient_latest_viral_load)
+-- Tenues à jour patient par patient par isanteplusreportsdmlscript.sql
+-- (sections 2, 3 et 6), qui pose @etl_latest_refreshed = 1 quand il précède
+-- ce script dans la même session. Sinon (script exécuté seul), elles sont
+-- recalculées ici pour tous les patients.
+-- -------------------------------------------------------------------------
+SET @etl_latest_refreshed := COALESCE(@etl_latest_refreshed, 0);
+
+CREATE TABLE IF NOT EXISTS patient_latest_visit (
+    patient_id INT(11) NOT NULL,
+    visit_date DATE,
+    hiv_first_visit_datetime DATETIME,
+    CONSTRAINT pk_patient_latest_visit PRIMARY KEY (patient_id)
+) ENGINE = InnoDB DEFAULT CHARSET = utf8;
+
+CREATE TABLE IF NOT EXISTS patient_latest_dispensing (
+    patient_id INT(11) NOT NULL,
+    first_arv_visit_date DATE,
+    last_arv_encounter_id INT(11),
+    next_arv_dispensation_date DATE,
+    next_arv_rx_dispensation_date DATE,
+    last_visit_date DATE,
+    CONSTRAINT pk_patient_latest_dispensing PRIMARY KEY (patient_id)
+) ENGINE = InnoDB DEFAULT CHARSET = utf8;
+
+CREATE TABLE IF NOT EXISTS patient_latest_viral_load (
+    patient_id INT(11) NOT NULL,
+    last_test_date DATE,
+    last_result_date DATE,
+    CONSTRAINT pk_patient_latest_viral_load PRIMARY KEY (patient_id)
+) ENGINE = InnoDB DEFAULT CHARSET = utf8;
+
+SET @sql := IF(@etl_latest_refreshed = 0,
+    'TRUNCATE TABLE patient_latest_visit',
+    'DO 0');
+PREPARE stmt FROM @sql;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
+
+INSERT INTO patient_latest_visit (patient_id, visit_date)
+SELECT
+    pvi.patient_id,
+    MAX(DATE(pvi.date_started)) AS visit_date
+FROM openmrs.visit pvi
+WHERE @etl_latest_refreshed = 0
+AND pvi.voided = 0
+GROUP BY pvi.patient_id;
+
+INSERT INTO patient_latest_visit (patient_id, hiv_first_visit_datetime)
+SELECT
+    e.patient_id,
+    MAX(e.encounter_datetime) AS hiv_first_visit_datetime
+FROM tmp_encounter_snapshot e
+WHERE @etl_latest_refreshed = 0
+AND e.encounter_type IN (@et_first_visit, @et_pediatric)
+GROUP BY e.patient_id
+ON DUPLICATE KEY UPDATE
+    hiv_first_visit_datetime = VALUES(hiv_first_visit_datetime);
+
+SET @sql := IF(@etl_latest_refreshed = 0,
+    'TRUNCATE TABLE patient_latest_dispensing',
+    'DO 0');
+PREPARE stmt FROM @sql;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
+
+INSERT INTO patient_latest_dispensing (patient_id, first_arv_visit_date,
+    last_arv_encounter_id, next_arv_dispensation_date,
+    next_arv_rx_dispensation_date, last_visit_date)
+SELECT
+    pdis.patient_id,
+    MIN(CASE WHEN pdis.arv_drug = 1065 THEN DATE(pdis.visit_date) END),
+    MAX(CASE WHEN pdis.arv_drug = 1065 THEN pdis.encounter_id END),
+    MAX(CASE WHEN pdis.arv_drug = 1065 AND pdis.voided <> 1
+        THEN pdis.next_dispensation_date END),
+    MAX(CASE WHEN pdis.arv_drug = 1065 AND pdis.voided <> 1
+        AND (pdis.rx_or_prophy <> 163768 OR pdis.rx_or_prophy IS NULL)
+        THEN pdis.next_dispensation_date END),
+    MAX(CASE WHEN pdis.voided <> 1 THEN DATE(pdis.visit_date) END)
+FROM isanteplus.patient_dispensing pdis
+WHERE @etl_latest_refreshed = 0
+GROUP BY pdis.patient_id;
+
+SET @sql := IF(@etl_latest_refreshed = 0,
+    'TRUNCATE TABLE patient_latest_viral_load',
+    'DO 0');
+PREPARE stmt FROM @sql;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
+
+INSERT INTO patient_latest_viral_load (patient_id, last_test_date, last_result_date)
+SELECT
+    pl.patient_id,
+    MAX(CASE WHEN pl.test_done = 1
+        AND ((pl.test_result IS NOT NULL) OR (pl.test_result <> ''))
+        THEN IFNULL(DATE(pl.date_test_done), DATE(pl.visit_date)) END),
+    MAX(CASE WHEN pl.test_result > 0
+        THEN IFNULL(DATE(pl.date_test_done), DATE(pl.visit_date)) END)
+FROM isanteplus.patient_laboratory pl
+WHERE @etl_latest_refreshed = 0
+AND pl.test_id IN (856, 1305)
+AND pl.voided <> 1
+GROUP BY pl.patient_id;
+
+SET @etl_latest_refreshed := 0;
+
 SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
 
 -- =============================================================================
@@ -258,21 +436,6 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
     FROM isanteplus.discontinuation_reason
     WHERE reason IN (159, 159492);
 
-    -- Table temporaire : Dernière date de dispensation par patient
-    DROP TEMPORARY TABLE IF EXISTS tmp_latest_dispensation;
-    CREATE TEMPORARY TABLE tmp_latest_dispensation (
-        patient_id INT NOT NULL,
-        next_dispensation_date DATE,
-        PRIMARY KEY (patient_id)
-    ) ENGINE=MEMORY
-    SELECT
-        pdisp.patient_id,
-        MAX(pdisp.next_dispensation_date) AS next_dispensation_date
-    FROM isanteplus.patient_dispensing pdisp
-    WHERE pdisp.voided <> 1
-      AND pdisp.arv_drug = 1065
-    GROUP BY pdisp.patient_id;
-
     COMMIT;
 
     -- =========================================================================
@@ -307,10 +470,13 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
 
     -- =========================================================================
     -- SECTION ENFANTS EXPOSÉS
+    -- Reconstruite dans exposed_infants_next puis échangée par un seul
+    -- RENAME TABLE : jusque-là les lecteurs voient l'ancienne table complète
     -- =========================================================================
-    START TRANSACTION;
+    DROP TABLE IF EXISTS exposed_infants_next;
+    CREATE TABLE exposed_infants_next LIKE exposed_infants;
 
-    TRUNCATE TABLE exposed_infants;
+    START TRANSACTION;
 
     -- -------------------------------------------------------------------------
     -- Patients avec résultats PCR négatifs (condition_exposee = 1)
@@ -363,7 +529,7 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
       AND o.concept_id IN (1030, 844)
       AND o.value_coded IN (664, 1302);  -- Résultats négatifs
 
-    INSERT INTO exposed_infants(patient_id, location_id, encounter_id, visit_date, condition_exposee)
+    INSERT INTO exposed_infants_next(patient_id, location_id, encounter_id, visit_date, condition_exposee)
     SELECT ppn.patient_id, ppn.location_id, ppn.encounter_id, ppn.encounter_date, 1
     FROM patient_pcr_negative ppn
     WHERE (ppn.concept_id = 1030 AND ppn.value_coded = 664)
@@ -375,7 +541,7 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
     -- -------------------------------------------------------------------------
     -- Condition B - Enfant exposé coché
     -- -------------------------------------------------------------------------
-    INSERT INTO exposed_infants(patient_id, location_id, encounter_id, visit_date, condition_exposee)
+    INSERT INTO exposed_infants_next(patient_id, location_id, encounter_id, visit_date, condition_exposee)
     SELECT DISTINCT
         ob.person_id,
         ob.location_id,
@@ -402,7 +568,7 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
     WHERE voided <> 1
     GROUP BY patient_id;
 
-    INSERT INTO exposed_infants(patient_id, location_id, encounter_id, visit_date, condition_exposee)
+    INSERT INTO exposed_infants_next(patient_id, location_id, encounter_id, visit_date, condition_exposee)
     SELECT DISTINCT
         pdisp.patient_id,
         pdisp.location_id,
@@ -447,7 +613,7 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
       AND o.value_coded = 1301
     ON DUPLICATE KEY UPDATE patient_id = VALUES(patient_id);
 
-    DELETE ei FROM exposed_infants ei
+    DELETE ei FROM exposed_infants_next ei
     INNER JOIN patient_pcr_positif pcp ON ei.patient_id = pcp.patient_id;
 
     DROP TEMPORARY TABLE IF EXISTS patient_pcr_positif;
@@ -455,7 +621,7 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
     -- -------------------------------------------------------------------------
     -- Retirer les patients avec test VIH positif (âge >= 18 mois)
     -- -------------------------------------------------------------------------
-    DELETE ei FROM exposed_infants ei
+    DELETE ei FROM exposed_infants_next ei
     INNER JOIN (
         SELECT pl.patient_id
         FROM patient_laboratory pl
@@ -470,7 +636,7 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
     -- -------------------------------------------------------------------------
     -- Retirer les patients VIH confirmé par test sérologique
     -- -------------------------------------------------------------------------
-    DELETE ei FROM exposed_infants ei
+    DELETE ei FROM exposed_infants_next ei
     INNER JOIN (
         SELECT DISTINCT ob.person_id
         FROM tmp_obs_snapshot ob
@@ -483,7 +649,7 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
     -- -------------------------------------------------------------------------
     -- Condition 5 - Séroréversion
     -- -------------------------------------------------------------------------
-    INSERT INTO exposed_infants(patient_id, location_id, encounter_id, visit_date, condition_exposee)
+    INSERT INTO exposed_infants_next(patient_id, location_id, encounter_id, visit_date, condition_exposee)
     SELECT DISTINCT
         ob.person_id,
         ob.location_id,
@@ -498,312 +664,291 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
 
     COMMIT;
 
+    DROP TABLE IF EXISTS exposed_infants_old;
+    RENAME TABLE exposed_infants TO exposed_infants_old,
+        exposed_infants_next TO exposed_infants;
+    DROP TABLE exposed_infants_old;
+
     -- =========================================================================
     -- SECTION STATUT ARV DES PATIENTS
     -- Traitement en transactions plus petites pour réduire la durée des verrous
     -- =========================================================================
 
+    -- Patients dont le dernier statut (patient_latest_status) est à
+    -- recalculer : ceux dont un statut du jour est supprimé ci-dessous, puis
+    -- ceux dont cette exécution écrit un statut et les enfants exposés
+    SET @status_run_start := NOW();
+
+    DROP TEMPORARY TABLE IF EXISTS tmp_status_patients;
+    CREATE TEMPORARY TABLE tmp_status_patients (
+        patient_id INT NOT NULL,
+        PRIMARY KEY (patient_id)
+    ) ENGINE=MEMORY
+    SELECT DISTINCT patient_id
+    FROM patient_status_arv
+    WHERE DATE(date_started_status) = CURDATE();
+
     -- Transaction : Suppression des statuts du jour
     START TRANSACTION;
     DELETE FROM patient_status_arv WHERE DATE(date_started_status) = CURDATE();
     COMMIT;
 
-    -- Transaction : Statuts 4 et 5 (Décédés/Transférés en Pré-ARV)
-    START TRANSACTION;
+    -- -------------------------------------------------------------------------
+    -- Classification en un passage : une ligne de caractéristiques par patient
+    -- (tmp_status_features), remplie par un parcours de chaque source, puis
+    -- les statuts 1-11 dérivés par une seule expression CASE et écrits en un
+    -- seul INSERT. Un patient peut recevoir plusieurs statuts le même jour
+    -- (ex. 7 et 11) : la CASE est évaluée pour chaque statut de la liste.
+    -- -------------------------------------------------------------------------
 
-    -- Statut 4 : Décédés en Pré-ARV
-    INSERT INTO patient_status_arv(patient_id, id_status, start_date, encounter_id, last_updated_date, date_started_status)
+    -- Rencontres d'arrêt : raisons 161555 (159 décédé, 159492 transféré,
+    -- 1667 arrêté) et détail 1667 (115198, 159737) de la même rencontre
+    DROP TEMPORARY TABLE IF EXISTS tmp_status_disc_encounter;
+    CREATE TEMPORARY TABLE tmp_status_disc_encounter (
+        encounter_id INT NOT NULL,
+        patient_id INT NOT NULL,
+        encounter_date DATE,
+        is_death TINYINT,
+        is_transfer TINYINT,
+        is_stopped TINYINT,
+        PRIMARY KEY (encounter_id),
+        KEY idx_patient (patient_id)
+    )
     SELECT
-        v.patient_id,
-        4 AS id_status,
-        DATE(v.date_started) AS start_date,
         enc.encounter_id,
-        NOW(),
-        NOW()
-    FROM isanteplus.patient ispat
-    INNER JOIN openmrs.visit v ON ispat.patient_id = v.patient_id
-    INNER JOIN tmp_encounter_snapshot enc ON v.visit_id = enc.visit_id
+        enc.patient_id,
+        DATE(enc.encounter_datetime) AS encounter_date,
+        MAX(ob.concept_id = 161555 AND ob.value_coded = 159) AS is_death,
+        MAX(ob.concept_id = 161555 AND ob.value_coded = 159492) AS is_transfer,
+        MAX(ob.concept_id = 161555 AND ob.value_coded = 1667)
+            AND MAX(ob.concept_id = 1667 AND ob.value_coded IN (115198, 159737)) AS is_stopped
+    FROM tmp_encounter_snapshot enc
     INNER JOIN tmp_obs_snapshot ob
         ON enc.encounter_id = ob.encounter_id
        AND enc.patient_id = ob.person_id
-    INNER JOIN tmp_latest_visit B
-        ON v.patient_id = B.patient_id
-       AND DATE(v.date_started) = B.visit_date
-    LEFT JOIN tmp_patients_on_arv parv ON enc.patient_id = parv.patient_id
     WHERE enc.encounter_type = @et_discontinuation
-      AND ob.concept_id = 161555
-      AND ob.value_coded = 159
-      AND ispat.vih_status = 1
-      AND parv.patient_id IS NULL
-      AND ispat.voided = 0
-    GROUP BY v.patient_id
-    ON DUPLICATE KEY UPDATE last_updated_date = VALUES(last_updated_date);
+      AND ob.concept_id IN (161555, 1667)
+    GROUP BY enc.encounter_id;
 
-    -- Statut 5 : Transférés en Pré-ARV
-    INSERT INTO patient_status_arv(patient_id, id_status, start_date, encounter_id, last_updated_date, date_started_status)
+    DROP TEMPORARY TABLE IF EXISTS tmp_status_features;
+    CREATE TEMPORARY TABLE tmp_status_features (
+        patient_id INT NOT NULL,
+        on_arv TINYINT NOT NULL DEFAULT 0,
+        in_patient TINYINT NOT NULL DEFAULT 0,
+        vih_status INT,
+        patient_voided INT,
+        disc_reason TINYINT NOT NULL DEFAULT 0,
+        disc_pre_arv TINYINT NOT NULL DEFAULT 0,
+        -- Statuts 1, 2, 3 : dernière rencontre d'arrêt, toutes dates
+        death_date DATE,
+        death_encounter_id INT,
+        transfer_date DATE,
+        transfer_encounter_id INT,
+        stopped_date DATE,
+        stopped_encounter_id INT,
+        -- Statuts 4, 5, 10, 7, 11 : rencontres des visites du jour de la dernière visite
+        death_pre_arv_date DATE,
+        death_pre_arv_encounter_id INT,
+        transfer_pre_arv_date DATE,
+        transfer_pre_arv_encounter_id INT,
+        lost_pre_arv_date DATE,
+        lost_pre_arv_encounter_id INT,
+        recent_pre_arv_date DATE,
+        recent_pre_arv_encounter_id INT,
+        active_pre_arv_date DATE,
+        active_pre_arv_encounter_id INT,
+        -- Statuts 6, 8, 9 : dispensations de la dernière date de prochaine dispensation
+        next_dispensation_date DATE,
+        arv_dispensing_date DATE,
+        arv_dispensing_encounter_id INT,
+        dispensing_date DATE,
+        dispensing_encounter_id INT,
+        PRIMARY KEY (patient_id)
+    );
+
+    INSERT INTO tmp_status_features (patient_id, death_date, death_encounter_id,
+        transfer_date, transfer_encounter_id, stopped_date, stopped_encounter_id)
+    SELECT
+        de.patient_id,
+        MAX(IF(de.is_death = 1, de.encounter_date, NULL)),
+        MAX(IF(de.is_death = 1, de.encounter_id, NULL)),
+        MAX(IF(de.is_transfer = 1, de.encounter_date, NULL)),
+        MAX(IF(de.is_transfer = 1, de.encounter_id, NULL)),
+        MAX(IF(de.is_stopped = 1, de.encounter_date, NULL)),
+        MAX(IF(de.is_stopped = 1, de.encounter_id, NULL))
+    FROM tmp_status_disc_encounter de
+    GROUP BY de.patient_id;
+
+    INSERT INTO tmp_status_features (patient_id, death_pre_arv_date,
+        death_pre_arv_encounter_id, transfer_pre_arv_date, transfer_pre_arv_encounter_id,
+        lost_pre_arv_date, lost_pre_arv_encounter_id, recent_pre_arv_date,
+        recent_pre_arv_encounter_id, active_pre_arv_date, active_pre_arv_encounter_id)
     SELECT
         v.patient_id,
-        5 AS id_status,
-        DATE(v.date_started) AS start_date,
-        enc.encounter_id,
-        NOW(),
-        NOW()
-    FROM isanteplus.patient ispat
-    INNER JOIN openmrs.visit v ON ispat.patient_id = v.patient_id
-    INNER JOIN tmp_encounter_snapshot enc ON v.visit_id = enc.visit_id
-    INNER JOIN tmp_obs_snapshot ob
-        ON enc.encounter_id = ob.encounter_id
-       AND enc.patient_id = ob.person_id
-    INNER JOIN tmp_latest_visit B
+        MAX(IF(de.is_death = 1, DATE(v.date_started), NULL)),
+        MAX(IF(de.is_death = 1, enc.encounter_id, NULL)),
+        MAX(IF(de.is_transfer = 1, DATE(v.date_started), NULL)),
+        MAX(IF(de.is_transfer = 1, enc.encounter_id, NULL)),
+        MAX(CASE WHEN v.voided <> 1
+                  AND enc.encounter_type NOT IN (
+                      @et_first_visit, @et_pediatric, @et_followup, @et_pediatric_followup,
+                      @et_dispensing1, @et_dispensing2, @et_lab)
+                  AND TIMESTAMPDIFF(MONTH, v.date_started, CURDATE()) > 12
+                 THEN DATE(v.date_started) END),
+        MAX(CASE WHEN v.voided <> 1
+                  AND enc.encounter_type NOT IN (
+                      @et_first_visit, @et_pediatric, @et_followup, @et_pediatric_followup,
+                      @et_dispensing1, @et_dispensing2, @et_lab)
+                  AND TIMESTAMPDIFF(MONTH, v.date_started, CURDATE()) > 12
+                 THEN enc.encounter_id END),
+        MAX(CASE WHEN v.voided <> 1
+                  AND enc.encounter_type IN (@et_first_visit, @et_pediatric)
+                  AND TIMESTAMPDIFF(MONTH, v.date_started, CURDATE()) <= 12
+                 THEN DATE(v.date_started) END),
+        MAX(CASE WHEN v.voided <> 1
+                  AND enc.encounter_type IN (@et_first_visit, @et_pediatric)
+                  AND TIMESTAMPDIFF(MONTH, v.date_started, CURDATE()) <= 12
+                 THEN enc.encounter_id END),
+        MAX(CASE WHEN v.voided <> 1
+                  AND enc.encounter_type IN (@et_followup, @et_pediatric_followup,
+                      @et_dispensing1, @et_dispensing2, @et_lab)
+                  AND TIMESTAMPDIFF(MONTH, v.date_started, CURDATE()) <= 12
+                 THEN DATE(v.date_started) END),
+        MAX(CASE WHEN v.voided <> 1
+                  AND enc.encounter_type IN (@et_followup, @et_pediatric_followup,
+                      @et_dispensing1, @et_dispensing2, @et_lab)
+                  AND TIMESTAMPDIFF(MONTH, v.date_started, CURDATE()) <= 12
+                 THEN enc.encounter_id END)
+    FROM openmrs.visit v
+    INNER JOIN patient_latest_visit B
         ON v.patient_id = B.patient_id
        AND DATE(v.date_started) = B.visit_date
-    LEFT JOIN tmp_patients_on_arv parv ON enc.patient_id = parv.patient_id
-    WHERE enc.encounter_type = @et_discontinuation
-      AND ob.concept_id = 161555
-      AND ob.value_coded = 159492
-      AND ispat.vih_status = 1
-      AND parv.patient_id IS NULL
-      AND ispat.voided = 0
+    INNER JOIN tmp_encounter_snapshot enc ON v.visit_id = enc.visit_id
+    LEFT JOIN tmp_status_disc_encounter de ON enc.encounter_id = de.encounter_id
     GROUP BY v.patient_id
-    ON DUPLICATE KEY UPDATE last_updated_date = VALUES(last_updated_date);
-
-    COMMIT;
-
-    -- Transaction : Statuts 6, 8, 9 (Réguliers, Rendez-vous ratés, Perdus de vue - basé sur dispensation)
-    START TRANSACTION;
-
-    -- Statut 6 : Réguliers (sous ARV, prochaine dispensation pas encore due)
-    INSERT INTO patient_status_arv(patient_id, id_status, start_date, encounter_id, last_updated_date, date_started_status)
-    SELECT
-        pdis.patient_id,
-        6 AS id_status,
-        MAX(DATE(pdis.visit_date)) AS start_date,
-        pdis.encounter_id,
-        NOW(),
-        NOW()
-    FROM isanteplus.patient ipat
-    INNER JOIN isanteplus.patient_dispensing pdis ON ipat.patient_id = pdis.patient_id
-    INNER JOIN tmp_patients_on_arv p ON pdis.patient_id = p.patient_id
-    INNER JOIN tmp_latest_dispensation mndisp
-        ON pdis.patient_id = mndisp.patient_id
-       AND pdis.next_dispensation_date = mndisp.next_dispensation_date
-    INNER JOIN tmp_encounter_snapshot enc ON pdis.visit_id = enc.visit_id
-    LEFT JOIN tmp_disc_patients_by_reason dreason ON enc.patient_id = dreason.patient_id
-    WHERE enc.encounter_type IN (@et_dispensing1, @et_dispensing2)
-      AND dreason.patient_id IS NULL
-      AND pdis.arv_drug = 1065
-      AND CURDATE() <= pdis.next_dispensation_date
-      AND pdis.voided <> 1
-    GROUP BY pdis.patient_id
-    ON DUPLICATE KEY UPDATE last_updated_date = VALUES(last_updated_date);
-
-    -- Statut 8 : Rendez-vous ratés (1-30 jours de retard)
-    INSERT INTO patient_status_arv(patient_id, id_status, start_date, encounter_id, last_updated_date, date_started_status)
-    SELECT
-        pdis.patient_id,
-        8 AS id_status,
-        MAX(DATE(pdis.visit_date)) AS start_date,
-        pdis.encounter_id,
-        NOW(),
-        NOW()
-    FROM isanteplus.patient ipat
-    INNER JOIN isanteplus.patient_dispensing pdis ON ipat.patient_id = pdis.patient_id
-    INNER JOIN tmp_latest_dispensation mndisp
-        ON pdis.patient_id = mndisp.patient_id
-       AND pdis.next_dispensation_date = mndisp.next_dispensation_date
-    INNER JOIN tmp_encounter_snapshot enc ON pdis.visit_id = enc.visit_id
-    INNER JOIN tmp_patients_on_arv parv ON enc.patient_id = parv.patient_id
-    LEFT JOIN tmp_disc_patients_by_reason dreason ON enc.patient_id = dreason.patient_id
-    WHERE enc.encounter_type IN (@et_dispensing1, @et_dispensing2)
-      AND dreason.patient_id IS NULL
-      AND DATEDIFF(CURDATE(), pdis.next_dispensation_date) BETWEEN 1 AND 30
-      AND pdis.voided <> 1
-    GROUP BY pdis.patient_id
-    ON DUPLICATE KEY UPDATE last_updated_date = VALUES(last_updated_date);
-
-    -- Statut 9 : Perdus de vue (>30 jours de retard)
-    INSERT INTO patient_status_arv(patient_id, id_status, start_date, encounter_id, last_updated_date, date_started_status)
+    ON DUPLICATE KEY UPDATE
+        death_pre_arv_date = VALUES(death_pre_arv_date),
+        death_pre_arv_encounter_id = VALUES(death_pre_arv_encounter_id),
+        transfer_pre_arv_date = VALUES(transfer_pre_arv_date),
+        transfer_pre_arv_encounter_id = VALUES(transfer_pre_arv_encounter_id),
+        lost_pre_arv_date = VALUES(lost_pre_arv_date),
+        lost_pre_arv_encounter_id = VALUES(lost_pre_arv_encounter_id),
+        recent_pre_arv_date = VALUES(recent_pre_arv_date),
+        recent_pre_arv_encounter_id = VALUES(recent_pre_arv_encounter_id),
+        active_pre_arv_date = VALUES(active_pre_arv_date),
+        active_pre_arv_encounter_id = VALUES(active_pre_arv_encounter_id);
+
+    INSERT INTO tmp_status_features (patient_id, next_dispensation_date,
+        arv_dispensing_date, arv_dispensing_encounter_id, dispensing_date,
+        dispensing_encounter_id)
     SELECT
         pdis.patient_id,
-        9 AS id_status,
-        MAX(DATE(pdis.visit_date)) AS start_date,
-        pdis.encounter_id,
-        NOW(),
-        NOW()
+        MAX(pdis.next_dispensation_date),
+        MAX(IF(pdis.arv_drug = 1065, DATE(pdis.visit_date), NULL)),
+        MAX(IF(pdis.arv_drug = 1065, pdis.encounter_id, NULL)),
+        MAX(DATE(pdis.visit_date)),
+        MAX(pdis.encounter_id)
     FROM isanteplus.patient_dispensing pdis
-    INNER JOIN tmp_latest_dispensation mndisp
+    INNER JOIN patient_latest_dispensing mndisp
         ON pdis.patient_id = mndisp.patient_id
-       AND pdis.next_dispensation_date = mndisp.next_dispensation_date
+       AND pdis.next_dispensation_date = mndisp.next_arv_dispensation_date
     INNER JOIN tmp_encounter_snapshot enc ON pdis.visit_id = enc.visit_id
-    INNER JOIN tmp_patients_on_arv parv ON enc.patient_id = parv.patient_id
-    LEFT JOIN tmp_disc_patients_by_reason dreason ON enc.patient_id = dreason.patient_id
     WHERE enc.encounter_type IN (@et_dispensing1, @et_dispensing2)
-      AND dreason.patient_id IS NULL
-      AND pdis.arv_drug = 1065
       AND pdis.voided <> 1
-      AND DATEDIFF(CURDATE(), pdis.next_dispensation_date) > 30
     GROUP BY pdis.patient_id
-    ON DUPLICATE KEY UPDATE last_updated_date = VALUES(last_updated_date);
-
-    COMMIT;
-
-    -- Transaction : Statuts 10, 7, 11 (Statuts pré-ARV)
+    ON DUPLICATE KEY UPDATE
+        next_dispensation_date = VALUES(next_dispensation_date),
+        arv_dispensing_date = VALUES(arv_dispensing_date),
+        arv_dispensing_encounter_id = VALUES(arv_dispensing_encounter_id),
+        dispensing_date = VALUES(dispensing_date),
+        dispensing_encounter_id = VALUES(dispensing_encounter_id);
+
+    -- Sous ARV, fiche patient et raisons d'arrêt
+    UPDATE tmp_status_features f
+    LEFT JOIN tmp_patients_on_arv parv ON f.patient_id = parv.patient_id
+    LEFT JOIN isanteplus.patient ispat ON f.patient_id = ispat.patient_id
+    LEFT JOIN tmp_disc_patients_by_reason dreason ON f.patient_id = dreason.patient_id
+    LEFT JOIN tmp_discontinued_pre_arv dpre ON f.patient_id = dpre.patient_id
+    SET f.on_arv = (parv.patient_id IS NOT NULL),
+        f.in_patient = (ispat.patient_id IS NOT NULL),
+        f.vih_status = ispat.vih_status,
+        f.patient_voided = ispat.voided,
+        f.disc_reason = (dreason.patient_id IS NOT NULL),
+        f.disc_pre_arv = (dpre.patient_id IS NOT NULL);
+
+    -- Transaction : Statuts 1 à 11
+    --   1, 2, 3  : décédés, transférés, arrêtés sous ARV
+    --   4, 5     : décédés, transférés en pré-ARV (dernière visite)
+    --   6, 8, 9  : réguliers, rendez-vous ratés (1-30 jours), perdus de vue
+    --              (> 30 jours), hors patients avec raison d'arrêt
+    --   10, 7, 11: perdus de vue (> 12 mois), récents, actifs en pré-ARV,
+    --              hors décédés/transférés (tmp_discontinued_pre_arv, PAS 1667)
     START TRANSACTION;
 
-    -- Statut 10 : Perdus de vue en Pré-ARV
-    -- Utilise tmp_discontinued_pre_arv (raisons 159, 159492 seulement - PAS 1667)
     INSERT INTO patient_status_arv(patient_id, id_status, start_date, encounter_id, last_updated_date, date_started_status)
     SELECT
-        v.patient_id,
-        10 AS id_status,
-        MAX(DATE(v.date_started)) AS start_date,
-        enc.encounter_id,
+        c.patient_id,
+        c.id_status,
+        c.start_date,
+        c.encounter_id,
         NOW(),
         NOW()
-    FROM isanteplus.patient ispat
-    INNER JOIN openmrs.visit v ON ispat.patient_id = v.patient_id
-    INNER JOIN tmp_encounter_snapshot enc ON v.visit_id = enc.visit_id
-    INNER JOIN tmp_latest_visit B
-        ON v.patient_id = B.patient_id
-       AND DATE(v.date_started) = B.visit_date
-    LEFT JOIN tmp_discontinued_pre_arv dreason ON enc.patient_id = dreason.patient_id
-    LEFT JOIN tmp_patients_on_arv parv ON ispat.patient_id = parv.patient_id
-    WHERE v.voided <> 1
-      AND enc.encounter_type NOT IN (
-          @et_first_visit, @et_pediatric, @et_followup, @et_pediatric_followup,
-          @et_dispensing1, @et_dispensing2, @et_lab
-      )
-      AND dreason.patient_id IS NULL
-      AND parv.patient_id IS NULL
-      AND ispat.vih_status = 1
-      AND TIMESTAMPDIFF(MONTH, v.date_started, CURDATE()) > 12
-    GROUP BY v.patient_id
-    ON DUPLICATE KEY UPDATE last_updated_date = VALUES(last_updated_date);
-
-    -- Statut 7 : Récent en Pré-ARV (dans les 12 derniers mois)
-    -- Utilise tmp_discontinued_pre_arv (raisons 159, 159492 seulement - PAS 1667)
-    INSERT INTO patient_status_arv(patient_id, id_status, start_date, encounter_id, last_updated_date, date_started_status)
-    SELECT
-        v.patient_id,
-        7 AS id_status,
-        MAX(DATE(v.date_started)) AS start_date,
-        enc.encounter_id,
-        NOW(),
-        NOW()
-    FROM isanteplus.patient ispat
-    INNER JOIN openmrs.visit v ON ispat.patient_id = v.patient_id
-    INNER JOIN tmp_encounter_snapshot enc ON v.visit_id = enc.visit_id
-    INNER JOIN tmp_latest_visit B
-        ON v.patient_id = B.patient_id
-       AND DATE(v.date_started) = B.visit_date
-    LEFT JOIN tmp_discontinued_pre_arv dreason ON enc.patient_id = dreason.patient_id
-    LEFT JOIN tmp_patients_on_arv parv ON ispat.patient_id = parv.patient_id
-    WHERE v.voided <> 1
-      AND enc.encounter_type IN (@et_first_visit, @et_pediatric)
-      AND dreason.patient_id IS NULL
-      AND parv.patient_id IS NULL
-      AND ispat.vih_status = 1
-      AND TIMESTAMPDIFF(MONTH, v.date_started, CURDATE()) <= 12
-    GROUP BY v.patient_id
-    ON DUPLICATE KEY UPDATE last_updated_date = VALUES(last_updated_date);
-
-    -- Statut 11 : Actifs en Pré-ARV (dans les 12 derniers mois)
-    -- Utilise tmp_discontinued_pre_arv (raisons 159, 159492 seulement - PAS 1667)
-    INSERT INTO patient_status_arv(patient_id, id_status, start_date, encounter_id, last_updated_date, date_started_status)
-    SELECT
-        v.patient_id,
-        11 AS id_status,
-        MAX(DATE(v.date_started)) AS start_date,
-        enc.encounter_id,
-        NOW(),
-        NOW()
-    FROM isanteplus.patient ispat
-    INNER JOIN openmrs.visit v ON ispat.patient_id = v.patient_id
-    INNER JOIN tmp_encounter_snapshot enc ON v.visit_id = enc.visit_id
-    INNER JOIN tmp_latest_visit B
-        ON v.patient_id = B.patient_id
-       AND DATE(v.date_started) = B.visit_date
-    LEFT JOIN tmp_discontinued_pre_arv dreason ON enc.patient_id = dreason.patient_id
-    LEFT JOIN tmp_patients_on_arv parv ON ispat.patient_id = parv.patient_id
-    WHERE v.voided <> 1
-      AND enc.encounter_type IN (@et_followup, @et_pediatric_followup, @et_dispensing1, @et_dispensing2, @et_lab)
-      AND dreason.patient_id IS NULL
-      AND parv.patient_id IS NULL
-      AND ispat.vih_status = 1
-      AND TIMESTAMPDIFF(MONTH, v.date_started, CURDATE()) <= 12
-    GROUP BY v.patient_id
+    FROM (
+        SELECT
+            f.patient_id,
+            s.id_status,
+            CASE s.id_status
+                WHEN 1 THEN IF(f.on_arv = 1, f.death_date, NULL)
+                WHEN 2 THEN IF(f.on_arv = 1, f.transfer_date, NULL)
+                WHEN 3 THEN IF(f.on_arv = 1, f.stopped_date, NULL)
+                WHEN 4 THEN IF(f.on_arv = 0 AND f.vih_status = 1 AND f.patient_voided = 0,
+                               f.death_pre_arv_date, NULL)
+                WHEN 5 THEN IF(f.on_arv = 0 AND f.vih_status = 1 AND f.patient_voided = 0,
+                               f.transfer_pre_arv_date, NULL)
+                WHEN 6 THEN IF(f.on_arv = 1 AND f.disc_reason = 0 AND f.in_patient = 1
+                               AND CURDATE() <= f.next_dispensation_date,
+                               f.arv_dispensing_date, NULL)
+                WHEN 8 THEN IF(f.on_arv = 1 AND f.disc_reason = 0 AND f.in_patient = 1
+                               AND DATEDIFF(CURDATE(), f.next_dispensation_date) BETWEEN 1 AND 30,
+                               f.dispensing_date, NULL)
+                WHEN 9 THEN IF(f.on_arv = 1 AND f.disc_reason = 0
+                               AND DATEDIFF(CURDATE(), f.next_dispensation_date) > 30,
+                               f.arv_dispensing_date, NULL)
+                WHEN 10 THEN IF(f.on_arv = 0 AND f.vih_status = 1 AND f.disc_pre_arv = 0,
+                                f.lost_pre_arv_date, NULL)
+                WHEN 7 THEN IF(f.on_arv = 0 AND f.vih_status = 1 AND f.disc_pre_arv = 0,
+                               f.recent_pre_arv_date, NULL)
+                WHEN 11 THEN IF(f.on_arv = 0 AND f.vih_status = 1 AND f.disc_pre_arv = 0,
+                                f.active_pre_arv_date, NULL)
+            END AS start_date,
+            CASE s.id_status
+                WHEN 1 THEN f.death_encounter_id
+                WHEN 2 THEN f.transfer_encounter_id
+                WHEN 3 THEN f.stopped_encounter_id
+                WHEN 4 THEN f.death_pre_arv_encounter_id
+                WHEN 5 THEN f.transfer_pre_arv_encounter_id
+                WHEN 6 THEN f.arv_dispensing_encounter_id
+                WHEN 8 THEN f.dispensing_encounter_id
+                WHEN 9 THEN f.arv_dispensing_encounter_id
+                WHEN 10 THEN f.lost_pre_arv_encounter_id
+                WHEN 7 THEN f.recent_pre_arv_encounter_id
+                WHEN 11 THEN f.active_pre_arv_encounter_id
+            END AS encounter_id
+        FROM tmp_status_features f
+        CROSS JOIN (
+            SELECT 1 AS id_status UNION ALL SELECT 2 UNION ALL SELECT 3
+            UNION ALL SELECT 4 UNION ALL SELECT 5 UNION ALL SELECT 6
+            UNION ALL SELECT 7 UNION ALL SELECT 8 UNION ALL SELECT 9
+            UNION ALL SELECT 10 UNION ALL SELECT 11
+        ) s
+    ) c
+    WHERE c.start_date IS NOT NULL
     ON DUPLICATE KEY UPDATE last_updated_date = VALUES(last_updated_date);
 
     COMMIT;
 
-    -- Transaction : Statuts 1, 2, 3 (Décédés, Transférés, Arrêtés sous ARV)
-    START TRANSACTION;
-
-    -- Statut 1 : Décédés (sous ARV)
-    INSERT INTO patient_status_arv(patient_id, id_status, start_date, encounter_id, last_updated_date, date_started_status)
-    SELECT
-        enc.patient_id,
-        1 AS id_status,
-        MAX(DATE(enc.encounter_datetime)) AS start_date,
-        enc.encounter_id,
-        NOW(),
-        NOW()
-    FROM tmp_encounter_snapshot enc
-    INNER JOIN tmp_obs_snapshot ob
-        ON enc.encounter_id = ob.encounter_id
-       AND enc.patient_id = ob.person_id
-    INNER JOIN tmp_patients_on_arv parv ON enc.patient_id = parv.patient_id
-    WHERE enc.encounter_type = @et_discontinuation
-      AND ob.concept_id = 161555
-      AND ob.value_coded = 159
-    GROUP BY enc.patient_id
-    ON DUPLICATE KEY UPDATE last_updated_date = VALUES(last_updated_date);
-
-    -- Statut 2 : Transférés (sous ARV)
-    INSERT INTO patient_status_arv(patient_id, id_status, start_date, encounter_id, last_updated_date, date_started_status)
-    SELECT
-        enc.patient_id,
-        2 AS id_status,
-        MAX(DATE(enc.encounter_datetime)) AS start_date,
-        enc.encounter_id,
-        NOW(),
-        NOW()
-    FROM tmp_encounter_snapshot enc
-    INNER JOIN tmp_obs_snapshot ob
-        ON enc.encounter_id = ob.encounter_id
-       AND enc.patient_id = ob.person_id
-    INNER JOIN tmp_patients_on_arv parv ON enc.patient_id = parv.patient_id
-    WHERE enc.encounter_type = @et_discontinuation
-      AND ob.concept_id = 161555
-      AND ob.value_coded = 159492
-    GROUP BY enc.patient_id
-    ON DUPLICATE KEY UPDATE last_updated_date = VALUES(last_updated_date);
-
-    -- Statut 3 : Arrêtés (traitement ARV)
-    INSERT INTO patient_status_arv(patient_id, id_status, start_date, encounter_id, last_updated_date, date_started_status)
-    SELECT
-        enc.patient_id,
-        3 AS id_status,
-        MAX(DATE(enc.encounter_datetime)) AS start_date,
-        enc.encounter_id,
-        NOW(),
-        NOW()
-    FROM tmp_encounter_snapshot enc
-    INNER JOIN tmp_obs_snapshot ob
-        ON enc.encounter_id = ob.encounter_id
-       AND enc.patient_id = ob.person_id
-    INNER JOIN tmp_obs_snapshot_2 ob2
-        ON ob.encounter_id = ob2.encounter_id
-    INNER JOIN tmp_patients_on_arv parv ON enc.patient_id = parv.patient_id
-    WHERE enc.encounter_type = @et_discontinuation
-      AND ob.concept_id = 161555
-      AND ob.value_coded = 1667
-      AND ob2.concept_id = 1667
-      AND ob2.value_coded IN (115198, 159737)
-    GROUP BY enc.patient_id
-    ON DUPLICATE KEY UPDATE last_updated_date = VALUES(last_updated_date);
-
-    COMMIT;
+    DROP TEMPORARY TABLE IF EXISTS tmp_status_disc_encounter;
+    DROP TEMPORARY TABLE IF EXISTS tmp_status_features;
 
     -- =========================================================================
     -- MISES À JOUR FINALES
@@ -823,6 +968,41 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
 
     COMMIT;
 
+    -- Dernier statut par patient (patient_latest_status) : recalculé pour
+    -- les patients dont un statut a changé, ou pour tous en reconstruction
+    -- complète et au premier passage
+    CREATE TABLE IF NOT EXISTS patient_latest_status (
+        patient_id INT(11) NOT NULL,
+        date_started_status DATETIME,
+        CONSTRAINT pk_patient_latest_status PRIMARY KEY (patient_id)
+    ) ENGINE = InnoDB DEFAULT CHARSET = utf8;
+
+    INSERT IGNORE INTO tmp_status_patients (patient_id)
+    SELECT psa.patient_id
+    FROM patient_status_arv psa
+    WHERE psa.last_updated_date >= @status_run_start;
+
+    INSERT IGNORE INTO tmp_status_patients (patient_id)
+    SELECT ei.patient_id
+    FROM exposed_infants ei;
+
+    SET @latest_status_full := IF(COALESCE(@etl_full_rebuild, 0) = 1
+        OR NOT EXISTS (SELECT 1 FROM patient_latest_status), 1, 0);
+    SET @sql := IF(@latest_status_full = 1,
+        'TRUNCATE TABLE patient_latest_status',
+        'DELETE ls FROM patient_latest_status ls INNER JOIN tmp_status_patients t ON t.patient_id = ls.patient_id');
+    PREPARE stmt FROM @sql;
+    EXECUTE stmt;
+    DEALLOCATE PREPARE stmt;
+
+    INSERT INTO patient_latest_status (patient_id, date_started_status)
+    SELECT psa.patient_id, MAX(psa.date_started_status)
+    FROM patient_status_arv psa
+    LEFT JOIN tmp_status_patients t ON t.patient_id = psa.patient_id
+    WHERE @latest_status_full = 1
+    OR t.patient_id IS NOT NULL
+    GROUP BY psa.patient_id;
+
     -- Transaction : Mise à jour de la table patient (transaction séparée pour limiter la portée des verrous)
     START TRANSACTION;
 
@@ -830,19 +1010,9 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
     UPDATE patient SET arv_status = NULL WHERE arv_status IS NOT NULL;
 
     -- Mise à jour de la table patient avec le dernier statut
-    DROP TEMPORARY TABLE IF EXISTS tmp_latest_status;
-    CREATE TEMPORARY TABLE tmp_latest_status (
-        patient_id INT NOT NULL,
-        date_started_status DATETIME NOT NULL,
-        PRIMARY KEY (patient_id)
-    ) ENGINE=MEMORY
-    SELECT patient_id, MAX(date_started_status) AS date_started_status
-    FROM patient_status_arv
-    GROUP BY patient_id;
-
     UPDATE patient p
     INNER JOIN patient_status_arv psa ON p.patient_id = psa.patient_id
-    INNER JOIN tmp_latest_status B
+    INNER JOIN patient_latest_status B
         ON psa.patient_id = B.patient_id
        AND DATE(psa.date_started_status) = DATE(B.date_started_status)
     SET p.arv_status = psa.id_status;
@@ -852,32 +1022,106 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
     -- Section 1 cleanup (tables locales uniquement)
     DROP TEMPORARY TABLE IF EXISTS tmp_disc_patients_by_reason;
     DROP TEMPORARY TABLE IF EXISTS tmp_discontinued_pre_arv;
-    DROP TEMPORARY TABLE IF EXISTS tmp_latest_dispensation;
-    DROP TEMPORARY TABLE IF EXISTS tmp_latest_status;
+    DROP TEMPORARY TABLE IF EXISTS tmp_status_patients;
 
 -- =============================================================================
 -- SECTION 2 : isanteplusregimen_dml
 --
 -- Calcule les combinaisons de régimes ARV à partir des prescriptions et met
 -- à jour les tables pepfarTable et openmrs.isanteplus_patient_arv.
+--
+-- Incrémental : seules les visites (patient, site, jour) dont une
+-- prescription a été créée, modifiée ou annulée depuis la dernière exécution
+-- (marque 'patient_prescription' de arv_watermark) sont recalculées, et le
+-- dernier régime n'est écrit dans openmrs que s'il a changé. Reconstruction
+-- complète sans marque, avec pepfarTable vide ou @etl_full_rebuild = 1.
 -- =============================================================================
 
     -- =========================================================================
     -- Nettoyage des tables temporaires des exécutions précédentes
     -- =========================================================================
     DROP TABLE IF EXISTS pepfarTableTemp;
-    DROP TABLE IF EXISTS oneDrugRegimenPrefixTemp;
-    DROP TABLE IF EXISTS twoDrugRegimenPrefixTemp;
+    DROP TEMPORARY TABLE IF EXISTS tmp_regimen_drug;
+    DROP TEMPORARY TABLE IF EXISTS tmp_regimen_visit;
+    DROP TEMPORARY TABLE IF EXISTS tmp_regimen_latest;
+
+    -- Index des prescriptions par date de mise à jour et de pepfarTable par
+    -- patient (bases créées avant leur ajout au DDL)
+    SET @idx_exists := (
+        SELECT COUNT(*)
+        FROM INFORMATION_SCHEMA.STATISTICS
+        WHERE TABLE_SCHEMA = 'isanteplus'
+          AND TABLE_NAME = 'patient_prescription'
+          AND INDEX_NAME = 'idx_prescription_last_updated'
+    );
+
+    SET @sql := IF(
+        @idx_exists = 0,
+        'ALTER TABLE isanteplus.patient_prescription ADD INDEX idx_prescription_last_updated (last_updated_date);',
+        'SELECT ''Index idx_prescription_last_updated already exists'';'
+    );
+
+    PREPARE stmt FROM @sql;
+    EXECUTE stmt;
+    DEALLOCATE PREPARE stmt;
+
+    SET @idx_exists := (
+        SELECT COUNT(*)
+        FROM INFORMATION_SCHEMA.STATISTICS
+        WHERE TABLE_SCHEMA = 'isanteplus'
+          AND TABLE_NAME = 'pepfarTable'
+          AND INDEX_NAME = 'idx_pepfar_patient_date'
+    );
+
+    SET @sql := IF(
+        @idx_exists = 0,
+        'ALTER TABLE isanteplus.pepfarTable ADD INDEX idx_pepfar_patient_date (patient_id, visit_date);',
+        'SELECT ''Index idx_pepfar_patient_date already exists'';'
+    );
+
+    PREPARE stmt FROM @sql;
+    EXECUTE stmt;
+    DEALLOCATE PREPARE stmt;
 
     -- =========================================================================
-    -- Supprimer les prescriptions annulées de pepfarTable
+    -- Visites à recalculer
     -- =========================================================================
-    DELETE pt FROM pepfarTable pt
-    INNER JOIN patient_prescription pp
-        ON pt.patient_id = pp.patient_id
-       AND pt.location_id = pp.location_id
-       AND DATE(pt.visit_date) = DATE(pp.visit_date)
-    WHERE pp.voided = 1;
+
+    -- Marques de ce script : début de la dernière exécution réussie
+    -- (last_date), par table source
+    CREATE TABLE IF NOT EXISTS arv_watermark (
+        source_table VARCHAR(64) NOT NULL,
+        last_id INT(11),
+        last_date DATETIME,
+        last_run_date DATETIME,
+        CONSTRAINT pk_arv_watermark PRIMARY KEY (source_table)
+    ) ENGINE = InnoDB DEFAULT CHARSET = utf8;
+
+    SET @regimen_run_start := NOW();
+    SET @regimen_last_date := (
+        SELECT w.last_date FROM arv_watermark w
+        WHERE w.source_table = 'patient_prescription'
+    );
+    SET @regimen_full := IF(COALESCE(@etl_full_rebuild, 0) = 1
+        OR @regimen_last_date IS NULL
+        OR NOT EXISTS (SELECT 1 FROM pepfarTable), 1, 0);
+
+    -- Jours de visite (pepfarTable garde la date seule) dont une prescription
+    -- a changé : toutes les visites en reconstruction complète. Une
+    -- annulation met aussi à jour last_updated_date.
+    CREATE TEMPORARY TABLE tmp_regimen_visit (
+        patient_id INT(11) NOT NULL,
+        location_id INT(11) NOT NULL,
+        visit_date DATE NOT NULL,
+        PRIMARY KEY (patient_id, location_id, visit_date)
+    )
+    SELECT DISTINCT
+        pp.patient_id,
+        pp.location_id,
+        DATE(pp.visit_date) AS visit_date
+    FROM patient_prescription pp
+    WHERE pp.visit_date IS NOT NULL
+      AND (@regimen_full = 1 OR pp.last_updated_date >= @regimen_last_date);
 
     -- =========================================================================
     -- Construction des combinaisons de régimes
@@ -893,105 +1137,89 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
     );
 
     -- -------------------------------------------------------------------------
-    -- Étape 1 : Trouver toutes les prescriptions ARV à un seul médicament
+    -- Signature des régimes : une ligne par médicament de chaque régime, avec
+    -- sa position (1 = le médicament ARV) et le nombre de médicaments du
+    -- régime, indexée par médicament.
+    -- Régimes retenus comme auparavant : 1 médicament (drugID2 = drugID3 = 0),
+    -- 2 médicaments (drugID3 = 0) ou 3 médicaments.
     -- -------------------------------------------------------------------------
-    CREATE TEMPORARY TABLE oneDrugRegimenPrefixTemp (
-        location_id INT(11),
-        patient_id INT(11),
-        visit_date DATETIME,
-        drugID1 INT(11),
-        rx_or_prophy INT(11)
-    );
-
-    INSERT INTO oneDrugRegimenPrefixTemp
-    SELECT
-        d1.location_id,
-        d1.patient_id,
-        d1.visit_date,
-        d1.drug_id,
-        d1.rx_or_prophy
-    FROM patient_prescription d1
-    INNER JOIN patient p ON d1.patient_id = p.patient_id
-    INNER JOIN (SELECT DISTINCT drugID1 FROM regimen) r ON r.drugID1 = d1.drug_id
-    WHERE d1.arv_drug = 1065
-      AND d1.voided <> 1;
-
-    -- Insérer les régimes à un seul médicament (drugID2 et drugID3 = 0)
-    INSERT INTO pepfarTableTemp (location_id, patient_id, visit_date, regimen, rx_or_prophy)
-    SELECT DISTINCT
-        d1.location_id,
-        d1.patient_id,
-        d1.visit_date,
-        r.shortname,
-        d1.rx_or_prophy
-    FROM oneDrugRegimenPrefixTemp d1
-    INNER JOIN regimen r ON r.drugID1 = d1.drugID1
-    WHERE r.drugID2 = 0
-      AND r.drugID3 = 0;
-
-    -- -------------------------------------------------------------------------
-    -- Étape 2 : Trouver les combinaisons ARV à deux médicaments
-    -- -------------------------------------------------------------------------
-    CREATE TEMPORARY TABLE twoDrugRegimenPrefixTemp (
-        location_id INT(11),
-        patient_id INT(11),
-        visit_date DATETIME,
-        drugID1 INT(11),
-        drugID2 INT(11),
-        rx_or_prophy INT(11)
-    );
-
-    INSERT INTO twoDrugRegimenPrefixTemp
-    SELECT
-        d1.location_id,
-        d1.patient_id,
-        d1.visit_date,
-        d1.drugID1,
-        d2.drug_id,
-        d1.rx_or_prophy
-    FROM oneDrugRegimenPrefixTemp d1
-    INNER JOIN patient_prescription d2 USING (location_id, patient_id, visit_date)
-    INNER JOIN (SELECT DISTINCT drugID1, drugID2 FROM regimen) r
-        ON r.drugID1 = d1.drugID1
-       AND r.drugID2 = d2.drug_id
-    WHERE d2.voided <> 1;
-
-    -- Insérer les régimes à deux médicaments (drugID3 = 0)
-    INSERT INTO pepfarTableTemp (location_id, patient_id, visit_date, regimen, rx_or_prophy)
-    SELECT DISTINCT
-        prefix.location_id,
-        prefix.patient_id,
-        prefix.visit_date,
-        r.shortname,
-        prefix.rx_or_prophy
-    FROM twoDrugRegimenPrefixTemp prefix
-    INNER JOIN regimen r
-        ON prefix.drugID1 = r.drugID1
-       AND prefix.drugID2 = r.drugID2
-    WHERE r.drugID3 = 0;
+    CREATE TEMPORARY TABLE tmp_regimen_drug (
+        regID INT(11) NOT NULL,
+        drug_id INT(11) NOT NULL,
+        drug_position TINYINT NOT NULL,
+        drug_count TINYINT NOT NULL,
+        PRIMARY KEY (regID, drug_position),
+        KEY idx_drug (drug_id)
+    ) ENGINE=MEMORY
+    SELECT r.regID, r.drugID1 AS drug_id, 1 AS drug_position,
+           1 + (r.drugID2 <> 0) + (r.drugID3 <> 0) AS drug_count
+    FROM regimen r
+    WHERE r.drugID1 <> 0
+      AND r.drugID2 IS NOT NULL
+      AND r.drugID3 IS NOT NULL
+      AND (r.drugID2 <> 0 OR r.drugID3 = 0)
+    UNION ALL
+    SELECT r.regID, r.drugID2, 2, 2 + (r.drugID3 <> 0)
+    FROM regimen r
+    WHERE r.drugID1 <> 0
+      AND r.drugID2 <> 0
+      AND r.drugID3 IS NOT NULL
+    UNION ALL
+    SELECT r.regID, r.drugID3, 3, 3
+    FROM regimen r
+    WHERE r.drugID1 <> 0
+      AND r.drugID2 <> 0
+      AND r.drugID3 <> 0;
 
     -- -------------------------------------------------------------------------
-    -- Étape 3 : Trouver les combinaisons ARV à trois médicaments
+    -- Régimes de chaque visite à recalculer en un seul parcours de ses
+    -- prescriptions : chaque prescription retrouve par l'index les régimes
+    -- qui contiennent son médicament ; un régime est retenu quand toutes ses
+    -- positions sont couvertes dans la visite (le médicament en position 1
+    -- prescrit comme ARV). Remplace les auto-jointures à 1, 2 et 3 médicaments de
+    -- patient_prescription (oneDrugRegimenPrefixTemp, twoDrugRegimenPrefixTemp).
     -- -------------------------------------------------------------------------
     INSERT INTO pepfarTableTemp (location_id, patient_id, visit_date, regimen, rx_or_prophy)
     SELECT DISTINCT
-        prefix.location_id,
-        prefix.patient_id,
-        prefix.visit_date,
+        m.location_id,
+        m.patient_id,
+        m.visit_date,
         r.shortname,
-        prefix.rx_or_prophy
-    FROM twoDrugRegimenPrefixTemp prefix
-    INNER JOIN patient_prescription pp USING (location_id, patient_id, visit_date)
-    INNER JOIN regimen r
-        ON prefix.drugID1 = r.drugID1
-       AND prefix.drugID2 = r.drugID2
-       AND pp.drug_id = r.drugID3
-    WHERE r.drugID3 != 0
-      AND pp.voided <> 1;
+        m.rx_or_prophy
+    FROM (
+        SELECT
+            pp.location_id,
+            pp.patient_id,
+            pp.visit_date,
+            rd.regID,
+            MAX(IF(rd.drug_position = 1, pp.rx_or_prophy, NULL)) AS rx_or_prophy
+        FROM tmp_regimen_visit v
+        INNER JOIN patient_prescription pp
+            ON pp.patient_id = v.patient_id
+           AND pp.location_id = v.location_id
+           AND pp.visit_date >= v.visit_date
+           AND pp.visit_date < v.visit_date + INTERVAL 1 DAY
+        INNER JOIN patient p ON pp.patient_id = p.patient_id
+        INNER JOIN tmp_regimen_drug rd ON rd.drug_id = pp.drug_id
+        WHERE pp.voided <> 1
+          AND (rd.drug_position > 1 OR pp.arv_drug = 1065)
+        GROUP BY pp.location_id, pp.patient_id, pp.visit_date, rd.regID
+        HAVING COUNT(DISTINCT rd.drug_position) = MAX(rd.drug_count)
+    ) m
+    INNER JOIN regimen r ON r.regID = m.regID;
 
     -- =========================================================================
-    -- Mise à jour de pepfarTable avec les résultats
+    -- Mise à jour de pepfarTable avec les résultats : les régimes des visites
+    -- recalculées sont remplacés (y compris ceux des prescriptions annulées)
     -- =========================================================================
+    START TRANSACTION;
+
+    DELETE pt FROM pepfarTable pt
+    INNER JOIN tmp_regimen_visit v
+        ON v.location_id = pt.location_id
+       AND v.patient_id = pt.patient_id
+       AND v.visit_date = pt.visit_date;
+
     INSERT INTO pepfarTable (location_id, patient_id, visit_date, regimen, rx_or_prophy, last_updated_date)
     SELECT
         p.location_id,
@@ -1007,26 +1235,49 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
 
     -- =========================================================================
     -- Mise à jour de openmrs.isanteplus_patient_arv avec le dernier régime
+    -- des patients recalculés, seulement s'il a changé : aucun des régimes
+    -- de leur dernière visite n'est celui déjà enregistré
     -- =========================================================================
+    CREATE TEMPORARY TABLE tmp_regimen_latest (
+        patient_id INT(11) NOT NULL,
+        visit_date DATE,
+        PRIMARY KEY (patient_id)
+    )
+    SELECT pf.patient_id, MAX(pf.visit_date) AS visit_date
+    FROM (SELECT DISTINCT v.patient_id FROM tmp_regimen_visit v) t
+    INNER JOIN pepfarTable pf ON pf.patient_id = t.patient_id
+    GROUP BY pf.patient_id;
+
     INSERT INTO openmrs.isanteplus_patient_arv (patient_id, arv_regimen, date_created, date_changed)
     SELECT
-        pft.patient_id,
-        pft.regimen,
-        pft.visit_date,
+        l.patient_id,
+        MIN(pft.regimen),
+        l.visit_date,
         NOW()
-    FROM pepfarTable pft
-    INNER JOIN (
-        SELECT pf.patient_id, MAX(pf.visit_date) AS visit_date_regimen
-        FROM pepfarTable pf
-        GROUP BY pf.patient_id
-    ) B ON pft.patient_id = B.patient_id AND pft.visit_date = B.visit_date_regimen
+    FROM tmp_regimen_latest l
+    INNER JOIN pepfarTable pft
+        ON pft.patient_id = l.patient_id
+       AND pft.visit_date = l.visit_date
+    LEFT JOIN openmrs.isanteplus_patient_arv ipa ON ipa.patient_id = l.patient_id
+    GROUP BY l.patient_id, l.visit_date
+    HAVING MAX(pft.regimen <=> ipa.arv_regimen) = 0
     ON DUPLICATE KEY UPDATE
-        arv_regimen = pft.regimen,
+        arv_regimen = VALUES(arv_regimen),
         date_changed = NOW();
 
+    -- Visites traitées : avancer la marque
+    INSERT INTO arv_watermark (source_table, last_id, last_date, last_run_date)
+    VALUES ('patient_prescription', NULL, @regimen_run_start, NOW())
+    ON DUPLICATE KEY UPDATE
+        last_date = VALUES(last_date),
+        last_run_date = VALUES(last_run_date);
+
+    COMMIT;
+
     -- Nettoyage des tables temporaires
-    DROP TEMPORARY TABLE oneDrugRegimenPrefixTemp;
-    DROP TEMPORARY TABLE twoDrugRegimenPrefixTemp;
+    DROP TEMPORARY TABLE tmp_regimen_latest;
+    DROP TEMPORARY TABLE tmp_regimen_visit;
+    DROP TEMPORARY TABLE tmp_regimen_drug;
     DROP TEMPORARY TABLE pepfarTableTemp;
 
     -- =========================================================================
@@ -1133,52 +1384,6 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
       AND pl.test_result IS NOT NULL
       AND pl.test_result <> '';
 
-    -- Dernière date de dispensation par patient (exclut prophylaxie)
-    DROP TEMPORARY TABLE IF EXISTS tmp_latest_dispensation_no_prophy;
-    CREATE TEMPORARY TABLE tmp_latest_dispensation_no_prophy (
-        patient_id INT NOT NULL,
-        next_dispensation_date DATE,
-        PRIMARY KEY (patient_id)
-    ) ENGINE=MEMORY
-    SELECT
-        pd.patient_id,
-        MAX(pd.next_dispensation_date) AS next_dispensation_date
-    FROM isanteplus.patient_dispensing pd
-    WHERE pd.arv_drug = 1065
-      AND (pd.rx_or_prophy <> 163768 OR pd.rx_or_prophy IS NULL)
-      AND pd.voided <> 1
-    GROUP BY pd.patient_id;
-
-    -- Dernière date de test de charge virale par patient
-    DROP TEMPORARY TABLE IF EXISTS tmp_latest_viral_load;
-    CREATE TEMPORARY TABLE tmp_latest_viral_load (
-        patient_id INT NOT NULL,
-        visit_date DATE NOT NULL,
-        PRIMARY KEY (patient_id)
-    ) ENGINE=MEMORY
-    SELECT
-        pl.patient_id,
-        MAX(IFNULL(DATE(pl.date_test_done), DATE(pl.visit_date))) AS visit_date
-    FROM isanteplus.patient_laboratory pl
-    WHERE pl.test_id IN (856, 1305)
-      AND pl.test_result > 0
-      AND pl.voided <> 1
-    GROUP BY pl.patient_id;
-
-    -- Dernière date de visite de dispensation par patient
-    DROP TEMPORARY TABLE IF EXISTS tmp_latest_dispensing_visit;
-    CREATE TEMPORARY TABLE tmp_latest_dispensing_visit (
-        patient_id INT NOT NULL,
-        visit_date DATE NOT NULL,
-        PRIMARY KEY (patient_id)
-    ) ENGINE=MEMORY
-    SELECT
-        pdi.patient_id,
-        MAX(DATE(pdi.visit_date)) AS visit_date
-    FROM isanteplus.patient_dispensing pdi
-    WHERE pdi.voided <> 1
-    GROUP BY pdi.patient_id;
-
     -- Patients sous prophylaxie INH (utilise la copie snapshot)
     DROP TEMPORARY TABLE IF EXISTS tmp_patients_with_inh;
     CREATE TEMPORARY TABLE tmp_patients_with_inh (
@@ -1198,16 +1403,19 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
 
     -- =========================================================================
     -- PHASE 3 : ÉCRITURE DANS LES TABLES ISANTEPLUS
+    -- Alertes recalculées dans alert_next puis appliquées à alert par
+    -- différence en fin de section : les alertes inchangées gardent leur
+    -- ligne (id, last_updated_date)
     -- =========================================================================
+    DROP TABLE IF EXISTS alert_next;
+    CREATE TABLE alert_next LIKE alert;
 
     START TRANSACTION;
 
-    TRUNCATE TABLE alert;
-
     -- -------------------------------------------------------------------------
     -- Alerte 1 : Patient sous ARV >= 6 mois sans résultat de charge virale
     -- -------------------------------------------------------------------------
-    INSERT INTO alert(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
+    INSERT INTO alert_next(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
     SELECT DISTINCT
         B.patient_id,
         1,
@@ -1227,7 +1435,7 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
     -- -------------------------------------------------------------------------
     -- Alerte 2 : Patient sous ARV = 5 mois sans résultat de charge virale
     -- -------------------------------------------------------------------------
-    INSERT INTO alert(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
+    INSERT INTO alert_next(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
     SELECT DISTINCT
         B.patient_id,
         2,
@@ -1247,7 +1455,7 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
     -- -------------------------------------------------------------------------
     -- Alerte 3 : Femme enceinte sous ARV >= 4 mois sans résultat de charge virale
     -- -------------------------------------------------------------------------
-    INSERT INTO alert(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
+    INSERT INTO alert_next(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
     SELECT DISTINCT
         B.patient_id,
         3,
@@ -1268,7 +1476,7 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
     -- -------------------------------------------------------------------------
     -- Alerte 4 : Dernière charge virale >= 12 mois (supprimée)
     -- -------------------------------------------------------------------------
-    INSERT INTO alert(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
+    INSERT INTO alert_next(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
     SELECT DISTINCT
         plab.patient_id,
         4,
@@ -1277,10 +1485,10 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
         NOW()
     FROM isanteplus.patient p
     INNER JOIN isanteplus.patient_laboratory plab ON p.patient_id = plab.patient_id
-    INNER JOIN tmp_latest_viral_load C ON plab.patient_id = C.patient_id
+    INNER JOIN patient_latest_viral_load C ON plab.patient_id = C.patient_id
     INNER JOIN tmp_patients_on_arv parv ON p.patient_id = parv.patient_id
-    WHERE IFNULL(DATE(plab.date_test_done), DATE(plab.visit_date)) = C.visit_date
-      AND TIMESTAMPDIFF(MONTH, C.visit_date, CURDATE()) >= 12
+    WHERE IFNULL(DATE(plab.date_test_done), DATE(plab.visit_date)) = C.last_result_date
+      AND TIMESTAMPDIFF(MONTH, C.last_result_date, CURDATE()) >= 12
       AND ((plab.test_id = 856 AND plab.test_result < 1000)
            OR (plab.test_id = 1305 AND plab.test_result = 1306))
       AND p.arv_status NOT IN (1, 2, 3)
@@ -1289,7 +1497,7 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
     -- -------------------------------------------------------------------------
     -- Alerte 5 : Dernière charge virale >= 3 mois avec résultat > 1000 copies/ml
     -- -------------------------------------------------------------------------
-    INSERT INTO alert(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
+    INSERT INTO alert_next(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
     SELECT DISTINCT
         ob.person_id,
         5,
@@ -1308,7 +1516,7 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
     -- -------------------------------------------------------------------------
     -- Alerte 6 : Dernière charge virale > 1000 copies/ml
     -- -------------------------------------------------------------------------
-    INSERT INTO alert(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
+    INSERT INTO alert_next(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
     SELECT DISTINCT
         plab.patient_id,
         6,
@@ -1338,7 +1546,7 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
     -- -------------------------------------------------------------------------
     -- Alerte 7 : Patient doit renouveler ses ARV dans les 30 jours
     -- -------------------------------------------------------------------------
-    INSERT INTO alert(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
+    INSERT INTO alert_next(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
     SELECT DISTINCT
         pdisp.patient_id,
         7,
@@ -1347,16 +1555,16 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
         NOW()
     FROM isanteplus.patient p
     INNER JOIN isanteplus.patient_dispensing pdisp ON p.patient_id = pdisp.patient_id
-    INNER JOIN tmp_latest_dispensation_no_prophy B
+    INNER JOIN patient_latest_dispensing B
         ON pdisp.patient_id = B.patient_id
-       AND pdisp.next_dispensation_date = B.next_dispensation_date
+       AND pdisp.next_dispensation_date = B.next_arv_rx_dispensation_date
     WHERE DATEDIFF(pdisp.next_dispensation_date, CURDATE()) BETWEEN 0 AND 30
       AND p.arv_status NOT IN (1, 2, 3);
 
     -- -------------------------------------------------------------------------
     -- Alerte 8 : Patient n'a plus de médicaments disponibles
     -- -------------------------------------------------------------------------
-    INSERT INTO alert(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
+    INSERT INTO alert_next(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
     SELECT DISTINCT
         pdisp.patient_id,
         8,
@@ -1365,10 +1573,10 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
         NOW()
     FROM isanteplus.patient p
     INNER JOIN isanteplus.patient_dispensing pdisp ON p.patient_id = pdisp.patient_id
-    INNER JOIN tmp_latest_dispensation_no_prophy B
+    INNER JOIN patient_latest_dispensing B
         ON pdisp.patient_id = B.patient_id
-       AND pdisp.next_dispensation_date = B.next_dispensation_date
-    WHERE DATEDIFF(B.next_dispensation_date, CURDATE()) < 0
+       AND pdisp.next_dispensation_date = B.next_arv_rx_dispensation_date
+    WHERE DATEDIFF(B.next_arv_rx_dispensation_date, CURDATE()) < 0
       AND p.arv_status NOT IN (1, 2, 3);
 
     COMMIT;
@@ -1378,9 +1586,11 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
     -- -------------------------------------------------------------------------
     START TRANSACTION;
 
-    -- TB/VIH à partir du formulaire de dispensation
-    DROP TABLE IF EXISTS traitement_tuberculeux;
-    CREATE TABLE traitement_tuberculeux (
+    -- TB/VIH à partir du formulaire de dispensation. Table temporaire : les
+    -- patients ayant les deux médicaments sont trouvés par regroupement
+    -- plutôt que par auto-jointure
+    DROP TEMPORARY TABLE IF EXISTS tmp_traitement_tuberculeux;
+    CREATE TEMPORARY TABLE tmp_traitement_tuberculeux (
         patient_id INT NOT NULL,
         id_alert INT,
         encounter_id INT,
@@ -1398,15 +1608,15 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
         NOW() AS last_updated_date
     FROM isanteplus.patient_dispensing pd
     INNER JOIN tmp_patients_on_arv poa ON pd.patient_id = poa.patient_id
-    INNER JOIN tmp_latest_dispensing_visit B
+    INNER JOIN patient_latest_dispensing B
         ON pd.patient_id = B.patient_id
-       AND DATE(pd.visit_date) = B.visit_date
+       AND DATE(pd.visit_date) = B.last_visit_date
     WHERE pd.rx_or_prophy = 138405
       AND pd.drug_id = 78280
       AND pd.voided <> 1;
 
     -- Rifampicine
-    INSERT INTO traitement_tuberculeux(patient_id, id_alert, encounter_id, drug_id, visit_date, last_updated_date)
+    INSERT INTO tmp_traitement_tuberculeux(patient_id, id_alert, encounter_id, drug_id, visit_date, last_updated_date)
     SELECT DISTINCT
         pd.patient_id,
         9,
@@ -1416,31 +1626,28 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
         NOW()
     FROM isanteplus.patient_dispensing pd
     INNER JOIN tmp_patients_on_arv poa ON pd.patient_id = poa.patient_id
-    INNER JOIN tmp_latest_dispensing_visit B
+    INNER JOIN patient_latest_dispensing B
         ON pd.patient_id = B.patient_id
-       AND DATE(pd.visit_date) = B.visit_date
+       AND DATE(pd.visit_date) = B.last_visit_date
     WHERE pd.drug_id = 767
       AND pd.voided <> 1;
 
     -- Insérer l'alerte pour les patients ayant les deux médicaments
-    INSERT INTO alert(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
-    SELECT DISTINCT
+    INSERT INTO alert_next(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
+    SELECT
         tb.patient_id,
-        tb.id_alert,
+        9,
         tb.encounter_id,
         tb.visit_date,
-        tb.last_updated_date
-    FROM traitement_tuberculeux tb
-    INNER JOIN traitement_tuberculeux tb1
-        ON tb.patient_id = tb1.patient_id
-       AND tb.visit_date = tb1.visit_date
-       AND tb.encounter_id = tb1.encounter_id
+        MAX(CASE WHEN tb.drug_id = 78280 THEN tb.last_updated_date END)
+    FROM tmp_traitement_tuberculeux tb
     INNER JOIN isanteplus.patient p ON tb.patient_id = p.patient_id
-    WHERE tb.drug_id = 78280
-      AND tb1.drug_id = 767
-      AND p.arv_status NOT IN (1, 2, 3);
+    WHERE tb.drug_id IN (78280, 767)
+      AND p.arv_status NOT IN (1, 2, 3)
+    GROUP BY tb.patient_id, tb.encounter_id, tb.visit_date
+    HAVING COUNT(DISTINCT tb.drug_id) = 2;
 
-    DROP TABLE IF EXISTS traitement_tuberculeux;
+    DROP TEMPORARY TABLE IF EXISTS tmp_traitement_tuberculeux;
 
     COMMIT;
 
@@ -1463,7 +1670,8 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
     GROUP BY en.patient_id;
 
     -- Isoniazide à partir des formulaires VIH (utilise les copies snapshot)
-    CREATE TABLE traitement_tuberculeux (
+    DROP TEMPORARY TABLE IF EXISTS tmp_traitement_tuberculeux;
+    CREATE TEMPORARY TABLE tmp_traitement_tuberculeux (
         patient_id INT NOT NULL,
         id_alert INT,
         encounter_id INT,
@@ -1493,7 +1701,7 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
       AND o2.value_coded = 1065;
 
     -- Rifampicine à partir des formulaires VIH
-    INSERT INTO traitement_tuberculeux(patient_id, id_alert, encounter_id, drug_id, visit_date, last_updated_date)
+    INSERT INTO tmp_traitement_tuberculeux(patient_id, id_alert, encounter_id, drug_id, visit_date, last_updated_date)
     SELECT DISTINCT
         o.person_id AS patient_id,
         9 AS id_alert,
@@ -1515,24 +1723,21 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
       AND o2.value_coded = 1065;
 
     -- Insérer l'alerte pour les patients ayant les deux médicaments (formulaires VIH)
-    INSERT INTO alert(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
-    SELECT DISTINCT
+    INSERT INTO alert_next(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
+    SELECT
         tb.patient_id,
-        tb.id_alert,
+        9,
         tb.encounter_id,
         tb.visit_date,
-        tb.last_updated_date
-    FROM traitement_tuberculeux tb
-    INNER JOIN traitement_tuberculeux tb1
-        ON tb.patient_id = tb1.patient_id
-       AND tb.visit_date = tb1.visit_date
-       AND tb.encounter_id = tb1.encounter_id
+        MAX(CASE WHEN tb.drug_id = 78280 THEN tb.last_updated_date END)
+    FROM tmp_traitement_tuberculeux tb
     INNER JOIN isanteplus.patient p ON tb.patient_id = p.patient_id
-    WHERE tb.drug_id = 78280
-      AND tb1.drug_id = 767
-      AND p.arv_status NOT IN (1, 2, 3);
+    WHERE tb.drug_id IN (78280, 767)
+      AND p.arv_status NOT IN (1, 2, 3)
+    GROUP BY tb.patient_id, tb.encounter_id, tb.visit_date
+    HAVING COUNT(DISTINCT tb.drug_id) = 2;
 
-    DROP TABLE IF EXISTS traitement_tuberculeux;
+    DROP TEMPORARY TABLE IF EXISTS tmp_traitement_tuberculeux;
     DROP TEMPORARY TABLE IF EXISTS tmp_latest_hiv_encounter;
 
     COMMIT;
@@ -1562,7 +1767,7 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
       AND pl1.voided <> 1
     ON DUPLICATE KEY UPDATE patient_id = VALUES(patient_id);
 
-    INSERT INTO alert(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
+    INSERT INTO alert_next(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
     SELECT DISTINCT
         B.patient_id,
         10,
@@ -1590,7 +1795,7 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
     -- -------------------------------------------------------------------------
     START TRANSACTION;
 
-    INSERT INTO alert(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
+    INSERT INTO alert_next(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
     SELECT DISTINCT
         pdisp.patient_id,
         11,
@@ -1613,7 +1818,7 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
     -- -------------------------------------------------------------------------
     START TRANSACTION;
 
-    INSERT INTO alert(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
+    INSERT INTO alert_next(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
     SELECT DISTINCT
         o.person_id,
         12,
@@ -1626,13 +1831,51 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
 
     COMMIT;
 
+    -- Appliquer la différence en une transaction : supprimer les alertes qui
+    -- ne sont plus levées, puis ajouter les nouvelles
+    START TRANSACTION;
+
+    DELETE a FROM alert a
+    LEFT JOIN alert_next n
+        ON n.patient_id = a.patient_id
+       AND n.id_alert = a.id_alert
+       AND n.encounter_id <=> a.encounter_id
+       AND n.date_alert <=> a.date_alert
+    WHERE n.patient_id IS NULL;
+
+    INSERT INTO alert(patient_id, id_alert, encounter_id, date_alert, last_updated_date)
+    SELECT n.patient_id, n.id_alert, n.encounter_id, n.date_alert, n.last_updated_date
+    FROM alert_next n
+    LEFT JOIN alert a
+        ON a.patient_id = n.patient_id
+       AND a.id_alert = n.id_alert
+       AND a.encounter_id <=> n.encounter_id
+       AND a.date_alert <=> n.date_alert
+    WHERE a.patient_id IS NULL;
+
+    -- alert ne contient plus les alertes de isanteplusreportsdmlscript.sql :
+    -- sa prochaine exécution les recalcule toutes. La marque 'alert' et
+    -- etl_reset_watermark appartiennent à ce script (absentes s'il n'a
+    -- jamais tourné)
+    SET @sql := IF(
+        EXISTS (SELECT 1 FROM INFORMATION_SCHEMA.ROUTINES
+                WHERE ROUTINE_SCHEMA = 'isanteplus'
+                  AND ROUTINE_NAME = 'etl_reset_watermark'),
+        'CALL etl_reset_watermark(''alert'')',
+        'DO 0'
+    );
+    PREPARE stmt FROM @sql;
+    EXECUTE stmt;
+    DEALLOCATE PREPARE stmt;
+
+    COMMIT;
+
+    DROP TABLE IF EXISTS alert_next;
+
     -- Section 3 cleanup (tables locales uniquement)
     DROP TEMPORARY TABLE IF EXISTS tmp_first_arv_dispensation;
     DROP TEMPORARY TABLE IF EXISTS tmp_patients_with_viral_load;
-    DROP TEMPORARY TABLE IF EXISTS tmp_latest_dispensation_no_prophy;
-    DROP TEMPORARY TABLE IF EXISTS tmp_latest_viral_load;
     DROP TEMPORARY TABLE IF EXISTS tmp_latest_obs_viral_load;
-    DROP TEMPORARY TABLE IF EXISTS tmp_latest_dispensing_visit;
     DROP TEMPORARY TABLE IF EXISTS tmp_disc_patients_by_encounter;
     DROP TEMPORARY TABLE IF EXISTS tmp_any_discontinuation;
     DROP TEMPORARY TABLE IF EXISTS tmp_patients_with_inh;
@@ -1646,149 +1889,136 @@ SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ;
 -- dans la table immunization_dose.
 -- =============================================================================
 
+    DROP TEMPORARY TABLE IF EXISTS tmp_immunization_obs;
+    DROP TEMPORARY TABLE IF EXISTS tmp_immunization_group;
+
     -- =========================================================================
-    -- Extraction des enregistrements de vaccination à partir des groupes obs
+    -- Obs des groupes de vaccination en UN SEUL PARCOURS de openmrs.obs
     -- Concept 1421 = Historique de vaccination (groupe)
     -- Concept 984 = Vaccination administrée (réponse)
+    -- Concept 1418 = Numéro de séquence de vaccination
+    -- Concept 1410 = Date de vaccination administrée
     -- =========================================================================
-    INSERT INTO isanteplus.patient_immunization (
-        patient_id, location_id, encounter_id, vaccine_obs_group_id,
-        vaccine_concept_id, encounter_date, vaccine_uuid, voided
+    CREATE TEMPORARY TABLE tmp_immunization_obs (
+        obs_id INT NOT NULL,
+        person_id INT NOT NULL,
+        location_id INT,
+        encounter_id INT,
+        obs_group_id INT NOT NULL,
+        concept_id INT NOT NULL,
+        value_coded INT,
+        value_numeric DOUBLE,
+        value_datetime DATETIME,
+        obs_datetime DATETIME,
+        voided TINYINT,
+        PRIMARY KEY (obs_id),
+        KEY idx_obs_group (obs_group_id)
     )
     SELECT
+        o.obs_id,
         o.person_id,
         o.location_id,
         o.encounter_id,
         o.obs_group_id,
+        o.concept_id,
         o.value_coded,
+        o.value_numeric,
+        o.value_datetime,
         o.obs_datetime,
-        c.uuid,
         o.voided
-    FROM openmrs.obs ob
-    INNER JOIN openmrs.obs o ON ob.obs_id = o.obs_group_id
-    INNER JOIN openmrs.concept c ON o.value_coded = c.concept_id
-    WHERE o.concept_id = 984      -- Vaccination administrée
-      AND ob.concept_id = 1421    -- Historique de vaccination
-    ON DUPLICATE KEY UPDATE
-        voided = o.voided;
-
-    -- =========================================================================
-    -- Mise à jour du numéro de dose à partir du groupe obs
-    -- Concept 1418 = Numéro de séquence de vaccination
-    -- =========================================================================
-    UPDATE isanteplus.patient_immunization pim
-    INNER JOIN openmrs.obs o ON pim.vaccine_obs_group_id = o.obs_group_id
-    SET pim.dose = o.value_numeric
-    WHERE o.concept_id = 1418;
+    FROM openmrs.obs o
+    INNER JOIN openmrs.obs ob ON ob.obs_id = o.obs_group_id
+    WHERE o.concept_id IN (984, 1418, 1410)
+      AND ob.concept_id = 1421;
+
+    -- Dose et date de chaque groupe (l'obs non annulée d'abord)
+    CREATE TEMPORARY TABLE tmp_immunization_group (
+        PRIMARY KEY (obs_group_id)
+    )
+    SELECT
+        io.obs_group_id,
+        COALESCE(
+            MAX(IF(io.concept_id = 1418 AND io.voided = 0, io.value_numeric, NULL)),
+            MAX(IF(io.concept_id = 1418, io.value_numeric, NULL))
+        ) AS dose,
+        COALESCE(
+            MAX(IF(io.concept_id = 1410 AND io.voided = 0, io.value_datetime, NULL)),
+            MAX(IF(io.concept_id = 1410, io.value_datetime, NULL))
+        ) AS vaccine_date
+    FROM tmp_immunization_obs io
+    GROUP BY io.obs_group_id;
 
     -- =========================================================================
-    -- Mise à jour de la date de vaccination à partir du groupe obs
-    -- Concept 1410 = Date de vaccination administrée
+    -- Vaccin, dose et date en une seule écriture de patient_immunization.
+    -- Sans obs de dose ou de date dans le groupe, la valeur actuelle est
+    -- gardée, comme avec les UPDATE séparés.
     -- =========================================================================
-    UPDATE isanteplus.patient_immunization pim
-    INNER JOIN openmrs.obs o ON pim.vaccine_obs_group_id = o.obs_group_id
-    SET pim.vaccine_date = o.value_datetime
-    WHERE o.concept_id = 1410;
+    INSERT INTO isanteplus.patient_immunization (
+        patient_id, location_id, encounter_id, vaccine_obs_group_id,
+        vaccine_concept_id, dose, vaccine_date, encounter_date, vaccine_uuid,
+        voided
+    )
+    SELECT
+        io.person_id,
+        io.location_id,
+        io.encounter_id,
+        io.obs_group_id,
+        io.value_coded,
+        g.dose,
+        g.vaccine_date,
+        io.obs_datetime,
+        c.uuid,
+        io.voided
+    FROM tmp_immunization_obs io
+    INNER JOIN tmp_immunization_group g ON g.obs_group_id = io.obs_group_id
+    INNER JOIN openmrs.concept c ON io.value_coded = c.concept_id
+    WHERE io.concept_id = 984
+    ON DUPLICATE KEY UPDATE
+        dose = COALESCE(VALUES(dose), patient_immunization.dose),
+        vaccine_date = COALESCE(VALUES(vaccine_date), patient_immunization.vaccine_date),
+        voided = VALUES(voided);
 
     -- =========================================================================
     -- Pivotage des données de dose dans la table immunization_dose
-    -- Crée une ligne par patient/vaccin avec des colonnes pour chaque date de dose
+    -- Une ligne par patient/vaccin avec une colonne par date de dose, en une
+    -- seule agrégation. Reconstruite dans immunization_dose_next puis échangée
+    -- par un seul RENAME TABLE
     -- =========================================================================
-    TRUNCATE TABLE immunization_dose;
+    DROP TABLE IF EXISTS immunization_dose_next;
+    CREATE TABLE immunization_dose_next LIKE immunization_dose;
 
-    -- Insérer les combinaisons patient/vaccin uniques
-    INSERT INTO immunization_dose (patient_id, vaccine_concept_id)
-    SELECT DISTINCT pati.patient_id, pati.vaccine_concept_id
+    INSERT INTO immunization_dose_next (
+        patient_id, vaccine_concept_id,
+        dose0, dose1, dose2, dose3, dose4, dose5, dose6, dose7, dose8
+    )
+    SELECT
+        pati.patient_id,
+        pati.vaccine_concept_id,
+        MAX(IF(CONVERT(pati.dose, SIGNED INTEGER) = 0, pati.vaccine_date, NULL)),
+        MAX(IF(CONVERT(pati.dose, SIGNED INTEGER) = 1, pati.vaccine_date, NULL)),
+        MAX(IF(CONVERT(pati.dose, SIGNED INTEGER) = 2, pati.vaccine_date, NULL)),
+        MAX(IF(CONVERT(pati.dose, SIGNED INTEGER) = 3, pati.vaccine_date, NULL)),
+        MAX(IF(CONVERT(pati.dose, SIGNED INTEGER) = 4, pati.vaccine_date, NULL)),
+        MAX(IF(CONVERT(pati.dose, SIGNED INTEGER) = 5, pati.vaccine_date, NULL)),
+        MAX(IF(CONVERT(pati.dose, SIGNED INTEGER) = 6, pati.vaccine_date, NULL)),
+        MAX(IF(CONVERT(pati.dose, SIGNED INTEGER) = 7, pati.vaccine_date, NULL)),
+        MAX(IF(CONVERT(pati.dose, SIGNED INTEGER) = 8, pati.vaccine_date, NULL))
     FROM patient_immunization pati
     WHERE pati.voided <> 1
-    ON DUPLICATE KEY UPDATE
-        vaccine_concept_id = pati.vaccine_concept_id;
-
-    -- Mise à jour dose0
-    UPDATE immunization_dose idose
-    INNER JOIN patient_immunization pati
-        ON idose.patient_id = pati.patient_id
-       AND idose.vaccine_concept_id = pati.vaccine_concept_id
-    SET idose.dose0 = pati.vaccine_date
-    WHERE CONVERT(pati.dose, SIGNED INTEGER) = 0
-      AND pati.voided <> 1;
-
-    -- Mise à jour dose1
-    UPDATE immunization_dose idose
-    INNER JOIN patient_immunization pati
-        ON idose.patient_id = pati.patient_id
-       AND idose.vaccine_concept_id = pati.vaccine_concept_id
-    SET idose.dose1 = pati.vaccine_date
-    WHERE CONVERT(pati.dose, SIGNED INTEGER) = 1
-      AND pati.voided <> 1;
-
-    -- Mise à jour dose2
-    UPDATE immunization_dose idose
-    INNER JOIN patient_immunization pati
-        ON idose.patient_id = pati.patient_id
-       AND idose.vaccine_concept_id = pati.vaccine_concept_id
-    SET idose.dose2 = pati.vaccine_date
-    WHERE CONVERT(pati.dose, SIGNED INTEGER) = 2
-      AND pati.voided <> 1;
-
-    -- Mise à jour dose3
-    UPDATE immunization_dose idose
-    INNER JOIN patient_immunization pati
-        ON idose.patient_id = pati.patient_id
-       AND idose.vaccine_concept_id = pati.vaccine_concept_id
-    SET idose.dose3 = pati.vaccine_date
-    WHERE CONVERT(pati.dose, SIGNED INTEGER) = 3
-      AND pati.voided <> 1;
-
-    -- Mise à jour dose4
-    UPDATE immunization_dose idose
-    INNER JOIN patient_immunization pati
-        ON idose.patient_id = pati.patient_id
-       AND idose.vaccine_concept_id = pati.vaccine_concept_id
-    SET idose.dose4 = pati.vaccine_date
-    WHERE CONVERT(pati.dose, SIGNED INTEGER) = 4
-      AND pati.voided <> 1;
-
-    -- Mise à jour dose5
-    UPDATE immunization_dose idose
-    INNER JOIN patient_immunization pati
-        ON idose.patient_id = pati.patient_id
-       AND idose.vaccine_concept_id = pati.vaccine_concept_id
-    SET idose.dose5 = pati.vaccine_date
-    WHERE CONVERT(pati.dose, SIGNED INTEGER) = 5
-      AND pati.voided <> 1;
-
-    -- Mise à jour dose6
-    UPDATE immunization_dose idose
-    INNER JOIN patient_immunization pati
-        ON idose.patient_id = pati.patient_id
-       AND idose.vaccine_concept_id = pati.vaccine_concept_id
-    SET idose.dose6 = pati.vaccine_date
-    WHERE CONVERT(pati.dose, SIGNED INTEGER) = 6
-      AND pati.voided <> 1;
-
-    -- Mise à jour dose7
-    UPDATE immunization_dose idose
-    INNER JOIN patient_immunization pati
-        ON idose.patient_id = pati.patient_id
-       AND idose.vaccine_concept_id = pati.vaccine_concept_id
-    SET idose.dose7 = pati.vaccine_date
-    WHERE CONVERT(pati.dose, SIGNED INTEGER) = 7
-      AND pati.voided <> 1;
-
-    -- Mise à jour dose8
-    UPDATE immunization_dose idose
-    INNER JOIN patient_immunization pati
-        ON idose.patient_id = pati.patient_id
-       AND idose.vaccine_concept_id = pati.vaccine_concept_id
-    SET idose.dose8 = pati.vaccine_date
-    WHERE CONVERT(pati.dose, SIGNED INTEGER) = 8
-      AND pati.voided <> 1;
+    GROUP BY pati.patient_id, pati.vaccine_concept_id;
+
+    DROP TABLE IF EXISTS immunization_dose_old;
+    RENAME TABLE immunization_dose TO immunization_dose_old,
+        immunization_dose_next TO immunization_dose;
+    DROP TABLE immunization_dose_old;
+
+    -- Section 4 cleanup (tables locales uniquement)
+    DROP TEMPORARY TABLE IF EXISTS tmp_immunization_group;
+    DROP TEMPORARY TABLE IF EXISTS tmp_immunization_obs;
 
 -- =============================================================================
 -- NETTOYAGE GLOBAL
 -- =============================================================================
-DROP TEMPORARY TABLE IF EXISTS tmp_latest_visit;
 DROP TEMPORARY TABLE IF EXISTS tmp_patients_on_arv;
 DROP TEMPORARY TABLE IF EXISTS tmp_obs_snapshot;
 DROP TEMPORARY TABLE IF EXISTS tmp_obs_snapshot_2;
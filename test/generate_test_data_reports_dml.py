@@ -2177,6 +2177,8 @@ CREATE TABLE person (
     creator INT DEFAULT NULL,
     date_created DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     voided TINYINT(1) NOT NULL DEFAULT 0,
+    date_changed DATETIME DEFAULT NULL,
+    date_voided DATETIME DEFAULT NULL,
     uuid CHAR(38) NOT NULL,
     PRIMARY KEY (person_id),
     UNIQUE KEY uuid (uuid)
@@ -2192,6 +2194,8 @@ CREATE TABLE person_name (
     creator INT NOT NULL DEFAULT 0,
     date_created DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     voided TINYINT(1) NOT NULL DEFAULT 0,
+    date_changed DATETIME DEFAULT NULL,
+    date_voided DATETIME DEFAULT NULL,
     uuid CHAR(38) NOT NULL,
     PRIMARY KEY (person_name_id),
     UNIQUE KEY uuid (uuid),
@@ -2210,6 +2214,8 @@ CREATE TABLE person_address (
     creator INT NOT NULL DEFAULT 0,
     date_created DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     voided TINYINT(1) NOT NULL DEFAULT 0,
+    date_changed DATETIME DEFAULT NULL,
+    date_voided DATETIME DEFAULT NULL,
     uuid CHAR(38) NOT NULL,
     PRIMARY KEY (person_address_id),
     UNIQUE KEY uuid (uuid),
@@ -2227,6 +2233,8 @@ CREATE TABLE person_attribute (
     creator INT NOT NULL DEFAULT 0,
     date_created DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     voided TINYINT(1) NOT NULL DEFAULT 0,
+    date_changed DATETIME DEFAULT NULL,
+    date_voided DATETIME DEFAULT NULL,
     uuid CHAR(38) NOT NULL,
     PRIMARY KEY (person_attribute_id),
     UNIQUE KEY uuid (uuid),
@@ -2241,6 +2249,8 @@ CREATE TABLE patient (
     creator INT NOT NULL DEFAULT 0,
     date_created DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     voided TINYINT(1) NOT NULL DEFAULT 0,
+    date_changed DATETIME DEFAULT NULL,
+    date_voided DATETIME DEFAULT NULL,
     PRIMARY KEY (patient_id),
     CONSTRAINT patient_person_fk FOREIGN KEY (patient_id)
         REFERENCES person (person_id)
@@ -2257,6 +2267,8 @@ CREATE TABLE patient_identifier (
     creator INT NOT NULL DEFAULT 0,
     date_created DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     voided TINYINT(1) NOT NULL DEFAULT 0,
+    date_changed DATETIME DEFAULT NULL,
+    date_voided DATETIME DEFAULT NULL,
     uuid CHAR(38) NOT NULL,
     PRIMARY KEY (patient_identifier_id),
     UNIQUE KEY uuid (uuid),
@@ -2277,6 +2289,8 @@ CREATE TABLE visit (
     creator INT NOT NULL DEFAULT 1,
     date_created DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     voided TINYINT(1) NOT NULL DEFAULT 0,
+    date_changed DATETIME DEFAULT NULL,
+    date_voided DATETIME DEFAULT NULL,
     uuid CHAR(38) NOT NULL,
     PRIMARY KEY (visit_id),
     UNIQUE KEY uuid (uuid),
@@ -2296,6 +2310,8 @@ CREATE TABLE encounter (
     creator INT NOT NULL DEFAULT 0,
     date_created DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     voided TINYINT(1) NOT NULL DEFAULT 0,
+    date_changed DATETIME DEFAULT NULL,
+    date_voided DATETIME DEFAULT NULL,
     visit_id INT DEFAULT NULL,
     uuid CHAR(38) NOT NULL,
     PRIMARY KEY (encounter_id),
@@ -2321,6 +2337,8 @@ CREATE TABLE encounter_provider (
     creator INT NOT NULL DEFAULT 0,
     date_created DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     voided TINYINT(1) NOT NULL DEFAULT 0,
+    date_changed DATETIME DEFAULT NULL,
+    date_voided DATETIME DEFAULT NULL,
     uuid CHAR(38) NOT NULL,
     PRIMARY KEY (encounter_provider_id),
     UNIQUE KEY uuid (uuid),
@@ -2347,6 +2365,7 @@ CREATE TABLE obs (
     creator INT NOT NULL DEFAULT 0,
     date_created DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     voided TINYINT(1) NOT NULL DEFAULT 0,
+    date_voided DATETIME DEFAULT NULL,
     uuid CHAR(38) NOT NULL,
     PRIMARY KEY (obs_id),
     UNIQUE KEY uuid (uuid),
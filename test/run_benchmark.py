@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""
+Scale-point benchmark for the ETL scripts.
+
+For each suite and each scale point (number of patients), generates a
+dataset with the suite's test data generator and a fixed seed (cached in
+--data-dir), loads it, then runs the suite's scripts through the
+orchestrator with --full-rebuild --profile-json.  The timings and temp
+table counters of every step (each section of the reports DML, or each
+script) are written to a results JSON.
+
+The peak temporary-table usage of each run is sampled around it, in
+bytes: the high-water mark of the memory/temptable/% instruments of
+performance_schema (reset before the run when the user may truncate the
+summary table) and the size of the InnoDB temporary tablespace (ibtmp1),
+which grows when temporary tables spill to disk.
+
+With --baseline, the results are compared with an earlier results file
+and the run fails if any step is slower than the baseline by more than
+--threshold (and by at least --min-seconds, to ignore noise on fast steps).
+The growth column is the exponent k of time ~ patients^k between two
+consecutive scale points: a step with k well above 1 is super-linear.
+
+Usage:
+    python3 test/run_benchmark.py -u root -p secret --scales 10000 100000 \\
+        --output benchmark.json
+    python3 test/run_benchmark.py -u root -p secret --scales 10000 100000 \\
+        --baseline benchmark.json --threshold 0.25
+"""
+
+import argparse
+import getpass
+import json
+import math
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from run_reports_comparison import (format_table, load_sql_dir, mysql_cmd,
+                                     _PASSWORD_WARNING_RE)
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+from etl.sections import split_blocks  # noqa: E402
+
+# Generator and scripts benchmarked by each suite
+SUITES = {
+    'reports': ('generate_test_data_reports_dml.py',
+                ['isanteplusreportsdmlscript.sql']),
+    'arv': ('generate_test_data_arv_dml.py',
+            ['patient_status_arv_dml.sql']),
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the ETL scripts at fixed scale points',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__,
+    )
+
+    db_group = parser.add_argument_group('Database connection')
+    db_group.add_argument('--host', '-H', default='localhost',
+                          help='MySQL host (default: localhost)')
+    db_group.add_argument('--port', '-P', type=int, default=3306,
+                          help='MySQL port (default: 3306)')
+    db_group.add_argument('--user', '-u', help='MySQL username')
+    db_group.add_argument('--password', '-p', help='MySQL password')
+
+    bench_group = parser.add_argument_group('Benchmark')
+    bench_group.add_argument('--suites', nargs='+', choices=sorted(SUITES),
+                             default=sorted(SUITES),
+                             help='Suites to run (default: all)')
+    bench_group.add_argument('--scales', nargs='+', type=int,
+                             default=[10000, 100000, 1000000], metavar='N',
+                             help='Patient counts to benchmark '
+                                  '(default: 10000 100000 1000000)')
+    bench_group.add_argument('--seed', type=int, default=42,
+                             help='Generator seed (default: 42)')
+    bench_group.add_argument('--data-dir', type=Path,
+                             default=REPO_ROOT / 'benchmark_data',
+                             help='Cache of the generated datasets')
+    bench_group.add_argument('--output', type=Path,
+                             default=Path('benchmark_results.json'),
+                             help='Results JSON (default: benchmark_results.json)')
+
+    cmp_group = parser.add_argument_group('Regression check')
+    cmp_group.add_argument('--baseline', type=Path,
+                           help='Results JSON of an earlier run to compare with')
+    cmp_group.add_argument('--threshold', type=float, default=0.25,
+                           help='Allowed slowdown as a fraction (default: 0.25)')
+    cmp_group.add_argument('--min-seconds', type=float, default=1.0,
+                           help='Ignore slowdowns smaller than this (default: 1.0)')
+
+    return parser.parse_args()
+
+
+def generate_dataset(args, suite, patients):
+    """Generate (or reuse) the DDL and data files of one scale point."""
+    generator, _ = SUITES[suite]
+    out_dir = args.data_dir / f'{suite}_{patients}_seed{args.seed}'
+    if (out_dir / '.complete').exists():
+        print(f'  dataset {out_dir.name}: cached', file=sys.stderr)
+        return out_dir
+    if out_dir.exists():
+        shutil.rmtree(out_dir)
+    out_dir.mkdir(parents=True)
+    print(f'  dataset {out_dir.name}: generating ... ', end='',
+          file=sys.stderr, flush=True)
+    subprocess.run(
+        [sys.executable, str(REPO_ROOT / 'test' / generator),
+         '--ddl-output', '--sql-output', '--patients', str(patients),
+         '--seed', str(args.seed), '--output-dir', str(out_dir)],
+        check=True, stdout=subprocess.DEVNULL,
+    )
+    (out_dir / '.complete').touch()
+    print('done', file=sys.stderr)
+    return out_dir
+
+
+TEMPTABLE_RESET_SQL = 'TRUNCATE TABLE performance_schema.memory_summary_global_by_event_name'
+
+# In-memory temporary tables (TempTable engine, MySQL 8) and on-disk ones
+TEMP_USAGE_SQL = """
+SELECT
+  (SELECT COALESCE(SUM(HIGH_NUMBER_OF_BYTES_USED), 0)
+   FROM performance_schema.memory_summary_global_by_event_name
+   WHERE EVENT_NAME LIKE 'memory/temptable/%'),
+  (SELECT COALESCE(SUM(TOTAL_EXTENTS * EXTENT_SIZE), 0)
+   FROM INFORMATION_SCHEMA.FILES
+   WHERE TABLESPACE_NAME = 'innodb_temporary' OR FILE_NAME LIKE '%ibtmp1')
+"""
+
+
+def query_mysql(args, sql):
+    """Run sql with the mysql client; return its rows, or None on failure."""
+    result = subprocess.run(
+        mysql_cmd(args) + ['--batch', '--skip-column-names'],
+        input=sql.encode('utf-8'), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+    if result.returncode != 0:
+        errors = [line for line in result.stderr.decode('utf-8', 'replace').splitlines()
+                  if not _PASSWORD_WARNING_RE.match(line)]
+        if errors:
+            print(f'  Warning: {errors[-1]}', file=sys.stderr)
+        return None
+    return [line.split('\t') for line in
+            result.stdout.decode('utf-8', 'replace').splitlines()]
+
+
+def sample_temp_usage(args):
+    """(temptable high-water bytes, ibtmp1 bytes), or None if unavailable."""
+    rows = query_mysql(args, TEMP_USAGE_SQL)
+    if not rows:
+        return None
+    return int(rows[0][0]), int(rows[0][1])
+
+
+def step_of_lines(sql_path):
+    """Map each statement line of a script to its benchmark step."""
+    name = sql_path.name
+    blocks = split_blocks(sql_path.read_text(encoding='utf-8'))
+    if not blocks.sections:
+        return lambda line: name
+
+    steps = {}
+    for label, statements in [('session', blocks.session),
+                              ('snapshot', blocks.setup),
+                              ('cleanup', blocks.cleanup)]:
+        for s in statements:
+            steps[s.line] = f'{name} {label}'
+    for number, statements in blocks.sections.items():
+        for s in statements:
+            steps[s.line] = f'{name} section {number}'
+    return lambda line: steps.get(line, name)
+
+
+def run_scripts(args, scripts):
+    """Run scripts through the orchestrator; return the profile statements."""
+    with tempfile.TemporaryDirectory() as tmp:
+        profile_path = Path(tmp) / 'profile.json'
+        result = subprocess.run(
+            [sys.executable, '-m', 'etl',
+             '-H', args.host, '-P', str(args.port),
+             '-u', args.user, '-p', args.password,
+             '--files', *scripts, '--full-rebuild',
+             '--profile-json', str(profile_path)],
+            cwd=REPO_ROOT, stdout=subprocess.DEVNULL,
+        )
+        if result.returncode != 0:
+            sys.exit(1)
+        return json.loads(profile_path.read_text(encoding='utf-8'))['statements']
+
+
+def summarize(statements, scripts):
+    """Total the profiled statements of each step."""
+    mappers = {name: step_of_lines(REPO_ROOT / 'sql_files' / name)
+               for name in scripts}
+    steps = {}
+    for p in statements:
+        mapper = mappers.get(p['file'])
+        step = mapper(p['line']) if mapper else p['file']
+        totals = steps.setdefault(step, {
+            'seconds': 0.0, 'statements': 0, 'rows_examined': 0,
+            'tmp_tables': 0, 'tmp_disk_tables': 0,
+        })
+        counters = p['counters']
+        totals['seconds'] += p['seconds']
+        totals['statements'] += 1
+        totals['rows_examined'] += p['rows_examined'] or 0
+        totals['tmp_tables'] += counters.get('Created_tmp_tables', 0)
+        totals['tmp_disk_tables'] += counters.get('Created_tmp_disk_tables', 0)
+    for totals in steps.values():
+        totals['seconds'] = round(totals['seconds'], 3)
+    return steps
+
+
+def growth(results, suite, step, scales):
+    """Exponent of time ~ patients^k between the last two scale points."""
+    points = [(n, results[suite][str(n)]['steps'].get(step, {}).get('seconds'))
+              for n in scales if str(n) in results[suite]]
+    points = [(n, t) for n, t in points if t]
+    if len(points) < 2:
+        return '-'
+    (n1, t1), (n2, t2) = points[-2:]
+    return f'{math.log(t2 / t1) / math.log(n2 / n1):.2f}'
+
+
+def print_results(results, scales):
+    headers = ['suite', 'step'] + [f'{n} pts (s)' for n in scales] + ['growth',
+                                                                      'tmp/disk']
+    rows = []
+    for suite, by_scale in results.items():
+        steps = []
+        for n in scales:
+            for step in by_scale.get(str(n), {}).get('steps', {}):
+                if step not in steps:
+                    steps.append(step)
+        for step in steps:
+            cells = [by_scale.get(str(n), {}).get('steps', {}).get(step)
+                     for n in scales]
+            last = next((c for c in reversed(cells) if c), None)
+            rows.append(
+                [suite, step]
+                + [f'{c["seconds"]:.2f}' if c else '-' for c in cells]
+                + [growth(results, suite, step, scales),
+                   f'{last["tmp_tables"]}/{last["tmp_disk_tables"]}' if last else '-']
+            )
+    print(format_table(headers, rows))
+
+
+def format_bytes(value):
+    if value is None:
+        return '-'
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if value < 1024 or unit == 'GiB':
+            return f'{value:.0f} {unit}' if unit == 'B' else f'{value:.1f} {unit}'
+        value /= 1024
+
+
+def print_temp_usage(results, scales):
+    """Peak temporary-table bytes of each run."""
+    rows = []
+    for suite, by_scale in results.items():
+        for n in scales:
+            usage = by_scale.get(str(n), {}).get('temp_usage')
+            if usage is None:
+                continue
+            rows.append([suite, str(n),
+                         format_bytes(usage['temptable_peak_bytes']),
+                         format_bytes(usage['ibtmp1_bytes']),
+                         format_bytes(usage['ibtmp1_growth_bytes'])])
+    if rows:
+        print(format_table(['suite', 'patients', 'temptable peak', 'ibtmp1',
+                            'ibtmp1 growth'], rows))
+
+
+def find_regressions(results, baseline, threshold, min_seconds):
+    """Steps slower than in the baseline beyond the threshold."""
+    regressions = []
+    for suite, by_scale in results.items():
+        for scale, current in by_scale.items():
+            base_steps = baseline.get(suite, {}).get(scale, {}).get('steps', {})
+            for step, totals in current['steps'].items():
+                base = base_steps.get(step)
+                if base is None:
+                    continue
+                slower = totals['seconds'] - base['seconds']
+                if (totals['seconds'] > base['seconds'] * (1 + threshold)
+                        and slower >= min_seconds):
+                    regressions.append([
+                        suite, scale, step, f'{base["seconds"]:.2f}',
+                        f'{totals["seconds"]:.2f}',
+                        f'+{100 * slower / max(base["seconds"], 1e-9):.0f}%',
+                    ])
+    return regressions
+
+
+def main():
+    args = parse_args()
+
+    if args.user is None:
+        args.user = input('MySQL username: ')
+    if args.password is None:
+        args.password = getpass.getpass('MySQL password: ')
+
+    if shutil.which('mysql') is None:
+        print('Error: mysql client not found on PATH', file=sys.stderr)
+        sys.exit(1)
+
+    scales = sorted(args.scales)
+    results = {}
+    for suite in args.suites:
+        _, scripts = SUITES[suite]
+        results[suite] = {}
+        for patients in scales:
+            print(f'=== {suite}: {patients} patients ===', file=sys.stderr)
+            data_dir = generate_dataset(args, suite, patients)
+            load_sql_dir(args, data_dir, 1, 2, 'dataset')
+            print(f'[2/2] Running {", ".join(scripts)}', file=sys.stderr)
+            # Reset the temptable high-water marks to the current usage
+            query_mysql(args, TEMPTABLE_RESET_SQL)
+            before = sample_temp_usage(args)
+            start = time.perf_counter()
+            statements = run_scripts(args, scripts)
+            wall_seconds = round(time.perf_counter() - start, 3)
+            after = sample_temp_usage(args)
+            results[suite][str(patients)] = {
+                'wall_seconds': wall_seconds,
+                'temp_usage': {
+                    'temptable_peak_bytes': after[0],
+                    'ibtmp1_bytes': after[1],
+                    'ibtmp1_growth_bytes': after[1] - before[1] if before else None,
+                } if after else None,
+                'steps': summarize(statements, scripts),
+            }
+
+    args.output.write_text(json.dumps({
+        'generated_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'seed': args.seed,
+        'results': results,
+    }, indent=2), encoding='utf-8')
+
+    print('\n=== Benchmark Results ===', file=sys.stderr)
+    print_results(results, scales)
+    print_temp_usage(results, scales)
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text(encoding='utf-8'))
+        if baseline.get('seed') != args.seed:
+            print(f'Warning: baseline was generated with seed {baseline.get("seed")}',
+                  file=sys.stderr)
+        regressions = find_regressions(results, baseline['results'],
+                                       args.threshold, args.min_seconds)
+        if regressions:
+            print(f'\n=== Regressions over {args.threshold:.0%} ===', file=sys.stderr)
+            print(format_table(['suite', 'patients', 'step', 'baseline (s)',
+                                'now (s)', 'change'], regressions))
+            sys.exit(1)
+        print(f'\nNo step regressed more than {args.threshold:.0%} '
+              f'against {args.baseline}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,10 @@
 Automated runner for the patient_status_arv ETL comparison test.
 
 Loads DDLs, test data, wraps each flat SQL file in a stored procedure,
-then runs the comparison script that diffs the results.
+then runs the comparison script that diffs the results.  With
+--engine-oracle, the results of the new version are also diffed against
+the in-memory engine (etl/arv_engine.py, needs pandas and
+mysql-connector-python).
 """
 
 import argparse
@@ -15,6 +18,9 @@ import sys
 from pathlib import Path
 
 REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+from etl import arv_engine  # noqa: E402
 
 
 def parse_args():
@@ -48,6 +54,10 @@ def parse_args():
                             default=REPO_ROOT / 'test' / 'test_patient_status_arv_dml_comparison.sql',
                             help='Comparison test SQL script')
 
+    oracle_group = parser.add_argument_group('Engine oracle')
+    oracle_group.add_argument('--engine-oracle', action='store_true',
+                              help='Also diff the new version against etl/arv_engine.py')
+
     return parser.parse_args()
 
 
@@ -161,6 +171,12 @@ def preflight(args):
         print('Error: mysql client not found on PATH', file=sys.stderr)
         sys.exit(1)
 
+    if args.engine_oracle and not (arv_engine.HAS_PANDAS and arv_engine.HAS_MYSQL):
+        print('Error: --engine-oracle requires pandas and mysql-connector-python.',
+              file=sys.stderr)
+        print('Install with: pip install pandas mysql-connector-python', file=sys.stderr)
+        sys.exit(1)
+
     missing = []
     for path, desc in [
         (args.ddl_dir, '--ddl-dir'),
@@ -258,6 +274,75 @@ def format_mysql_output(text):
     return '\n'.join(parts)
 
 
+# Tables captured by the comparison script after the new version ran, and
+# the rows of each that the engine reproduces
+ORACLE_TABLES = {
+    'patient_status_arv': (
+        'SELECT patient_id, id_status, start_date FROM isanteplus._test_new_patient_status_arv '
+        'WHERE DATE(last_updated_date) = CURDATE()', ['start_date']),
+    'exposed_infants': (
+        'SELECT patient_id, condition_exposee FROM isanteplus._test_new_exposed_infants', []),
+    'patient_arv_status': (
+        'SELECT patient_id, arv_status FROM isanteplus._test_new_patient_arv_status', []),
+    'alert': (
+        'SELECT patient_id, id_alert, encounter_id, date_alert FROM isanteplus._test_new_alert',
+        ['date_alert']),
+}
+
+
+def format_value(value):
+    """Format an engine value like mysql's batch output."""
+    if value is None or value != value:
+        return 'NULL'
+    if hasattr(value, 'date'):
+        return str(value.date())
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def format_frame(frame, limit=100):
+    """Format the first rows of a DataFrame as an ASCII box table."""
+    rows = [[format_value(value) for value in row]
+            for row in frame.head(limit).astype(object).itertuples(index=False)]
+    return format_table([str(c) for c in frame.columns], rows)
+
+
+def run_engine_oracle(args, step_num, total_steps):
+    """Diff the results of the new version against the in-memory engine.
+
+    Reads the inputs after the new version ran: the engine recomputes the
+    day's statuses from the statuses of earlier days, so the rows written by
+    the run do not leak into its inputs.
+    """
+    print(f'[{step_num}/{total_steps}] Running the engine oracle ... ',
+          end='', file=sys.stderr, flush=True)
+    conn = arv_engine.connect(args)
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT CURDATE()')
+        as_of = cursor.fetchone()[0]
+        cursor.close()
+        results = arv_engine.run(arv_engine.load_inputs(conn, as_of), as_of)
+        actual = {name: arv_engine.read_frame(conn, sql, dates=dates)
+                  for name, (sql, dates) in ORACLE_TABLES.items()}
+    finally:
+        conn.close()
+    print('done', file=sys.stderr)
+
+    parts = []
+    differences = 0
+    for name, keys in arv_engine.RESULT_KEYS.items():
+        sql_only, engine_only = arv_engine.compare(actual[name], results[name], keys)
+        for label, rows in [('in NEW only', sql_only), ('in ENGINE only', engine_only)]:
+            parts.append(f'\n--- {name}: {label} ---')
+            if len(rows):
+                parts.append(format_frame(rows))
+            differences += len(rows)
+    parts.append(f'\n{differences} difference(s) between the new version and the engine')
+    return '\n'.join(parts)
+
+
 def main():
     args = parse_args()
 
@@ -268,7 +353,7 @@ def main():
 
     preflight(args)
 
-    total_steps = 5
+    total_steps = 6 if args.engine_oracle else 5
 
     # Step 1: Load DDLs
     load_sql_dir(args, args.ddl_dir, 1, total_steps, 'DDL')
@@ -288,9 +373,16 @@ def main():
     stdout, _ = run_mysql(args, input_file=args.comparison_sql, capture_stdout=True)
     print('done', file=sys.stderr)
 
+    # Step 6: Diff the new version against the engine
+    oracle = run_engine_oracle(args, 6, total_steps) if args.engine_oracle else None
+
     print('\n=== Comparison Results ===', file=sys.stderr)
     print(format_mysql_output(stdout))
 
+    if oracle is not None:
+        print('\n=== Engine Oracle Results ===', file=sys.stderr)
+        print(oracle)
+
 
 if __name__ == '__main__':
     main()